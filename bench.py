@@ -0,0 +1,338 @@
+"""
+End to end throughput benchmark.  Runs the Socket -> Packet -> Writer
+pipeline in this process on a loopback port, drives it with
+generate.py or replay.py at a series of rates, and prints the
+results as JSON so builds can be compared.
+
+    bench.py --rates 5000,10000,20000,40000 > before.json
+    bench.py --rates 1,2,4 --capture capture.* > replay.json
+    bench.py --engine asyncio --generate-args='--version 5'
+
+The pipeline is started once, so its threads register their metrics
+once, and each step is measured from the counters it moved.  A step
+ends when the pipeline has drained, so nothing is left over for the
+next one.  For each step we report:
+
+    sent_packets, sent_flows: What the sender says it sent
+    received_packets: Datagrams the socket reader read
+    kernel_drops: Datagrams dropped by the kernel, from /proc/net/udp
+    drop_rate: Packets sent that never got to the reader
+    flows_written, output_bytes: What ended up in the output files
+    flows_per_sec: flows_written over the time from the first packet
+        until the pipeline drained
+    queue_high_water: The most items seen on the socket queue and
+        the writer queue
+    cpu_seconds: User plus system CPU used by each pipeline thread
+
+With --capture, the rates are replay speeds (1 is the original
+speed) and sent_flows is not known.
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import ipfixd_app.ipfixd_log
+import ipfixd_app.cflowd
+import ipfixd_app.sockets
+import ipfixd_app.async_engine
+import ipfixd_app.packet
+import ipfixd_app.writer
+import ipfixd_app.util
+
+_here = os.path.dirname( os.path.abspath( __file__ ) )
+_clock_ticks = os.sysconf( 'SC_CLK_TCK' )
+
+_generate_re = re.compile( r'Sent (\d+) packets .*, (\d+) flows,' )
+_replay_re = re.compile( r'Sent (\d+) datagrams' )
+
+def parse_args():
+
+    """
+    Parse the arguments.
+    """
+
+    p = argparse.ArgumentParser( description =
+        "Runs the ipfixd pipeline in-process at stepped rates and "
+        "reports throughput, drops, queue depths and CPU as JSON." )
+
+    p.add_argument( '--port', type=int, default=29055,
+        help='Loopback port to listen on.' )
+
+    p.add_argument( '--rates', default='2000,5000,10000,20000',
+        help='Comma separated packets/sec for each step, or replay '
+            'speeds with --capture.' )
+
+    p.add_argument( '--duration', type=float, default=10,
+        help='Seconds to send at each rate.' )
+
+    p.add_argument( '--format', default='cflowd',
+        choices=[ 'cflowd', 'cflowd6' ],
+        help='Output format to write.' )
+
+    p.add_argument( '--engine', default='threads',
+        choices=[ 'threads', 'asyncio' ],
+        help='Socket reader model.  See ipfixd --engine.' )
+
+    p.add_argument( '--capture', nargs='+',
+        help='Replay these capture files instead of generating traffic.' )
+
+    p.add_argument( '--generate-args', default='--exporters 10',
+        help='Extra arguments for generate.py.' )
+
+    p.add_argument( '--output', '-o',
+        help='Write the JSON here instead of stdout.' )
+
+    p.add_argument( '--verbose', '-v', action='count',
+        help='Show the pipeline logging.' )
+
+    return( p.parse_args() )
+
+def thread_cpu( threads ):
+
+    """
+    Returns the CPU seconds, user plus system, used by each thread so
+    far.  Linux only, reads /proc/self/task/<tid>/stat.
+
+    Args:
+        threads: A list of Thread objects
+    """
+
+    cpu = {}
+    for t in threads:
+        try:
+            with open( '/proc/self/task/%d/stat' % t.native_id ) as f:
+                l = f.read().rsplit( ')', 1 )[1].split()
+            cpu[ t.name ] = ( int( l[11] ) + int( l[12] ) ) / _clock_ticks
+        except ( OSError, TypeError ):
+            cpu[ t.name ] = 0.0
+
+    return( cpu )
+
+def sender_command( cmdparse, rate ):
+
+    """
+    Returns the command line to send traffic at a rate.
+    """
+
+    if cmdparse.capture:
+        return( [ sys.executable, os.path.join( _here, 'replay.py' ),
+            '--port', str( cmdparse.port ), '--speed', str( rate ) ] +
+            cmdparse.capture )
+
+    return( [ sys.executable, os.path.join( _here, 'generate.py' ),
+        '--port', str( cmdparse.port ), '--rate', str( rate ),
+        '--duration', str( cmdparse.duration ) ] +
+        cmdparse.generate_args.split() )
+
+class Pipeline( object ):
+
+    """
+    The Socket -> Packet -> Writer threads on the loopback port, and
+    a temp directory for the output.
+    """
+
+    def __init__( self, cmdparse ):
+
+        self.temp_dir = tempfile.mkdtemp( prefix='ipfixd-bench-' )
+        ns = argparse.Namespace( profile=False )
+
+        writer_args = { f: ( f == cmdparse.format )
+                                    for f in ipfixd_app.writer.file_formats }
+        self.writer = ipfixd_app.writer.Writer( self.temp_dir, 3600,
+                                            self.temp_dir, **writer_args )
+        self.writer.start()
+
+        self.s = ipfixd_app.sockets.Socket( cmdparse.port,
+                                                bind_address='127.0.0.1' )
+        if cmdparse.engine == 'asyncio':
+            self.reader = ipfixd_app.async_engine.AsyncEngine()
+            self.reader.add_socket( self.s )
+        else:
+            self.reader = self.s
+        self.reader.start()
+
+        if cmdparse.format == 'cflowd':
+            self.packet = ipfixd_app.packet.Packet( ns, self.s, self.s.name,
+                                                    self.writer, None, None )
+            self.record_len = ipfixd_app.cflowd.cflowd_struct.size
+        else:
+            self.packet = ipfixd_app.packet.Packet( ns, self.s, self.s.name,
+                                                    None, None, self.writer )
+            self.record_len = ipfixd_app.cflowd.cflowd6_struct.size
+        self.packet._max_time_in_list = 1   # Don't hold output at the end
+        self.packet.start()
+
+        self.threads = [ self.reader, self.packet, self.writer ]
+        time.sleep( 0.5 )                   # Let the socket get bound
+
+    def stop( self ):
+
+        """
+        Stops the threads and removes the temp directory.
+        """
+
+        for t in self.threads:
+            t.stop()
+        self.reader.wakeup()
+        for t in self.threads:
+            t.join( 30 )
+
+        shutil.rmtree( self.temp_dir )
+
+def run_step( cmdparse, pipeline, rate ):
+
+    """
+    Sends traffic at the rate, waits for the pipeline to drain and
+    returns the step results.
+    """
+
+    s = pipeline.s
+    writer = pipeline.writer
+
+    drops_before = ( ipfixd_app.util.udp_socket_stats( cmdparse.port ) or
+                                                                ( 0, 0 ) )[1]
+    cpu_before = thread_cpu( pipeline.threads )
+    received_before = s.metric_io_read_result
+    bytes_before = writer.metric_bytes
+    s.qsize()                               # Reset the high water marks
+    writer.qsize()
+    high_water = { 'socket': 0, 'writer': 0 }
+
+    def sample():
+        ( z, m ) = s.qsize()
+        high_water[ 'socket' ] = max( high_water[ 'socket' ], z, m )
+        ( z, m ) = writer.qsize()
+        high_water[ 'writer' ] = max( high_water[ 'writer' ], z, m )
+
+    start = time.monotonic()
+    sender = subprocess.Popen( sender_command( cmdparse, rate ),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        cwd=_here )
+    while sender.poll() is None:
+        sample()
+        time.sleep( 0.1 )
+    sender_output = sender.stdout.read()
+
+# Wait until the packet thread has had everything the socket read,
+# the socket buffer and writer queue are empty, and the packet thread
+# has let go of what it holds, for a while.
+
+    idle = 0
+    drained = time.monotonic()
+    written = writer.metric_bytes
+    while idle < 15:
+        sample()
+        stats = ipfixd_app.util.udp_socket_stats( cmdparse.port )
+        if ( pipeline.packet.metric_packets < s.metric_io_read_result or
+                writer.queue().qsize() or ( stats and stats[0] ) or
+                writer.metric_bytes != written ):
+            idle = 0
+            drained = time.monotonic()
+            written = writer.metric_bytes
+        else:
+            idle += 1
+        time.sleep( 0.1 )
+
+    drops = ( ipfixd_app.util.udp_socket_stats( cmdparse.port ) or
+                                                    ( 0, drops_before ) )[1]
+    cpu_after = thread_cpu( pipeline.threads )
+    received = s.metric_io_read_result - received_before
+    output_bytes = writer.metric_bytes - bytes_before
+
+    sent_packets = 0
+    sent_flows = None
+    m = _generate_re.search( sender_output ) or _replay_re.search(
+                                                            sender_output )
+    if m:
+        sent_packets = int( m.group( 1 ) )
+        if m.re is _generate_re:
+            sent_flows = int( m.group( 2 ) )
+
+    elapsed = drained - start
+    flows_written = output_bytes // pipeline.record_len
+
+    return( {
+        'rate': rate,
+        'sent_packets': sent_packets,
+        'sent_flows': sent_flows,
+        'received_packets': received,
+        'kernel_drops': drops - drops_before,
+        'drop_rate': ( ( sent_packets - received ) / sent_packets
+                                            if sent_packets else 0.0 ),
+        'flows_written': flows_written,
+        'flows_per_sec': flows_written / elapsed if elapsed else 0.0,
+        'output_bytes': output_bytes,
+        'seconds': elapsed,
+        'queue_high_water': high_water,
+        'cpu_seconds': { k: cpu_after[ k ] - cpu_before.get( k, 0.0 )
+                                                    for k in cpu_after }
+    } )
+
+def git_revision():
+
+    """
+    Returns the git revision of this tree, or None.
+    """
+
+    try:
+        return( subprocess.run( [ 'git', 'describe', '--always', '--dirty' ],
+            cwd=_here, capture_output=True, text=True,
+            check=True ).stdout.strip() )
+    except ( OSError, subprocess.CalledProcessError ):
+        return( None )
+
+def main():
+
+    """
+    Runs each step and prints the JSON report.
+    """
+
+    cmdparse = parse_args()
+    ipfixd_app.ipfixd_log.set_logging( cmdparse )
+
+    ipfixd_app.cflowd.netflow_v5_init(
+        ipfixd_app.cflowd.netflow_v5_header_keys,
+        ipfixd_app.cflowd.netflow_v5_keys )
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'started': time.strftime( '%Y-%m-%dT%H:%M:%SZ', time.gmtime() ),
+        'format': cmdparse.format,
+        'engine': cmdparse.engine,
+        'source': 'capture' if cmdparse.capture else 'generate',
+        'generate_args': None if cmdparse.capture else cmdparse.generate_args,
+        'duration': cmdparse.duration,
+        'steps': []
+    }
+
+    pipeline = Pipeline( cmdparse )
+    for rate in [ float( r ) for r in cmdparse.rates.split( ',' ) ]:
+        step = run_step( cmdparse, pipeline, rate )
+        report[ 'steps' ].append( step )
+        print( 'rate %g: %d/%d packets, %.0f flows/sec, %d kernel drops' %
+            ( rate, step[ 'received_packets' ], step[ 'sent_packets' ],
+                step[ 'flows_per_sec' ], step[ 'kernel_drops' ] ),
+            file=sys.stderr )
+    pipeline.stop()
+
+    text = json.dumps( report, indent=2 )
+    if cmdparse.output:
+        with open( cmdparse.output, 'w' ) as f:
+            f.write( text + '\n' )
+    else:
+        print( text )
+
+if __name__ == '__main__':
+    main()
+
+# End.
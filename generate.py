@@ -0,0 +1,612 @@
+"""
+Synthetic load generator for ipfixd.  Where send.py blasts a single
+fixed NetFlow v5 packet, this simulates any number of exporters
+sending NetFlow v5, v9 or IPFIX.
+
+    generate.py --version 10 --exporters 50 --rate 20000 --port 2055
+    generate.py --version 5 --rate 0 --count 1000000     # Flat out
+
+Each exporter has its own socket, bound to its own loopback
+address (127.0.1.1, 127.0.1.2, ...) when sending to a loopback
+collector, so the collector keeps their templates and sequence
+numbers apart.  IPFIX exporters send:
+
+    256: The usual IPv4 flow record with millisecond timestamps
+    257: The same with an enterprise specific field (--enterprise)
+    258: The same with a variable length field (--varlen)
+    259: An options template reporting the sampling interval (--options)
+
+V9 exporters send the same flow record and options template with
+sysUpTime timestamps.  V9 has no enterprise or variable length
+fields.  V5 packets are built with the netflow_v5_header_struct
+and netflow_v5_struct definitions the collector decodes them with.
+
+Templates are resent every --template-refresh seconds.  With
+--gap-every N, every Nth packet's sequence number is skipped as if
+the packet was lost in the network.
+
+Packets are built ahead of time into a pool of buffers for each
+exporter.  Only the header is rewritten when a packet is sent.
+With the ipfixd_app.mmsg module built, a batch of packets is sent
+with one sendmmsg call.
+"""
+
+import sys
+import time
+import socket
+import struct
+import random
+import argparse
+
+import ipfixd_app.cflowd
+import ipfixd_app.ipfixd_log
+
+try:
+    import ipfixd_app.mmsg
+    send_mmsg = ipfixd_app.mmsg.send_mmsg
+except ImportError:                 # Not built, send one at a time
+    send_mmsg = None
+
+ipfixd_app.ipfixd_log.set_logging( None )       # Basic stderr logging
+
+v5_header_struct = ipfixd_app.cflowd.netflow_v5_header_struct
+v5_header_keys = ipfixd_app.cflowd.netflow_v5_header_keys
+v5_struct = ipfixd_app.cflowd.netflow_v5_struct
+v5_keys = ipfixd_app.cflowd.netflow_v5_keys
+
+v9_header_struct = struct.Struct( '!HHLLLL' )   # Version, count, uptime,
+                                                # secs, sequence, source id
+v10_header_struct = struct.Struct( '!HHLLL' )   # Version, length, secs,
+                                                # sequence, obs domain id
+set_header_struct = struct.Struct( '!HH' )
+
+enterprise_number = 32473       # RFC 5612 documentation PEN
+max_packet_len = 1400           # Records only, stay under the MTU
+
+#
+# Flow record fields as ( IE id, length, struct format ).  The
+# timestamp fields are filled in for the version.
+#
+
+_flow_fields = [
+    ( 8, 4, 'L' ),          # sourceIPv4Address
+    ( 12, 4, 'L' ),         # destinationIPv4Address
+    ( 15, 4, 'L' ),         # ipNextHopIPv4Address
+    ( 10, 4, 'L' ),         # ingressInterface
+    ( 14, 4, 'L' ),         # egressInterface
+    ( 2, 8, 'Q' ),          # packetDeltaCount
+    ( 1, 8, 'Q' ),          # octetDeltaCount
+    None,                   # Start time
+    None,                   # End time
+    ( 7, 2, 'H' ),          # sourceTransportPort
+    ( 11, 2, 'H' ),         # destinationTransportPort
+    ( 6, 1, 'B' ),          # tcpControlBits
+    ( 4, 1, 'B' ),          # protocolIdentifier
+    ( 5, 1, 'B' ),          # ipClassOfService
+    ( 16, 4, 'L' ),         # bgpSourceAsNumber
+    ( 17, 4, 'L' ),         # bgpDestinationAsNumber
+    ( 9, 1, 'B' ),          # sourceIPv4PrefixLength
+    ( 13, 1, 'B' )          # destinationIPv4PrefixLength
+]
+
+_v10_times = [ ( 152, 8, 'Q' ), ( 153, 8, 'Q' ) ]   # flowStart/EndMilliseconds
+_v9_times = [ ( 22, 4, 'L' ), ( 21, 4, 'L' ) ]      # FIRST/LAST_SWITCHED
+
+def flow_fields( version ):
+
+    """
+    Returns the flow record fields for v9 or IPFIX.
+    """
+
+    if version == 9:
+        times = _v9_times
+    else:
+        times = _v10_times
+
+    l = list( _flow_fields )
+    l[ 7:9 ] = times
+
+    return( l )
+
+def parse_args():
+
+    """
+    Parse the arguments.
+    """
+
+    p = argparse.ArgumentParser( description =
+        "Simulates NetFlow v5, v9 and IPFIX exporters sending to a "
+        "collector." )
+
+    p.add_argument( '--host', default='127.0.0.1',
+        help='The collector.  Default 127.0.0.1.' )
+
+    p.add_argument( '--port', type=int, default=2055,
+        help='The collector port.  Default 2055.' )
+
+    p.add_argument( '--version', type=int, choices=[ 5, 9, 10 ],
+        default=10,
+        help='NetFlow version.  10 is IPFIX, the default.' )
+
+    p.add_argument( '--exporters', type=int, default=1,
+        help='The number of exporters to simulate.' )
+
+    p.add_argument( '--source-base',
+        help='The address of the first exporter.  The others count '
+            'up from it.  Defaults to 127.0.1.1 for a loopback '
+            'collector.  Otherwise the exporters share the host '
+            'address and differ by source id.' )
+
+    p.add_argument( '--flows', type=int, default=0,
+        help='Flow records per packet.  Default 30 for v5, 20 otherwise.' )
+
+    p.add_argument( '--rate', type=float, default=1000,
+        help='Packets per second for all the exporters.  0 sends as '
+            'fast as possible.' )
+
+    p.add_argument( '--count', type=int, default=0,
+        help='Stop after sending this many packets.' )
+
+    p.add_argument( '--duration', type=float, default=0,
+        help='Stop after this many seconds.' )
+
+    p.add_argument( '--gap-every', type=int, default=0,
+        help='Skip a sequence number every this many packets.' )
+
+    p.add_argument( '--template-refresh', type=float, default=30,
+        help='Seconds between template packets.' )
+
+    p.add_argument( '--options', action='store_true',
+        help='Send an options template and sampling options data.' )
+
+    p.add_argument( '--enterprise', action='store_true',
+        help='IPFIX: also send records with an enterprise field.' )
+
+    p.add_argument( '--varlen', action='store_true',
+        help='IPFIX: also send records with a variable length field.' )
+
+    p.add_argument( '--sampling-interval', type=int, default=1,
+        help='Sampling interval reported in the options data.' )
+
+    p.add_argument( '--pool', type=int, default=64,
+        help='Packets pre-built for each exporter.' )
+
+    p.add_argument( '--batch', type=int, default=64,
+        help='Packets per send call.' )
+
+    p.add_argument( '--seed', type=int, default=1,
+        help='Random seed, so runs are repeatable.' )
+
+    cmdparse = p.parse_args()
+
+    if not cmdparse.flows:
+        if cmdparse.version == 5:
+            cmdparse.flows = 30
+        else:
+            cmdparse.flows = 20
+    if cmdparse.version == 5 and cmdparse.flows > 30:
+        p.error( 'v5 packets hold at most 30 flows' )
+    if cmdparse.source_base is None and cmdparse.host.startswith( '127.' ):
+        cmdparse.source_base = '127.0.1.1'
+
+    return( cmdparse )
+
+class Exporter:
+
+    """
+    A simulated exporter.  It owns a socket connected to the
+    collector, its templates and a pool of pre-built packets.
+    Packets returned by next_packets have the sequence number and
+    export time filled in.
+    """
+
+    def __init__( self, cmdparse, index, rnd ):
+
+        """
+        Builds the exporter's templates and packet pool.
+
+        Args:
+            cmdparse: The parse_args results
+            index: The exporter number, 0 based
+            rnd: A random.Random to build flows with
+        """
+
+        self.version = cmdparse.version
+        self.source_id = index + 1
+        self._flows = cmdparse.flows
+        self._gap_every = cmdparse.gap_every
+        self._refresh = cmdparse.template_refresh
+        self._sampling_interval = cmdparse.sampling_interval
+        self._rnd = rnd
+
+        family = socket.getaddrinfo( cmdparse.host, None )[0][0]
+        self.s = socket.socket( family, socket.SOCK_DGRAM )
+        self.s.setsockopt( socket.SOL_SOCKET, socket.SO_SNDBUF, 2**22 )
+        if cmdparse.source_base:
+            base = struct.unpack( '!L',
+                socket.inet_aton( cmdparse.source_base ) )[0]
+            self.address = socket.inet_ntoa( struct.pack( '!L', base + index ) )
+            self.s.bind( ( self.address, 0 ) )
+        else:
+            self.address = cmdparse.host
+        self.s.connect( ( cmdparse.host, cmdparse.port ) )
+
+        self.packets = 0
+        self.flows = 0          # Flow records sent
+        self.sequence = 0       # v5/IPFIX: records, v9: packets
+        self.gaps = 0
+        self._boot = time.time() - 3600
+        self._next_refresh = 0
+
+#
+# Data sets are ( template id, record struct, records built by ).  The
+# first one is the plain flow record.
+#
+
+        self._data_sets = []
+        self._template_sets = []
+
+        if self.version == 5:
+            self._pool = [ ( self._v5_packet(), self._flows )
+                                    for i in range( cmdparse.pool ) ]
+            return
+
+        fields = flow_fields( self.version )
+        fmt = '!' + ''.join( f[2] for f in fields )
+        self._add_template( 256, fields, struct.Struct( fmt ), None )
+
+        if self.version == 10 and cmdparse.enterprise:
+            efields = fields + [ ( 0x8000 | 1, 4, 'L' ) ]
+            self._add_template( 257, efields,
+                struct.Struct( fmt + 'L' ), 'enterprise' )
+
+        if self.version == 10 and cmdparse.varlen:
+            vfields = fields + [ ( 96, 65535, None ) ]  # applicationName
+            self._add_template( 258, vfields,
+                struct.Struct( fmt ), 'varlen' )
+
+        if cmdparse.options:
+            self._add_options_template()
+
+        self._pool = [ self._data_packet( i ) for i in range( cmdparse.pool ) ]
+
+    def _add_template( self, template_id, fields, rec_struct, extra ):
+
+        """
+        Adds a data template and remembers how to build its records.
+        """
+
+        t = struct.pack( '!HH', template_id, len( fields ) )
+        for ( ie, l, fmt ) in fields:
+            t += struct.pack( '!HH', ie, l )
+            if ie & 0x8000:
+                t += struct.pack( '!L', enterprise_number )
+
+        self._template_sets.append( ( 'template', template_id, t ) )
+        self._data_sets.append( ( template_id, rec_struct, extra ) )
+
+    def _add_options_template( self ):
+
+        """
+        Adds an options template with the observation domain (IPFIX)
+        or system (v9) as the scope, and the sampling interval and
+        algorithm as the options.
+        """
+
+        if self.version == 10:      # id, field cnt, scope field cnt
+            t = struct.pack( '!HHH', 259, 3, 1 )
+            t += struct.pack( '!HHHHHH', 149, 4, 34, 4, 35, 1 )
+        else:                       # id, scope len, option len, bytes
+            t = struct.pack( '!HHH', 259, 4, 8 )
+            t += struct.pack( '!HHHHHH', 1, 4, 34, 4, 35, 1 )
+
+        self._template_sets.append( ( 'options', 259, t ) )
+        self._options_data = struct.pack( '!LLB', self.source_id,
+                                            self._sampling_interval, 1 )
+
+    def _flow_values( self, i ):
+
+        """
+        Returns the values for one random flow record, without times.
+        """
+
+        r = self._rnd
+        return( [
+            0x0a000000 | ( self.source_id << 12 ) | r.randrange( 4096 ),
+            0xc0a80000 | r.randrange( 65536 ),
+            0x0a000001,
+            r.randrange( 1, 48 ),
+            r.randrange( 1, 48 ),
+            r.randrange( 1, 1000 ),
+            r.randrange( 64, 1500000 ),
+            r.randrange( 1024, 65536 ),
+            r.choice( [ 22, 25, 53, 80, 443, 8080 ] ),
+            r.choice( [ 0x02, 0x12, 0x18, 0x11, 0x1b ] ),
+            r.choice( [ 6, 6, 6, 17, 1 ] ),
+            0,
+            r.randrange( 64512 ),
+            r.randrange( 64512 ),
+            24,
+            16 ] )
+
+    def _v5_packet( self ):
+
+        """
+        Builds a v5 packet.  The header is rewritten when sent.
+        """
+
+        uptime = int( ( time.time() - self._boot ) * 1000 )
+        h = [ 0 ] * len( v5_header_keys )
+        h[ v5_header_keys[ 'exportProtocolVersion' ] ] = 5
+        h[ v5_header_keys[ 'xx_cnt' ] ] = self._flows
+        h[ v5_header_keys[ 'xx_sysUpTimeDeltaMilliseconds' ] ] = uptime
+        h[ v5_header_keys[ 'xx_sysUpTime' ] ] = int( time.time() )
+        p = bytearray( v5_header_struct.pack( *h ) )
+
+        names = [ 'sourceIPv4Address', 'destinationIPv4Address',
+            'ipNextHopIPv4Address', 'ingressInterface', 'egressInterface',
+            'packetDeltaCount', 'octetDeltaCount', 'sourceTransportPort',
+            'destinationTransportPort', 'tcpControlBits',
+            'protocolIdentifier', 'ipClassOfService', 'bgpSourceAsNumber',
+            'bgpDestinationAsNumber', 'sourceIPv4PrefixLength',
+            'destinationIPv4PrefixLength' ]
+
+        for i in range( self._flows ):
+            r = [ 0 ] * len( v5_keys )
+            for ( n, v ) in zip( names, self._flow_values( i ) ):
+                r[ v5_keys[ n ] ] = v
+            r[ v5_keys[ 'ingressInterface' ] ] &= 0xffff
+            r[ v5_keys[ 'egressInterface' ] ] &= 0xffff
+            r[ v5_keys[ 'packetDeltaCount' ] ] &= 0xffffffff
+            r[ v5_keys[ 'octetDeltaCount' ] ] &= 0xffffffff
+            r[ v5_keys[ 'bgpSourceAsNumber' ] ] &= 0xffff
+            r[ v5_keys[ 'bgpDestinationAsNumber' ] ] &= 0xffff
+            r[ v5_keys[ 'flowStartSysUpTime' ] ] = uptime - 2000
+            r[ v5_keys[ 'flowEndSysUpTime' ] ] = uptime - 1000
+            p += v5_struct.pack( *r )
+
+        return( p )
+
+    def _record( self, rec_struct, extra, i ):
+
+        """
+        Builds one data record for a template.
+        """
+
+        v = self._flow_values( i )
+        if self.version == 10:
+            now_ms = int( time.time() * 1000 )
+            times = [ now_ms - 2000, now_ms - 1000 ]
+        else:
+            uptime = int( ( time.time() - self._boot ) * 1000 )
+            times = [ uptime - 2000, uptime - 1000 ]
+        v[ 7:7 ] = times
+
+        if extra == 'enterprise':
+            v.append( self._rnd.randrange( 2**32 ) )
+        rec = rec_struct.pack( *v )
+        if extra == 'varlen':
+            name = self._rnd.choice( [ b'dns', b'https', b'ssh',
+                                    b'bittorrent', b'x' * 300 ] )
+            if len( name ) < 255:
+                rec += struct.pack( '!B', len( name ) ) + name
+            else:
+                rec += struct.pack( '!BH', 255, len( name ) ) + name
+
+        return( rec )
+
+    def _data_packet( self, n ):
+
+        """
+        Builds a v9 or IPFIX data packet.  The packets take turns
+        using the data templates.  Variable length records can make
+        a packet too big, so records stop at max_packet_len.
+
+        Returns:
+            The packet and the number of records in it.
+        """
+
+        ( template_id, rec_struct, extra ) = (
+                            self._data_sets[ n % len( self._data_sets ) ] )
+        records = b''
+        cnt = 0
+        while cnt < self._flows:
+            rec = self._record( rec_struct, extra, cnt )
+            if cnt and len( records ) + len( rec ) > max_packet_len:
+                break
+            records += rec
+            cnt += 1
+
+        if self.version == 10:
+            pad = 0
+            s = set_header_struct.pack( template_id, 4 + len( records ) )
+        else:
+            pad = -len( records ) % 4    # V9 flowsets are 32 bit aligned
+            s = set_header_struct.pack( template_id,
+                                                4 + len( records ) + pad )
+
+        return( self._message( [ s + records + bytes( pad ) ], cnt ), cnt )
+
+    def _message( self, sets, cnt ):
+
+        """
+        Puts a header on a list of sets.  The sequence number and time
+        are filled in when the packet is sent.
+
+        Args:
+            sets: The encoded sets, with set headers.
+            cnt: The v9 header count, records plus template records.
+        """
+
+        body = b''.join( sets )
+        if self.version == 10:
+            h = v10_header_struct.pack( 10, v10_header_struct.size +
+                len( body ), 0, 0, self.source_id )
+        else:
+            h = v9_header_struct.pack( 9, cnt, 0, 0, 0, self.source_id )
+
+        return( bytearray( h + body ) )
+
+    def template_packet( self ):
+
+        """
+        Builds a packet with all the templates, and the options data
+        if there is an options template.  Returns ( packet, records ),
+        records being the options data records, which count in the
+        sequence numbers like flow records.
+        """
+
+        sets = []
+        cnt = 0
+        records = 0
+        for ( kind, template_id, t ) in self._template_sets:
+            if self.version == 10:
+                set_id = 2 if kind == 'template' else 3
+            else:
+                set_id = 0 if kind == 'template' else 1
+            if self.version == 9:
+                t += bytes( -len( t ) % 4 )
+            sets.append( set_header_struct.pack( set_id, 4 + len( t ) ) + t )
+            cnt += 1
+
+            if kind == 'options':
+                d = self._options_data
+                if self.version == 9:
+                    d += bytes( -len( d ) % 4 )
+                sets.append( set_header_struct.pack( 259, 4 + len( d ) ) + d )
+                cnt += 1
+                records += 1
+
+        return( ( self._message( sets, cnt ), records ) )
+
+    def _stamp( self, p, now, records ):
+
+        """
+        Fills in the sequence number and time of a packet.
+        """
+
+        self.packets += 1
+        if self._gap_every and self.packets % self._gap_every == 0:
+            self.sequence += records if self.version != 9 else 1
+            self.gaps += 1
+
+        if self.version == 5:
+            struct.pack_into( '!LL', p, 4,
+                int( ( now - self._boot ) * 1000 ), int( now ) )
+            struct.pack_into( '!L', p, 16, self.sequence )
+            self.sequence += records
+        elif self.version == 9:
+            struct.pack_into( '!LLL', p, 4,
+                int( ( now - self._boot ) * 1000 ), int( now ),
+                self.sequence )
+            self.sequence += 1
+        else:
+            struct.pack_into( '!LL', p, 4, int( now ), self.sequence )
+            self.sequence += records
+
+    def next_packets( self, n, now ):
+
+        """
+        Returns the next n packets to send, starting with a template
+        packet if it is time for one.
+        """
+
+        l = []
+        if self.version != 5 and now >= self._next_refresh:
+            ( p, records ) = self.template_packet()
+            self._stamp( p, now, records )
+            l.append( p )
+            self._next_refresh = now + self._refresh
+
+        pool = self._pool
+        while len( l ) < n:
+            ( p, records ) = pool[ self.packets % len( pool ) ]
+            self._stamp( p, now, records )
+            self.flows += records
+            l.append( p )
+
+        return( l )
+
+    def send( self, packets ):
+
+        """
+        Sends a list of packets, with sendmmsg if we have it.
+        """
+
+        if send_mmsg:
+            i = 0
+            while i < len( packets ):
+                try:
+                    i += send_mmsg( self.s.fileno(),
+                        packets[ i:i + ipfixd_app.mmsg.max_batch ] )
+                except ConnectionRefusedError:  # Collector not up yet
+                    i += 1
+        else:
+            for p in packets:
+                try:
+                    self.s.send( p )
+                except ConnectionRefusedError:
+                    pass
+
+def main():
+
+    """
+    Sends packets round robin from the exporters until the count or
+    duration is reached, or we are interrupted.
+    """
+
+    cmdparse = parse_args()
+    rnd = random.Random( cmdparse.seed )
+    exporters = [ Exporter( cmdparse, i, rnd )
+                                for i in range( cmdparse.exporters ) ]
+
+    print( 'Exporters %s..%s, version %d, %d flows/packet, sendmmsg: %s' %
+        ( exporters[0].address, exporters[-1].address, cmdparse.version,
+            cmdparse.flows, send_mmsg is not None ) )
+
+    batch = max( 1, cmdparse.batch )
+    sent = 0
+    start = time.monotonic()
+    last_report = start
+
+    try:
+        while True:
+            for e in exporters:
+                now = time.monotonic()
+                elapsed = now - start
+                if cmdparse.duration and elapsed >= cmdparse.duration:
+                    raise StopIteration
+                n = batch
+                if cmdparse.count:
+                    n = min( n, cmdparse.count - sent )
+                    if n <= 0:
+                        raise StopIteration
+
+                if cmdparse.rate > 0:   # Stay on schedule
+                    delay = sent / cmdparse.rate - elapsed
+                    if delay > 0:
+                        time.sleep( delay )
+
+                packets = e.next_packets( n, time.time() )
+                e.send( packets )
+                sent += len( packets )
+
+                if now - last_report >= 5:
+                    print( '%d packets, %.0f packets/sec' %
+                                            ( sent, sent / elapsed ) )
+                    last_report = now
+    except ( StopIteration, KeyboardInterrupt ):
+        pass
+
+    elapsed = time.monotonic() - start
+    flows = sum( e.flows for e in exporters )
+    sequence = sum( e.sequence for e in exporters )
+    gaps = sum( e.gaps for e in exporters )
+    print( 'Sent %d packets in %.3f seconds, %.0f packets/sec, '
+        '%d flows, sequence %d, %d gaps' % ( sent, elapsed,
+            sent / elapsed if elapsed else 0, flows, sequence, gaps ) )
+
+if __name__ == '__main__':
+    main()
+
+# End.
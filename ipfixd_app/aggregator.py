@@ -0,0 +1,295 @@
+"""
+Rolls flows up in the collector.  The packet threads for a temp
+directory with the 'aggregate' output format put their extended
+(cflowd6) records on an Aggregator's queue, as if it were a writer.
+The Aggregator adds each record to a FlowTable, keyed by source and
+destination prefix, protocol and destination port, and at the end of
+every interval puts the table on its Writer's queue as aggregate
+records (see ipfixd_app.cflowd.aggregate_field_list), one per key,
+and clears it.  A day of a busy exporter's flows becomes a few
+thousand records per interval.
+
+The prefixes are the router's mask lengths from the flow records
+when it sends them, else --aggregate-prefix.  Intervals are aligned
+to the wall clock, so every collector's 60 second aggregates start on
+the minute.  If the table fills before the interval ends it is
+written out early, as a partial interval, and the early flushes are
+counted.  Several records for a key in one interval then end up in
+the file, and readers should add them up; the counts are still
+right.
+"""
+
+import os
+import sys
+import time
+import queue
+import traceback
+from ipfixd_app.ipfixd_log import log
+import ipfixd_app.ipfixd_queue
+import ipfixd_app.ipfixd_thread
+import ipfixd_app.metrics
+import ipfixd_app.util
+import ipfixd_app.cflowd
+import ipfixd_app.flow_table
+from ipfixd_app.trace import Trace
+
+class Aggregator( ipfixd_app.ipfixd_thread.IPFixdThread ):
+
+    """
+    Aggregates the extended records put on its queue, and queues the
+    aggregates on a Writer every interval.
+
+    To get this thread to stop, call stop() and write a 0 length
+    packet to the queue.  The partial interval is written and the
+    0 length packet is passed on to the Writer.
+    """
+
+    def __init__( self, writer, temp_directory, interval=60,
+            table_size=2**18, v4_prefix=24, v6_prefix=64, profile=False,
+            max_queue_size=100000, max_queue_bytes=0 ):
+
+        """
+        Args:
+            writer: The Writer for the aggregate records
+            temp_directory: The writer's temp directory, for the metrics
+            interval: Seconds of flows in each aggregate
+            table_size: The most keys in an interval before the
+                table is written out early
+            v4_prefix: IPv4 prefix length when a record has no mask
+            v6_prefix: IPv6 prefix length when a record has no mask
+            profile: If True, profile
+            max_queue_size: The maximum length of the queue
+            max_queue_bytes: The most bytes we allow on the queue, 0 for
+                no limit.  See ipfixd_app.ipfixd_queue.ByteQueue.
+        """
+
+        if ( ipfixd_app.flow_table.record_len !=
+                                ipfixd_app.cflowd.aggregate_struct.size ):
+            raise ValueError( 'flow_table does not match the aggregate '
+                'record, rebuild it' )
+
+        self._writer = writer
+        self._interval = interval
+        self._table = ipfixd_app.flow_table.FlowTable( table_size,
+            ipfixd_app.util.field_offsets(
+                                    ipfixd_app.cflowd.cflowd6_field_list ),
+            v4_prefix, v6_prefix )
+
+        name = 'Aggregator (%d secs, /%d /%d) for %s' % ( interval,
+                                    v4_prefix, v6_prefix, writer.name )
+
+        ipfixd_app.ipfixd_thread.IPFixdThread.__init__(
+                self, profile=profile, name=name, target=self.aggregate_loop )
+        self.daemon = True
+
+        self._queue = ipfixd_app.ipfixd_queue.ByteQueue(
+                        maxsize = max_queue_size, maxbytes = max_queue_bytes )
+        self._max_qsize = 0
+
+        self.metric_items = 0
+        self.metric_intervals = 0
+        self.metric_early_flushes = 0
+        self.metric_flow_records = 0
+        self.metric_records = 0
+        self._register_metrics( temp_directory )
+
+        log().info( 'INFO: Created thread %s, table of %d slots' % ( name,
+                                                    self._table.capacity ) )
+
+    def _register_metrics( self, temp_directory ):
+
+        """
+        Adds our counters to the metrics registry.  The records
+        counter is the table's, read without the lock like the rest.
+        """
+
+        table = self._table
+        labels = { 'directory': os.path.join( temp_directory, '' ) }
+        Counter = ipfixd_app.metrics.Counter
+        Gauge = ipfixd_app.metrics.Gauge
+
+        for m in (
+            Counter( 'ipfixd_aggregator_flow_records_total',
+                'Extended flow records added to the table.', labels,
+                lambda: table.metric_records ),
+            Counter( 'ipfixd_aggregator_records_total',
+                'Aggregate records written.', labels,
+                lambda: table.metric_written ),
+            Counter( 'ipfixd_aggregator_intervals_total',
+                'Intervals written.', labels,
+                lambda: self.metric_intervals ),
+            Counter( 'ipfixd_aggregator_early_flushes_total',
+                'Times the table filled and was written before the end '
+                'of the interval.', labels,
+                lambda: self.metric_early_flushes ),
+            Counter( 'ipfixd_aggregator_probes_total',
+                'Extra table slots looked at to find a key.', labels,
+                lambda: table.metric_probes ),
+            Gauge( 'ipfixd_aggregator_table_entries',
+                'Keys in the table.', labels, lambda: len( table ) ),
+            Gauge( 'ipfixd_aggregator_table_load',
+                'Keys in the table over its slots.', labels,
+                lambda: table.load ),
+            Gauge( 'ipfixd_queue_items',
+                'Items waiting on the queue.',
+                dict( labels, thread='aggregator' ),
+                lambda: self._queue.qsize() ),
+            Gauge( 'ipfixd_queue_bytes',
+                'Bytes waiting on the queue.',
+                dict( labels, thread='aggregator' ),
+                lambda: self._queue.bytes ) ):
+            ipfixd_app.metrics.registry.register( m )
+
+    def _write( self, start, end ):
+
+        """
+        Queues the table's aggregates on the writer, and clears it.
+
+        Args:
+            start: Unix time the interval started
+            end: Unix time it ended, or now for a partial interval
+        """
+
+        if not len( self._table ):
+            return
+
+        records = self._table.write( int( start ), int( end ) )
+        self._writer.queue().put( [ records ], nbytes=len( records ) )
+
+    def aggregate_loop( self ):
+
+        """
+        Runs the aggregator loop.  This just traps and prints
+        exceptions to the log, see _aggregate_loop.
+        """
+
+        try:
+            self._aggregate_loop()
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            f = traceback.format_exception( exc_type, exc_value, exc_traceback )
+            del exc_traceback
+            [ log().error( x ) for x in f ]
+            log().error( 'Thread aborted: %s' % self.name )
+            raise exc_type
+
+    def _aggregate_loop( self ):
+
+        """
+        Adds the buffers on the queue to the table until the end of
+        the interval, then writes the table.  The queue is waited on
+        with a timeout, so an interval is written on time even when
+        no flows arrive.  Traces are dropped, the time through the
+        table is not a stage of their trip.
+        """
+
+        if self._profile:
+            self._profile.enable()
+
+        table = self._table
+        interval = self._interval
+        record_len = ipfixd_app.cflowd.cflowd6_struct.size
+        start = time.time()
+        end = ( start // interval + 1 ) * interval
+
+        while True:
+            timeout = end - time.time()
+            if timeout > 0:
+                try:
+                    items = self._queue.get( block=True, timeout=timeout )
+                except queue.Empty:
+                    items = []
+            else:
+                items = []
+
+            self._max_qsize = max( self._max_qsize, len( items ) +
+                                                    self._queue.qsize() )
+
+            for item in items:
+                if item.__class__ is Trace:
+                    continue
+                elif len( item ) == 0:
+                    if not self.should_stop():
+                        continue
+                    log().info( 'INFO: Thread %s stopping by request',
+                                                                self.name )
+                    self._write( start, time.time() )
+                    self._writer.queue().put( [ bytearray(0) ] )
+                    if self._profile:
+                        self._profile.disable()
+                        self._profile.dump_stats( "stats/" +
+                                            self.name.replace( '/', '-' ) )
+                    return
+
+                self.metric_items += 1
+                cnt = len( item ) // record_len
+                n = table.add( item, len( item ), 0 )
+                while n < cnt:
+                    self.metric_early_flushes += 1
+                    self._write( start, time.time() )
+                    n = table.add( item, len( item ), n )
+
+            now = time.time()
+            if now >= end:
+                self._write( start, end )
+                self.metric_intervals += 1
+                start = end
+                end = ( now // interval + 1 ) * interval
+
+    def qsize( self ):
+
+        """
+        Returns a tuple: the current qsize and the max since the last
+        call.
+        """
+
+        m = self._max_qsize
+        self._max_qsize = 0
+
+        return( self._queue.qsize(), m )
+
+    def print_metrics( self ):
+
+        """
+        Logs the aggregation counts since the last call.
+        """
+
+        self.metric_flow_records = self._table.metric_records
+        self.metric_records = self._table.metric_written
+        d = ipfixd_app.metrics.deltas( self, [ 'metric_items',
+                                    'metric_flow_records', 'metric_records',
+                                    'metric_intervals',
+                                    'metric_early_flushes' ] )
+
+        log().info( 'INFO: %s: items: %d, flow records: %d, aggregates: %d, '
+            'intervals: %d, early flushes: %d, table load: %.2f' %
+            ( self.name,
+                d[ 'metric_items' ],
+                d[ 'metric_flow_records' ],
+                d[ 'metric_records' ],
+                d[ 'metric_intervals' ],
+                d[ 'metric_early_flushes' ],
+                self._table.load ) )
+
+    def qempty( self ):
+
+        """
+        Empties the queue immediately.  This is usually done as part of
+        a fast shutdown.
+        """
+
+        while True:
+            try:
+                self._queue.get( block=False, timeout=0 )
+            except queue.Empty:
+                break
+
+    def queue( self ):
+
+        """
+        Returns the queue the packet threads put extended records on.
+        """
+
+        return( self._queue )
+
+# End.
@@ -9,11 +9,13 @@ on a temp before, or it must match.
 
 import sys
 import os
+import socket
 import argparse
 import ipfixd_app.ipfixd_profile
 from  ipfixd_app.ipfixd_log import log
 
 last_write_timeout=300
+last_max_latency=10
 ports = {}
 temp_directories = {}
 dest_directories = {}
@@ -28,13 +30,42 @@ class ParsePorts(argparse.Action):
     def __call__(self, parse, namespace, values, option_string=None):
 
         global last_write_timeout
+        global last_max_latency
 
         last_cflowd = True
         last_ipfix = False
+        last_cflowd6 = False
+        last_capture = False
+        last_aggregate = False
+        last_export = False
+
+#
+# An optional bind address comes first, in brackets since IPv6
+# addresses contain colons.  [::]:2055:/tmp or [10.1.1.1]:2055:/tmp
+#
+
+        bind_address = None
+        if values.startswith( '[' ):
+            ( bind_address, sep, values ) = values[1:].partition( ']:' )
+            if not sep:
+                raise ValueError( 'bind address must be followed by :port' )
+            try:
+                if ':' in bind_address:
+                    socket.inet_pton( socket.AF_INET6, bind_address )
+                else:
+                    socket.inet_pton( socket.AF_INET, bind_address )
+            except OSError:
+                raise ValueError( 'bad bind address: %s' % bind_address )
 
         l = values.split(':')
 
+        transport = 'udp'
         if len(l) > 1:
+            ( l[0], sep, t ) = l[0].partition( '/' )
+            if sep:
+                transport = t.lower()
+                if transport not in ( 'udp', 'tcp' ):
+                    raise ValueError( 'transport must be udp or tcp' )
             try:
                 port = int(l[0])
                 if port < 1 or port > 65535:
@@ -69,16 +100,57 @@ class ParsePorts(argparse.Action):
             if f:
                 last_cflowd = False
                 last_ipfix = False
+                last_cflowd6 = False
+                last_capture = False
+                last_aggregate = False
+                last_export = False
                 for fmt in f:
                     if fmt == 'cflowd':
                         last_cflowd = True
                     elif fmt == 'ipfix':
                         last_ipfix = True
+                    elif fmt == 'cflowd6':
+                        last_cflowd6 = True
+                    elif fmt == 'capture':
+                        last_capture = True
+                    elif fmt == 'aggregate':
+                        last_aggregate = True
+                    elif fmt == 'export':
+                        last_export = True
                     else:
                         raise ValueError( 'Unknown file format: %s' % fmt )
+
+        if len(l)>5 and l[5]:
+            max_latency=float(l[5])
+            if max_latency <= 0:
+                raise ValueError( 'max-latency must be more than 0' )
+            last_max_latency = max_latency
+        else:
+            max_latency=last_max_latency
+
+#
+# Sampling is N or N/hash and, unlike the fields before it, does not
+# carry over to the next port.
+#
+
+        sample_every = 1
+        sample_mode = 'count'
+        if len(l)>6 and l[6]:
+            ( n, sep, mode ) = l[6].partition( '/' )
+            sample_every = int( n )
+            if sample_every < 1:
+                raise ValueError( 'sample must be at least 1' )
+            if sep:
+                sample_mode = mode.lower()
+                if sample_mode not in ( 'count', 'hash' ):
+                    raise ValueError( 'sample mode must be count or hash' )
             
         cflowd=last_cflowd
         ipfix=last_ipfix
+        cflowd6=last_cflowd6
+        capture=last_capture
+        aggregate=last_aggregate
+        export=last_export
 
         if temp_directory[:-1] != os.sep:
             temp_directory += os.sep
@@ -94,11 +166,20 @@ class ParsePorts(argparse.Action):
             raise ValueError
 
         ports[port] = { 'port': port,
+            'bind_address': bind_address,
+            'transport': transport,
             'temp_directory': temp_directory,
             'dest_directory': dest_directory,
             'write_timeout': write_timeout,
+            'max_latency': max_latency,
+            'sample_every': sample_every,
+            'sample_mode': sample_mode,
             'cflowd': cflowd,
-            'ipfix': ipfix }
+            'ipfix': ipfix,
+            'cflowd6': cflowd6,
+            'capture': capture,
+            'aggregate': aggregate,
+            'export': export }
 
         temp_directories[ temp_directory ] = ports[port]
         dest_directories[ dest_directory ] = ports[port]
@@ -117,7 +198,9 @@ def parse_args():
 
     p.add_argument( '--ports', '-p',
         required=True,
-        metavar='port:tempdir[:destdir[:write-timeout[:ipfix,cflowd]]]',
+        metavar='[[address]:]port[/tcp]:tempdir[:destdir[:write-timeout'
+            '[:ipfix,cflowd,cflowd6,capture,aggregate,export[:max-latency'
+            '[:sample[/hash]]]]]]',
         action=ParsePorts,
         help='Specifies a UDP port to listen on, a temp directory '
             'to write the flow file output, a destination directory '
@@ -128,10 +211,55 @@ def parse_args():
             'the last one specified.  The format of the output files '
             'may also be given as a comma seperated list.  The format '
             'defaults to "cflowd", and inherits from prior port '
-            'arguments if not specified.  '
+            'arguments if not specified.  "cflowd6" is an extended '
+            'cflowd record with IPv6 addresses and 64 bit counters.  '
+            '"ipfix" writes the IPFIX messages as received to '
+            'ipfix-flows.* files, with each exporter in its own '
+            'observation domain and its templates in front of its first '
+            'message in a file, so a file can be read on its own.  '
+            '"capture" also writes every datagram received, with its '
+            'arrival time, to capture.* files that replay.py can send '
+            'back to a collector.  "aggregate" rolls the flows up by '
+            'prefixes, protocol and destination port every '
+            '--aggregate-interval and writes the totals to aggregate.* '
+            'files.  "export" writes the flows as IPFIX messages of one '
+            'template, whatever the exporter sent, to ipfix-export.* '
+            'files that start with the template.  '
+            'By default, the port is opened on all IPv6 and IPv4 '
+            'addresses.  A bind address in brackets, such as '
+            '[::1]:2055 or [10.1.1.1]:2055, limits the addresses.  '
+            'A port given as 4739/tcp accepts IPFIX over TCP instead '
+            'of UDP.  An exporter\'s templates are forgotten when its '
+            'last connection closes.  '
+            'max-latency is the most seconds decoded flows are held '
+            'before being queued for writing, 10 by default, and also '
+            'inherits.  Batches grow under load and shrink when idle '
+            'within that bound.  '
+            'sample keeps one cflowd and cflowd6 flow record in that '
+            'many, every sample\'th record, or with /hash the flows '
+            'whose addresses, ports and protocol hash to it, so a flow '
+            'is kept whole.  The packet and octet counts of the records '
+            'kept are multiplied by sample.  It does not inherit.  '
             'This option may be specified '
             'more than once.' )
 
+    p.add_argument( '--engine',
+        choices=[ 'threads', 'asyncio' ],
+        default='threads',
+        help='How the UDP ports are read.  "threads", the default, '
+            'starts a reader thread for every port.  "asyncio" reads '
+            'all the UDP ports from one thread with an event loop, '
+            'which is better when listening on lots of ports.  TCP '
+            'ports always get their own thread.' )
+
+    p.add_argument( '--metrics',
+        metavar='host:port|/path',
+        help='Serves the metrics in the Prometheus text format on '
+            'this address, for example 127.0.0.1:9155, [::1]:9155 or '
+            'the path of a Unix socket such as /run/ipfixd/metrics.  '
+            'The counters are cumulative.  SIGUSR1 still logs them, '
+            'as the change since the last SIGUSR1.' )
+
     p.add_argument( '--nofork', '-f',
         action='store_true',
         help='Does not fork a daemon process.  Program runs in foreground.')
@@ -150,7 +278,202 @@ def parse_args():
     p.add_argument( '--log-missing-full',
         action='store_true',
         default=False,
-        help = 'Logs full info about missing flows instead of summary.' )
+        help = 'Logs every gap in the flow sequence numbers, as well as '
+            'the --sequence-summary lines.' )
+
+    p.add_argument( '--sequence-summary',
+        type=int,
+        default=60,
+        metavar='SECONDS',
+        help = 'How often to log a summary line for each exporter that '
+            'lost flows, restarted, or sent packets out of order.  0 '
+            'turns the summary off.  The counts are always available '
+            'from --metrics.' )
+
+    p.add_argument( '--log-rate',
+        type=float,
+        default=10.0,
+        metavar='PER_SECOND',
+        help = 'Limits how fast each log message, by where it is logged '
+            'from, can repeat.  A burst of ten seconds worth is allowed, '
+            'then extra messages are counted and the count logged with '
+            'the next one.  0 turns the limit off.' )
+
+    p.add_argument( '--queue-bytes',
+        type=int,
+        default=256,
+        metavar='MB',
+        help = 'The most megabytes of output waiting for each writer.  '
+            'See --overload.' )
+
+    p.add_argument( '--spill-directory',
+        metavar='DIR',
+        help = 'While a temp file can not be written, keep the output in '
+            'a journal in this directory, and write it to the temp file '
+            'when writing works again.  Best on a different file system '
+            'than the temp directories.  Without it, the output is '
+            'thrown away while the temp file can not be written.' )
+
+    p.add_argument( '--spill-max',
+        type=int,
+        default=1024,
+        metavar='MB',
+        help = 'The largest each writer\'s spill journal may grow.' )
+
+    p.add_argument( '--overload',
+        choices=[ 'block', 'shed' ],
+        default='block',
+        help = 'What to do when a writer falls behind and its queue is '
+            'full.  "block", the default, waits for the writer, and '
+            'packets back up into the kernel, which drops them for every '
+            'exporter on the port.  "shed" throws away the output that '
+            'does not fit and counts it, so reading and decoding (and '
+            'the sequence and template tracking) carry on.' )
+
+    p.add_argument( '--shed-sample',
+        type=int,
+        default=0,
+        metavar='N',
+        help = 'With --overload shed, once a writer queue is half full '
+            'keep only one output buffer in N, so a slow writer still '
+            'gets a sample of the data.  0, the default, keeps '
+            'everything until the queue is full.' )
+
+    p.add_argument( '--normalize-sampling',
+        action='store_true',
+        help = 'Multiplies the packet and octet counts of cflowd and '
+            'cflowd6 records by the sampling interval the exporter '
+            'reports, in the NetFlow v5 header or IPFIX options data, so '
+            'they estimate the real traffic.' )
+
+    p.add_argument( '--max-exporters',
+        type=int,
+        default=10000,
+        metavar='EXPORTERS',
+        help = 'The most exporters, by address, port and observation '
+            'domain, kept in the per-exporter statistics.  Sources can '
+            'be spoofed, so when full, the exporter heard from longest '
+            'ago is dropped to make room.  0 for no limit.' )
+
+    p.add_argument( '--options-cache-size',
+        type=int,
+        default=10000,
+        metavar='RECORDS',
+        help = 'The most IPFIX options data records, such as sampler '
+            'settings and interface names, kept for all the exporters.  '
+            'When full, the records the exporters refreshed longest ago '
+            'are dropped.  The cache is on --metrics /status.' )
+
+    p.add_argument( '--aggregate-interval',
+        type=int,
+        default=60,
+        metavar='SECONDS',
+        help = 'How many seconds of flows each aggregate record adds up, '
+            'for the "aggregate" format.  Intervals start on a multiple '
+            'of this since the epoch.' )
+
+    p.add_argument( '--aggregate-prefix',
+        default='24,64',
+        metavar='V4,V6',
+        help = 'The IPv4 and IPv6 prefix lengths the "aggregate" format '
+            'rolls addresses up to when the exporter does not send the '
+            'mask length.  24,64 by default.' )
+
+    p.add_argument( '--aggregate-table-size',
+        type=int,
+        default=2**18,
+        metavar='KEYS',
+        help = 'The most prefix, protocol and port keys aggregated at '
+            'once for each temp directory.  When there are more in an '
+            'interval, the aggregates so far are written early.' )
+
+    p.add_argument( '--top-talkers',
+        type=int,
+        default=0,
+        metavar='N',
+        help = 'Keeps the N source addresses that sent the most bytes on '
+            'each port, in fixed memory, and writes them as JSON to a '
+            'talkers-<port>.* file next to each output file when it is '
+            'moved.  They are also on --metrics /status.  0, the '
+            'default, turns this off.' )
+
+    p.add_argument( '--distinct',
+        type=int,
+        default=0,
+        metavar='PRECISION',
+        help = 'Estimates the distinct source and destination addresses '
+            'on each port and from each exporter with HyperLogLog '
+            'sketches of 2 ** PRECISION registers, 4 to 18 (12 is 4 KB '
+            'and about 1.6%% error), and writes them to a '
+            'distinct-<port>.* file next to each output file when it is '
+            'moved.  The files can be merged with python -m '
+            'ipfixd_app.cardinality.  The estimates are also on '
+            '--metrics /status.  0, the default, turns this off.' )
+
+    p.add_argument( '--forward',
+        action='append',
+        default=[],
+        metavar='HOST:PORT',
+        help = 'Also sends every datagram received, on every port, to '
+            'the collector at HOST:PORT, as received, each port from its '
+            'own socket.  May be given more than once.  Put IPv6 '
+            'addresses in brackets, [::1]:2055.' )
+
+    p.add_argument( '--forward-preserve-source',
+        action='store_true',
+        help = 'Forwards datagrams from IPv4 exporters to IPv4 '
+            'collectors with the exporter as the source address, so the '
+            'collector sees the router.  Needs root or CAP_NET_RAW, so '
+            'not with --user.' )
+
+    p.add_argument( '--forward-max-pending',
+        type=int,
+        default=10000,
+        metavar='DATAGRAMS',
+        help = 'The most datagrams waiting to be forwarded for a port.  '
+            'Past that datagrams are not forwarded, and counted, rather '
+            'than holding up the port.' )
+
+    p.add_argument( '--ipfix-export',
+        action='append',
+        default=[],
+        metavar='udp|tcp:HOST:PORT',
+        help = 'Sends the flows of every port to the collector at '
+            'HOST:PORT as IPFIX, over UDP or TCP, normalized to one '
+            'template whether they came as NetFlow v5 or IPFIX.  '
+            'NetFlow v9 is not decoded, so it is not sent.  This '
+            'applies to every port: the ports of each temp directory '
+            'are sent from their own socket or connection, with their '
+            'own sequence numbers.  May be given more than once.  Put '
+            'IPv6 addresses in brackets, tcp:[::1]:4739.' )
+
+    p.add_argument( '--ipfix-export-mtu',
+        type=int,
+        default=1400,
+        metavar='BYTES',
+        help = 'The largest IPFIX message sent over UDP.  As many '
+            'records as fit are sent in each message.' )
+
+    p.add_argument( '--ipfix-export-template-refresh',
+        type=int,
+        default=60,
+        metavar='SECONDS',
+        help = 'How often the template is sent again over UDP.' )
+
+    p.add_argument( '--ipfix-export-domain',
+        type=int,
+        default=1,
+        metavar='ID',
+        help = 'The observation domain ID of the exported IPFIX, sent to '
+            'collectors and to "export" files.' )
+
+    p.add_argument( '--trace-sample',
+        type=int,
+        default=0,
+        metavar='N',
+        help = 'Traces one packet in N from recv to the temp file write, '
+            'and serves the time spent between stages as histograms on '
+            '--metrics.  0, the default, turns tracing off.' )
 
     p.add_argument( '--verbose', '-v',
         action='count',
@@ -178,6 +501,66 @@ def parse_args():
         log().error( 'ERROR: %s' % e )
         exit( 1 )
 
+    try:
+        ( v4, v6 ) = [ int( n ) for n in
+                                    cmdparse.aggregate_prefix.split( ',' ) ]
+        if not 0 < v4 <= 32 or not 0 < v6 <= 128:
+            raise ValueError
+    except ValueError:
+        log().error( 'ERROR: --aggregate-prefix must be V4,V6, for '
+            'example 24,64' )
+        exit( 1 )
+    setattr( cmdparse, 'aggregate_prefix', ( v4, v6 ) )
+
+    if cmdparse.distinct and not 4 <= cmdparse.distinct <= 18:
+        log().error( 'ERROR: --distinct must be 4 to 18' )
+        exit( 1 )
+
+    forward = []
+    for f in cmdparse.forward:
+        ( host, colon, port ) = f.rpartition( ':' )
+        if host.startswith( '[' ) and host.endswith( ']' ):
+            host = host[1:-1]
+        try:
+            port = int( port )
+            if not host or not 0 < port < 65536:
+                raise ValueError
+        except ValueError:
+            log().error( 'ERROR: --forward must be HOST:PORT, not %s' % f )
+            exit( 1 )
+        forward.append( ( host, port ) )
+    setattr( cmdparse, 'forward', forward )
+
+    ipfix_export = []
+    for e in cmdparse.ipfix_export:
+        ( transport, colon, host_port ) = e.partition( ':' )
+        ( host, colon, port ) = host_port.rpartition( ':' )
+        if host.startswith( '[' ) and host.endswith( ']' ):
+            host = host[1:-1]
+        try:
+            port = int( port )
+            if ( transport not in ( 'udp', 'tcp' ) or not host or
+                                                not 0 < port < 65536 ):
+                raise ValueError
+        except ValueError:
+            log().error( 'ERROR: --ipfix-export must be udp:HOST:PORT or '
+                'tcp:HOST:PORT, not %s' % e )
+            exit( 1 )
+        ipfix_export.append( ( transport, host, port ) )
+    setattr( cmdparse, 'ipfix_export', ipfix_export )
+
+    if cmdparse.ipfix_export_mtu < 200:
+        log().error( 'ERROR: --ipfix-export-mtu must be at least 200' )
+        exit( 1 )
+
+    if cmdparse.max_exporters < 0:
+        log().error( 'ERROR: --max-exporters can not be negative' )
+        exit( 1 )
+
+    if cmdparse.aggregate_interval < 1:
+        log().error( 'ERROR: --aggregate-interval must be at least 1' )
+        exit( 1 )
+
     setattr( cmdparse, 'ports', ports )
     setattr( cmdparse, 'temp_directories', temp_directories )
     setattr( cmdparse, 'dest_directories', dest_directories )
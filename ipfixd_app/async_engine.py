@@ -0,0 +1,306 @@
+"""
+Optional asyncio ingest engine.  With the default threaded model
+every UDP port has its own Socket thread spinning in read_loop.
+With lots of ports, that is lots of threads fighting over the GIL.
+
+AsyncEngine is a single thread that runs an asyncio event loop and
+listens on all the UDP ports at once.  The Socket objects are still
+created for each port, they just aren't started.  The engine uses
+their sockets, free lists and queues, so the Packet threads can't
+tell the difference.
+
+We don't use a DatagramProtocol.  It hands us a new bytes object
+for every datagram, which defeats the free list buffers.  Instead
+the engine registers a reader callback for each socket with
+loop.add_reader and reads the socket with recvfrom_into until it
+would block, or until it has read a large read_list, then puts the
+read_list on the queue.  The reader stays registered, so a busy port
+is called again once the loop has served the other ports.
+"""
+
+import asyncio
+import time
+
+from ipfixd_app.ipfixd_log import log
+import ipfixd_app.ipfixd_thread
+from ipfixd_app.sockets import ReadListReasons, FreeListReasons
+from ipfixd_app.sockets import _rxq_ovfl_cmsg_size
+from ipfixd_app.capture import capture_record
+
+class AsyncEngine( ipfixd_app.ipfixd_thread.IPFixdThread ):
+
+    """
+    Reads all the UDP ports on one event loop.  Add Socket objects
+    with add_socket before calling start.  Don't start the Socket
+    objects themselves.
+
+    To get this thread to stop, call stop() and then wakeup().
+    """
+
+    def __init__( self, profile=False ):
+
+        """
+        Returns a thread object.  Call add_socket for each port and
+        then start.
+        """
+
+        name = 'Asyncio socket engine'
+        self._sockets = []
+        self._loop = None
+
+        ipfixd_app.ipfixd_thread.IPFixdThread.__init__(
+                    self, name=name, profile=profile, target=self.run_loop )
+        self.daemon = True
+        log().info( 'INFO: Created thread %s' % name )
+
+    def add_socket( self, s ):
+
+        """
+        Adds an unstarted Socket to the engine.
+        """
+
+        self._sockets.append( s )
+
+    def qsize( self ):
+
+        """
+        Returns a tuple: the total qsize and max since the last call
+        for all the ports.
+        """
+
+        z = 0
+        m = 0
+        for s in self._sockets:
+            ( sz, sm ) = s.qsize()
+            z += sz
+            m += sm
+
+        return( z, m )
+
+    def qempty( self ):
+
+        """
+        Empties all the port queues.
+        """
+
+        for s in self._sockets:
+            s.qempty()
+
+    def print_metrics( self ):
+
+        """
+        Prints the metrics for every port.
+        """
+
+        for s in self._sockets:
+            ( z, m ) = s.qsize()
+            log().info( 'INFO: %s: queue cnt/max: %d/%d' % ( s.name, z, m ) )
+            s.print_metrics()
+
+    def wakeup( self ):
+
+        """
+        Wakes up the event loop so it notices a stop request.
+        """
+
+        loop = self._loop
+        if loop is None:
+            return
+
+        try:
+            loop.call_soon_threadsafe( self._check_stop )
+        except RuntimeError:    # Loop already closed
+            pass
+
+    def run_loop( self ):
+
+        """
+        Thread target.  Runs the event loop until we are asked to stop.
+        """
+
+        if self._profile:
+            self._profile.enable()
+
+        self._loop = asyncio.new_event_loop()
+        self._done = self._loop.create_future()
+
+        try:
+            self._loop.run_until_complete( self._main() )
+        finally:
+            self._loop.close()
+
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats( "stats/" + self.name )
+
+        return( 0 )
+
+    async def _main( self ):
+
+        """
+        Opens every socket and registers it with the loop.  Then waits
+        until _check_stop says we are done.
+        """
+
+        self._ports = []
+
+        for s in self._sockets:
+            try:
+                s._make_socket()
+            except OSError:
+                continue            # Its packet thread was told to stop
+            s.s.setblocking( False )
+
+            read_list = []
+            free_list = []
+            s.read_list_management( read_list, ReadListReasons.none )
+            s.free_list_management( free_list, FreeListReasons.none )
+            s.free_list_management( free_list, FreeListReasons.empty )
+
+            port = [ s, read_list, free_list ]
+            self._ports.append( port )
+            self._loop.add_reader( s.s.fileno(), self._drain, port )
+
+        self._loop.call_later( 2.0, self._tick )
+        await self._done
+
+    def _tick( self ):
+
+        """
+        Checks for stop requests every so often, in case the wakeup
+        got lost.
+        """
+
+        if not self._check_stop():
+            self._loop.call_later( 2.0, self._tick )
+
+    def _check_stop( self ):
+
+        """
+        If we were asked to stop, puts a zero length item on every
+        queue so the packet threads stop, closes the sockets and ends
+        the loop.
+
+        Returns:
+            True if we are stopping.
+        """
+
+        if not self.should_stop() or self._done.done():
+            return( self._done.done() )
+
+        for ( s, read_list, free_list ) in self._ports:
+            self._loop.remove_reader( s.s.fileno() )
+            if not free_list:
+                s.free_list_management( free_list, FreeListReasons.empty )
+            read_list.append( [ bytes( 16 ), s.port, free_list.pop(), 0 ] )
+            s.request_stop( read_list )
+            s.s.close()
+
+        self._done.set_result( None )
+
+        return( True )
+
+    def _resume( self, port ):
+
+        """
+        Starts reading a port again after its free list ran dry.
+        """
+
+        ( s, read_list, free_list ) = port
+
+        if self._done.done():
+            return
+
+        s.free_list_management( free_list, FreeListReasons.empty,
+                                                            block=False )
+        if free_list:
+            log().info( 'INFO: Exhausted socket free list relieved %s',
+                                                                s.name )
+            s.metric_free_list_exhausted += 1
+            self._loop.add_reader( s.s.fileno(), self._drain, port )
+        else:
+            self._loop.call_later( 0.01, self._resume, port )
+
+    def _drain( self, port ):
+
+        """
+        Reader callback.  Reads datagrams until the socket would
+        block, then puts the read_list on the queue.  If the read_list
+        gets large it is put on the queue and we return, so one busy
+        port can't hold up its packet thread or the other ports.
+
+        We never wait on the free queue or the capture queue here,
+        that would hold up every port.  If a port runs out of buffers,
+        we stop reading it and let the kernel buffer hold the packets
+        until the packet thread returns some buffers.  Capture records
+        that don't fit are dropped and counted.
+        """
+
+        ( s, read_list, free_list ) = port
+        recvfrom_into = s.s.recvfrom_into
+        recvmsg_into = s.s.recvmsg_into if s._rxq_ovfl else None
+        buff_size = s._buff_size
+        exporter_keys = s._exporter_keys
+        capture_list = s._capture_list
+        tracer = s._tracer
+        large = s._queue_size // 2
+
+        if s._free_len >= large:
+            s.free_list_management( free_list, FreeListReasons.large_list,
+                                                            block=False )
+
+        while True:
+            if not free_list:
+                s.free_list_management( free_list, FreeListReasons.empty,
+                                                            block=False )
+                if not free_list:
+                    log().warn( 'WARN: Exhausted socket free list %s',
+                                                                s.name )
+                    self._loop.remove_reader( s.s.fileno() )
+                    self._loop.call_later( 0.01, self._resume, port )
+                    break
+
+            try:
+                if recvmsg_into:
+                    ( nbytes, ancdata, flags, address ) = recvmsg_into(
+                        [ free_list[-1] ], _rxq_ovfl_cmsg_size )
+                    if ancdata:
+                        s._note_kernel_drops( ancdata )
+                else:
+                    ( nbytes, address ) = recvfrom_into( free_list[-1],
+                                                            buff_size )
+                s.metric_io_read_result += 1
+            except BlockingIOError:
+                s.metric_io_non_blocking_result += 1
+                break
+            except OSError as e:
+                log().error( 'ERROR: %s: recvfrom, errno=%d: %s' %
+                                        ( s.name, e.errno, e.strerror ) )
+                break
+
+            try:
+                key = exporter_keys[ address[0] ]
+            except KeyError:
+                key = s._exporter_key( address[0] )
+
+            buff = free_list.pop()
+            read_list.append( [ key, s.port, buff, nbytes ] )
+            if capture_list is not None and nbytes:
+                capture_list.append( capture_record( time.time(), key,
+                                                    s.port, buff, nbytes ) )
+            if tracer:
+                trace = tracer.sample()
+                if trace:
+                    read_list[-1].append( trace )
+
+            if len( read_list ) >= large:
+                s.read_list_management( read_list,
+                                    ReadListReasons.large_list, block=False )
+                return
+
+        s.metric_io_non_blocking += 1
+        if read_list:
+            s.read_list_management( read_list, ReadListReasons.blocked_io,
+                                                                block=False )
+
+# End.
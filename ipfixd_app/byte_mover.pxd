@@ -26,14 +26,15 @@ cdef class ByteMover:
 
 #
 # Save the offset arrays for moving data and some summary
-# information about the arrays.
+# information about the arrays.  There is an offset per byte moved,
+# and the extended record is 120 bytes.
 #
 
-    cdef unsigned int _in_offsets[ 100 ]
-    cdef unsigned int _out_offsets[ 100 ]
+    cdef unsigned int _in_offsets[ 128 ]
+    cdef unsigned int _out_offsets[ 128 ]
     cdef unsigned int _num_offsets
 
-    cdef unsigned int _check_for_zero[ 100 ]
+    cdef unsigned int _check_for_zero[ 128 ]
     cdef unsigned int _num_check_for_zero
 
     cdef unsigned int _in_offset
@@ -46,6 +47,16 @@ cdef class ByteMover:
     cdef uint32_t _address           # Needed for cflowd
     cdef uint32_t _flow_id           # Needed for cflowd
 
+# Extended (IPv6) records store a 16 byte exporter address and have
+# a few constant bytes (IPv4 mapped address markers, ipVersion) that
+# are filled in for every record.
+
+    cdef uint8_t _address6[ 16 ]
+    cdef unsigned int _address_len
+    cdef unsigned int _fill_offsets[ 32 ]
+    cdef uint8_t _fill_values[ 32 ]
+    cdef unsigned int _num_fill
+
 # Offsets into cflowd buffer.
 
     cdef unsigned int _cflowd_offset_to_flowStartSeconds
@@ -94,4 +105,48 @@ cdef class ByteMoverMilliSeconds( ByteMover ):
         uint8_t * in_buffer,
         uint8_t * out_buffer )
 
+cdef class SampleLayout:
+
+    """
+    Where FlowSampler finds the flow key and the counters in an
+    output record.
+    """
+
+    cdef unsigned int _record_len
+    cdef unsigned int _key_offsets[ 64 ]    # Bytes hashed, in order
+    cdef unsigned int _num_key_offsets
+    cdef unsigned int _packets_offset
+    cdef unsigned int _octets_offset
+    cdef unsigned int _counter_len          # 4 or 8 bytes
+
+cdef class FlowSampler:
+
+    """
+    Keeps one flow record in N and scales the counters of the ones
+    kept.
+    """
+
+    cdef uint32_t _every
+    cdef uint32_t _countdown
+    cdef bint _hash
+    cdef public bint normalize
+    cdef uint8_t * _keep            # Keep flags from the last select
+    cdef unsigned int _keep_len
+    cdef unsigned int _selected
+    cdef uint64_t _records_in
+    cdef uint64_t _records_kept
+
+    cpdef int select( self,
+        uint8_t * buff,
+        unsigned int offset,
+        unsigned int cnt,
+        SampleLayout layout ) except -1
+
+    cpdef int apply( self,
+        uint8_t * buff,
+        unsigned int offset,
+        unsigned int cnt,
+        SampleLayout layout,
+        uint64_t scale ) except -1
+
 # End.
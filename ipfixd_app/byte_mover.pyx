@@ -7,7 +7,8 @@ import cython
 cimport ipfixd_app.byte_mover
 
 from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t
-from libc.string cimport memcpy
+from libc.string cimport memcpy, memmove
+from cpython.mem cimport PyMem_Realloc, PyMem_Free
 
 cdef extern from "arpa/inet.h":
     uint16_t ntohs( uint16_t ) nogil
@@ -59,8 +60,8 @@ cdef class ByteMover:
                                 range( self._num_check_for_zero )])
 
         def __set__( self, check_for_zero ):
-            if len( check_for_zero ) > 100:
-                raise( ValueError( 'Number of check_for_zero > 100' ))
+            if len( check_for_zero ) > 128:
+                raise( ValueError( 'Number of check_for_zero > 128' ))
             cdef unsigned int i
             cdef unsigned int b
             for ( i, b ) in enumerate( check_for_zero ):
@@ -172,12 +173,56 @@ cdef class ByteMover:
         def __set__( self, value ):
             self._cflowd_offset_to_flowId = value
     property cflowd_offset_to_exporterIPv4Address:
-        """Sets the cflowd offset to exporterIPv4Address"""
+        """
+        Sets the cflowd offset to exporterIPv4Address.  For extended
+        records this is the offset to exporterIPv6Address.
+        """
         def __get__( self ):
             return( self._cflowd_offset_to_exporterIPv4Address )
         def __set__( self, value ):
             self._cflowd_offset_to_exporterIPv4Address = value
 
+    property address6:
+        """
+        Sets the 16 byte router address used by extended records.
+        Setting it switches the ByteMover to storing 16 byte exporter
+        addresses.
+        """
+
+        def __get__( self ):
+            return( bytes( self._address6[:16] ) )
+        def __set__( self, value ):
+            cdef unsigned int i
+            if len( value ) != 16:
+                raise( ValueError( 'address6 must be 16 bytes' ))
+            for i in range( 16 ):
+                self._address6[ i ] = value[ i ]
+            self._address_len = 16
+
+    property address_len:
+        """The size of the exporter address in the output, 4 or 16."""
+        def __get__( self ):
+            return( self._address_len )
+
+    property fill:
+        """
+        A list of ( output offset, byte value ) tuples that are stored
+        in every output record.
+        """
+
+        def __get__( self ):
+            cdef unsigned int i
+            return([ ( self._fill_offsets[i], self._fill_values[i] )
+                                        for i in range( self._num_fill )])
+        def __set__( self, fill ):
+            if len( fill ) > 32:
+                raise( ValueError( 'Number of fill bytes > 32' ))
+            cdef unsigned int i
+            for ( i, ( o, v ) ) in enumerate( fill ):
+                self._fill_offsets[ i ] = o
+                self._fill_values[ i ] = v
+            self._num_fill = len( fill )
+
     property template:
         def __get__( self ):
             return( self._template )
@@ -200,10 +245,10 @@ cdef class ByteMover:
                 have an overflow.
         """
 
-        if len( in_offsets ) > 100:
-            raise( ValueError( 'Number of in_offsets > 100' ))
-        elif len( check_for_zero ) > 100:
-            raise( ValueError( 'Number of check_for_zero > 100' ))
+        if len( in_offsets ) > 128:
+            raise( ValueError( 'Number of in_offsets > 128' ))
+        elif len( check_for_zero ) > 128:
+            raise( ValueError( 'Number of check_for_zero > 128' ))
         elif len( in_offsets ) != len( out_offsets ):
             raise( ValueError( 'Number of input offsets != '
                 'number of output offsets' ))
@@ -240,6 +285,8 @@ cdef class ByteMover:
         self.cflowd_offset_to_flowId = 0
         self.cflowd_offset_to_exporterIPv4Address = 0
         self._template = None
+        self._address_len = 4
+        self._num_fill = 0
 
     cdef int _byte_mover( self,
         uint8_t * in_buffer,
@@ -295,6 +342,10 @@ cdef class ByteMover:
         cdef unsigned int num_check_for_zero = self._num_check_for_zero
         cdef unsigned int * check_for_zero = self._check_for_zero
 
+        cdef unsigned int num_fill = self._num_fill
+        cdef unsigned int * fill_offsets = self._fill_offsets
+        cdef uint8_t * fill_values = self._fill_values
+
         in_buffer += self._in_offset
         out_buffer += self._out_offset
 
@@ -306,6 +357,8 @@ cdef class ByteMover:
                         break
                     else:
                         overflow = in_buffer[check_for_zero[j]]
+            for j in range( num_fill ):
+                out_buffer[fill_offsets[j]] = fill_values[j]
 
             in_buffer += in_len         # Next input buffer
             out_buffer += out_len       # Next output buffer
@@ -326,7 +379,13 @@ cdef class ByteMover:
         results.append( 'Must be zero input bytes: %s' %
                 ','.join( [ str(i) for i in self.check_for_zero ] ) )
 
-        results.append( 'address = %x' % self.address )
+        results.append( 'Fill bytes: %s' %
+                ','.join( [ '%d=%x' % f for f in self.fill ] ) )
+
+        if self._address_len == 16:
+            results.append( 'address6 = %s' % self.address6.hex() )
+        else:
+            results.append( 'address = %x' % self.address )
         results.append( 'flow_id = %d' % self.flow_id )
         results.append( 'in_len = %d' % self.in_len )
         results.append( 'out_len = %d' % self.out_len )
@@ -440,11 +499,16 @@ cdef class ByteMoverNetflowV5( ByteMover ):
             unsigned int out_len = self._out_len
             unsigned int cnt = self._cnt
             uint32_t address = self._address
+            uint8_t * p_address = <uint8_t *>&address
+            unsigned int address_len = self._address_len
             uint32_t flow_id = self._flow_id
             int overflow
             int sysUpTimeDeltaMilliseconds=self._sysUpTimeDeltaMilliseconds
             int sysUpTime = self._sysUpTime
 
+        if address_len == 16:                       # Extended record
+            p_address = self._address6
+
         with nogil:
             overflow = ByteMover._byte_mover( self, in_buffer, out_buffer )
 
@@ -453,7 +517,7 @@ cdef class ByteMoverNetflowV5( ByteMover ):
                 p_out_fi += out_len
                 flow_id += 1
 
-                memcpy( p_out_a, &address, sizeof( address ) )
+                memcpy( p_out_a, p_address, address_len )
                 p_out_a += out_len
 
                 memcpy( &in_st, p_in_st, sizeof( in_st ) )
@@ -595,10 +659,15 @@ cdef class ByteMoverMilliSeconds( ByteMover ):
             unsigned int out_len = self._out_len   # Output buffer len
             unsigned int cnt = self._cnt
             uint32_t address = self._address       # Copy the address
+            uint8_t * p_address = <uint8_t *>&address
+            unsigned int address_len = self._address_len
             uint32_t flow_id = self._flow_id       # and flowId
 
             int overflow
 
+        if address_len == 16:                       # Extended record
+            p_address = self._address6
+
 # Call the superclass byte mover.
 
         with nogil:
@@ -609,7 +678,7 @@ cdef class ByteMoverMilliSeconds( ByteMover ):
                 p_out_fi += out_len
                 flow_id += 1
 
-                memcpy( p_out_a, &address, sizeof( address ) )  # Router addr
+                memcpy( p_out_a, p_address, address_len )  # Router addr
                 p_out_a += out_len
 
                 memcpy( in_st, p_in_st, sizeof( in_st ) )   # Get in times
@@ -637,5 +706,278 @@ cdef class ByteMoverMilliSeconds( ByteMover ):
 
             self._flow_id = flow_id
         return( overflow )
-        
+
+#
+# Flow sampling.  The conversion routines move a set of records into
+# the output buffer, then FlowSampler.select picks the records to keep
+# and FlowSampler.apply packs the kept ones to the front of the set
+# and scales their counters.  Picking and applying are separate so the
+# same records are kept in the cflowd and the extended output when a
+# port writes both.  The records are in the output format, so one
+# sampler handles NetFlow v5 and every IPFIX template.
+#
+
+cdef uint32_t _fnv_offset = 2166136261
+cdef uint32_t _fnv_prime = 16777619
+
+cdef class SampleLayout:
+
+    """
+    Where FlowSampler finds the flow key and the counters in an
+    output record.  The key is hashed in hash mode, so records with
+    the same key, the 5-tuple for cflowd, are all kept or all dropped.
+    """
+
+    def __init__( self, record_len, key_fields, packets_offset,
+                                            octets_offset, counter_len ):
+
+        """
+        Args:
+            record_len: Size of a record
+            key_fields: A list of ( offset, len ) of the key fields
+            packets_offset: Offset to packetDeltaCount
+            octets_offset: Offset to octetDeltaCount
+            counter_len: 4 or 8, the size of both counters
+        """
+
+        cdef unsigned int n = 0
+
+        if counter_len not in ( 4, 8 ):
+            raise( ValueError( 'counter_len must be 4 or 8' ) )
+
+        for ( offset, l ) in key_fields:
+            for i in range( offset, offset + l ):
+                if n == 64:
+                    raise( ValueError( 'Key longer than 64 bytes' ) )
+                self._key_offsets[ n ] = i
+                n += 1
+
+        self._num_key_offsets = n
+        self._record_len = record_len
+        self._packets_offset = packets_offset
+        self._octets_offset = octets_offset
+        self._counter_len = counter_len
+
+    property record_len:
+        """The size of a record."""
+        def __get__( self ):
+            return( self._record_len )
+
+cdef inline void _scale_counter( uint8_t * p, unsigned int counter_len,
+                                            uint64_t scale ) noexcept nogil:
+
+    """
+    Multiplies a native order counter by scale, stopping at the
+    largest value the counter can hold.
+    """
+
+    cdef uint32_t v32
+    cdef uint64_t v64
+
+    if counter_len == 4:
+        memcpy( &v32, p, 4 )
+        if v32 and scale > 0xffffffffU // v32:
+            v32 = 0xffffffffU
+        else:
+            v32 = <uint32_t>( v32 * scale )
+        memcpy( p, &v32, 4 )
+    else:
+        memcpy( &v64, p, 8 )
+        if v64 and scale > 0xffffffffffffffffULL // v64:
+            v64 = 0xffffffffffffffffULL
+        else:
+            v64 *= scale
+        memcpy( p, &v64, 8 )
+
+cdef class FlowSampler:
+
+    """
+    Keeps one flow record in every.  In count mode that is every
+    every'th record the sampler sees, in hash mode the records whose
+    key hashes (FNV-1a) to 0 modulo every.  Hashing keeps all of a
+    flow or none of it, and the same flows on any collector using the
+    same every.
+
+    The counters of a kept record are multiplied by every, so sums
+    over the output estimate the real traffic, and by the exporter's
+    own sampling interval when normalize is set.  One sampler belongs
+    to one packet thread.
+    """
+
+    def __cinit__( self ):
+        self._keep = NULL
+        self._keep_len = 0
+        self._selected = 0
+        self._records_in = 0
+        self._records_kept = 0
+
+    def __init__( self, every=1, mode='count', normalize=False ):
+
+        """
+        Args:
+            every: Keep one record in this many.  1 keeps them all.
+            mode: 'count' or 'hash'
+            normalize: Also scale by the exporter's sampling interval
+        """
+
+        if every < 1:
+            raise( ValueError( 'every must be at least 1' ) )
+        if mode not in ( 'count', 'hash' ):
+            raise( ValueError( 'mode must be count or hash' ) )
+
+        self._every = every
+        self._countdown = every
+        self._hash = ( mode == 'hash' )
+        self.normalize = normalize
+
+    def __dealloc__( self ):
+        PyMem_Free( self._keep )
+
+    property every:
+        """Keep one record in this many."""
+        def __get__( self ):
+            return( self._every )
+
+    property mode:
+        """'count' or 'hash'."""
+        def __get__( self ):
+            return( 'hash' if self._hash else 'count' )
+
+    property records_in:
+        """Records seen by select, cumulative."""
+        def __get__( self ):
+            return( self._records_in )
+
+    property records_kept:
+        """Records select kept, cumulative."""
+        def __get__( self ):
+            return( self._records_kept )
+
+    cpdef int select( self,
+        uint8_t * buff,
+        unsigned int offset,
+        unsigned int cnt,
+        SampleLayout layout ) except -1:
+
+        """
+        Picks the records to keep from a set of cnt records.  Call
+        apply with the same cnt for each output buffer holding the set.
+
+        Args:
+            buff: The output buffer
+            offset: Offset to the first record of the set
+            cnt: The number of records in the set
+            layout: The SampleLayout of the records
+
+        Returns:
+            The number of records kept.
+        """
+
+        cdef:
+            unsigned int i
+            unsigned int j
+            unsigned int kept = 0
+            uint32_t h
+            uint32_t every = self._every
+            uint32_t countdown = self._countdown
+            uint8_t * keep
+            uint8_t * rec = buff + offset
+            unsigned int record_len = layout._record_len
+            unsigned int * key_offsets = layout._key_offsets
+            unsigned int num_key_offsets = layout._num_key_offsets
+
+        if cnt > self._keep_len:
+            keep = <uint8_t *>PyMem_Realloc( self._keep, cnt )
+            if keep == NULL:
+                raise MemoryError()
+            self._keep = keep
+            self._keep_len = cnt
+
+        keep = self._keep
+
+        with nogil:
+            for i in range( cnt ):
+                if every == 1:
+                    keep[ i ] = 1
+                elif self._hash:
+                    h = _fnv_offset
+                    for j in range( num_key_offsets ):
+                        h = ( h ^ rec[ key_offsets[ j ] ] ) * _fnv_prime
+                    keep[ i ] = ( h % every ) == 0
+                else:
+                    countdown -= 1
+                    if countdown:
+                        keep[ i ] = 0
+                    else:
+                        keep[ i ] = 1
+                        countdown = every
+                kept += keep[ i ]
+                rec += record_len
+
+        self._countdown = countdown
+        self._selected = cnt
+        self._records_in += cnt
+        self._records_kept += kept
+
+        return( kept )
+
+    cpdef int apply( self,
+        uint8_t * buff,
+        unsigned int offset,
+        unsigned int cnt,
+        SampleLayout layout,
+        uint64_t scale ) except -1:
+
+        """
+        Packs the records select kept to the front of the set and
+        scales their packet and octet counters.
+
+        Args:
+            buff: The output buffer
+            offset: Offset to the first record of the set
+            cnt: The number of records in the set, as given to select
+            layout: The SampleLayout of the records
+            scale: Multiply the counters by this.  Usually every, times
+                the exporter's sampling interval when normalizing.
+
+        Returns:
+            The number of records kept.  They are at offset, and the
+            rest of the set's bytes are junk.
+        """
+
+        cdef:
+            unsigned int i
+            unsigned int kept = 0
+            uint8_t * keep = self._keep
+            uint8_t * rec = buff + offset
+            uint8_t * out = buff + offset
+            unsigned int record_len = layout._record_len
+            unsigned int packets_offset = layout._packets_offset
+            unsigned int octets_offset = layout._octets_offset
+            unsigned int counter_len = layout._counter_len
+
+        if cnt != self._selected:
+            raise( ValueError( 'apply cnt %d, select cnt %d' %
+                                                ( cnt, self._selected ) ) )
+
+        with nogil:
+            for i in range( cnt ):
+                if keep[ i ]:
+                    if out != rec:
+                        memmove( out, rec, record_len )
+                    if scale > 1:
+                        _scale_counter( out + packets_offset, counter_len,
+                                                                    scale )
+                        _scale_counter( out + octets_offset, counter_len,
+                                                                    scale )
+                    out += record_len
+                    kept += 1
+                rec += record_len
+
+        return( kept )
+
+    def __str__( self ):
+        return( 'FlowSampler every=%d mode=%s normalize=%s' %
+                        ( self._every, self.mode, bool( self.normalize ) ) )
+
 # End.
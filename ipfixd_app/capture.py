@@ -0,0 +1,72 @@
+"""
+Packet capture file format.  A socket reader can tee every datagram
+it receives to a capture Writer, and replay.py sends a capture back
+to a collector.  That lets us reproduce a production load on a test
+box and compare releases.
+
+A capture file is just a series of records.  There is no file
+header, so the files can be rotated by the normal Writer code and
+concatenated with cat.  Each record is:
+
+    double      arrival time, seconds since the epoch
+    uint16_t    the port the datagram arrived on
+    uint16_t    the length of the datagram
+    uint8_t     exporter address, packed 16 byte form, see util.exporter_key
+    uint8_t     the datagram, length bytes
+
+All in network byte order.
+"""
+
+import struct
+
+capture_record_struct = struct.Struct( '!dHH16s' )
+
+def capture_record( arrival, key, port, buff, nbytes ):
+
+    """
+    Builds a capture record.  The datagram is copied since the
+    buffer goes back on the free list.
+
+    Args:
+        arrival: time.time() when the datagram was read
+        key: The packed 16 byte exporter address
+        port: The port we are listening on
+        buff: The buffer the datagram was read into
+        nbytes: The length of the datagram
+
+    Returns:
+        The record as bytes.
+    """
+
+    return( capture_record_struct.pack( arrival, port, nbytes, key ) +
+                                                            buff[ :nbytes ] )
+
+def read_capture( f ):
+
+    """
+    Generator that reads the records in a capture file.  A truncated
+    record at the end of the file, as found in the current temp file,
+    is ignored.
+
+    Args:
+        f: A file opened for binary reading
+
+    Yields:
+        A tuple of arrival time, exporter key, port and datagram.
+    """
+
+    header_len = capture_record_struct.size
+
+    while True:
+        h = f.read( header_len )
+        if len( h ) < header_len:
+            return
+        ( arrival, port, nbytes, key ) = capture_record_struct.unpack( h )
+
+        data = f.read( nbytes )
+        if len( data ) < nbytes:
+            return
+
+        yield( arrival, key, port, data )
+
+# End.
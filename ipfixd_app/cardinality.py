@@ -0,0 +1,305 @@
+"""
+Distinct source and destination counts per port and per exporter.
+With --distinct P, each port's packet thread feeds its decoded flow
+records to a DistinctCounts, which adds the source and destination
+addresses to HyperLogLog sketches of 2 ** P registers (see
+ipfixd_app.hyperloglog): one pair for the port, and one pair for
+each exporter sending to it.  Each sketch is a fixed size however
+many addresses there are.  A scan shows up as a jump in the distinct
+destinations of one source's exporter, a DDoS as a jump in the
+distinct sources.
+
+The window is the port's output file, like the top talkers, and
+ends when the first of the port's writers rotates.  When a writer
+rotates its temp file the sketches, registers and all, are written
+next to it as JSON, distinct-<port>.<date>, and start over.  Writing
+one window next to two files does no harm to a merge.  The
+estimates for the window so far and the last complete one are on
+--metrics /status.
+
+Sketches merge by taking the larger of each register, so the files
+for an hour or a day can be merged into the distinct counts for the
+whole time without going back to the flows:
+
+    python -m ipfixd_app.cardinality distinct-2055.20240101_*
+
+The packet thread adds and the writer's rename thread and the
+metrics server read, so a lock covers the sketches.  It is taken
+once per packet.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import threading
+import ipfixd_app.util
+import ipfixd_app.metrics
+import ipfixd_app.cflowd
+import ipfixd_app.hyperloglog
+from ipfixd_app.ipfixd_log import log
+
+distinct_counts = []        # Every DistinctCounts, for /status
+
+def _sketch_json( sketch ):
+    return( { 'estimate': sketch.estimate(),
+        'registers': base64.b64encode( sketch.registers ).decode( 'ascii' ) } )
+
+class DistinctCounts( object ):
+
+    """
+    Distinct source and destination addresses for a port and its
+    exporters, per output file.
+    """
+
+    def __init__( self, port, precision, temp_directory, extended=True,
+                                                            interval=0 ):
+
+        """
+        Args:
+            port: The port, for the file name and /status
+            precision: log2 of the registers in each sketch
+            temp_directory: Where to write the file before it is moved
+                next to the output file
+            extended: True if fed extended (cflowd6) records, else
+                cflowd records
+            interval: The writers' write timeout.  See
+                ipfixd_app.talkers.TopTalkers.
+        """
+
+        if extended:
+            fields = ipfixd_app.util.field_offsets(
+                                    ipfixd_app.cflowd.cflowd6_field_list )
+            self._src = fields[ 'sourceIPv6Address' ]
+            self._dst = fields[ 'destinationIPv6Address' ]
+        else:
+            fields = ipfixd_app.util.field_offsets(
+                                    ipfixd_app.cflowd.cflowd_field_list )
+            self._src = fields[ 'sourceIPv4Address' ]
+            self._dst = fields[ 'destinationIPv4Address' ]
+        self._record_len = fields[ 'record_len' ]
+
+        self.port = port
+        self.precision = precision
+        self.extended = extended
+        self._temp_directory = temp_directory
+        self._lock = threading.Lock()
+        self._sources = ipfixd_app.hyperloglog.HyperLogLog( precision )
+        self._destinations = ipfixd_app.hyperloglog.HyperLogLog( precision )
+        self._exporters = {}    # address: ( sources, destinations )
+        self._start = time.time()
+        self._last = None
+        self._last_window = None        # With the registers, for rotate
+        self._interval = interval
+
+        self.metric_dumps = 0
+        self.metric_dump_errors = 0
+
+        labels = { 'port': str( port ) }
+        for m in (
+            ipfixd_app.metrics.Counter( 'ipfixd_distinct_dumps_total',
+                'Distinct count files written.', labels,
+                lambda: self.metric_dumps ),
+            ipfixd_app.metrics.Counter( 'ipfixd_distinct_dump_errors_total',
+                'Distinct count files that could not be written.', labels,
+                lambda: self.metric_dump_errors ),
+            ipfixd_app.metrics.Gauge( 'ipfixd_distinct_exporters',
+                'Exporters with sketches in the current window.', labels,
+                lambda: len( self._exporters ) ) ):
+            ipfixd_app.metrics.registry.register( m )
+
+        distinct_counts.append( self )
+
+    def add( self, exporter, buff ):
+
+        """
+        Adds the addresses of the flow records in a buffer.
+
+        Args:
+            exporter: The packed 16 byte address of the exporter that
+                sent them
+            buff: The flow records
+        """
+
+        with self._lock:
+            try:
+                ( sources, destinations ) = self._exporters[ exporter ]
+            except KeyError:
+                sources = ipfixd_app.hyperloglog.HyperLogLog( self.precision )
+                destinations = ipfixd_app.hyperloglog.HyperLogLog(
+                                                            self.precision )
+                self._exporters[ exporter ] = ( sources, destinations )
+
+            self._sources.add_records( buff, self._record_len, self._src,
+                                                                    sources )
+            self._destinations.add_records( buff, self._record_len,
+                                                    self._dst, destinations )
+
+    def _window( self, end, registers ):
+
+        """
+        Returns the window so far as a dict.  Called with the lock
+        held.
+
+        Args:
+            end: When the window ends
+            registers: True to include the registers, else only the
+                estimates
+        """
+
+        if registers:
+            sketch = _sketch_json
+        else:
+            sketch = lambda s: { 'estimate': s.estimate() }
+
+        return( { 'port': self.port, 'start': int( self._start ),
+            'end': int( end ), 'precision': self.precision,
+            'sources': sketch( self._sources ),
+            'destinations': sketch( self._destinations ),
+            'exporters': [ { 'exporter': ipfixd_app.util.format_address( e ),
+                    'sources': sketch( s ), 'destinations': sketch( d ) }
+                for ( e, ( s, d ) ) in sorted( self._exporters.items() ) ] } )
+
+    def rotate( self, dest_file_name ):
+
+        """
+        Writes the window's sketches next to a rotated output file,
+        and starts a new window.  A Writer rotate hook, called from
+        its rename thread.
+
+        Args:
+            dest_file_name: The name the output file was renamed to
+        """
+
+        now = time.time()
+        with self._lock:
+            if self._last_window and now - self._start < self._interval / 2:
+                window = self._last_window  # Another writer ended it
+            else:
+                window = self._window( now, True )
+                self._sources.reset()
+                self._destinations.reset()
+                self._exporters = {}
+                self._start = now
+                self._last = self._window_estimates( window )
+                self._last_window = window
+
+        ( dest_directory, base ) = os.path.split( dest_file_name )
+        name = 'distinct-%d.%s' % ( self.port, base.partition( '.' )[2] )
+        temp_name = os.path.join( self._temp_directory, name + '.current' )
+
+        try:
+            with open( temp_name, 'w' ) as f:
+                json.dump( window, f )
+            os.rename( temp_name, os.path.join( dest_directory, name ) )
+            self.metric_dumps += 1
+        except OSError as e:
+            self.metric_dump_errors += 1
+            log().error( 'ERROR: writing distinct counts for port %d to '
+                '%s: %s' % ( self.port, name, e ) )
+
+    @staticmethod
+    def _window_estimates( window ):
+
+        """
+        Returns a copy of a window without the registers.
+        """
+
+        def strip( d ):
+            return( { 'estimate': d[ 'estimate' ] } )
+
+        return( dict( window, sources=strip( window[ 'sources' ] ),
+            destinations=strip( window[ 'destinations' ] ),
+            exporters=[ dict( e, sources=strip( e[ 'sources' ] ),
+                        destinations=strip( e[ 'destinations' ] ) )
+                for e in window[ 'exporters' ] ] ) )
+
+    def status( self ):
+
+        """
+        Returns the estimates for the window so far and the last one,
+        for /status.
+        """
+
+        with self._lock:
+            return( { 'current': self._window( time.time(), False ),
+                                                    'last': self._last } )
+
+def status():
+
+    """
+    Returns the distinct counts of every port, for /status.
+    """
+
+    return( [ d.status() for d in distinct_counts ] )
+
+ipfixd_app.metrics.registry.add_status( 'distinct', status )
+
+def merge( windows ):
+
+    """
+    Merges windows read from distinct-* files into one covering them
+    all.  They must have the same precision.
+
+    Args:
+        windows: The windows, as dicts from json.load
+
+    Returns:
+        A window dict with the estimates and registers of the unions.
+    """
+
+    def load( d ):
+        return( ipfixd_app.hyperloglog.HyperLogLog( precision,
+                                    base64.b64decode( d[ 'registers' ] ) ) )
+
+    precision = windows[0][ 'precision' ]
+    sources = ipfixd_app.hyperloglog.HyperLogLog( precision )
+    destinations = ipfixd_app.hyperloglog.HyperLogLog( precision )
+    exporters = {}
+    for w in windows:
+        sources.merge( load( w[ 'sources' ] ) )
+        destinations.merge( load( w[ 'destinations' ] ) )
+        for e in w[ 'exporters' ]:
+            ( s, d ) = exporters.setdefault( e[ 'exporter' ], (
+                ipfixd_app.hyperloglog.HyperLogLog( precision ),
+                ipfixd_app.hyperloglog.HyperLogLog( precision ) ) )
+            s.merge( load( e[ 'sources' ] ) )
+            d.merge( load( e[ 'destinations' ] ) )
+
+    return( { 'port': windows[0][ 'port' ],
+        'start': min( w[ 'start' ] for w in windows ),
+        'end': max( w[ 'end' ] for w in windows ), 'precision': precision,
+        'sources': _sketch_json( sources ),
+        'destinations': _sketch_json( destinations ),
+        'exporters': [ { 'exporter': e, 'sources': _sketch_json( s ),
+                                        'destinations': _sketch_json( d ) }
+            for ( e, ( s, d ) ) in sorted( exporters.items() ) ] } )
+
+if __name__ == '__main__':
+
+#
+# Merges the distinct-* files given and prints the estimates, or with
+# -o FILE writes the merged window, registers and all, to FILE.
+#
+
+    args = sys.argv[1:]
+    out = None
+    if args[:1] == [ '-o' ]:
+        out = args[1]
+        args = args[2:]
+
+    windows = []
+    for name in args:
+        with open( name ) as f:
+            windows.append( json.load( f ) )
+    window = merge( windows )
+
+    if out:
+        with open( out, 'w' ) as f:
+            json.dump( window, f )
+    else:
+        print( json.dumps( DistinctCounts._window_estimates( window ),
+                                                                indent=1 ) )
+
+# End.
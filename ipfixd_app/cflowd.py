@@ -1,16 +1,23 @@
 import sys
+import time
+import zlib
 import struct
 import socket
+import threading
 from collections import namedtuple
 import pyximport; pyximport.install()
 import ipfixd_app.byte_mover
+import ipfixd_app.exporter_stats
+import ipfixd_app.options_cache
 
 import ipfixd_app.netflow_v5
 import ipfixd_app.netflow_v10
 import ipfixd_app.header
 import ipfixd_app.ipfix
 import ipfixd_app.util
+import ipfixd_app.metrics
 from ipfixd_app.ipfixd_log import log
+from ipfixd_app.util import format_key
 from ipfixd_app.packet import t_address, t_port, t_p, t_p_len
 import collections
 
@@ -84,6 +91,172 @@ cflowd_keys: Field name to item index for pack/unpack of a cflowd item
 (cflowd_struct, cflowd_keys) = ipfixd_app.util.make_pack_items(
                     cflowd_field_list, network_byte_order=False )
 
+"""
+The extended (cflowd6) record.  cflowd can only hold IPv4 flows with
+32 bit counters and 16 bit AS numbers and interface indexes.  This
+record holds IPv6 addresses, 64 bit counters, and 32 bit AS numbers
+and interface indexes.  Integers are native byte order, like cflowd.
+Addresses are 16 bytes in network order.  IPv4 flows are stored as
+IPv4 mapped addresses (::ffff:a.b.c.d) and ipVersion is set to 4.
+
+typedef struct {
+    uint32_t    index;          /* 000. Index from UDP packet */
+    uint8_t     router[16];     /* 004. Router reporting information */
+    uint8_t     srcIpAddr[16];  /* 020. Source of flow */
+    uint8_t     dstIpAddr[16];  /* 036. Dest flow */
+    uint8_t     ipNextHop[16];  /* 052. */
+    uint32_t    inputIfIndex;   /* 068. Router interface index */
+    uint32_t    outputIfIndex;  /* 072. */
+    uint16_t    srcPort;        /* 076. */
+    uint16_t    dstPort;        /* 078. */
+    uint64_t    pkts;           /* 080. */
+    uint64_t    bytes;          /* 088. */
+    uint32_t    startTime;      /* 096. */
+    uint32_t    endTime;        /* 100. */
+    uint32_t    srcAs;          /* 104. Autonomous system numbers */
+    uint32_t    dstAs;          /* 108. */
+    uint8_t     protocol;       /* 112. */
+    uint8_t     tos;            /* 113. Protocol type of service */
+    uint8_t     srcMaskLen;     /* 114. */
+    uint8_t     dstMaskLen;     /* 115. */
+    uint8_t     tcpFlags;       /* 116. */
+    uint8_t     ipVersion;      /* 117. 4 or 6 */
+    uint16_t    pad;            /* 118. */
+} flow6_t;
+
+#define FLOW6_LEN 120
+"""
+
+cflowd6_field_list = [
+    [ 'flowId', 4 ],
+    [ 'exporterIPv6Address', 16 ],
+    [ 'sourceIPv6Address', 16 ],
+    [ 'destinationIPv6Address', 16 ],
+    [ 'ipNextHopIPv6Address', 16 ],
+    [ 'ingressInterface', 4 ],
+    [ 'egressInterface', 4 ],
+    [ 'sourceTransportPort', 2 ],
+    [ 'destinationTransportPort', 2 ],
+    [ 'packetDeltaCount', 8 ],
+    [ 'octetDeltaCount', 8 ],
+    [ 'flowStartSeconds', 4 ],
+    [ 'flowEndSeconds', 4 ],
+    [ 'bgpSourceAsNumber', 4 ],
+    [ 'bgpDestinationAsNumber', 4 ],
+    [ 'protocolIdentifier', 1 ],
+    [ 'ipClassOfService', 1 ],
+    [ 'sourceIPv6PrefixLength', 1 ],
+    [ 'destinationIPv6PrefixLength', 1 ],
+    [ 'tcpControlBits', 1 ],
+    [ 'ipVersion', 1 ],
+    [ 'paddingOctets', 2 ]
+]
+
+(cflowd6_struct, cflowd6_keys) = ipfixd_app.util.make_pack_items(
+                    cflowd6_field_list, network_byte_order=False )
+
+#
+# IPv4 input fields that are stored in the IPv6 fields of the
+# extended record when the input has no IPv6 field of its own.
+#
+
+_cflowd6_v4_fields = {
+    'sourceIPv4Address': 'sourceIPv6Address',
+    'destinationIPv4Address': 'destinationIPv6Address',
+    'ipNextHopIPv4Address': 'ipNextHopIPv6Address',
+    'sourceIPv4PrefixLength': 'sourceIPv6PrefixLength',
+    'destinationIPv4PrefixLength': 'destinationIPv6PrefixLength'
+}
+
+def _sample_layout( field_list, the_struct, address_fields ):
+
+    """
+    Makes the ipfixd_app.byte_mover.SampleLayout for an output record.
+    The flow key is the 5-tuple.
+
+    Args:
+        field_list: The record's field list, cflowd_field_list, etc.
+        the_struct: The record's Struct
+        address_fields: The source and destination address field names
+
+    Returns:
+        The SampleLayout.
+    """
+
+    offsets = ipfixd_app.util.field_offsets( field_list )
+    if offsets[ 'record_len' ] != the_struct.size:
+        raise ValueError
+
+    return( ipfixd_app.byte_mover.SampleLayout( the_struct.size,
+        [ offsets[ name ] for name in list( address_fields ) + [
+            'sourceTransportPort', 'destinationTransportPort',
+            'protocolIdentifier' ] ],
+        offsets[ 'packetDeltaCount' ][0], offsets[ 'octetDeltaCount' ][0],
+        offsets[ 'packetDeltaCount' ][1] ) )
+
+cflowd_sample_layout = _sample_layout( cflowd_field_list, cflowd_struct,
+    ( 'sourceIPv4Address', 'destinationIPv4Address' ) )
+cflowd6_sample_layout = _sample_layout( cflowd6_field_list, cflowd6_struct,
+    ( 'sourceIPv6Address', 'destinationIPv6Address' ) )
+
+#
+# The sampling interval each exporter says it uses, keyed by
+# ( address, port, obs_id ) like exporter_stats.  IPFIX exporters
+# send it in options data, and v10_options_data works it out from
+# options_cache when it changes, so the decoders look it up with one
+# dict get.  NetFlow v5 has it in the header, which is read for every
+# packet, so it is not kept here.  Only used to scale the counters
+# with --normalize-sampling.
+#
+
+sampling_intervals = {}
+
+"""
+The aggregate record, written by ipfixd_app.aggregator.  Each one
+is the flows of an interval with the same source and destination
+prefixes, protocol and destination port, added up.  Like the
+extended record, integers are native byte order, addresses are 16
+bytes in network order and IPv4 prefixes are IPv4 mapped, with
+prefix lengths counted from the start of the IPv4 address.
+
+typedef struct {
+    uint32_t    startTime;      /* 000. Start of the interval */
+    uint32_t    endTime;        /* 004. End of the interval */
+    uint8_t     srcPrefix[16];  /* 008. */
+    uint8_t     dstPrefix[16];  /* 024. */
+    uint8_t     srcMaskLen;     /* 040. */
+    uint8_t     dstMaskLen;     /* 041. */
+    uint8_t     protocol;       /* 042. */
+    uint8_t     ipVersion;      /* 043. 4 or 6 */
+    uint16_t    dstPort;        /* 044. */
+    uint16_t    pad;            /* 046. */
+    uint64_t    flows;          /* 048. Flow records added up */
+    uint64_t    pkts;           /* 056. */
+    uint64_t    bytes;          /* 064. */
+} aggregate_t;
+
+#define AGGREGATE_LEN 72
+"""
+
+aggregate_field_list = [
+    [ 'flowStartSeconds', 4 ],
+    [ 'flowEndSeconds', 4 ],
+    [ 'sourceIPv6Address', 16 ],
+    [ 'destinationIPv6Address', 16 ],
+    [ 'sourceIPv6PrefixLength', 1 ],
+    [ 'destinationIPv6PrefixLength', 1 ],
+    [ 'protocolIdentifier', 1 ],
+    [ 'ipVersion', 1 ],
+    [ 'destinationTransportPort', 2 ],
+    [ 'paddingOctets', 2 ],
+    [ 'deltaFlowCount', 8 ],
+    [ 'packetDeltaCount', 8 ],
+    [ 'octetDeltaCount', 8 ]
+]
+
+(aggregate_struct, aggregate_keys) = ipfixd_app.util.make_pack_items(
+                    aggregate_field_list, network_byte_order=False )
+
 """
 netflow_v5_header_struct: A Struct that maps the binary struct of a
     NetFlow V5 header.
@@ -111,6 +284,7 @@ netflow_v5_keys: Field name to item index for pack/unpack of a
 #
 
 netflow_v5_to_cflowd_byte_mover = 1     # Placeholder name
+netflow_v5_to_cflowd6_byte_mover = 1    # Placeholder name
 
 _header_cnt_index = netflow_v5_header_keys[ 'xx_cnt' ]
 _flow_id_index = netflow_v5_header_keys[ 'flowId' ]
@@ -120,8 +294,8 @@ _sysUpTime_index = (
         netflow_v5_header_keys[ 'xx_sysUpTime' ] )
 
 """
-Keeps track of the last netflow v5 id found.  Indexed by sending
-IP and server port, as a tuple.
+Keeps track of the last netflow v5 id found.  Indexed by the packed
+sending IP and server port, as a tuple.
 """
 
 netflow_v5_flow_ids = {}
@@ -202,12 +376,14 @@ _v10_options_template_header_sfcnt = (
     netflow_v10_options_template_header_keys[ 'xx_scope_field_cnt' ] )
 
 """
-Define the templates dict.  The key is a tuple of ip-address, server-port,
-and template id (an int).  The value is 
+Define the templates dict.  The key is a tuple of the packed 16 byte
+exporter address (see util.exporter_key), server-port, observation
+domain id and template id (an int).  The value is 
 
     {
         'the_struct': class struct.Struct
         'byte_mover': ByteMover object for the template
+        'byte_mover6': ByteMover object for the extended record
         'template_bytes': The actual bytes that
             define the template.  We check these
             and omit processing if we've seen the
@@ -220,6 +396,194 @@ and template id (an int).  The value is
 templates = {}
 listed_templates = {}       # An error message about template has been output
 
+#
+# Per exporter counters, keyed by ( address, port, obs_id ).  NetFlow
+# v5 has no observation domain, so it uses 0.  The row number is kept
+# in the v5 flow info so the fast path does not look it up again.
+# IPFIX looks it up once per packet.  See ipfixd_app.exporter_stats.
+#
+
+exporter_stats = ipfixd_app.exporter_stats.ExporterStats()
+
+def _exporter_evicted( key ):
+
+    """
+    Forgets the row number NetFlow v5 keeps for an exporter whose
+    exporter_stats row was given to another one.
+    """
+
+    if key[2] == 0:
+        netflow_v5_flow_ids.pop( key[:2], None )
+
+exporter_stats.on_evict = _exporter_evicted
+
+#
+# ipfix files hold the messages of every exporter on some ports, and
+# many exporters use the same observation domain and template IDs.
+# So each ( address, port, obs_id ) gets its own domain in the files,
+# a hash of it that stays the same across restarts unless two
+# collide, and the message headers are rewritten to it.  Domain 0 is
+# ours, see IPFixFileTemplates.
+#
+
+ipfix_domains = {}          # ( address, port, obs_id ): packed domain
+ipfix_domain_keys = {}      # domain: ( address, port, obs_id )
+_ipfix_domain_lock = threading.Lock()
+
+class _ExporterMetric( ipfixd_app.metrics.Metric ):
+
+    """
+    One exporter_stats column as a metric, one sample per exporter.
+    """
+
+    def __init__( self, name, help_text, column, kind='counter' ):
+        ipfixd_app.metrics.Metric.__init__( self, name, help_text )
+        self.column = column
+        self.kind = kind
+
+    def samples( self ):
+        return( [ ( '', _exporter_labels( key ), row[ self.column ] )
+                                    for ( key, row ) in exporter_stats.rows() ] )
+
+def _exporter_labels( key ):
+
+    """
+    Returns the labels, or status fields, for an exporter_stats key.
+    """
+
+    return( { 'exporter': ipfixd_app.util.format_address( key[0] ),
+        'port': key[1], 'observation_domain': key[2] } )
+
+def exporter_status():
+
+    """
+    Returns the exporter_stats table as a list of dicts for /status.
+    """
+
+    return( [ dict( _exporter_labels( key ), **row )
+                                for ( key, row ) in exporter_stats.rows() ] )
+
+for ( name, help_text, column, kind ) in (
+        ( 'ipfixd_exporter_packets_total', 'Packets decoded.', 'packets',
+            'counter' ),
+        ( 'ipfixd_exporter_flows_total', 'Flow records decoded.', 'flows',
+            'counter' ),
+        ( 'ipfixd_exporter_bytes_total', 'Packet bytes decoded.', 'bytes',
+            'counter' ),
+        ( 'ipfixd_exporter_sequence_gaps_total',
+            'Gaps in the sequence numbers.', 'gaps', 'counter' ),
+        ( 'ipfixd_exporter_lost_flows_total',
+            'Flows missing according to the sequence numbers.',
+            'lost_flows', 'counter' ),
+        ( 'ipfixd_exporter_templates_total',
+            'Templates and option templates received.', 'templates',
+            'counter' ),
+        ( 'ipfixd_exporter_decode_errors_total',
+            'Packets or sets that could not be decoded.', 'decode_errors',
+            'counter' ),
+        ( 'ipfixd_exporter_sequence_restarts_total',
+            'Times the sequence numbers started over.', 'restarts',
+            'counter' ),
+        ( 'ipfixd_exporter_reordered_packets_total',
+            'Late or duplicate packets.', 'reordered', 'counter' ),
+        ( 'ipfixd_exporter_late_flows_total',
+            'Flows in late or duplicate packets.  They were counted as '
+            'lost when the gap was seen.', 'late_flows', 'counter' ),
+        ( 'ipfixd_exporter_last_seen_seconds',
+            'When the exporter last sent, Unix time.', 'last_seen',
+            'gauge' ) ):
+    ipfixd_app.metrics.registry.register(
+                            _ExporterMetric( name, help_text, column, kind ) )
+
+ipfixd_app.metrics.registry.register( ipfixd_app.metrics.Counter(
+    'ipfixd_exporter_evictions_total',
+    'Exporters dropped from the statistics table because it was full.',
+    None, lambda: exporter_stats.evictions ) )
+
+ipfixd_app.metrics.registry.add_status( 'exporters', exporter_status )
+
+#
+# Decoded options data, by exporter and scope.  See v10_options_data
+# and ipfixd_app.options_cache.  main sets the size from
+# --options-cache-size.
+#
+
+options_cache = ipfixd_app.options_cache.OptionsCache()
+
+for m in (
+    ipfixd_app.metrics.Counter( 'ipfixd_options_updates_total',
+        'Options data records decoded.', None,
+        lambda: options_cache.metric_updates ),
+    ipfixd_app.metrics.Counter( 'ipfixd_options_evictions_total',
+        'Options records dropped because the cache was full.', None,
+        lambda: options_cache.metric_evictions ),
+    ipfixd_app.metrics.Gauge( 'ipfixd_options_records',
+        'Options records in the cache.', None,
+        lambda: len( options_cache ) ) ):
+    ipfixd_app.metrics.registry.register( m )
+
+ipfixd_app.metrics.registry.add_status( 'options', options_cache.status )
+
+_summary_last = {}          # exporter_stats rows at the last summary
+
+def log_sequence_summary( interval ):
+
+    """
+    Logs one line for each exporter that lost flows, restarted or
+    sent packets out of order since the last call.  The main thread
+    calls this every --sequence-summary seconds, so a lossy exporter
+    costs a log line a minute instead of one per packet.
+
+    Args:
+        interval: Seconds since the last call, for the message
+    """
+
+    global _summary_last
+
+    summary = {}
+    for ( key, row ) in exporter_stats.rows():
+        summary[ key ] = row
+        last = _summary_last.get( key )
+        if last:
+            d = { k: row[ k ] - last[ k ] for k in ( 'flows', 'gaps',
+                    'lost_flows', 'restarts', 'reordered', 'late_flows' ) }
+        else:
+            d = row
+        if not ( d[ 'gaps' ] or d[ 'restarts' ] or d[ 'reordered' ] ):
+            continue
+
+# Late flows were counted as lost when their gap was seen, maybe in
+# an earlier interval.
+
+        lost = max( d[ 'lost_flows' ] - d[ 'late_flows' ], 0 )
+        total = d[ 'flows' ] + lost
+        log().warn( 'WARN: %s:%d/%d - lost %d of %d flows (%.2f%%) in %d '
+            'gaps, %d restarts, %d late packets in the last %d seconds.' % (
+                ipfixd_app.util.format_address( key[0] ), key[1], key[2],
+                lost, total, 100.0 * lost / total if total else 0.0,
+                d[ 'gaps' ], d[ 'restarts' ], d[ 'reordered' ], interval ),
+            extra={ 'rate_limit_exempt': True } )  # One a minute per exporter
+
+    _summary_last = summary
+
+def count_decode_error( t ):
+
+    """
+    Counts a packet we could not decode against its exporter.  The
+    observation domain comes from the header if this looks like IPFIX.
+
+    Args:
+        t: Standard tuple.  See t_ indexes.
+    """
+
+    obs_id = 0
+    if ( t[ t_p_len ] >= ipfixd_app.header.v10_header_len() and
+            ipfixd_app.header.netflow_version( t[ t_p ] ) == 10 ):
+        obs_id = ipfixd_app.header.v10_header( t[ t_p ] )[4]
+
+    exporter_stats.error( exporter_stats.row(
+                                    ( t[ t_address ], t[ t_port ], obs_id ) ) )
+
 def set_cflowd_log_options( cmdparse ):
 
     """
@@ -234,44 +598,118 @@ def set_cflowd_log_options( cmdparse ):
     log_unchanged_templates = cmdparse.log_unchanged_templates
     log_missing_full = cmdparse.log_missing_full
 
-def netflow_v5_init( netflow_v5_header_keys, template_keys ):
+def make_cflowd6_byte_moves( input_struct, input_keys ):
 
     """
-    Initializes some of the data structures that would have been
-    inconvienent to init at import time.  For instance, the log()
-    routine would not have been available to log errors.
+    Works like ipfixd_app.util.make_byte_moves with the extended
+    record as the output.  IPv4 input fields are moved into the
+    matching IPv6 fields when the input has no IPv6 version of the
+    field.  The bytes that mark an IPv4 mapped address and the
+    ipVersion (if not in the input) are returned as fill bytes.
+
+    Args:
+        input_struct: A struct type for input
+        input_keys: A dict, keyed by input keys, data item index
+
+    Returns:
+        The same tuple as make_byte_moves, followed by a list of
+        ( output offset, byte value ) fill tuples.
     """
 
-    global netflow_v5_to_cflowd_byte_mover
+    keys = dict( input_keys )
+    mapped = []
+
+    if 'sourceIPv6Address' in keys:
+        ip_version = 6
+    else:
+        ip_version = 4
+
+    for ( v4, v6 ) in _cflowd6_v4_fields.items():
+        if v4 in keys and v6 not in keys:
+            keys[ v6 ] = keys.pop( v4 )
+            if v6.endswith( 'Address' ):
+                mapped.append( v6 )
 
     ( in_offsets, out_offsets, in_data, out_data, check_for_zero ) = (
         ipfixd_app.util.make_byte_moves(
-            netflow_v5_struct, netflow_v5_keys, cflowd_struct, cflowd_keys ))
+            input_struct, keys, cflowd6_struct, cflowd6_keys ))
+
+    fill = []
+    for k in mapped:                            # ::ffff:a.b.c.d
+        fill.append( ( out_data[ k ][ 'byte_offset' ] + 10, 0xff ) )
+        fill.append( ( out_data[ k ][ 'byte_offset' ] + 11, 0xff ) )
+    if 'ipVersion' not in keys:
+        fill.append( ( out_data[ 'ipVersion' ][ 'byte_offset' ], ip_version ) )
+
+    return( in_offsets, out_offsets, in_data, out_data, check_for_zero, fill )
+
+def _netflow_v5_byte_mover( out_struct, moves, exporter_field ):
+
+    """
+    Creates a NetFlow V5 ByteMover for an output record.
+
+    Args:
+        out_struct: The output record struct.
+        moves: The make_byte_moves (or make_cflowd6_byte_moves) results.
+        exporter_field: Output field name for the exporter address.
+
+    Returns:
+        A ByteMoverNetflowV5 object.
+    """
+
+    ( in_offsets, out_offsets, in_data, out_data, check_for_zero ) = moves[:5]
 
-    netflow_v5_to_cflowd_byte_mover = ipfixd_app.byte_mover.ByteMoverNetflowV5(
+    bm = ipfixd_app.byte_mover.ByteMoverNetflowV5(
         in_offsets, out_offsets, check_for_zero )
 
-    netflow_v5_to_cflowd_byte_mover.in_len = netflow_v5_struct.size
-    netflow_v5_to_cflowd_byte_mover.out_len = cflowd_struct.size
-    netflow_v5_to_cflowd_byte_mover.in_offset = netflow_v5_header_struct.size
+    if len( moves ) > 5:
+        bm.fill = moves[ 5 ]
 
-    netflow_v5_to_cflowd_byte_mover.cflowd_offset_to_flowStartSeconds = (
+    bm.in_len = netflow_v5_struct.size
+    bm.out_len = out_struct.size
+    bm.in_offset = netflow_v5_header_struct.size
+
+    bm.cflowd_offset_to_flowStartSeconds = (
         out_data[ 'flowStartSeconds' ][ 'byte_offset' ] )
-    netflow_v5_to_cflowd_byte_mover.cflowd_offset_to_flowEndSeconds = (
+    bm.cflowd_offset_to_flowEndSeconds = (
         out_data[ 'flowEndSeconds' ][ 'byte_offset' ] )
 
-    netflow_v5_to_cflowd_byte_mover.offset_to_flowStartSysUpTime = (
+    bm.offset_to_flowStartSysUpTime = (
         in_data[ 'flowStartSysUpTime' ][ 'byte_offset' ] )
-    netflow_v5_to_cflowd_byte_mover.offset_to_flowEndSysUpTime = (
+    bm.offset_to_flowEndSysUpTime = (
         in_data[ 'flowEndSysUpTime' ][ 'byte_offset' ] )
 
-    netflow_v5_to_cflowd_byte_mover.cflowd_offset_to_flowId = (
-        out_data[ 'flowId' ][ 'byte_offset' ] )
-    netflow_v5_to_cflowd_byte_mover.cflowd_offset_to_exporterIPv4Address = (
-        out_data[ 'exporterIPv4Address' ][ 'byte_offset' ] )
+    bm.cflowd_offset_to_flowId = out_data[ 'flowId' ][ 'byte_offset' ]
+    bm.cflowd_offset_to_exporterIPv4Address = (
+        out_data[ exporter_field ][ 'byte_offset' ] )
+
+    return( bm )
+
+def netflow_v5_init( netflow_v5_header_keys, template_keys ):
+
+    """
+    Initializes some of the data structures that would have been
+    inconvienent to init at import time.  For instance, the log()
+    routine would not have been available to log errors.
+    """
+
+    global netflow_v5_to_cflowd_byte_mover
+    global netflow_v5_to_cflowd6_byte_mover
+
+    netflow_v5_to_cflowd_byte_mover = _netflow_v5_byte_mover( cflowd_struct,
+        ipfixd_app.util.make_byte_moves(
+            netflow_v5_struct, netflow_v5_keys, cflowd_struct, cflowd_keys ),
+        'exporterIPv4Address' )
+
+    netflow_v5_to_cflowd6_byte_mover = _netflow_v5_byte_mover( cflowd6_struct,
+        make_cflowd6_byte_moves( netflow_v5_struct, netflow_v5_keys ),
+        'exporterIPv6Address' )
+    netflow_v5_to_cflowd6_byte_mover.address6 = bytes( 16 )
 
     log().info( 'INFO: NetFlow V5 ByteMover: %s' %
             str(netflow_v5_to_cflowd_byte_mover) )
+    log().info( 'INFO: NetFlow V5 extended ByteMover: %s' %
+            str(netflow_v5_to_cflowd6_byte_mover) )
 
 def null_cvt_rtn( cflowd, ipfix, address, port, buff ):
 
@@ -297,7 +735,7 @@ def v5_get_info( t, flow_info ):
     or returns it.
 
     We can avoid redoing some of the messy address conversion code
-    if we stash it along with the expected_flow_id information.
+    if we stash it along with the exporter_stats row.
     Some things should be thread local so we can avoid possibly
     needing a mutex should Python change how it works or we
     use an implementation that does not have a global lock.
@@ -307,25 +745,26 @@ def v5_get_info( t, flow_info ):
 
     ( cnt, flow_id ) = flow_info
 
-    k = tuple( [ t[ t_address ][0], t[ t_port ] ] )
+    k = tuple( [ t[ t_address ], t[ t_port ] ] )
     if k in netflow_v5_flow_ids:
         info = netflow_v5_flow_ids[ k ]         # Mutex!!
     else:
-        a=socket.inet_pton( socket.AF_INET, t[t_address][0] )
-        address_int = (a[0]<<24)+(a[1]<<16)+(a[2]<<8)+a[3]
+        ( address_int, address6 ) = (
+            ipfixd_app.util.exporter_address( t[ t_address ] ) )
         info = netflow_v5_flow_ids[ k ] = {}    # Mutex!!
         info[ 'address_int' ] = address_int
-        info[ 'expected_flow_id' ] = flow_id
-        netflow_v5_to_cflowd_byte_mover.address = address_int
+        info[ 'address6' ] = address6
+        info[ 'stats_row' ] = exporter_stats.row( k + ( 0, ) )
 
     return( info )
     
 def v5_handle_expected_flow_id( t, flow_info, info ):
 
     """
-    This routine looks up the expected flow id and compares it to
-    what we received.  Issues an error if there is a gap.  Updates
-    the next expected flow id.
+    This routine checks the flow id we received against the expected
+    one and counts any gap in the exporter_stats table.  With
+    --log-missing-full, every gap is also logged.  Otherwise gaps only
+    show up in log_sequence_summary.
 
     Args:
         t: Standard tuple.  See t_ indexes.
@@ -335,43 +774,108 @@ def v5_handle_expected_flow_id( t, flow_info, info ):
 
     ( cnt, flow_id ) = flow_info
 
-#
-#
+    lost = exporter_stats.sequence( info[ 'stats_row' ], flow_id, cnt )
+    if lost:
+        _log_sequence_event( '%s:%d' % (
+            ipfixd_app.util.format_address( t[ t_address ] ), t[ t_port ] ),
+                flow_id, lost )
+
+def _log_sequence_event( name, flow_id, lost ):
 
-    expected_flow_id = info[ 'expected_flow_id' ]
+    """
+    Logs a gap, if --log-missing-full, or an exporter restart.
+    Restarts are rare enough to always log.
 
-    if log_missing_full:
-        info[ 'expected_flow_id' ] = flow_id + cnt
-        if flow_id != expected_flow_id and flow_id > expected_flow_id:
-            log().error( 'ERROR: %s:%d - missing flows, expected %d, '
-                'got %d, lost %d.' % ( 
-                    t[ t_address ][0], t[ t_port ], expected_flow_id,
-                              flow_id, flow_id - expected_flow_id))
+    Args:
+        name: The exporter, for the message
+        flow_id: The sequence number we got
+        lost: What exporter_stats.sequence returned
+    """
 
-def netflow_v5_to_cflowd( cflowd, ipfix, t ):
+    if lost < 0:
+        log().info( 'INFO: %s - sequence number restarted at %d, '
+            'exporter restart?' % ( name, flow_id ) )
+    elif log_missing_full:
+        log().error( 'ERROR: %s - missing flows, expected %d, '
+            'got %d, lost %d.' % ( name, ( flow_id - lost ) & 0xffffffff,
+                flow_id, lost ) )
+
+def _sample_set( sampler, cflowd_buff, cflowd_offset, cflowd6_buff,
+        cflowd6_offset, cnt, interval ):
 
     """
-    Converts a complete NetFlow V5 packet to a buffer of cflowd records.
+    Samples a set of records that has just been moved into the output
+    buffers.  The records are picked from the extended records when
+    there are some, they have the whole address, and the same ones are
+    kept in both buffers.
+
+    Args:
+        sampler: The packet thread's ipfixd_app.byte_mover.FlowSampler
+        cflowd_buff: The cflowd buffer, or None if the set is not in it
+        cflowd_offset: Offset to the set in cflowd_buff
+        cflowd6_buff: The extended buffer, or None
+        cflowd6_offset: Offset to the set in cflowd6_buff
+        cnt: Records in the set
+        interval: The exporter's sampling interval, 1 if none
 
-    If cflowd is False, then we don't process anything.
-    If ipfix is True, then we just return the input packet
+    Returns:
+        The records kept, now at the front of the set.
+    """
+
+    if cflowd6_buff is not None:
+        sampler.select( cflowd6_buff, cflowd6_offset, cnt,
+                                                cflowd6_sample_layout )
+    else:
+        sampler.select( cflowd_buff, cflowd_offset, cnt,
+                                                cflowd_sample_layout )
+
+    scale = sampler.every * interval
+    if cflowd_buff is not None:
+        kept = sampler.apply( cflowd_buff, cflowd_offset, cnt,
+                                                cflowd_sample_layout, scale )
+    if cflowd6_buff is not None:
+        kept = sampler.apply( cflowd6_buff, cflowd6_offset, cnt,
+                                                cflowd6_sample_layout, scale )
+
+    return( kept )
+
+def v5_sampling_interval( buff ):
+
+    """
+    Returns the sampling interval from a NetFlow v5 header, 1 if the
+    exporter is not sampling.  The last two bytes of the header are
+    two bits of sampling mode and 14 bits of interval.
+    """
+
+    return( ( ( buff[ 22 ] << 8 ) | buff[ 23 ] ) & 0x3fff or 1 )
+
+def netflow_v5_to_cflowd( cflowd, ipfix, cflowd6, t, sampler=None ):
+
+    """
+    Converts a complete NetFlow V5 packet to a buffer of cflowd records
+    and/or a buffer of extended (cflowd6) records.
+
+    If cflowd and cflowd6 are False, then we only check the header
+    and count the packet.  There is never ipfix output: NetFlow V5 is
+    not IPFIX, and an ipfix file holds only IPFIX messages.  The
+    'export' format has V5 flows as IPFIX, see ipfixd_app.exporter.
 
     Args:
         cflowd: Return cflowd data
-        ipfix: Return ipfix data
+        ipfix: Ignored
+        cflowd6: Return extended record data
         t: Tuple in standard format.  See the t_ constants in packet.
+        sampler: A FlowSampler for the port, or None to keep every
+            record.  See _sample_set.
 
     Returns:
-        A buffer containing cflowd records.
+        A tuple of the cflowd, ipfix and cflowd6 buffers.  A buffer
+        is None if it was not requested.
     """
 
     buff = t[ t_p ]
     buff_len = t[ t_p_len ]
-
-    ret = [ [ None, -1], [ None, buff ] ]
-
-    if not cflowd:
-        return( ret[ 0 ][ cflowd ], ret[ 1 ][ ipfix ] )
+    ipfix_buff = None
 
     offset = ipfixd_app.header.v5_header_len()
     if buff_len < offset:
@@ -381,31 +885,61 @@ def netflow_v5_to_cflowd( cflowd, ipfix, t ):
 
     flow_info = ipfixd_app.header.v5_header( buff,
                                 netflow_v5_to_cflowd_byte_mover )
-    netflow_v5_to_cflowd_byte_mover.cnt = cnt = flow_info[0]
+    cnt = flow_info[0]
 
     if offset + (cnt * netflow_v5_struct.size) > buff_len:
         raise ValueError
 
-    cflowd_buff=bytearray( cnt * cflowd_struct.size )   # Make cflowd buffer
-    ret[ 0 ][ 1 ] = cflowd_buff                         # For returns
-
     info = v5_get_info( t, flow_info )
     v5_handle_expected_flow_id( t, flow_info, info )
-    if netflow_v5_to_cflowd_byte_mover.byte_mover(buff, cflowd_buff):
-        log().error( 'ERROR: Unexpected non-zero byte in Netflow V5' )
+    exporter_stats.packet( info[ 'stats_row' ], cnt, buff_len )
 
-    return( ret[ 0 ][ cflowd ], ret[ 1 ][ ipfix ] )
+    if not (cflowd or cflowd6):             # Only counting
+        return( None, ipfix_buff, None )
+
+    if cflowd:
+        netflow_v5_to_cflowd_byte_mover.cnt = cnt
+        netflow_v5_to_cflowd_byte_mover.address = info[ 'address_int' ]
+        cflowd_buff=bytearray( cnt * cflowd_struct.size ) # Make cflowd buffer
+        if netflow_v5_to_cflowd_byte_mover.byte_mover(buff, cflowd_buff):
+            log().error( 'ERROR: Unexpected non-zero byte in Netflow V5' )
+    else:
+        cflowd_buff = None
+
+    if cflowd6:
+        ipfixd_app.header.v5_header( buff, netflow_v5_to_cflowd6_byte_mover )
+        netflow_v5_to_cflowd6_byte_mover.cnt = cnt
+        netflow_v5_to_cflowd6_byte_mover.address6 = info[ 'address6' ]
+        cflowd6_buff=bytearray( cnt * cflowd6_struct.size )
+        netflow_v5_to_cflowd6_byte_mover.byte_mover(buff, cflowd6_buff)
+    else:
+        cflowd6_buff = None
+
+    if sampler:
+        if sampler.normalize:
+            interval = v5_sampling_interval( buff )
+        else:
+            interval = 1
+        kept = _sample_set( sampler, cflowd_buff, 0, cflowd6_buff, 0, cnt,
+                                                                interval )
+        if cflowd:
+            del cflowd_buff[ kept * cflowd_struct.size: ]
+        if cflowd6:
+            del cflowd6_buff[ kept * cflowd6_struct.size: ]
+
+    return( cflowd_buff, ipfix_buff, cflowd6_buff )
 
 def v10_get_info( key, flow_id, set_s, set_e ):
 
     """
-    This routine locates the template.  If the template is cflowd
-    compatable, then it checks to see if the flow we are receiving
-    is the expected flow.  If not, an error message is logged and
-    processing continues.
+    This routine locates the template and counts the records in the
+    set, saving the count in the template's 'cnt', or -1 if the
+    records are variable length.  Sequence numbers are checked for the
+    whole packet by the caller, since IPFIX numbers all the data
+    records in an observation domain, not each template's.
 
-    The byte_mover is located in the template and various setups
-    are made.
+    If the template is compatible, the byte_movers are located in the
+    template and various setups are made.
 
     Args:
         key: The key used to index the template and last flow information.
@@ -415,10 +949,10 @@ def v10_get_info( key, flow_id, set_s, set_e ):
         set_e: Slice style ending byte of the record set
 
     Returns:
-        The byte_mover object associated with the template.
-        This object has nothing to do with last flow info, but
-        we do need to make changes to it here, so we might as
-        well return the object since the caller will need it too.
+        The template.  Its 'byte_mover' (cflowd) and 'byte_mover6'
+        (extended record) objects are set up for the record set
+        when the template is compatible with that output.  None if
+        the template is unknown.
     """
 
     try:
@@ -426,87 +960,125 @@ def v10_get_info( key, flow_id, set_s, set_e ):
     except KeyError:
         if key not in listed_templates:
             log().error( 'ERROR: Template %s not yet defined.' %
-                str(key) )
+                format_key(key) )
             listed_templates[ key ] = 1
+        exporter_stats.error( exporter_stats.row( key[:3] ) )
         return( None )
 
-    if not template[ 'cflowd_compat' ]:
-        return( None )
+    size = template[ 'the_struct' ].size
+    if size:
+        cnt = (set_e - set_s) // size       # # of input records
+    else:
+        cnt = -1                            # Variable length records
+    template[ 'cnt' ] = cnt
+
+    if not (template[ 'cflowd_compat' ] or template[ 'cflowd6_compat' ]):
+        return( template )
 
-    try:                                            # Expected flow id
+    try:
         info = template[ 'last_flow_info' ]
-        expected_flow_id = info[ 'expected_flow_id' ]
         address_int = info[ 'address_int' ]
-
-        if log_missing_full:
-            if flow_id != expected_flow_id and flow_id > expected_flow_id:
-                log().error( 'ERROR: %s - missing flows, '
-                    'expected %d, '
-                    'got %d, lost %d.' % ( str(key), expected_flow_id,
-                                flow_id, flow_id - expected_flow_id))
     except KeyError:
         info = template[ 'last_flow_info' ] = {}
-        a=socket.inet_pton( socket.AF_INET, key[0][0] )
-        address_int = (a[0]<<24)+(a[1]<<16)+(a[2]<<8)+a[3]
+        ( address_int, address6 ) = (
+            ipfixd_app.util.exporter_address( key[0] ) )
         info[ 'address_int' ] = address_int
+        info[ 'address6' ] = address6
+
+    if template[ 'cflowd_compat' ]:
+        bm = template[ 'byte_mover' ]       # Get template's ByteMover
+        bm.address = address_int            # Set the router address
+        bm.flow_id = flow_id                # Set the base flow_id
+        bm.in_offset = set_s                # Offset to input
+        bm.cnt = cnt
+
+    if template[ 'cflowd6_compat' ]:
+        bm = template[ 'byte_mover6' ]
+        bm.address6 = info[ 'address6' ]
+        bm.flow_id = flow_id
+        bm.in_offset = set_s
+        bm.cnt = cnt
 
-    bm = template[ 'byte_mover' ]           # Get template's ByteMover
-    bm.address = address_int                # Set the router address
-    bm.flow_id = flow_id                    # Set the base flow_id
-    bm.in_offset = set_s                    # Offset to input
-    bm.cnt = cnt = (set_e - set_s) // bm.in_len # # of input records
-    info[ 'expected_flow_id' ] = flow_id + cnt
-
-    return( bm )
+    return( template )
 
-def netflow_v10_to_cflowd( cflowd, ipfix, t ):
+def netflow_v10_to_cflowd( cflowd, ipfix, cflowd6, t, sampler=None ):
 
     """
     Converts a complete NetFlow V10 packet to a buffer of cflowd
-    records.
+    records and/or a buffer of extended (cflowd6) records.
 
-    A proper implementation of ipfix needs to know if the
-    templates have been written to the current file or not.
-    If not, then the current templates need to be written.
-    We have not implemented this yet.
+    The ipfix output is the whole message, as received, with the
+    observation domain the exporter has in ipfix files, see
+    ipfix_domain.  So an ipfix file is a series of complete IPFIX
+    messages.  The writer puts each exporter's templates in front of
+    its first message in a file, see IPFixFileTemplates, so each file
+    can be read on its own.
 
     Args:
         cflowd: If True, output cflowd
-        ipfix: If True, output ipfix records
+        ipfix: If True, output the ipfix message
+        cflowd6: If True, output extended records
         t: Standard tuple.  See t_ constants.
+        sampler: A FlowSampler for the port, or None to keep every
+            record.  Each data set is sampled as it is converted, see
+            _sample_set.  ipfix records are not sampled.
 
     Returns:
-        A buffer containing cflowd records.
+        A tuple of the cflowd, ipfix and cflowd6 buffers.  A buffer
+        is None if it was not requested.
 
     Globals:
         listed_templates
         templates
+        sampling_intervals
     """
 
     buff = t[ t_p ]
     buff_len = t[ t_p_len ]
 
-    if ipfix:
-        ipfix_buff = bytearray( buff_len )
-        ipfix_buff_offset = 0
-    else:
-        ipfix_buff = None
-
     offset = ipfixd_app.header.v10_header_len()
     if buff_len < offset:
         raise ValueError
 
     ( version, header_buff_len, flow_start_seconds, flow_id, obs_id ) = (
             ipfixd_app.header.v10_header( buff ) )
+    stats_row = exporter_stats.row( ( t[ t_address ], t[ t_port ], obs_id ) )
     if header_buff_len > buff_len:
         log().error( 'ERROR: packet declared length longer than buffer: '
-            '%d > %d' % ( header_buff_len, buff_len ) )
-        return( None, None )
+            '%d > %d', header_buff_len, buff_len )
+        exporter_stats.error( stats_row )
+        return( None, None, None )
+
+    if ipfix:
+        ipfix_buff = bytearray( buff[ :header_buff_len ] )
+        ipfix_buff[ 12:16 ] = ipfix_domain( ( t[ t_address ], t[ t_port ],
+                                                                obs_id ) )
+    else:
+        ipfix_buff = None
 
-    cflowd_buff=bytearray( buff_len * 10 )   # Won't need more than this?
+    if cflowd:
+        cflowd_buff=bytearray( buff_len * 10 )   # Won't need more than this?
+    else:
+        cflowd_buff = None
     cflowd_len = cflowd_struct.size
     cflowd_buff_offset = 0
+
+    if cflowd6:                                 # 120 byte records
+        cflowd6_buff=bytearray( buff_len * 10 ) # Smallest input is > 12
+    else:
+        cflowd6_buff = None
+    cflowd6_len = cflowd6_struct.size
+    cflowd6_buff_offset = 0
+
+    if sampler and sampler.normalize:
+        interval = sampling_intervals.get(
+                            ( t[ t_address ], t[ t_port ], obs_id ), 1 )
+    else:
+        interval = 1
+
     shl = ipfixd_app.header.v10_set_header_len()
+    flows = 0                   # Records we converted
+    records = 0                 # All data records, for the sequence number
 
     while offset < buff_len:
         if buff_len < offset + shl:
@@ -521,44 +1093,79 @@ def netflow_v10_to_cflowd( cflowd, ipfix, t ):
         set_e = offset + set_len    # Set length includes set header
 
         if set_id > 255:
-            bm = v10_get_info( 
+            template = v10_get_info( 
                 tuple( [ t[ t_address ], t[ t_port ], obs_id, set_id ] ),
                 flow_id, set_s, set_e)
-            if not bm:                              # Unknown or incompatable
+            if not template:                        # Unknown
+                records = -1                        # Can't check sequence
                 offset += set_len
                 continue
-            bm.out_offset = cflowd_buff_offset      # Offset to output
-
-            overflow = bm.byte_mover( buff, cflowd_buff )   # Moves the bytes
-            if overflow:
-                ipfixd_app.util.find_non_zero_bytes( bm.template, buff )
-            cflowd_buff_offset += cflowd_len * bm.cnt
-
-            if ipfix:
-                ipfix_buff[ipfix_buff_offset:ipfix_buff_offset+(set_e-set_s)]=(
-                    buff[ set_s:set_e ] )
-                ipfix_buff_offset += set_e-set_s
+            if template.get( 'options' ):
+                cnt = v10_options_data( template, buff, set_s, set_e )
+            else:
+                cnt = template[ 'cnt' ]
+            if cnt < 0 or records < 0:
+                records = -1
+            else:
+                records += cnt
+            if not (template[ 'cflowd_compat' ] or
+                                            template[ 'cflowd6_compat' ]):
+                offset += set_len
+                continue
+            flows += template[ 'cnt' ]
+            moved = template[ 'cnt' ]
+
+            if cflowd and template[ 'cflowd_compat' ]:
+                bm = template[ 'byte_mover' ]
+                bm.out_offset = cflowd_buff_offset  # Offset to output
+
+                overflow = bm.byte_mover( buff, cflowd_buff ) # Moves the bytes
+                if overflow:
+                    ipfixd_app.util.find_non_zero_bytes( bm.template, buff )
+                set_cflowd_buff = cflowd_buff
+            else:
+                set_cflowd_buff = None
+
+            if cflowd6 and template[ 'cflowd6_compat' ]:
+                bm = template[ 'byte_mover6' ]
+                bm.out_offset = cflowd6_buff_offset
+                bm.byte_mover( buff, cflowd6_buff ) # No overflows, all 64 bit
+                set_cflowd6_buff = cflowd6_buff
+            else:
+                set_cflowd6_buff = None
+
+            if sampler and moved and ( set_cflowd_buff is not None or
+                                            set_cflowd6_buff is not None ):
+                moved = _sample_set( sampler, set_cflowd_buff,
+                    cflowd_buff_offset, set_cflowd6_buff, cflowd6_buff_offset,
+                    moved, interval )
+
+            if set_cflowd_buff is not None:
+                cflowd_buff_offset += cflowd_len * moved
+            if set_cflowd6_buff is not None:
+                cflowd6_buff_offset += cflowd6_len * moved
 
         elif set_id == 2:
-            new_template = v10_template_set(t[ t_address ],
-                                        t[ t_port ], obs_id, buff, set_s, set_e)
-
-            if ipfix and new_template:
-                ipfix_buff[ipfix_buff_offset:ipfix_buff_offset+(set_e-set_s)]=(
-                    buff[ set_s:set_e ] )
-                ipfix_buff_offset += set_e-set_s
+            v10_template_set( t[ t_address ], t[ t_port ], obs_id, buff,
+                                                                set_s, set_e )
         elif set_id == 3:
-            new_template = v10_options_template_set(t[ t_address ],
-                                        t[ t_port ], obs_id, buff, set_s, set_e)
-            if ipfix and new_template:
-                ipfix_buff[ipfix_buff_offset:ipfix_buff_offset+(set_e-set_s)]=(
-                    buff[ set_s:set_e ] )
-                ipfix_buff_offset += set_e-set_s
+            v10_options_template_set( t[ t_address ], t[ t_port ], obs_id,
+                                                        buff, set_s, set_e )
         offset += set_len
 
-    cflowd_buff[ cflowd_buff_offset: ] = []         # Truncate buffer
+    if cflowd:
+        cflowd_buff[ cflowd_buff_offset: ] = []     # Truncate buffer
+    if cflowd6:
+        cflowd6_buff[ cflowd6_buff_offset: ] = []
 
-    return( cflowd_buff, ipfix_buff )
+    exporter_stats.packet( stats_row, flows, buff_len )
+    lost = exporter_stats.sequence( stats_row, flow_id, records )
+    if lost:
+        _log_sequence_event( '%s:%d/%d' % (
+            ipfixd_app.util.format_address( t[ t_address ] ), t[ t_port ],
+                obs_id ), flow_id, lost )
+
+    return( cflowd_buff, ipfix_buff, cflowd6_buff )
 
 def check_for_new_template( address, port, obs_id, header_struct,
         buff, start, end ):
@@ -621,7 +1228,7 @@ def check_for_new_template( address, port, obs_id, header_struct,
     while (offset + flen) <= end:
         id = netflow_v10_field_struct.unpack_from( buff, offset=offset )[0]
         offset += flen
-        if (id >= 0x1000) and ((offset + 4) <= end):
+        if (id & 0x8000) and ((offset + 4) <= end):   # Enterprise number
             offset += 4
 
     real_end = offset
@@ -633,7 +1240,7 @@ def check_for_new_template( address, port, obs_id, header_struct,
         if template_bytes == buff[ start:real_end ]:
             if log_unchanged_templates:
                 log().info('INFO: template key %s is unchanged' %
-                    str(template_key))
+                    format_key(template_key))
             return( template )
     except KeyError:
         pass
@@ -644,6 +1251,206 @@ def check_for_new_template( address, port, obs_id, header_struct,
 
     return( template )
 
+def end_session( address, port ):
+
+    """
+    Forgets the templates and options templates of an exporter whose
+    TCP session ended.  They are scoped to the session (RFC 7011,
+    section 8), so it sends them again when it reconnects.  See
+    ipfixd_app.sockets.TCPSocket.
+
+    Args:
+        address: The exporter's packed 16 byte address
+        port: The port it was connected to
+    """
+
+    ended = [ key for key in list( templates )
+                                if key[0] == address and key[1] == port ]
+    for key in ended:
+        templates.pop( key, None )
+        listed_templates.pop( key, None )
+
+    log().info( 'INFO: %s port %d: session ended, %d templates '
+        'dropped' % ( ipfixd_app.util.format_address( address ), port,
+                                                            len( ended ) ) )
+
+def ipfix_domain( key ):
+
+    """
+    Returns the observation domain an exporter has in ipfix files,
+    packed, giving it one if it is new.  See ipfix_domains.
+
+    Args:
+        key: ( address, port, obs_id )
+    """
+
+    try:
+        return( ipfix_domains[ key ] )
+    except KeyError:
+        pass
+
+    with _ipfix_domain_lock:
+        if key not in ipfix_domains:
+            domain = zlib.crc32( key[0] + struct.pack( '!HL', key[1],
+                                                                key[2] ) )
+            while domain == 0 or domain in ipfix_domain_keys:
+                domain = ( domain + 1 ) & 0xffffffff
+            ipfix_domain_keys[ domain ] = key
+            ipfix_domains[ key ] = struct.pack( '!L', domain )
+            log().info( 'INFO: exporter %s is observation domain %d in '
+                                'ipfix files' % ( format_key( key ), domain ) )
+
+    return( ipfix_domains[ key ] )
+
+def _ipfix_messages( sets, export_time, sequence, domain ):
+
+    """
+    Returns sets packed into as few IPFIX messages as they fit in.
+
+    Args:
+        sets: A list of ( set id, [ record bytes ] ).  A set longer
+            than a message is split.
+        export_time: The export time for the headers
+        sequence: The sequence number for the headers
+        domain: The observation domain ID
+    """
+
+    hl = ipfixd_app.header.v10_header_len()
+    shl = ipfixd_app.header.v10_set_header_len()
+    max_len = 65535
+
+    set_list = []
+    for ( set_id, records ) in sets:
+        body = b''
+        for record in records:
+            if body and hl + shl + len( body ) + len( record ) > max_len:
+                set_list.append( struct.pack( '!HH', set_id,
+                                                shl + len( body ) ) + body )
+                body = b''
+            body += record
+        set_list.append( struct.pack( '!HH', set_id,
+                                                shl + len( body ) ) + body )
+
+    messages = []
+    body = b''
+    for set_bytes in set_list + [ None ]:
+        if body and ( set_bytes is None or
+                                hl + len( body ) + len( set_bytes ) > max_len ):
+            messages.append( struct.pack( '!HHLLL', 10, hl + len( body ),
+                                    export_time, sequence, domain ) + body )
+            body = b''
+        if set_bytes:
+            body += set_bytes
+
+    return( b''.join( messages ) )
+
+class IPFixFileTemplates( object ):
+
+    """
+    Puts the templates an ipfix file needs in it, so the file can be
+    read on its own.  An ipfix Writer calls prefix with each message
+    it writes (see ipfixd_app.writer.Writer.set_prefix).  In front of
+    the first message of each observation domain in a file, it puts
+    a message in domain 0 with a domain map record, which says which
+    exporter the domain is, and a message with the exporter's
+    templates and options templates.  So a file only has the
+    templates of the exporters that wrote to it.
+
+    The domain map is an options template, 256 in domain 0, scoped
+    by observationDomainId, with originalExporterIPv6Address (IPv4
+    exporters are IPv4 mapped), originalObservationDomainId and
+    collectorTransportPort, the port we got it on.
+    """
+
+    map_template_id = 256
+    map_field_list = [ ( 'observationDomainId', 4 ),
+                    ( 'originalExporterIPv6Address', 16 ),
+                    ( 'originalObservationDomainId', 4 ),
+                    ( 'collectorTransportPort', 2 ) ]
+    map_template = struct.pack( '!HHH', map_template_id,
+            len( map_field_list ), 1 ) + b''.join( struct.pack( '!HH',
+                    ipfixd_app.ipfix.ipfix_name_to_info[ name ].id, l )
+                                            for ( name, l ) in map_field_list )
+    _map_struct = struct.Struct( '!L16sLH' )
+
+    def __init__( self ):
+        self.reset()
+
+    def reset( self ):
+
+        """
+        Forgets what has been written.  Called when the Writer starts
+        a new temp file or spill journal.
+        """
+
+        self._written = set()           # Packed domains
+        self._map_sequence = 0
+        self._index = None
+
+    def _template_index( self ):
+
+        """
+        Returns the template and options template records we have,
+        by exporter: { ( address, port, obs_id ): [ ( set id,
+        template id, bytes ) ] }.  The packet threads may be adding
+        templates, so the dict is copied first.
+        """
+
+        index = {}
+        for ( key, template ) in list( templates.items() ):
+            if 'template_bytes' not in template:
+                continue
+            if template[ 'template_bytes' ][ 2:4 ] == b'\0\0':
+                continue                    # A withdrawal, no fields
+            set_id = 3 if template.get( 'options' ) else 2
+            index.setdefault( key[:3], [] ).append(
+                        ( set_id, key[3], template[ 'template_bytes' ] ) )
+
+        return( index )
+
+    def prefix( self, item ):
+
+        """
+        Returns the messages to write in front of an ipfix message,
+        or None if its domain already has them in this file.
+
+        Args:
+            item: The message, with its domain from ipfix_domain
+        """
+
+        domain = bytes( item[ 12:16 ] )
+        if domain in self._written:
+            return( None )
+        self._written.add( domain )
+
+        ( d, ) = struct.unpack( '!L', domain )
+        try:
+            key = ipfix_domain_keys[ d ]
+        except KeyError:
+            return( None )              # From a journal before a restart
+
+        if self._index is None or key not in self._index:
+            self._index = self._template_index()
+
+        now = int( time.time() )
+        map_sets = []
+        if not self._map_sequence:
+            map_sets.append( ( 3, [ self.map_template ] ) )
+        map_sets.append( ( self.map_template_id, [ self._map_struct.pack( d,
+                                                key[0], key[2], key[1] ) ] ) )
+        messages = _ipfix_messages( map_sets, now, self._map_sequence, 0 )
+        self._map_sequence += 1
+
+        sets = {}
+        for ( set_id, template_id, record ) in sorted(
+                                            self._index.get( key, [] ) ):
+            sets.setdefault( set_id, [] ).append( record )
+        if sets:                        # Same sequence as the message
+            messages += _ipfix_messages( sorted( sets.items() ), now,
+                struct.unpack( '!L', item[ 8:12 ] )[0], d )
+
+        return( messages )
+
 def v10_template_set( address, port, obs_id, buff, offset, end ):
 
     """
@@ -670,6 +1477,7 @@ def v10_template_set( address, port, obs_id, buff, offset, end ):
             netflow_v10_template_header_struct, buff, offset, end )
     if not template[ 'new' ]:
         return( False )
+    exporter_stats.template( exporter_stats.row( template[ 'key' ][:3] ) )
 
     template_header = template[ 'header' ]
     template_key = template[ 'key' ]
@@ -678,7 +1486,7 @@ def v10_template_set( address, port, obs_id, buff, offset, end ):
     offset += netflow_v10_template_header_struct.size
 
     log().info( 'INFO: Process a template, key=%s,field cnt=%d.' %
-        ( str(template[ 'key' ]), cnt ) )
+        ( format_key(template[ 'key' ]), cnt ) )
 
     fields = '!'
     field_list = []
@@ -692,70 +1500,126 @@ def v10_template_set( address, port, obs_id, buff, offset, end ):
         id = field[ _v10_field_id ]
         l = field[ _v10_field_len ]
 
-        if field[ _v10_field_id ] > 0x1000:
-            en = struct.unpack_from( '!L', buff, offset=offset + flen )
+        if id & 0x8000:                 # Enterprise bit
+            id &= 0x7fff
+            en = struct.unpack_from( '!L', buff, offset=offset + flen )[0]
             offset += 4
+            fd = ( 'enterprise', l, '%ds' % l )     # Not an IANA field
         else:
             en = -1
+            try:
+                fd = ipfixd_app.ipfix.ipfix_id_to_info[id]
+            except IndexError:
+                fd = ( 'RESERVED', l, '%ds' % l )
 
         offset += flen
 
-        try:
-            fd = ipfixd_app.ipfix.ipfix_id_to_info[id]
-        except IndexError:
-            fd = ( 'RESERVED', l, '%ds' % l )
-
         log().info( 'INFO:     field=%s(%d), offset=%d, len=%d, en=%d' %
             ( fd[0], id, data_offset, l, en ) )
         field_list.append( [ fd[0], l, data_offset ] )
         data_offset += l
 
     template[ 'field_list' ] = field_list
+    template[ 'options' ] = False
+
+    if any( f[ 1 ] == 65535 for f in field_list ):
+        log().error( 'ERROR: template %s has variable length fields, '
+            'records will not be converted.' % format_key( template_key ) )
+        template[ 'the_struct' ] = struct.Struct( '!' )
+        template[ 'cflowd_compat' ] = False
+        template[ 'cflowd6_compat' ] = False
+        return( True )
 
     (the_struct, the_keys) = ipfixd_app.util.make_pack_items( field_list )
-    ( in_offsets, out_offsets, in_data, out_data, check_for_zero ) = (
-        ipfixd_app.util.make_byte_moves(
-            the_struct, the_keys, cflowd_struct, cflowd_keys ))
 
     if ('flowStartMilliseconds' in the_keys and
         'flowEndMilliseconds' in the_keys ):
-        bm = template[ 'byte_mover' ] = (
-            ipfixd_app.byte_mover.ByteMoverMilliSeconds(
-                                in_offsets, out_offsets, check_for_zero )
-            )
-
-        bm.template = template
-        bm.offset_to_flowStartMilliseconds = (
-            in_data[ 'flowStartMilliseconds' ][ 'byte_offset' ])
-        bm.offset_to_flowEndMilliseconds = (
-            in_data[ 'flowEndMilliseconds' ][ 'byte_offset' ])
-        bm.in_len = the_struct.size
-        bm.out_len = cflowd_struct.size
-
-        bm.cflowd_offset_to_flowStartSeconds = (
-            out_data[ 'flowStartSeconds' ][ 'byte_offset' ] )
-        bm.cflowd_offset_to_flowEndSeconds = (
-            out_data[ 'flowEndSeconds' ][ 'byte_offset' ] )
-        bm.cflowd_offset_to_flowId = out_data[ 'flowId' ][ 'byte_offset' ]
-        bm.cflowd_offset_to_exporterIPv4Address = (
-            out_data[ 'exporterIPv4Address' ][ 'byte_offset' ] )
-        cflowd_compat = True
+        cflowd6_compat = True
+        cflowd_compat = 'sourceIPv4Address' in the_keys     # IPv6 won't fit
     else:
-        log().error('ERROR: no compatable template to cflowd conversion found.')
+        cflowd6_compat = False
         cflowd_compat = False
 
+    if cflowd_compat:
+        bm = template[ 'byte_mover' ] = _milliseconds_byte_mover( template,
+            the_struct, cflowd_struct,
+            ipfixd_app.util.make_byte_moves(
+                the_struct, the_keys, cflowd_struct, cflowd_keys ),
+            'exporterIPv4Address' )
+    elif cflowd6_compat:
+        log().info( 'INFO: template %s has no IPv4 addresses, converted to '
+            'extended records only.' % format_key( template_key ) )
+    else:
+        log().error('ERROR: no compatable template to cflowd conversion found.')
+
+    if cflowd6_compat:
+        bm6 = template[ 'byte_mover6' ] = _milliseconds_byte_mover( template,
+            the_struct, cflowd6_struct,
+            make_cflowd6_byte_moves( the_struct, the_keys ),
+            'exporterIPv6Address' )
+        bm6.address6 = bytes( 16 )
+
     template[ 'the_struct' ] = the_struct
     template[ 'cflowd_compat' ] = cflowd_compat
+    template[ 'cflowd6_compat' ] = cflowd6_compat
 
     log().info( 'INFO: Ending template, key=%s, data size=%d, fields=%s, '
-        'cflowd_compat=%s' % ( str(template_key), the_struct.size,
-                                    the_struct.format, cflowd_compat ) )
+        'cflowd_compat=%s, cflowd6_compat=%s' % ( format_key(template_key),
+            the_struct.size, the_struct.format, cflowd_compat,
+            cflowd6_compat ) )
     if cflowd_compat:
         log().info('INFO: ByteMover for %s: %s' %
-                                (str(template['key']), str(bm)))
+                                (format_key(template['key']), str(bm)))
+    if cflowd6_compat:
+        log().info('INFO: Extended ByteMover for %s: %s' %
+                                (format_key(template['key']), str(bm6)))
 
     return( True )
 
+def _milliseconds_byte_mover( template, the_struct, out_struct, moves,
+        exporter_field ):
+
+    """
+    Creates a ByteMover for a template that has flowStartMilliseconds
+    and flowEndMilliseconds.
+
+    Args:
+        template: The template dict.
+        the_struct: The struct for the template's data records.
+        out_struct: The output record struct.
+        moves: The make_byte_moves (or make_cflowd6_byte_moves) results.
+        exporter_field: Output field name for the exporter address.
+
+    Returns:
+        A ByteMoverMilliSeconds object.
+    """
+
+    ( in_offsets, out_offsets, in_data, out_data, check_for_zero ) = moves[:5]
+
+    bm = ipfixd_app.byte_mover.ByteMoverMilliSeconds(
+                                in_offsets, out_offsets, check_for_zero )
+
+    if len( moves ) > 5:
+        bm.fill = moves[ 5 ]
+
+    bm.template = template
+    bm.offset_to_flowStartMilliseconds = (
+        in_data[ 'flowStartMilliseconds' ][ 'byte_offset' ])
+    bm.offset_to_flowEndMilliseconds = (
+        in_data[ 'flowEndMilliseconds' ][ 'byte_offset' ])
+    bm.in_len = the_struct.size
+    bm.out_len = out_struct.size
+
+    bm.cflowd_offset_to_flowStartSeconds = (
+        out_data[ 'flowStartSeconds' ][ 'byte_offset' ] )
+    bm.cflowd_offset_to_flowEndSeconds = (
+        out_data[ 'flowEndSeconds' ][ 'byte_offset' ] )
+    bm.cflowd_offset_to_flowId = out_data[ 'flowId' ][ 'byte_offset' ]
+    bm.cflowd_offset_to_exporterIPv4Address = (
+        out_data[ exporter_field ][ 'byte_offset' ] )
+
+    return( bm )
+
 def v10_options_template_set(address, port, obs_id, buff, offset, end):
 
     """
@@ -781,6 +1645,7 @@ def v10_options_template_set(address, port, obs_id, buff, offset, end):
             netflow_v10_options_template_header_struct, buff, offset, end )
     if not template[ 'new' ]:
         return( False )
+    exporter_stats.template( exporter_stats.row( template[ 'key' ][:3] ) )
 
     template_header = template[ 'header' ]
     template_key = template[ 'key' ]
@@ -790,11 +1655,13 @@ def v10_options_template_set(address, port, obs_id, buff, offset, end):
     flen = netflow_v10_field_struct.size
 
     log().info( 'INFO: Process an options template, '
-        'key=%s,field cnt=%d,scnt=%d.' % ( str(template_key), cnt, scnt ) )
+        'key=%s,field cnt=%d,scnt=%d.' % ( format_key(template_key),
+            cnt, scnt ) )
 
     fields = '!'
 
     field_list = []
+    options_fields = []
 
     data_offset = 0
     for i in range( 0, cnt ):
@@ -805,19 +1672,20 @@ def v10_options_template_set(address, port, obs_id, buff, offset, end):
         id = field[ _v10_field_id ]
         l = field[ _v10_field_len ]
 
-        if field[ _v10_field_id ] > 0x1000:
-            en = struct.unpack_from( '!L', buff, offset=offset + flen )
+        if id & 0x8000:                 # Enterprise bit
+            id &= 0x7fff
+            en = struct.unpack_from( '!L', buff, offset=offset + flen )[0]
             offset += 4
+            fd = ( 'enterprise', l, '%ds' % l )     # Not an IANA field
         else:
             en = -1
+            try:
+                fd = ipfixd_app.ipfix.ipfix_id_to_info[id]
+            except IndexError:
+                fd = ( 'RESERVED', l, '%ds' % l )
 
         offset += flen
 
-        try:
-            fd = ipfixd_app.ipfix.ipfix_id_to_info[id]
-        except IndexError:
-            fd = ( 'RESERVED', l, '%ds' % l )
-
         if i < scnt:
             scope='SCOPE: '
         else:
@@ -826,32 +1694,225 @@ def v10_options_template_set(address, port, obs_id, buff, offset, end):
         log().info( 'INFO:     %sfield=%s(%d), offset=%d, len=%d, en=%d' %
             ( scope, fd[0], id, data_offset, l, en ))
         field_list.append( [ fd[0], l, data_offset ] )
+        options_fields.append( _options_field( fd, id, en, l ) )
         data_offset += l
 
     template[ 'field_list' ] = field_list
 
-    (the_struct, the_keys) = ipfixd_app.util.make_pack_items( field_list )
-
-    the_keys[ 'flowId' ] = len( the_keys )
-    the_keys[ 'exporterIPv4Address' ] = len( the_keys )
+#
+# Options data is decoded field by field, see v10_options_data, so
+# the struct is only used for its size, to count fixed length records.
+# Size 0 means variable length records.
+#
 
-    """
-    try:
-        template_to_cflowd_list = netflow_v10_init(
-            netflow_v10_header_keys, the_keys )
-    except KeyError as e:
-        log().error( 'ERROR: issue with %s' % e )
-    """
+    if any( f[ 1 ] == 65535 for f in field_list ):
+        the_struct = struct.Struct( '!' )
+    else:
+        the_struct = struct.Struct( '!%dx' % data_offset )
 
     template[ 'the_struct' ] = the_struct
+    template[ 'options_fields' ] = options_fields
+    template[ 'scope_cnt' ] = scnt
     template[ 'cflowd_compat' ] = False
+    template[ 'cflowd6_compat' ] = False
+    template[ 'options' ] = True
 
     log().info( 'INFO: Ending options template, key=%s, '
-        'data size=%d, fields=%s, cflowd_compat=%s' %
-        ( str(template_key), the_struct.size, the_struct.format, False ) )
+        'data size=%d, cflowd_compat=%s' %
+        ( format_key(template_key), the_struct.size, False ) )
 
     return( True )
 
+def _options_field( fd, id, en, l ):
+
+    """
+    Returns how to decode an options data field, a list of the
+    name, length and kind.  Unknown and enterprise fields get names
+    of their own so their values don't overwrite each other in the
+    options cache.
+
+    Args:
+        fd: The ipfix_id_to_info entry, or a stand in
+        id: The information element id
+        en: The enterprise number, -1 for IANA
+        l: The length from the template, 65535 if variable
+    """
+
+    if en >= 0:
+        name = '%d.%d' % ( en, id )
+    elif fd[0] == 'RESERVED':
+        name = 'ie%d' % id
+    else:
+        name = fd[0]
+
+    if name.endswith( 'IPv4Address' ) and l == 4:
+        kind = 'ipv4'
+    elif name.endswith( 'IPv6Address' ) and l == 16:
+        kind = 'ipv6'
+    elif ( en < 0 and fd[2] == 's' ) or name.endswith( 'Name' ):
+        kind = 'string'
+    elif l <= 8:
+        kind = 'int'
+    else:
+        kind = 'bytes'
+
+    return( [ name, l, kind ] )
+
+#
+# Options data fields that give the sampling interval, in the order
+# we believe them.
+#
+
+_sampling_fields = ( 'samplingInterval', 'samplerRandomInterval',
+    'samplingPacketInterval', 'samplingPacketSpace', 'samplingSize',
+    'samplingPopulation' )
+
+def _options_sampling_interval( values ):
+
+    """
+    Works out the sampling interval from an options data record.
+
+    Args:
+        values: A dict of the _sampling_fields in the record
+
+    Returns:
+        The interval, one packet in this many was sampled, or None
+        if the record does not say.
+    """
+
+    for f in ( 'samplingInterval', 'samplerRandomInterval' ):
+        if values.get( f ):
+            return( values[ f ] )
+
+    if values.get( 'samplingPacketInterval' ):      # Count based, RFC 5476
+        i = values[ 'samplingPacketInterval' ]
+        return( max( 1, round( ( i + values.get( 'samplingPacketSpace',
+                                                            0 ) ) / i ) ) )
+
+    if values.get( 'samplingSize' ) and values.get( 'samplingPopulation' ):
+        return( max( 1, round( values[ 'samplingPopulation' ] /
+                                                values[ 'samplingSize' ] ) ) )
+
+    return( None )
+
+def _decode_options_record( fields, buff, offset, end ):
+
+    """
+    Decodes one options data record.
+
+    Args:
+        fields: The template's 'options_fields'
+        buff: The raw input buffer
+        offset: Offset to the record
+        end: End of the set
+
+    Returns:
+        A tuple of the list of ( name, value ) and the offset to the
+        next record.
+
+    Raises:
+        ValueError: The record runs past the end of the set
+    """
+
+    values = []
+    for ( name, l, kind ) in fields:
+        if l == 65535:                      # Variable length, RFC 7011 7.
+            if offset >= end:
+                raise ValueError
+            l = buff[ offset ]
+            offset += 1
+            if l == 255:
+                if offset + 2 > end:
+                    raise ValueError
+                l = ( buff[ offset ] << 8 ) | buff[ offset + 1 ]
+                offset += 2
+
+        if offset + l > end:
+            raise ValueError
+        b = bytes( buff[ offset:offset + l ] )
+        offset += l
+
+        if kind == 'int':
+            v = int.from_bytes( b, 'big' )
+        elif kind == 'ipv4':
+            v = socket.inet_ntop( socket.AF_INET, b )
+        elif kind == 'ipv6':
+            v = socket.inet_ntop( socket.AF_INET6, b )
+        elif kind == 'string':
+            v = b.rstrip( b'\0' ).decode( 'utf-8', 'replace' )
+        else:
+            v = b.hex()
+        values.append( ( name, v ) )
+
+    return( values, offset )
+
+def v10_options_data( template, buff, set_s, set_e ):
+
+    """
+    Decodes an options data set into options_cache, one entry per
+    record keyed by its scope fields.  The sampling interval is then
+    worked out again from the exporter's latest options and kept in
+    sampling_intervals, where the decoders can get it cheaply.  An
+    exporter with more than one sampler gets the interval it sent
+    last, since the flow records are not matched to their sampler.
+
+    Args:
+        template: The options template, from v10_get_info
+        buff: The raw input buffer
+        set_s: Starting byte index of the record set
+        set_e: Slice style ending byte of the record set
+
+    Returns:
+        The number of records, for the sequence number check, or -1
+        if the set could not be decoded.
+
+    Globals:
+        options_cache
+        sampling_intervals
+    """
+
+    fields = template[ 'options_fields' ]
+    scope_cnt = template[ 'scope_cnt' ]
+    template_id = template[ 'id' ]
+    exporter = template[ 'key' ][:3]
+
+#
+# A set may end with padding, which is shorter than any record.
+#
+
+    min_len = sum( 1 if l == 65535 else l for ( name, l, kind ) in fields )
+    if not min_len:
+        return( 0 )
+
+    offset = set_s
+    n = 0
+    sampling = False
+    while set_e - offset >= min_len:
+        try:
+            ( values, offset ) = _decode_options_record( fields, buff,
+                                                            offset, set_e )
+        except ValueError:
+            log().error( 'ERROR: %s options data record %d is truncated',
+                                                format_key( exporter ), n )
+            exporter_stats.error( exporter_stats.row( exporter ) )
+            return( -1 )
+
+        data = dict( values[ scope_cnt: ] )
+        options_cache.update( exporter, template_id,
+                                        tuple( values[ :scope_cnt ] ), data )
+        sampling = sampling or any( f in data for f in _sampling_fields )
+        n += 1
+
+    if sampling:
+        interval = _options_sampling_interval(
+                                        options_cache.latest( exporter ) )
+        if interval and sampling_intervals.get( exporter ) != interval:
+            log().info( 'INFO: %s sampling interval is %d',
+                                            format_key( exporter ), interval )
+            sampling_intervals[ exporter ] = interval
+
+    return( n )
+
 if __name__ == '__main__':
     ipfixd_app.ipfixd_log.set_logging( None )
     log().info( 'test' )
@@ -0,0 +1,702 @@
+"""
+Re-exports the flows as IPFIX.  The packet threads for a temp
+directory put their extended (cflowd6) records on an Exporter's
+queue, as if it were a writer.  Whether it came in as NetFlow v5 or
+IPFIX, the extended record is the same, so the Exporter sends one
+template, export_field_list, and every flow as a data record of it.
+NetFlow v9 is not decoded by the packet threads, so it is not
+re-exported.  The records of a batch are put in network byte order
+once, in C (see ipfixd_app.ipfix_encoder), and cut into messages of
+as many records as fit, so the headers are a small part of each
+message.
+
+The messages go to any number of sinks:
+
+    UDPSink     A collector over UDP.  Messages fit in --ipfix-export-mtu
+                and go out with sendmmsg when the mmsg module is built.
+                The template is sent again every
+                --ipfix-export-template-refresh seconds, since UDP
+                may lose it.
+    TCPSink     A collector over TCP.  The template is sent when the
+                connection is made.  The socket never blocks the
+                Exporter: messages wait in a buffer of at most
+                max_pending bytes, and the records of messages that
+                don't fit, or are still waiting when the connection
+                fails, are counted as dropped.  A failed connection
+                is tried again every retry seconds.
+    FileSink    An 'export' format Writer.  The Writer starts every
+                file with the template, so each file is a complete
+                IPFIX file that any IPFIX reader can take.
+
+Each sink has its own sequence numbers.  IPv4 flows have IPv4 mapped
+addresses, as in the extended record, and ipVersion 4.
+
+To get this thread to stop, call stop() and write a 0 length packet
+to the queue.  The sinks are closed, and a FileSink passes the 0
+length packet on to its Writer.
+"""
+
+import os
+import sys
+import time
+import errno
+import queue
+import select
+import socket
+import collections
+import struct
+import traceback
+from ipfixd_app.ipfixd_log import log
+import ipfixd_app.ipfixd_queue
+import ipfixd_app.ipfixd_thread
+import ipfixd_app.metrics
+import ipfixd_app.util
+import ipfixd_app.cflowd
+import ipfixd_app.ipfix
+import ipfixd_app.ipfix_encoder
+from ipfixd_app.trace import Trace
+
+try:
+    import pyximport; pyximport.install()
+    import ipfixd_app.mmsg
+    send_mmsg = ipfixd_app.mmsg.send_mmsg
+    max_batch = ipfixd_app.mmsg.max_batch
+except ImportError:
+    send_mmsg = None
+    max_batch = 1024
+
+#
+# The template: the extended record less its padding.  flowId is
+# sent in 4 bytes, reduced size encoding.  The flow times are sent in
+# milliseconds, as ipfixd and most collectors want them, though the
+# extended record only has seconds.
+#
+
+_milliseconds = { 'flowStartSeconds': 'flowStartMilliseconds',
+                    'flowEndSeconds': 'flowEndMilliseconds' }
+
+export_field_list = [ [ _milliseconds[ f[0] ], 8 ] if f[0] in _milliseconds
+        else f for f in ipfixd_app.cflowd.cflowd6_field_list
+                                            if f[0] != 'paddingOctets' ]
+
+template_id = 256
+
+_header_struct = struct.Struct( '!HHLLL' )
+_set_header_struct = struct.Struct( '!HH' )
+
+def _template_set():
+
+    """
+    Returns the template set for export_field_list.
+    """
+
+    fields = b''.join( struct.pack( '!HH',
+                            ipfixd_app.ipfix.ipfix_name_to_info[ name ].id, l )
+                                        for ( name, l ) in export_field_list )
+    record = struct.pack( '!HH', template_id, len( export_field_list ) )
+
+    return( _set_header_struct.pack( 2, 4 + len( record ) + len( fields ) ) +
+                                                            record + fields )
+
+template_set = _template_set()
+
+def template_message( export_time, sequence, domain ):
+
+    """
+    Returns a message with just the template.
+
+    Args:
+        export_time: The export time for the header
+        sequence: The sink's sequence number
+        domain: The observation domain ID
+    """
+
+    return( _header_struct.pack( 10, 16 + len( template_set ),
+        int( export_time ), sequence & 0xffffffff, domain ) + template_set )
+
+def _encoder():
+
+    """
+    Returns the RecordEncoder from the extended record to the template.
+    """
+
+    in_fields = ipfixd_app.util.field_offsets(
+                                    ipfixd_app.cflowd.cflowd6_field_list )
+    out_fields = ipfixd_app.util.field_offsets( export_field_list )
+
+    return( ipfixd_app.ipfix_encoder.RecordEncoder( in_fields[ 'record_len' ],
+        out_fields[ 'record_len' ],
+        [ ( in_fields[ name ][0], out_fields[ name ][0], l )
+                                    for ( name, l ) in export_field_list
+                                    if name in in_fields ],
+        version_offset=out_fields[ 'ipVersion' ][0],
+        prefix_offsets=( out_fields[ 'sourceIPv6PrefixLength' ][0],
+                    out_fields[ 'destinationIPv6PrefixLength' ][0] ),
+        milliseconds=[ ( in_fields[ s ][0], out_fields[ ms ][0] )
+                                for ( s, ms ) in _milliseconds.items() ] ) )
+
+class Sink( object ):
+
+    """
+    Somewhere to send messages.  The subclasses say how, each with a
+    send( records, record_len, now ) method that takes data records
+    in network byte order, the length of one, and the time for the
+    export time.  They use frame() to cut them into messages.
+    """
+
+    def __init__( self, name, max_message, domain ):
+
+        """
+        Args:
+            name: For the logs and metrics
+            max_message: The largest message, in bytes
+            domain: The observation domain ID
+        """
+
+        record_len = ipfixd_app.util.field_offsets(
+                                        export_field_list )[ 'record_len' ]
+
+        self.name = name
+        self.domain = domain
+        self.per_message = ( max_message -
+            ipfixd_app.ipfix_encoder.message_header_len -
+            ipfixd_app.ipfix_encoder.set_header_len ) // record_len
+        if self.per_message < 1:
+            raise ValueError( '%s: messages of %d bytes can not hold a '
+                                        'record' % ( name, max_message ) )
+        self.sequence = 0
+
+        self.metric_messages = 0
+        self.metric_records = 0
+        self.metric_bytes = 0
+        self.metric_errors = 0
+        self.metric_dropped = 0
+
+    def frame( self, records, record_len, now ):
+
+        """
+        Returns the records as messages, see
+        ipfixd_app.ipfix_encoder.frame.  The sequence number counts
+        them whether they get sent or not, so a collector sees the
+        ones we drop as lost.
+        """
+
+        ( messages, ends ) = ipfixd_app.ipfix_encoder.frame( records,
+            record_len, self.per_message, template_id, int( now ),
+            self.sequence & 0xffffffff, self.domain )
+        self.sequence += len( records ) // record_len
+
+        return( messages, ends )
+
+    def split( self, messages, ends ):
+
+        """
+        Returns a list of memoryviews, one per message, from what
+        frame returned.
+        """
+
+        m = memoryview( messages )
+
+        return( [ m[ start:end ] for ( start, end ) in
+                                        zip( [ 0 ] + ends[ :-1 ], ends ) ] )
+
+    def records( self, message, record_len ):
+
+        """
+        Returns the data records in a message from frame.
+        """
+
+        overhead = ( ipfixd_app.ipfix_encoder.message_header_len +
+                                    ipfixd_app.ipfix_encoder.set_header_len )
+
+        return( ( len( message ) - overhead ) // record_len )
+
+    def sent( self, messages, records, nbytes ):
+
+        """
+        Counts messages as sent.
+        """
+
+        self.metric_messages += messages
+        self.metric_records += records
+        self.metric_bytes += nbytes
+
+    def close( self ):
+
+        """
+        Called when the Exporter stops.
+        """
+
+        pass
+
+class UDPSink( Sink ):
+
+    """
+    Sends to a collector over UDP.
+    """
+
+    def __init__( self, host, port, domain, mtu=1400, template_refresh=60 ):
+
+        """
+        Args:
+            host: The collector's address or name
+            port: Its port
+            domain: The observation domain ID
+            mtu: The largest message, in bytes
+            template_refresh: How many seconds between templates
+        """
+
+        Sink.__init__( self, 'udp:' +
+                ipfixd_app.util.format_host_port( host, port ), mtu, domain )
+
+        ( family, sock_type, proto, canon, address ) = socket.getaddrinfo(
+                host, port, type=socket.SOCK_DGRAM )[0]
+        self._s = socket.socket( family, socket.SOCK_DGRAM )
+        self._s.connect( address )
+        self._template_refresh = template_refresh
+        self._template_time = 0
+
+    def send( self, records, record_len, now ):
+
+        if now - self._template_time >= self._template_refresh:
+            try:
+                self._s.send( template_message( now, self.sequence,
+                                                                self.domain ) )
+                self._template_time = now
+            except OSError as e:
+                self.metric_errors += 1
+                log().error( 'ERROR: %s: sending the template: %s' %
+                                                            ( self.name, e ) )
+
+        ( messages, ends ) = self.frame( records, record_len, now )
+        buffs = self.split( messages, ends )
+
+# An error costs the message that caused it.
+
+        i = 0
+        while i < len( buffs ):
+            try:
+                if send_mmsg:
+                    sent = send_mmsg( self._s.fileno(),
+                                                buffs[ i:i + max_batch ] )
+                else:
+                    self._s.send( buffs[i] )
+                    sent = 1
+            except OSError as e:
+                self.metric_errors += 1
+                self.metric_dropped += self.records( buffs[i], record_len )
+                log().error( 'ERROR: %s: %s' % ( self.name, e ) )
+                i += 1
+                continue
+            done = buffs[ i:i + sent ]
+            self.sent( len( done ), sum( self.records( b, record_len )
+                        for b in done ), sum( len( b ) for b in done ) )
+            i += max( sent, 1 )
+
+    def close( self ):
+        self._s.close()
+
+class TCPSink( Sink ):
+
+    """
+    Sends to a collector over TCP, without blocking.
+    """
+
+    def __init__( self, host, port, domain, retry=10, timeout=30,
+                                                    max_pending=4 * 2**20 ):
+
+        """
+        Args:
+            host: The collector's address or name
+            port: Its port
+            domain: The observation domain ID
+            retry: Seconds between tries to connect
+            timeout: Seconds to wait for the collector to connect, and
+                to take what is waiting when the Exporter stops
+            max_pending: The most message bytes waiting to be sent
+        """
+
+        Sink.__init__( self, 'tcp:' +
+                ipfixd_app.util.format_host_port( host, port ), 65535, domain )
+
+        self._address = ( host, port )
+        self._retry = retry
+        self._timeout = timeout
+        self._max_pending = max_pending
+        self._retry_time = 0
+        self._s = None
+        self._connected = False
+        self._connect_time = 0
+        self._pending = collections.deque()     # [ message, records ]
+        self._pending_bytes = 0
+        self._offset = 0                # Sent of the first message
+
+    def _connect( self, now ):
+
+        """
+        Starts connecting, if it is time to try, with the template
+        first in line to send.
+        """
+
+        if now < self._retry_time:
+            return
+        self._retry_time = now + self._retry
+
+        try:
+            ( family, sock_type, proto, canon, address ) = socket.getaddrinfo(
+                    self._address[0], self._address[1],
+                    type=socket.SOCK_STREAM )[0]
+            self._s = socket.socket( family, socket.SOCK_STREAM )
+            self._s.setblocking( False )
+            err = self._s.connect_ex( address )
+            if err not in ( 0, errno.EINPROGRESS ):
+                raise OSError( err, os.strerror( err ) )
+        except OSError as e:
+            self._fail( 'connecting: %s' % e )
+            return
+
+        self._connected = False
+        self._connect_time = now
+        t = template_message( now, self.sequence, self.domain )
+        self._pending.appendleft( [ memoryview( t ), 0 ] )
+        self._pending_bytes += len( t )
+
+    def _fail( self, why ):
+
+        """
+        Closes the connection, counting what was waiting as dropped.
+        """
+
+        self.metric_errors += 1
+        log().error( 'ERROR: %s: %s, will reconnect' % ( self.name, why ) )
+        self.metric_dropped += sum( r for ( m, r ) in self._pending )
+        self._pending.clear()
+        self._pending_bytes = 0
+        self._offset = 0
+        if self._s:
+            self._s.close()
+            self._s = None
+
+    def _flush( self, now ):
+
+        """
+        Sends what is waiting, as far as the socket will take it
+        without blocking.
+        """
+
+        if not self._connected:
+            ( r, w, x ) = select.select( [], [ self._s ], [], 0 )
+            if not w:
+                if now - self._connect_time > self._timeout:
+                    self._fail( 'connecting: timed out' )
+                return
+            err = self._s.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+            if err:
+                self._fail( 'connecting: %s' % os.strerror( err ) )
+                return
+            self._connected = True
+            log().info( 'INFO: %s: connected' % self.name )
+
+        while self._pending:
+            ( m, records ) = self._pending[0]
+            try:
+                self._offset += self._s.send( m[ self._offset: ] )
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self._fail( str( e ) )
+                return
+            if self._offset < len( m ):
+                return
+            self._pending.popleft()
+            self._pending_bytes -= len( m )
+            self._offset = 0
+            if records:
+                self.sent( 1, records, len( m ) )
+
+    def send( self, records, record_len, now ):
+
+        if not self._s:
+            self._connect( now )
+        if not self._s:
+            self.metric_dropped += len( records ) // record_len
+            return
+
+        ( messages, ends ) = self.frame( records, record_len, now )
+        for m in self.split( messages, ends ):
+            if self._pending_bytes + len( m ) > self._max_pending:
+                self.metric_dropped += self.records( m, record_len )
+                continue
+            self._pending.append( [ m, self.records( m, record_len ) ] )
+            self._pending_bytes += len( m )
+
+        self._flush( now )
+
+    def close( self ):
+
+        """
+        Gives the collector timeout seconds to take what is waiting,
+        then closes the connection.
+        """
+
+        deadline = time.time() + self._timeout
+        while self._s and self._pending and time.time() < deadline:
+            select.select( [], [ self._s ], [], 0.1 )
+            self._flush( time.time() )
+        if self._s:
+            self.metric_dropped += sum( r for ( m, r ) in self._pending )
+            self._pending.clear()
+            self._s.close()
+            self._s = None
+
+class FileSink( Sink ):
+
+    """
+    Queues messages on an 'export' format Writer.
+    """
+
+    def __init__( self, writer, domain ):
+
+        """
+        Args:
+            writer: The Writer
+            domain: The observation domain ID
+        """
+
+        Sink.__init__( self, 'file:' + writer.name, 65535, domain )
+
+        self._writer = writer
+        writer.set_preamble( lambda: template_message( time.time(),
+                                                self.sequence, self.domain ) )
+
+    def send( self, records, record_len, now ):
+
+        ( messages, ends ) = self.frame( records, record_len, now )
+        self._writer.queue().put( [ messages ], nbytes=len( messages ) )
+        self.sent( len( ends ), len( records ) // record_len,
+                                                            len( messages ) )
+
+    def close( self ):
+        self._writer.queue().put( [ bytearray(0) ] )
+
+class Exporter( ipfixd_app.ipfixd_thread.IPFixdThread ):
+
+    """
+    Encodes the extended records put on its queue as IPFIX and sends
+    them to its sinks.
+    """
+
+    def __init__( self, sinks, temp_directory, profile=False,
+            max_queue_size=100000, max_queue_bytes=0 ):
+
+        """
+        Args:
+            sinks: The Sinks to send to
+            temp_directory: The temp directory of the ports feeding
+                us, for the metrics
+            profile: If True, profile
+            max_queue_size: The maximum length of the queue
+            max_queue_bytes: The most bytes we allow on the queue, 0 for
+                no limit.  See ipfixd_app.ipfixd_queue.ByteQueue.
+        """
+
+        self._sinks = sinks
+        self._encoder = _encoder()
+
+        name = 'Exporter for %s to %s' % ( temp_directory,
+                                    ','.join( s.name for s in sinks ) )
+
+        ipfixd_app.ipfixd_thread.IPFixdThread.__init__(
+                self, profile=profile, name=name, target=self.export_loop )
+        self.daemon = True
+
+        self._queue = ipfixd_app.ipfixd_queue.ByteQueue(
+                        maxsize = max_queue_size, maxbytes = max_queue_bytes )
+        self._max_qsize = 0
+
+        self.metric_items = 0
+        self.metric_records = 0
+        self._register_metrics( temp_directory )
+
+        log().info( 'INFO: Created thread %s' % name )
+
+    def _register_metrics( self, temp_directory ):
+
+        """
+        Adds our counters, and each sink's, to the metrics registry.
+        """
+
+        labels = { 'directory': os.path.join( temp_directory, '' ) }
+        Counter = ipfixd_app.metrics.Counter
+
+        for m in (
+            Counter( 'ipfixd_ipfix_export_flow_records_total',
+                'Extended flow records encoded.', labels,
+                lambda: self.metric_records ),
+            ipfixd_app.metrics.Gauge( 'ipfixd_queue_items',
+                'Items waiting on the queue.',
+                dict( labels, thread='exporter' ),
+                lambda: self._queue.qsize() ),
+            ipfixd_app.metrics.Gauge( 'ipfixd_queue_bytes',
+                'Bytes waiting on the queue.',
+                dict( labels, thread='exporter' ),
+                lambda: self._queue.bytes ) ):
+            ipfixd_app.metrics.registry.register( m )
+
+        for s in self._sinks:
+            s_labels = dict( labels, sink=s.name )
+            for m in (
+                Counter( 'ipfixd_ipfix_export_messages_total',
+                    'IPFIX messages sent.', s_labels,
+                    lambda s=s: s.metric_messages ),
+                Counter( 'ipfixd_ipfix_export_records_total',
+                    'Data records sent.', s_labels,
+                    lambda s=s: s.metric_records ),
+                Counter( 'ipfixd_ipfix_export_bytes_total',
+                    'Message bytes sent.', s_labels,
+                    lambda s=s: s.metric_bytes ),
+                Counter( 'ipfixd_ipfix_export_errors_total',
+                    'Errors sending or connecting.', s_labels,
+                    lambda s=s: s.metric_errors ),
+                Counter( 'ipfixd_ipfix_export_dropped_total',
+                    'Data records not sent because there was no '
+                    'connection.', s_labels,
+                    lambda s=s: s.metric_dropped ) ):
+                ipfixd_app.metrics.registry.register( m )
+
+    def _export( self, buffs ):
+
+        """
+        Encodes a list of extended record buffers and sends them to
+        every sink.
+        """
+
+        encoder = self._encoder
+        cnt = sum( len( b ) // encoder.in_len for b in buffs )
+        if not cnt:
+            return
+
+        records = bytearray( cnt * encoder.out_len )
+        offset = 0
+        for b in buffs:
+            offset = encoder.encode( b, records, offset )
+        self.metric_records += cnt
+
+        now = time.time()
+        for s in self._sinks:
+            s.send( records, encoder.out_len, now )
+
+    def export_loop( self ):
+
+        """
+        Runs the exporter loop.  This just traps and prints
+        exceptions to the log, see _export_loop.
+        """
+
+        try:
+            self._export_loop()
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            f = traceback.format_exception( exc_type, exc_value, exc_traceback )
+            del exc_traceback
+            [ log().error( x ) for x in f ]
+            log().error( 'Thread aborted: %s' % self.name )
+            raise exc_type
+
+    def _export_loop( self ):
+
+        """
+        Exports what is on the queue, each get at once, so the
+        messages are as full as the queue allows.  Traces are
+        dropped, like the aggregator's.
+        """
+
+        if self._profile:
+            self._profile.enable()
+
+        while True:
+            items = self._queue.get( block=True )
+            self._max_qsize = max( self._max_qsize, len( items ) )
+
+            buffs = []
+            stopping = False
+            for item in items:
+                if item.__class__ is Trace:
+                    continue
+                elif len( item ) == 0:
+                    if self.should_stop():
+                        stopping = True
+                        break
+                    continue
+                buffs.append( item )
+            self.metric_items += len( buffs )
+
+            self._export( buffs )
+
+            if stopping:
+                log().info( 'INFO: Thread %s stopping by request',
+                                                                self.name )
+                for s in self._sinks:
+                    s.close()
+                if self._profile:
+                    self._profile.disable()
+                    self._profile.dump_stats( "stats/" +
+                                            self.name.replace( '/', '-' ) )
+                return
+
+    def qsize( self ):
+
+        """
+        Returns a tuple: the current qsize and the max since the last
+        call.
+        """
+
+        m = self._max_qsize
+        self._max_qsize = 0
+
+        return( self._queue.qsize(), m )
+
+    def print_metrics( self ):
+
+        """
+        Logs the export counts since the last call.
+        """
+
+        d = ipfixd_app.metrics.deltas( self, [ 'metric_items',
+                                                        'metric_records' ] )
+        log().info( 'INFO: %s: items: %d, flow records: %d' %
+            ( self.name, d[ 'metric_items' ], d[ 'metric_records' ] ) )
+
+        for s in self._sinks:
+            d = ipfixd_app.metrics.deltas( s, [ 'metric_messages',
+                'metric_records', 'metric_errors', 'metric_dropped' ] )
+            log().info( 'INFO: %s: %s: messages: %d, records: %d, '
+                'errors: %d, dropped: %d' %
+                ( self.name, s.name,
+                    d[ 'metric_messages' ],
+                    d[ 'metric_records' ],
+                    d[ 'metric_errors' ],
+                    d[ 'metric_dropped' ] ) )
+
+    def qempty( self ):
+
+        """
+        Empties the queue immediately.  This is usually done as part of
+        a fast shutdown.
+        """
+
+        while True:
+            try:
+                self._queue.get( block=False, timeout=0 )
+            except queue.Empty:
+                break
+
+    def queue( self ):
+
+        """
+        Returns the queue the packet threads put extended records on.
+        """
+
+        return( self._queue )
+
+# End.
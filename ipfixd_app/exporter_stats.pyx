@@ -0,0 +1,287 @@
+"""
+This is cython module.  It needs to be converted to C and compiled before use.
+
+Per exporter statistics.  An exporter is the tuple of the packed 16
+byte address, our port and the IPFIX observation domain id (0 for
+NetFlow v5, which has none).  Each exporter gets a row in a C array
+of counters.  The decoders look up the row once and then bump the
+counters with cpdef calls that do no Python object work, so the
+cost per packet is a dict lookup and a few adds.
+
+Sequence numbers are checked here too, see sequence.  NetFlow v5
+and IPFIX both number flow records, not packets, in 32 bits, so the
+next packet should carry this packet's number plus its record count,
+modulo 2**32.  A number a little behind that is a late or duplicate
+packet.  One far away, either direction, means the exporter
+restarted and we start over from it rather than count billions of
+lost flows.  The flows of a late packet were counted as lost when the
+gap was seen; they are counted again in late_flows rather than taken
+off lost_flows, so every column only goes up.
+
+The table holds at most max_exporters rows.  Exporters are UDP
+source addresses, which anyone can spoof, so when the table is full
+a new exporter takes the row of the one heard from longest ago.  The
+on_evict function, if set, is called with the old key, so callers
+that keep row numbers can forget them.  A packet thread that looked
+up the row just before it was taken may count one packet against
+the new exporter.
+
+The packet threads all update the same table.  The methods run
+with the GIL held and never release it, so an update is never seen
+half done and no lock is needed.  Readers (the metrics endpoint)
+take a snapshot with rows().
+"""
+
+import cython
+
+from libc.stdint cimport uint32_t, int64_t, uint64_t
+from libc.string cimport memset
+from libc.time cimport time
+from cpython.mem cimport PyMem_Realloc, PyMem_Free
+
+cdef struct exporter_row:
+    uint64_t packets            # Packets decoded
+    uint64_t flows              # Flow records decoded
+    uint64_t bytes              # Packet bytes
+    uint64_t gaps               # Sequence gaps seen
+    uint64_t lost_flows         # Flows missing according to the sequence
+    uint64_t templates          # Templates and option templates received
+    uint64_t decode_errors      # Packets or sets we could not decode
+    uint64_t restarts           # Sequence numbers started over
+    uint64_t reordered          # Late or duplicate packets
+    uint64_t late_flows         # Flows in them, already counted lost
+    uint64_t first_seen         # Unix seconds
+    uint64_t last_seen
+    uint32_t expected           # Next sequence number
+    uint32_t expected_known     # False until we have seen a packet
+
+columns = ( 'packets', 'flows', 'bytes', 'gaps', 'lost_flows', 'templates',
+    'decode_errors', 'restarts', 'reordered', 'late_flows', 'first_seen',
+    'last_seen' )
+
+#
+# A sequence number up to reorder_window flows behind the expected one
+# is a late packet.  One more than restart_gap flows ahead of it is a
+# restart, not loss.  At 100K flows/sec, 2**24 flows is almost three
+# minutes of data, longer than any burst of loss we have seen that
+# wasn't an exporter reboot.
+#
+
+reorder_window = 1 << 16
+restart_gap = 1 << 24
+
+cdef class ExporterStats:
+
+    """
+    The table.  Set max_exporters to change the size, and on_evict
+    to hear about rows that are taken over.
+    """
+
+    cdef exporter_row *_rows
+    cdef unsigned int _num_rows
+    cdef unsigned int _max_rows
+    cdef public unsigned int max_exporters
+    cdef public object on_evict
+    cdef public uint64_t evictions
+    cdef dict _index
+    cdef list _keys
+    cdef uint32_t _reorder_window
+    cdef uint32_t _restart_gap
+
+    def __cinit__( self ):
+        self._rows = NULL
+        self._num_rows = 0
+        self._max_rows = 0
+        self.max_exporters = 10000
+        self.on_evict = None
+        self.evictions = 0
+        self._index = {}
+        self._keys = []
+        self._reorder_window = reorder_window
+        self._restart_gap = restart_gap
+
+    def __dealloc__( self ):
+        PyMem_Free( self._rows )
+
+    def __len__( self ):
+        return( self._num_rows )
+
+    cpdef int row( self, key ) except -1:
+
+        """
+        Returns the row number for an exporter, adding a row the first
+        time we see it.  If the table is full, the row is the one that
+        was idle longest, see the module notes.
+
+        Args:
+            key: ( packed address, port, observation domain id )
+        """
+
+        cdef unsigned int n
+        cdef exporter_row *rows
+
+        try:
+            return( self._index[ key ] )
+        except KeyError:
+            pass
+
+        if self.max_exporters and self._num_rows >= self.max_exporters:
+            n = self._idlest()
+            old_key = self._keys[ n ]
+            del self._index[ old_key ]
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict( old_key )
+            self._new_row( n, key )
+            self._keys[ n ] = key
+            return( n )
+
+        if self._num_rows == self._max_rows:
+            n = self._max_rows * 2 if self._max_rows else 64
+            rows = <exporter_row *>PyMem_Realloc( self._rows,
+                                                n * sizeof( exporter_row ) )
+            if rows == NULL:
+                raise MemoryError()
+            self._rows = rows
+            self._max_rows = n
+
+        n = self._num_rows
+        self._new_row( n, key )
+        self._keys.append( key )
+        self._num_rows += 1
+
+        return( n )
+
+    cdef void _new_row( self, unsigned int n, key ):
+
+        """
+        Clears a row for an exporter.  The caller sets _keys.
+        """
+
+        memset( &self._rows[ n ], 0, sizeof( exporter_row ) )
+        self._rows[ n ].first_seen = time( NULL )
+        self._rows[ n ].last_seen = self._rows[ n ].first_seen
+        self._index[ key ] = n
+
+    cdef unsigned int _idlest( self ):
+
+        """
+        Returns the row last seen longest ago.
+        """
+
+        cdef unsigned int i
+        cdef unsigned int n = 0
+
+        for i in range( 1, self._num_rows ):
+            if self._rows[ i ].last_seen < self._rows[ n ].last_seen:
+                n = i
+
+        return( n )
+
+    cpdef void packet( self, unsigned int row, uint64_t flows,
+                                                        uint64_t nbytes ):
+
+        """
+        Counts a decoded packet.
+        """
+
+        cdef exporter_row *r = &self._rows[ row ]
+        r.packets += 1
+        r.flows += flows
+        r.bytes += nbytes
+        r.last_seen = time( NULL )
+
+    cpdef int64_t sequence( self, unsigned int row, uint32_t seq,
+                                                            int64_t cnt ):
+
+        """
+        Checks a packet's sequence number against the expected one
+        and counts any gap, then sets the next expected number.
+
+        Args:
+            row: The exporter's row
+            seq: The sequence number from the packet header
+            cnt: The flow records in the packet, or -1 if we could
+                not count them all.  The next packet is then not
+                checked.
+
+        Returns:
+            The flows lost, 0 if none, or -1 if the exporter restarted.
+        """
+
+        cdef exporter_row *r = &self._rows[ row ]
+        cdef uint32_t ahead
+        cdef uint32_t behind
+        cdef int64_t lost = 0
+
+        if r.expected_known:
+            ahead = seq - r.expected            # Modulo 2**32
+            behind = r.expected - seq
+            if ahead == 0:
+                pass
+            elif ahead <= self._restart_gap:
+                r.gaps += 1
+                r.lost_flows += ahead
+                lost = ahead
+            elif behind <= self._reorder_window:
+                r.reordered += 1                # Late, so not lost after all
+                if cnt > 0:
+                    r.late_flows += cnt
+                return( 0 )                     # Don't move expected back
+            else:
+                r.restarts += 1
+                lost = -1
+
+        if cnt < 0:
+            r.expected_known = 0
+        else:
+            r.expected = seq + <uint32_t>cnt
+            r.expected_known = 1
+
+        return( lost )
+
+    cpdef void template( self, unsigned int row ):
+
+        """
+        Counts a template or option template.
+        """
+
+        self._rows[ row ].templates += 1
+
+    cpdef void error( self, unsigned int row ):
+
+        """
+        Counts a decode error.
+        """
+
+        self._rows[ row ].decode_errors += 1
+        self._rows[ row ].last_seen = time( NULL )
+
+    def get( self, unsigned int row ):
+
+        """
+        Returns one row as a dict of the columns.
+        """
+
+        if row >= self._num_rows:
+            raise IndexError( row )
+
+        cdef exporter_row r = self._rows[ row ]
+        return( { 'packets': r.packets, 'flows': r.flows, 'bytes': r.bytes,
+            'gaps': r.gaps, 'lost_flows': r.lost_flows,
+            'templates': r.templates, 'decode_errors': r.decode_errors,
+            'restarts': r.restarts, 'reordered': r.reordered,
+            'late_flows': r.late_flows,
+            'first_seen': r.first_seen, 'last_seen': r.last_seen } )
+
+    def rows( self ):
+
+        """
+        Returns a snapshot of the table, a list of ( key, row dict ).
+        """
+
+        cdef unsigned int i
+        return( [ ( self._keys[ i ], self.get( i ) )
+                                        for i in range( self._num_rows ) ] )
+
+# End.
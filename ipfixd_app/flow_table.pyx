@@ -0,0 +1,346 @@
+"""
+This is cython module.  It needs to be converted to C and compiled before use.
+
+The hash table the aggregator rolls flows up in.  Each extended
+(cflowd6) record is reduced to a key of the source and destination
+prefixes, protocol and destination port, and its flow, packet and
+octet counts are added to the key's entry.  At the end of an
+interval the entries are written out as aggregate records, see
+ipfixd_app.cflowd.aggregate_field_list, and the table is cleared.
+
+The table is one C array of entries with open addressing and linear
+probing, sized a power of two.  A key is 40 bytes, the two 16 byte
+prefixes (IPv4 mapped for IPv4) and a few small fields, so an entry
+with its counters is 72 bytes and a million of them is about 70 MB.
+Nothing is ever removed before the table is cleared, so there are no
+tombstones.  Past three quarters full, probe chains get long, so add
+stops there and the caller writes the table out early.  See
+ipfixd_app.aggregator.
+
+The aggregator thread owns the table.  The counters are read by the
+metrics endpoint without a lock, like the other metric_* counters.
+"""
+
+import cython
+
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t
+from libc.string cimport memcpy, memset, memcmp
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+cdef struct flow_key:
+    uint8_t src[ 16 ]
+    uint8_t dst[ 16 ]
+    uint16_t port
+    uint8_t proto
+    uint8_t src_len
+    uint8_t dst_len
+    uint8_t version
+    uint8_t pad[ 2 ]
+
+cdef struct flow_entry:
+    flow_key key
+    uint32_t hash                   # 0 for an empty entry
+    uint32_t pad
+    uint64_t flows
+    uint64_t packets
+    uint64_t octets
+
+#
+# Must match aggregate_field_list in ipfixd_app.cflowd.
+#
+
+cdef packed struct aggregate_record:
+    uint32_t start
+    uint32_t end
+    uint8_t src[ 16 ]
+    uint8_t dst[ 16 ]
+    uint8_t src_len
+    uint8_t dst_len
+    uint8_t proto
+    uint8_t version
+    uint16_t port
+    uint16_t pad
+    uint64_t flows
+    uint64_t packets
+    uint64_t octets
+
+record_len = sizeof( aggregate_record )
+
+cdef inline uint64_t _mix( uint64_t h ) noexcept nogil:
+
+    """
+    The murmur3 finalizer.  Spreads every input bit over the output.
+    """
+
+    h ^= h >> 33
+    h *= 0xff51afd7ed558ccdULL
+    h ^= h >> 33
+    h *= 0xc4ceb9fe1a85ec53ULL
+    h ^= h >> 33
+    return( h )
+
+cdef inline uint64_t _hash_key( flow_key * key ) noexcept nogil:
+
+    cdef uint64_t w[ 5 ]
+    cdef uint64_t h = 0
+    cdef unsigned int i
+
+    memcpy( w, key, sizeof( flow_key ) )
+    for i in range( 5 ):
+        h = _mix( h ^ w[ i ] )
+    return( h )
+
+cdef inline void _mask( uint8_t * a, unsigned int bits ) noexcept nogil:
+
+    """
+    Zeroes the bits of a 16 byte address past the first bits.
+    """
+
+    cdef unsigned int i = bits >> 3
+
+    if i < 16:
+        a[ i ] &= <uint8_t>( 0xff00 >> ( bits & 7 ) )
+        i += 1
+        while i < 16:
+            a[ i ] = 0
+            i += 1
+
+cdef class FlowTable:
+
+    """
+    Flow aggregates keyed by prefixes, protocol and port.
+    """
+
+    cdef flow_entry * _entries
+    cdef unsigned int _capacity             # A power of two
+    cdef unsigned int _max_entries          # Three quarters of that
+    cdef unsigned int _num_entries
+
+    cdef unsigned int _record_len           # Input record offsets
+    cdef unsigned int _src
+    cdef unsigned int _dst
+    cdef unsigned int _src_len
+    cdef unsigned int _dst_len
+    cdef unsigned int _port
+    cdef unsigned int _proto
+    cdef unsigned int _version
+    cdef unsigned int _packets
+    cdef unsigned int _octets
+
+    cdef uint8_t _v4_prefix
+    cdef uint8_t _v6_prefix
+
+    cdef readonly uint64_t metric_records   # Records added
+    cdef readonly uint64_t metric_probes    # Extra slots looked at
+    cdef readonly uint64_t metric_written   # Entries written out
+
+    def __cinit__( self ):
+        self._entries = NULL
+
+    def __init__( self, size, offsets, v4_prefix=24, v6_prefix=64 ):
+
+        """
+        Args:
+            size: The most entries.  The table is the next power of
+                two above 4/3 of this.
+            offsets: A dict of the extended record's field names to
+                ( offset, len ), and 'record_len'.
+            v4_prefix: Prefix length for IPv4 addresses when the
+                record has none
+            v6_prefix: The same for IPv6
+        """
+
+        cdef unsigned int capacity = 16
+
+        while capacity * 3 // 4 < size:
+            capacity *= 2
+
+        self._entries = <flow_entry *>PyMem_Malloc(
+                                            capacity * sizeof( flow_entry ) )
+        if self._entries == NULL:
+            raise MemoryError()
+        memset( self._entries, 0, capacity * sizeof( flow_entry ) )
+        self._capacity = capacity
+        self._max_entries = capacity * 3 // 4
+        self._num_entries = 0
+
+        self._record_len = offsets[ 'record_len' ]
+        self._src = offsets[ 'sourceIPv6Address' ][0]
+        self._dst = offsets[ 'destinationIPv6Address' ][0]
+        self._src_len = offsets[ 'sourceIPv6PrefixLength' ][0]
+        self._dst_len = offsets[ 'destinationIPv6PrefixLength' ][0]
+        self._port = offsets[ 'destinationTransportPort' ][0]
+        self._proto = offsets[ 'protocolIdentifier' ][0]
+        self._version = offsets[ 'ipVersion' ][0]
+        self._packets = offsets[ 'packetDeltaCount' ][0]
+        self._octets = offsets[ 'octetDeltaCount' ][0]
+
+        self._v4_prefix = v4_prefix
+        self._v6_prefix = v6_prefix
+
+        self.metric_records = 0
+        self.metric_probes = 0
+        self.metric_written = 0
+
+    def __dealloc__( self ):
+        PyMem_Free( self._entries )
+
+    def __len__( self ):
+        return( self._num_entries )
+
+    property capacity:
+        """Slots in the table."""
+        def __get__( self ):
+            return( self._capacity )
+
+    property max_entries:
+        """Entries allowed before the table must be written out."""
+        def __get__( self ):
+            return( self._max_entries )
+
+    property load:
+        """Entries over slots."""
+        def __get__( self ):
+            return( self._num_entries / self._capacity )
+
+    cpdef unsigned int add( self, uint8_t * buff, unsigned int nbytes,
+                                                    unsigned int start ):
+
+        """
+        Adds the extended records in a buffer to the table, starting
+        with record number start.
+
+        Args:
+            buff: A buffer of extended records
+            nbytes: Its length
+            start: The first record to add
+
+        Returns:
+            The number of the first record not added.  Less than the
+            records in the buffer if the table filled up, in which
+            case write it out and call again from there.
+        """
+
+        cdef:
+            unsigned int i
+            unsigned int cnt = nbytes // self._record_len
+            unsigned int end = cnt
+            unsigned int mask = self._capacity - 1
+            unsigned int bits
+            uint8_t * rec
+            uint64_t h
+            uint32_t h32
+            uint64_t v
+            flow_key key
+            flow_entry * e
+
+        with nogil:
+            for i in range( start, cnt ):
+                if self._num_entries >= self._max_entries:
+                    end = i
+                    break
+
+                rec = buff + i * self._record_len
+
+                memset( &key, 0, sizeof( key ) )
+                key.version = rec[ self._version ]
+                key.proto = rec[ self._proto ]
+                memcpy( &key.port, rec + self._port, 2 )
+                memcpy( key.src, rec + self._src, 16 )
+                memcpy( key.dst, rec + self._dst, 16 )
+
+# IPv4 addresses are mapped, so their prefix lengths count from bit 96.
+
+                key.src_len = rec[ self._src_len ]
+                key.dst_len = rec[ self._dst_len ]
+                if key.version == 4:
+                    if not key.src_len or key.src_len > 32:
+                        key.src_len = self._v4_prefix
+                    if not key.dst_len or key.dst_len > 32:
+                        key.dst_len = self._v4_prefix
+                    _mask( key.src, 96 + key.src_len )
+                    _mask( key.dst, 96 + key.dst_len )
+                else:
+                    if not key.src_len or key.src_len > 128:
+                        key.src_len = self._v6_prefix
+                    if not key.dst_len or key.dst_len > 128:
+                        key.dst_len = self._v6_prefix
+                    _mask( key.src, key.src_len )
+                    _mask( key.dst, key.dst_len )
+
+                h = _hash_key( &key )
+                h32 = <uint32_t>( h >> 32 ) | 1
+                bits = <unsigned int>h & mask
+
+                while True:
+                    e = &self._entries[ bits ]
+                    if e.hash == 0:
+                        e.key = key
+                        e.hash = h32
+                        self._num_entries += 1
+                        break
+                    if e.hash == h32 and memcmp( &e.key, &key,
+                                                    sizeof( key ) ) == 0:
+                        break
+                    bits = ( bits + 1 ) & mask
+                    self.metric_probes += 1
+
+                e.flows += 1
+                memcpy( &v, rec + self._packets, 8 )
+                e.packets += v
+                memcpy( &v, rec + self._octets, 8 )
+                e.octets += v
+
+            if end > start:
+                self.metric_records += end - start
+
+        return( end )
+
+    def write( self, uint32_t start, uint32_t end ):
+
+        """
+        Returns the entries as a bytearray of aggregate records and
+        clears the table.
+
+        Args:
+            start: Unix time the aggregation interval started
+            end: Unix time it ended
+        """
+
+        cdef:
+            unsigned int i
+            unsigned int n = 0
+            flow_entry * e
+            aggregate_record * r
+            bytearray out = bytearray( self._num_entries *
+                                                sizeof( aggregate_record ) )
+            uint8_t * p = out
+
+        with nogil:
+            for i in range( self._capacity ):
+                e = &self._entries[ i ]
+                if e.hash == 0:
+                    continue
+                r = <aggregate_record *>( p + n * sizeof( aggregate_record ) )
+                r.start = start
+                r.end = end
+                memcpy( r.src, e.key.src, 16 )
+                memcpy( r.dst, e.key.dst, 16 )
+                r.src_len = e.key.src_len
+                r.dst_len = e.key.dst_len
+                r.proto = e.key.proto
+                r.version = e.key.version
+                r.port = e.key.port
+                r.pad = 0
+                r.flows = e.flows
+                r.packets = e.packets
+                r.octets = e.octets
+                n += 1
+
+            memset( self._entries, 0, self._capacity * sizeof( flow_entry ) )
+            self._num_entries = 0
+            self.metric_written += n
+
+        return( out )
+
+# End.
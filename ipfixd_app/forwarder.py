@@ -0,0 +1,415 @@
+"""
+Forwards the datagrams a port receives to other collectors, so
+several teams can get the same exports without configuring every
+router with more destinations or running a samplicator.
+
+The packet thread hands each batch of socket items to the port's
+Forwarder after decoding it, instead of returning the buffers to the
+socket's free list.  The Forwarder sends every datagram to each
+destination straight from the socket buffer, with sendmmsg when the
+mmsg module is built, then returns the buffers.  So a datagram is
+never copied.  Each destination has its own connected UDP socket,
+and the socket's send buffer is its queue.
+
+The Forwarder holds at most max_pending datagrams waiting to be sent.
+Past that the packet thread returns the buffers itself and counts
+the datagrams as not forwarded, so a stuck destination can not use
+up the free list and stop the port.
+
+With preserve_source, datagrams from IPv4 exporters are sent to IPv4
+destinations on a raw socket, with the exporter's address as the
+source, so the downstream collector sees the router.  Only the IP
+and UDP headers are built, and sent in front of the socket buffer.
+The exporter's source port is not kept in the socket items, so the
+source port is the port the datagram arrived on.  A raw socket needs
+root or CAP_NET_RAW; without it, or for IPv6, datagrams are sent
+from our own address.
+
+To get this thread to stop, call stop() and put an empty batch on
+the queue.
+"""
+
+import sys
+import queue
+import socket
+import struct
+import traceback
+from ipfixd_app.ipfixd_log import log
+import ipfixd_app.ipfixd_queue
+import ipfixd_app.ipfixd_thread
+import ipfixd_app.metrics
+import ipfixd_app.util
+from ipfixd_app.packet import t_address, t_port, t_p, t_p_len
+
+try:
+    import pyximport; pyximport.install()
+    import ipfixd_app.mmsg
+    send_mmsg = ipfixd_app.mmsg.send_mmsg
+    max_batch = ipfixd_app.mmsg.max_batch
+except ImportError:
+    send_mmsg = None
+    max_batch = 1024
+
+_ip_header_struct = struct.Struct( '!BBHHHBBH4s4s' )
+_udp_header_struct = struct.Struct( '!HHHH' )
+
+class Destination( object ):
+
+    """
+    A collector we forward to, with its sockets and counters.
+    """
+
+    def __init__( self, host, port, preserve_source=False ):
+
+        """
+        Args:
+            host: An address or name
+            port: The UDP port
+            preserve_source: Try to open a raw socket to send with the
+                exporters' addresses
+        """
+
+        ( family, sock_type, proto, canon, address ) = socket.getaddrinfo(
+                host, port, type=socket.SOCK_DGRAM )[0]
+
+        self.name = ipfixd_app.util.format_host_port( host, port )
+        self.address = address
+        self.port = port
+        self.s = socket.socket( family, socket.SOCK_DGRAM )
+        self.s.connect( address )
+
+        self.raw = None
+        if preserve_source and family == socket.AF_INET:
+            try:
+                self.raw = socket.socket( socket.AF_INET, socket.SOCK_RAW,
+                                                        socket.IPPROTO_RAW )
+                self.raw.connect( ( address[0], 0 ) )
+                self._packed_address = socket.inet_aton( address[0] )
+            except OSError as e:
+                log().warn( 'WARN: forwarding to %s from our own address, '
+                    'no raw socket: %s' % ( self.name, e ) )
+                self.raw = None
+        self._headers = {}          # ( exporter, port ): IP header
+
+        self.metric_datagrams = 0
+        self.metric_bytes = 0
+        self.metric_errors = 0
+
+    def ip_header( self, key, port ):
+
+        """
+        Returns the IP and UDP headers, less the UDP length, to send a
+        datagram from an exporter on the raw socket, or None if the
+        exporter is not IPv4.  The kernel fills in the IP length, ID
+        and checksum.  The UDP checksum is 0, none, which IPv4 allows.
+
+        Args:
+            key: The packed 16 byte exporter address
+            port: The port it was sent to
+        """
+
+        try:
+            return( self._headers[ ( key, port ) ] )
+        except KeyError:
+            pass
+
+        if key[:12] == ipfixd_app.util._v4_mapped_prefix:
+            header = _ip_header_struct.pack( 0x45, 0, 0, 0, 0, 64,
+                    socket.IPPROTO_UDP, 0, key[12:], self._packed_address )
+        else:
+            header = None
+        self._headers[ ( key, port ) ] = header
+
+        return( header )
+
+class Forwarder( ipfixd_app.ipfixd_thread.IPFixdThread ):
+
+    """
+    Sends a port's datagrams to a list of destinations.
+    """
+
+    def __init__( self, src_obj, destinations, preserve_source=False,
+            max_pending=10000, profile=False ):
+
+        """
+        Args:
+            src_obj: The Socket the datagrams were read by, to return
+                the buffers to
+            destinations: A list of ( host, port )
+            preserve_source: Send from the exporters' addresses, see
+                the module notes
+            max_pending: The most datagrams held waiting to be sent
+            profile: If True, profile
+        """
+
+        self._src_obj = src_obj
+        self._destinations = [ Destination( host, port, preserve_source )
+                                    for ( host, port ) in destinations ]
+
+        name = 'Forwarder for port %d to %s' % ( src_obj.port,
+                        ','.join( d.name for d in self._destinations ) )
+
+        ipfixd_app.ipfixd_thread.IPFixdThread.__init__(
+                self, profile=profile, name=name, target=self.forward_loop )
+        self.daemon = True
+
+# The "bytes" of the queue are datagrams, so maxbytes bounds the
+# buffers we hold.
+
+        self._queue = ipfixd_app.ipfixd_queue.ByteQueue(
+                                                    maxbytes = max_pending )
+        self._max_qsize = 0
+
+        self.metric_batches = 0
+        self.metric_dropped = 0
+        self._register_metrics()
+
+        log().info( 'INFO: Created thread %s, sendmmsg: %s' % ( name,
+                                                    bool( send_mmsg ) ) )
+
+    def _register_metrics( self ):
+
+        """
+        Adds our counters to the metrics registry.
+        """
+
+        labels = { 'port': str( self._src_obj.port ) }
+        Counter = ipfixd_app.metrics.Counter
+
+        for m in (
+            Counter( 'ipfixd_forward_dropped_total',
+                'Datagrams not forwarded because too many were waiting.',
+                labels, lambda: self.metric_dropped ),
+            ipfixd_app.metrics.Gauge( 'ipfixd_queue_items',
+                'Items waiting on the queue.',
+                dict( labels, thread='forwarder' ),
+                lambda: self._queue.qsize() ) ):
+            ipfixd_app.metrics.registry.register( m )
+
+        for d in self._destinations:
+            d_labels = dict( labels, destination=d.name )
+            for m in (
+                Counter( 'ipfixd_forward_datagrams_total',
+                    'Datagrams forwarded.', d_labels,
+                    lambda d=d: d.metric_datagrams ),
+                Counter( 'ipfixd_forward_bytes_total',
+                    'Bytes forwarded.', d_labels,
+                    lambda d=d: d.metric_bytes ),
+                Counter( 'ipfixd_forward_errors_total',
+                    'Datagrams the destination socket would not send.',
+                    d_labels, lambda d=d: d.metric_errors ) ):
+                ipfixd_app.metrics.registry.register( m )
+
+    def forward( self, items ):
+
+        """
+        Takes a batch of socket items to forward.  The buffers are
+        returned to the socket when they have been sent, or now if
+        too many are waiting.  Called by the packet thread.
+
+        Args:
+            items: Socket items, see the t_* constants in
+                ipfixd_app.packet
+        """
+
+        try:
+            self._queue.put( [ items ], block=False, nbytes=len( items ) )
+        except queue.Full:
+            self.metric_dropped += len( items )
+            self._src_obj.return_buffs( items )
+
+    def _send( self, d, buffs, headers ):
+
+        """
+        Sends datagrams to a destination, max_batch at a time.  An
+        error costs the datagram that caused it.
+
+        Args:
+            d: The Destination
+            buffs: Memoryviews of the datagrams
+            headers: For the raw socket, the IP and UDP headers of each
+                datagram, else None
+        """
+
+        if headers is None:
+            s = d.s
+        else:
+            s = d.raw
+        fd = s.fileno()
+
+        i = 0
+        while i < len( buffs ):
+            try:
+                if send_mmsg:
+                    if headers is None:
+                        sent = send_mmsg( fd, buffs[ i:i + max_batch ] )
+                    else:
+                        sent = send_mmsg( fd, buffs[ i:i + max_batch ],
+                                        headers=headers[ i:i + max_batch ] )
+                else:
+                    if headers is None:
+                        s.send( buffs[i] )
+                    else:
+                        s.send( headers[i] + buffs[i] )
+                    sent = 1
+            except OSError as e:
+                d.metric_errors += 1
+                log().error( 'ERROR: %s: sending to %s: %s' % ( self.name,
+                                                                d.name, e ) )
+                sent = 1
+            else:
+                d.metric_datagrams += sent
+                d.metric_bytes += sum( len( b ) for b in buffs[ i:i + sent ] )
+            i += max( sent, 1 )
+
+    def _forward( self, batches ):
+
+        """
+        Sends a list of batches to every destination and returns the
+        buffers.
+        """
+
+        items = [ t for batch in batches for t in batch if t[ t_p_len ] ]
+        buffs = [ memoryview( t[ t_p ] )[ :t[ t_p_len ] ] for t in items ]
+        udp_len = _udp_header_struct
+
+        for d in self._destinations:
+            if not d.raw:
+                self._send( d, buffs, None )
+                continue
+
+# Datagrams from IPv4 exporters go on the raw socket, the rest from
+# our own address.
+
+            raw_buffs = []
+            headers = []
+            own_buffs = []
+            for ( t, b ) in zip( items, buffs ):
+                header = d.ip_header( t[ t_address ], t[ t_port ] )
+                if header:
+                    raw_buffs.append( b )
+                    headers.append( header + udp_len.pack( t[ t_port ],
+                                            d.port, len( b ) + 8, 0 ) )
+                else:
+                    own_buffs.append( b )
+            if raw_buffs:
+                self._send( d, raw_buffs, headers )
+            if own_buffs:
+                self._send( d, own_buffs, None )
+
+        for b in buffs:
+            b.release()
+        for batch in batches:
+            self._src_obj.return_buffs( batch )
+
+    def forward_loop( self ):
+
+        """
+        Runs the forwarder loop.  This just traps and prints
+        exceptions to the log, see _forward_loop.
+        """
+
+        try:
+            self._forward_loop()
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            f = traceback.format_exception( exc_type, exc_value, exc_traceback )
+            del exc_traceback
+            [ log().error( x ) for x in f ]
+            log().error( 'Thread aborted: %s' % self.name )
+            raise exc_type
+
+    def _forward_loop( self ):
+
+        """
+        Forwards the batches on the queue until an empty batch says
+        to stop.
+        """
+
+        if self._profile:
+            self._profile.enable()
+
+        while True:
+            batches = self._queue.get( block=True )
+            self._max_qsize = max( self._max_qsize, len( batches ) )
+            self.metric_batches += len( batches )
+
+            stopping = False
+            for ( i, batch ) in enumerate( batches ):
+                if len( batch ) == 0 and self.should_stop():
+                    batches = list( batches )[ :i ]
+                    stopping = True
+                    break
+
+            self._forward( batches )
+
+            if stopping:
+                log().info( 'INFO: Thread %s stopping by request',
+                                                                self.name )
+                for d in self._destinations:
+                    d.s.close()
+                    if d.raw:
+                        d.raw.close()
+                if self._profile:
+                    self._profile.disable()
+                    self._profile.dump_stats( "stats/" +
+                                            self.name.replace( '/', '-' ) )
+                return
+
+    def qsize( self ):
+
+        """
+        Returns a tuple: the current qsize and the max since the last
+        call.
+        """
+
+        m = self._max_qsize
+        self._max_qsize = 0
+
+        return( self._queue.qsize(), m )
+
+    def print_metrics( self ):
+
+        """
+        Logs the forwarding counts since the last call.
+        """
+
+        self.metric_sent = sum( d.metric_datagrams
+                                                for d in self._destinations )
+        self.metric_errors = sum( d.metric_errors
+                                                for d in self._destinations )
+        d = ipfixd_app.metrics.deltas( self, [ 'metric_batches',
+                        'metric_sent', 'metric_errors', 'metric_dropped' ] )
+
+        log().info( 'INFO: %s: batches: %d, datagrams sent: %d, errors: %d, '
+            'dropped: %d' %
+            ( self.name,
+                d[ 'metric_batches' ],
+                d[ 'metric_sent' ],
+                d[ 'metric_errors' ],
+                d[ 'metric_dropped' ] ) )
+
+    def qempty( self ):
+
+        """
+        Empties the queue immediately, returning the buffers.  This
+        is usually done as part of a fast shutdown.
+        """
+
+        while True:
+            try:
+                batches = self._queue.get( block=False, timeout=0 )
+            except queue.Empty:
+                break
+            for batch in batches:
+                self._src_obj.return_buffs( batch )
+
+    def queue( self ):
+
+        """
+        Returns the queue the packet thread puts batches on.
+        """
+
+        return( self._queue )
+
+# End.
@@ -0,0 +1,237 @@
+"""
+This is cython module.  It needs to be converted to C and compiled before use.
+
+HyperLogLog distinct counting (Flajolet, Fusy, Gandouet and Meunier),
+used for the distinct source and destination counts, see
+ipfixd_app.cardinality.  A sketch is 2 ** precision one byte
+registers.  Each address is hashed to 64 bits; the first precision
+bits pick a register, and the register keeps the most leading zeros
+plus one seen in the rest.  The estimate is within about
+1.04 / sqrt( 2 ** precision ) of the real count, 1.6% at precision
+12, whatever the count.
+
+Two sketches of the same precision are merged by taking the larger
+of each register, and the result is the sketch of the union.  So
+sketches written for every file can be merged into an hour or a day
+without the addresses.
+
+Addresses are hashed as 16 bytes, IPv4 mapped for IPv4, so sketches
+from cflowd and extended records merge.  4 byte IPv4 addresses are
+native integers, as in a cflowd record.  The hash is the murmur3
+64 bit finalizer over the two halves; it must not change, or
+sketches written before won't merge with new ones.
+"""
+
+import cython
+
+from libc.stdint cimport uint8_t, uint32_t, uint64_t
+from libc.string cimport memcpy, memset
+from libc.math cimport log, ldexp
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+cdef inline uint64_t _fmix64( uint64_t h ) noexcept nogil:
+    h ^= h >> 33
+    h *= 0xff51afd7ed558ccdULL
+    h ^= h >> 33
+    h *= 0xc4ceb9fe1a85ec53ULL
+    h ^= h >> 33
+    return( h )
+
+cdef inline uint64_t _hash_address( const uint8_t * a ) noexcept nogil:
+
+    cdef uint64_t w[ 2 ]
+
+    memcpy( w, a, 16 )
+    return( _fmix64( _fmix64( w[0] ) ^ w[1] ) )
+
+cdef inline void _update( uint8_t * registers, unsigned int precision,
+                                            uint64_t h ) noexcept nogil:
+
+    cdef uint64_t rest = h << precision
+    cdef uint8_t rho = 1
+
+    while rho <= 64 - precision and not ( rest & 0x8000000000000000ULL ):
+        rest <<= 1
+        rho += 1
+
+    h >>= 64 - precision
+    if registers[ h ] < rho:
+        registers[ h ] = rho
+
+cdef class HyperLogLog:
+
+    """
+    A distinct count sketch.
+    """
+
+    cdef uint8_t * _registers
+    cdef unsigned int _precision
+    cdef unsigned int _m
+
+    def __cinit__( self ):
+        self._registers = NULL
+
+    def __init__( self, precision=12, registers=None ):
+
+        """
+        Args:
+            precision: log2 of the number of registers, 4 to 18
+            registers: bytes of 2 ** precision registers to start
+                with, as from the registers property
+        """
+
+        if precision < 4 or precision > 18:
+            raise ValueError( 'precision must be 4 to 18' )
+
+        self._precision = precision
+        self._m = 1 << precision
+        self._registers = <uint8_t *>PyMem_Malloc( self._m )
+        if self._registers == NULL:
+            raise MemoryError()
+
+        if registers is None:
+            self.reset()
+        elif len( registers ) != self._m:
+            raise ValueError( 'need %d registers' % self._m )
+        else:
+            memcpy( self._registers, <const uint8_t *>registers, self._m )
+
+    def __dealloc__( self ):
+        PyMem_Free( self._registers )
+
+    property precision:
+        """log2 of the number of registers."""
+        def __get__( self ):
+            return( self._precision )
+
+    property registers:
+        """The registers as bytes, for writing out and merging."""
+        def __get__( self ):
+            return( self._registers[ :self._m ] )
+
+    def reset( self ):
+
+        """
+        Forgets every address.
+        """
+
+        memset( self._registers, 0, self._m )
+
+    def add( self, address ):
+
+        """
+        Adds one packed 16 byte address.
+        """
+
+        cdef const uint8_t[:] a = address
+
+        if a.shape[0] != 16:
+            raise ValueError
+        _update( self._registers, self._precision, _hash_address( &a[0] ) )
+
+    def add_records( self, const uint8_t[:] buff, unsigned int record_len,
+            key_field, HyperLogLog also=None ):
+
+        """
+        Adds the address field of every record in a buffer.
+
+        Args:
+            buff: A buffer of records
+            record_len: The length of a record
+            key_field: ( offset, len ) of the address in a record, a 16
+                byte address or a 4 byte native integer IPv4 address
+            also: Another sketch of the same precision to add the
+                addresses to, sharing the hashing
+        """
+
+        cdef:
+            unsigned int n
+            unsigned int cnt = buff.shape[0] // record_len
+            unsigned int offset = key_field[0]
+            unsigned int key_len = key_field[1]
+            const uint8_t * p
+            const uint8_t * rec
+            uint8_t key[ 16 ]
+            uint32_t a32
+            uint64_t h
+            uint8_t * also_registers = NULL
+
+        if key_len not in ( 4, 16 ):
+            raise ValueError
+        if also is not None:
+            if also._precision != self._precision:
+                raise ValueError( 'precisions differ' )
+            also_registers = also._registers
+        if not cnt:
+            return
+        p = &buff[0]
+
+        with nogil:
+            memset( key, 0, 10 )
+            key[ 10 ] = 0xff
+            key[ 11 ] = 0xff
+            for n in range( cnt ):
+                rec = p + n * record_len
+                if key_len == 4:
+                    memcpy( &a32, rec + offset, 4 )
+                    key[ 12 ] = a32 >> 24
+                    key[ 13 ] = ( a32 >> 16 ) & 0xff
+                    key[ 14 ] = ( a32 >> 8 ) & 0xff
+                    key[ 15 ] = a32 & 0xff
+                    h = _hash_address( key )
+                else:
+                    h = _hash_address( rec + offset )
+                _update( self._registers, self._precision, h )
+                if also_registers:
+                    _update( also_registers, self._precision, h )
+
+    def merge( self, HyperLogLog other ):
+
+        """
+        Makes this the sketch of the union of both.
+        """
+
+        cdef unsigned int i
+
+        if other._precision != self._precision:
+            raise ValueError( 'precisions differ' )
+        for i in range( self._m ):
+            if self._registers[ i ] < other._registers[ i ]:
+                self._registers[ i ] = other._registers[ i ]
+
+    def estimate( self ):
+
+        """
+        Returns the estimated number of distinct addresses.  Linear
+        counting is used while it is the better estimate.  With a 64
+        bit hash no large range correction is needed.
+        """
+
+        cdef unsigned int i
+        cdef unsigned int zeros = 0
+        cdef double s = 0
+        cdef double m = self._m
+        cdef double alpha
+        cdef double e
+
+        for i in range( self._m ):
+            s += ldexp( 1.0, -self._registers[ i ] )
+            if not self._registers[ i ]:
+                zeros += 1
+
+        if self._m >= 128:
+            alpha = 0.7213 / ( 1.0 + 1.079 / m )
+        elif self._m == 64:
+            alpha = 0.709
+        elif self._m == 32:
+            alpha = 0.697
+        else:
+            alpha = 0.673
+
+        e = alpha * m * m / s
+        if e <= 2.5 * m and zeros:
+            e = m * log( m / zeros )
+
+        return( int( e + 0.5 ) )
+
+# End.
@@ -25,6 +25,7 @@ ipfix_id_to_info = [ ( 'RESERVED', 0, 'x' ) for i in range( 0, 512 )]
 ipfix_id_to_info[0] = ( 'pad', 1, 'x' )
 ipfix_id_to_info[1] = ( 'octetDeltaCount', 8, 'Q' )
 ipfix_id_to_info[2] = ( 'packetDeltaCount', 8, 'Q' )
+ipfix_id_to_info[3] = ( 'deltaFlowCount', 8, 'Q' )
 ipfix_id_to_info[4] = ( 'protocolIdentifier', 1, 'B' )
 ipfix_id_to_info[5] = ( 'ipClassOfService', 1, 'B' )
 
@@ -64,6 +65,8 @@ ipfix_id_to_info[30] = ( 'destinationIPv6PrefixLength', 1, 'B' )
 ipfix_id_to_info[31] = ( 'flowLabelIPv6', 4, 'L' )
 ipfix_id_to_info[32] = ( 'icmpTypeCodeIPv4', 2, 'H' )
 ipfix_id_to_info[33] = ( 'igmpType', 1, 'B' )
+ipfix_id_to_info[34] = ( 'samplingInterval', 4, 'L' )
+ipfix_id_to_info[35] = ( 'samplingAlgorithm', 1, 'B' )
 ipfix_id_to_info[36] = ( 'flowActiveTimeout', 2, 'H' )
 ipfix_id_to_info[37] = ( 'flowIdleTimeout', 2, 'H' )
 ipfix_id_to_info[40] = ( 'exportedOctetTotalCount', 8, 'Q' )
@@ -73,6 +76,9 @@ ipfix_id_to_info[44] = ( 'sourceIPv4Prefix', 4, 'L' )
 ipfix_id_to_info[45] = ( 'destinationIPv4Prefix', 4, 'L' )
 ipfix_id_to_info[46] = ( 'mplsTopLabelType', 1, 'B' )
 ipfix_id_to_info[47] = ( 'mplsTopLabelIPv4Address', 4, 'L' )
+ipfix_id_to_info[48] = ( 'samplerId', 1, 'B' )
+ipfix_id_to_info[49] = ( 'samplerMode', 1, 'B' )
+ipfix_id_to_info[50] = ( 'samplerRandomInterval', 4, 'L' )
 ipfix_id_to_info[52] = ( 'minimumTTL', 1, 'B' )
 ipfix_id_to_info[53] = ( 'maximumTTL', 1, 'B' )
 ipfix_id_to_info[54] = ( 'fragmentIdentification', 4, 'L' )
@@ -158,6 +164,9 @@ ipfix_id_to_info[78] = ( 'mplsLabelStackSection9', 3, '3s' )
 ipfix_id_to_info[79] = ( 'mplsLabelStackSection10', 3, '3s' )
 ipfix_id_to_info[80] = ( 'destinationMacAddress', 6, '6s' )
 ipfix_id_to_info[81] = ( 'postSourceMacAddress', 6, '6s' )
+ipfix_id_to_info[82] = ( 'interfaceName', 65535, 's' )
+ipfix_id_to_info[83] = ( 'interfaceDescription', 65535, 's' )
+ipfix_id_to_info[84] = ( 'samplerName', 65535, 's' )
 ipfix_id_to_info[85] = ( 'octetTotalCount', 8, 'Q' )
 ipfix_id_to_info[86] = ( 'packetTotalCount', 8, 'Q' )
 ipfix_id_to_info[88] = ( 'fragmentOffset', 2, 'H' )
@@ -382,9 +391,22 @@ ipfix_id_to_info[208] = ( 'ipv4Options', 4, 'L' )
 ipfix_id_to_info[209] = ( 'tcpOptions', 8, 'Q' )
 ipfix_id_to_info[214] = ( 'exportProtocolVersion', 1, 'B' )
 ipfix_id_to_info[215] = ( 'exportTransportProtocol', 1, 'B' )
+ipfix_id_to_info[216] = ( 'collectorTransportPort', 2, 'H' )
+ipfix_id_to_info[234] = ( 'ingressVRFID', 4, 'L' )
+ipfix_id_to_info[235] = ( 'egressVRFID', 4, 'L' )
+ipfix_id_to_info[236] = ( 'VRFname', 65535, 's' )
 ipfix_id_to_info[243] = ( 'dot1qVlanId', 2, 'H' )
 ipfix_id_to_info[245] = ( 'dot1qCustomerVlanId', 2, 'H' )
 ipfix_id_to_info[256] = ( 'ethernetType', 2, 'H' )
+ipfix_id_to_info[302] = ( 'selectorId', 8, 'Q' )
+ipfix_id_to_info[304] = ( 'selectorAlgorithm', 2, 'H' )
+ipfix_id_to_info[305] = ( 'samplingPacketInterval', 4, 'L' )
+ipfix_id_to_info[306] = ( 'samplingPacketSpace', 4, 'L' )
+ipfix_id_to_info[309] = ( 'samplingSize', 4, 'L' )
+ipfix_id_to_info[310] = ( 'samplingPopulation', 4, 'L' )
+ipfix_id_to_info[403] = ( 'originalExporterIPv4Address', 4, 'L' )
+ipfix_id_to_info[404] = ( 'originalExporterIPv6Address', 16, '16s' )
+ipfix_id_to_info[405] = ( 'originalObservationDomainId', 4, 'L' )
 
 ipff = namedtuple( 'IPFixFields', 'name len fmt id' )
 
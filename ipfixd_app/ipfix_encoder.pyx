@@ -0,0 +1,251 @@
+"""
+This is cython module.  It needs to be converted to C and compiled before use.
+
+Encodes extended (cflowd6) records as IPFIX messages, for the IPFIX
+exporter, see ipfixd_app.exporter.  A RecordEncoder turns a buffer of
+native byte order records into network byte order data records laid
+out as a template says, and frame() cuts a buffer of data records
+into messages of at most so many records, each with its message and
+set headers.  Both work on whole converted buffers, so a packet
+thread's batch of records costs a few Python calls, not a few per
+record.
+"""
+
+import cython
+
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t
+from libc.string cimport memcpy
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+message_header_len = 16
+set_header_len = 4
+
+cdef struct field_move:
+    unsigned int in_offset
+    unsigned int out_offset
+    unsigned int len
+    bint swap
+
+cdef inline void _put_uint( uint8_t * p, uint64_t v,
+                                        unsigned int n ) noexcept nogil:
+
+    """
+    Stores the low n bytes of v at p in network byte order.
+    """
+
+    cdef unsigned int i
+
+    for i in range( n ):
+        p[ n - 1 - i ] = v & 0xff
+        v >>= 8
+
+cdef class RecordEncoder:
+
+    """
+    Moves the fields of native byte order records into network byte
+    order data records.
+    """
+
+    cdef field_move * _moves
+    cdef unsigned int _num_moves
+    cdef readonly unsigned int in_len
+    cdef readonly unsigned int out_len
+    cdef int _version_offset
+    cdef int _prefix_offsets[ 2 ]
+    cdef int _ms_offsets[ 4 ]
+
+    def __cinit__( self ):
+        self._moves = NULL
+
+    def __init__( self, in_len, out_len, moves, version_offset=-1,
+                                    prefix_offsets=(), milliseconds=() ):
+
+        """
+        Args:
+            in_len: The length of an input record
+            out_len: The length of a data record
+            moves: A list of ( in_offset, out_offset, len ), one per
+                field.  Fields of 2, 4 and 8 bytes are unsigned
+                integers and are put in network byte order, the others
+                are copied.
+            version_offset: The offset of ipVersion in the data
+                record, or -1.  IPv4 flows in an extended record have
+                IPv4 mapped addresses and prefix lengths counted from
+                the start of the IPv4 address; with this, the prefix
+                lengths are made IPv6 ones to match the addresses.
+            prefix_offsets: The offsets of the prefix lengths in the
+                data record, at most 2
+            milliseconds: A list of ( in_offset, out_offset ), at most
+                2, of 4 byte times in seconds to send as 8 byte times
+                in milliseconds
+        """
+
+        cdef unsigned int i
+
+        if len( prefix_offsets ) > 2:
+            raise ValueError( 'At most 2 prefix lengths' )
+        if len( milliseconds ) > 2:
+            raise ValueError( 'At most 2 millisecond times' )
+        for ( in_offset, out_offset ) in milliseconds:
+            if in_offset + 4 > in_len or out_offset + 8 > out_len:
+                raise ValueError( 'Field past the end of the record' )
+
+        self._moves = <field_move *>PyMem_Malloc(
+                                    len( moves ) * sizeof( field_move ) )
+        if self._moves == NULL:
+            raise MemoryError()
+
+        for ( i, ( in_offset, out_offset, l ) ) in enumerate( moves ):
+            if in_offset + l > in_len or out_offset + l > out_len:
+                raise ValueError( 'Field past the end of the record' )
+            self._moves[ i ].in_offset = in_offset
+            self._moves[ i ].out_offset = out_offset
+            self._moves[ i ].len = l
+            self._moves[ i ].swap = l in ( 2, 4, 8 )
+        self._num_moves = len( moves )
+
+        self.in_len = in_len
+        self.out_len = out_len
+        self._version_offset = version_offset
+        self._prefix_offsets[0] = -1
+        self._prefix_offsets[1] = -1
+        for ( i, offset ) in enumerate( prefix_offsets ):
+            self._prefix_offsets[ i ] = offset
+        for i in range( 4 ):
+            self._ms_offsets[ i ] = -1
+        for ( i, ( in_offset, out_offset ) ) in enumerate( milliseconds ):
+            self._ms_offsets[ 2 * i ] = in_offset
+            self._ms_offsets[ 2 * i + 1 ] = out_offset
+
+    def __dealloc__( self ):
+        PyMem_Free( self._moves )
+
+    def encode( self, const uint8_t[:] buff, uint8_t[:] out,
+                                                    unsigned int offset ):
+
+        """
+        Encodes every record in a buffer.
+
+        Args:
+            buff: The input records
+            out: Where to put the data records
+            offset: Where in out the first one goes
+
+        Returns:
+            The offset after the last data record.
+        """
+
+        cdef:
+            unsigned int n
+            unsigned int j
+            unsigned int cnt = buff.shape[0] // self.in_len
+            const uint8_t * p
+            const uint8_t * rec
+            uint8_t * o
+            field_move * m
+            uint16_t v16
+            uint32_t v32
+            uint64_t v64
+            int k
+
+        if not cnt:
+            return( offset )
+        if offset + cnt * self.out_len > out.shape[0]:
+            raise ValueError( 'Output buffer too small' )
+        p = &buff[0]
+        o = &out[0] + offset
+
+        with nogil:
+            for n in range( cnt ):
+                rec = p + n * self.in_len
+                for j in range( self._num_moves ):
+                    m = &self._moves[ j ]
+                    if not m.swap:
+                        memcpy( o + m.out_offset, rec + m.in_offset, m.len )
+                    elif m.len == 2:
+                        memcpy( &v16, rec + m.in_offset, 2 )
+                        _put_uint( o + m.out_offset, v16, 2 )
+                    elif m.len == 4:
+                        memcpy( &v32, rec + m.in_offset, 4 )
+                        _put_uint( o + m.out_offset, v32, 4 )
+                    else:
+                        memcpy( &v64, rec + m.in_offset, 8 )
+                        _put_uint( o + m.out_offset, v64, 8 )
+
+                for k in range( 0, 4, 2 ):
+                    if self._ms_offsets[ k ] >= 0:
+                        memcpy( &v32, rec + self._ms_offsets[ k ], 4 )
+                        _put_uint( o + self._ms_offsets[ k + 1 ],
+                                                <uint64_t>v32 * 1000, 8 )
+
+                if self._version_offset >= 0 and (
+                                        o[ self._version_offset ] == 4 ):
+                    for k in range( 2 ):
+                        j = self._prefix_offsets[ k ]
+                        if self._prefix_offsets[ k ] >= 0 and (
+                                                    0 < o[ j ] <= 32 ):
+                            o[ j ] += 96
+                o += self.out_len
+
+        return( offset + cnt * self.out_len )
+
+def frame( const uint8_t[:] records, unsigned int record_len,
+        unsigned int per_message, unsigned int set_id, uint32_t export_time,
+        uint32_t sequence, uint32_t domain ):
+
+    """
+    Cuts data records into IPFIX messages of one data set each.
+
+    Args:
+        records: The data records, in network byte order
+        record_len: The length of a data record
+        per_message: The most records in a message
+        set_id: The template ID of the records
+        export_time: The export time for the message headers
+        sequence: The sequence number of the first message, the data
+            records sent before it
+        domain: The observation domain ID
+
+    Returns:
+        A tuple of the messages, as a bytearray, and a list of the
+        offsets where each one ends.
+    """
+
+    cdef:
+        unsigned int cnt = records.shape[0] // record_len
+        unsigned int messages
+        unsigned int n
+        unsigned int m
+        unsigned int length
+        unsigned int overhead = message_header_len + set_header_len
+        uint8_t * o
+        const uint8_t * p
+        list ends = []
+
+    if per_message < 1 or overhead + per_message * record_len > 65535:
+        raise ValueError( 'Messages must hold 1 to 65535 bytes of records' )
+
+    messages = ( cnt + per_message - 1 ) // per_message
+    out = bytearray( cnt * record_len + messages * overhead )
+    if not cnt:
+        return( out, ends )
+    o = out
+    p = &records[0]
+
+    for n in range( 0, cnt, per_message ):
+        m = min( per_message, cnt - n )
+        length = overhead + m * record_len
+        _put_uint( o, 10, 2 )
+        _put_uint( o + 2, length, 2 )
+        _put_uint( o + 4, export_time, 4 )
+        _put_uint( o + 8, <uint32_t>( sequence + n ), 4 )
+        _put_uint( o + 12, domain, 4 )
+        _put_uint( o + 16, set_id, 2 )
+        _put_uint( o + 18, length - message_header_len, 2 )
+        memcpy( o + overhead, p + n * record_len, m * record_len )
+        o += length
+        ends.append( ( ends[-1] if ends else 0 ) + length )
+
+    return( out, ends )
+
+# End.
@@ -2,22 +2,119 @@
 This module contains the routine that sets up logging and a
 routine that provides the current logging object.  The logging
 object is derived from the system base module of logging.
-"""
 
+The socket and packet threads log, and the handlers (syslog, stderr)
+do blocking I/O.  So log() only has a QueueHandler, and a
+QueueListener thread does the I/O.  A thread can't be stalled by a
+slow syslog, just by the CPU to make the record.
 
+Each call site is also rate limited with a token bucket, see
+RateLimit, so an exporter sending garbage can't bury us in log
+lines.  Suppressed messages are counted and reported with the next
+message from that call site, or by flush_suppressed.
+"""
 
+import os
+import time
+import queue
+import atexit
 import logging
 import logging.handlers
 
 #
 # _theconsole and _thesyslog handlers are kept accessable so we
-# can modify them as needed, or remove them.
+# can modify them as needed, or remove them.  They are run by
+# _thelistener, which reads _thequeue.
 #
 
 _thelog = None
 _theo2log = None
 _theconsole = None
 _thesyslog = None
+_thequeue = queue.SimpleQueue()
+_thequeuehandler = None
+_thelistener = None
+_thelistener_pid = None
+_theratelimit = None
+
+class RateLimit( logging.Filter ):
+
+    """
+    A token bucket for each call site, the ( file, line ) of the
+    log() call.  A call site can log burst messages at once and then
+    rate a second.  Extra messages are dropped and counted, and the
+    count is added to the next message that gets through.
+
+    The buckets are updated without a lock.  Two threads logging from
+    the same call site at the same time might both get the last
+    token.  Close enough.
+    """
+
+    def __init__( self, rate=10.0, burst=None ):
+
+        """
+        Args:
+            rate: Messages per second per call site.  0 turns off
+                rate limiting.
+            burst: Messages allowed at once.  Defaults to 10 seconds'
+                worth.
+        """
+
+        logging.Filter.__init__( self )
+        self._buckets = {}
+        self.set_rate( rate, burst )
+
+    def set_rate( self, rate, burst=None ):
+
+        """
+        Changes the rate.  See __init__.
+        """
+
+        self.rate = rate
+        self.burst = burst or max( 1.0, rate * 10 )
+
+    def filter( self, record ):
+
+        if self.rate <= 0 or getattr( record, 'rate_limit_exempt', False ):
+            return( True )
+
+        key = ( record.pathname, record.lineno )
+        now = time.monotonic()
+        try:
+            b = self._buckets[ key ]        # [ tokens, time, suppressed ]
+        except KeyError:
+            b = self._buckets[ key ] = [ self.burst, now, 0 ]
+
+        tokens = min( self.burst, b[0] + ( now - b[1] ) * self.rate )
+        b[1] = now
+        if tokens < 1:
+            b[0] = tokens
+            b[2] += 1
+            return( False )
+
+        b[0] = tokens - 1
+        if b[2]:
+            record.msg = '%s [%d similar messages suppressed]' % (
+                                            record.getMessage(), b[2] )
+            record.args = None
+            b[2] = 0
+
+        return( True )
+
+    def take_suppressed( self ):
+
+        """
+        Returns a list of ( call site, count ) for the call sites with
+        suppressed messages, and zeroes the counts.
+        """
+
+        l = []
+        for ( key, b ) in list( self._buckets.items() ):
+            if b[2]:
+                l.append( ( key, b[2] ) )
+                b[2] = 0
+
+        return( l )
 
 def log():
     """
@@ -37,12 +134,15 @@ def set_logging( cmdparse ):
 
     """
     Sets up logging.  Creates the logging object returned by log().
+    May be called again, for instance after the arguments are parsed
+    or after forking the daemon, which loses the listener thread.
+    Each call starts a new listener with the current handlers.
 
     Args:
         cmdparse    -- The results of argument processing.  Attributes
                        such as log, which is used to set up syslog
-                       logging, and verbose controls the logging
-                       level.
+                       logging, verbose controls the logging
+                       level and log_rate the rate limit.
 
     Returns
         None
@@ -52,6 +152,8 @@ def set_logging( cmdparse ):
     global _theo2log
     global _theconsole
     global _thesyslog
+    global _thequeuehandler
+    global _theratelimit
 
     _thelog = logging.getLogger( __name__ )
     _theo2log = logging.getLogger( 'oauth2client.util' )
@@ -68,26 +170,85 @@ def set_logging( cmdparse ):
             _thesyslog.setFormatter( syslog_format )
 
         _thesyslog.setLevel( logging.INFO )
-        _thelog.addHandler( _thesyslog )
-        _theo2log.addHandler( _thesyslog )
     elif _thesyslog:
-        _thelog.removeHandler( _thesyslog )
-        _theo2log.removeHandler( _thesyslog )
         _thesyslog = None
 
     if not _theconsole:
         _theconsole = logging.StreamHandler()
-        _thelog.addHandler( _theconsole )
-        _theo2log.addHandler( _theconsole )
 
     if hasattr( cmdparse, 'verbose' ) and cmdparse.verbose:
         _theconsole.setLevel( logging.INFO )
     else:
         _theconsole.setLevel( logging.WARN )
 
+    if not _thequeuehandler:
+        _theratelimit = RateLimit()
+        _thequeuehandler = logging.handlers.QueueHandler( _thequeue )
+        _thequeuehandler.addFilter( _theratelimit )
+        _thelog.addHandler( _thequeuehandler )
+        _theo2log.addHandler( _thequeuehandler )
+        atexit.register( stop_logging )
+
+    if getattr( cmdparse, 'log_rate', None ) is not None:
+        _theratelimit.set_rate( cmdparse.log_rate )
+
     _thelog.setLevel( logging.INFO )
     _theo2log.setLevel( logging.INFO )
 
+    _start_listener( [ h for h in ( _theconsole, _thesyslog ) if h ] )
+
+def _start_listener( handlers ):
+
+    """
+    Replaces the listener thread.  The old one is stopped first, which
+    writes anything still queued.  After a fork the old thread does
+    not exist in this process, so there is nothing to stop, and what
+    was queued since the fork is written by the new one.
+
+    Args:
+        handlers: The handlers for the listener to call.
+    """
+
+    global _thelistener
+    global _thelistener_pid
+
+    if _thelistener and _thelistener_pid == os.getpid():
+        _thelistener.stop()
+
+    _thelistener = logging.handlers.QueueListener( _thequeue, *handlers,
+                                                respect_handler_level=True )
+    _thelistener.start()
+    _thelistener_pid = os.getpid()
+
+def stop_logging():
+
+    """
+    Stops the listener thread after it writes what is queued.  Called
+    at exit.
+    """
+
+    global _thelistener
+
+    if _thelistener and _thelistener_pid == os.getpid():
+        _thelistener.stop()
+    _thelistener = None
+
+def flush_suppressed():
+
+    """
+    Logs a line for each call site that had messages suppressed since
+    its last message got through.  The main thread calls this now and
+    then, so a burst that stops is still reported.
+    """
+
+    if not _theratelimit:
+        return
+
+    for ( ( path, line ), cnt ) in _theratelimit.take_suppressed():
+        _thelog.warning( 'WARN: %d similar messages suppressed from %s:%d',
+            cnt, os.path.basename( path ), line,
+            extra={ 'rate_limit_exempt': True } )
+
 def log_user_info( u, action ):
 
     """
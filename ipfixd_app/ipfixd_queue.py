@@ -1,3 +1,4 @@
+import time
 import queue
 import collections
 
@@ -27,4 +28,73 @@ class IterQueue( queue.Queue ):
         self.queue = collections.deque()
         return( q )
 
+class ByteQueue( IterQueue ):
+
+    """
+    An IterQueue that is also bounded by the bytes in it, the sum of
+    the len() of the items.  Counting items alone, a queue of 100000
+    output buffers could be 10 MB or 1 GB.  put blocks, or raises
+    queue.Full, while either limit is reached.  Like maxsize,
+    maxbytes can be exceeded by one put.
+
+    The bytes attribute may be read without the lock to see how full
+    the queue is.
+    """
+
+    def __init__( self, maxsize=0, maxbytes=0 ):
+
+        """
+        Args:
+            maxsize: The most items, 0 for no limit
+            maxbytes: The most bytes, 0 for no limit
+        """
+
+        IterQueue.__init__( self, maxsize )
+        self.maxbytes = maxbytes
+        self.bytes = 0
+
+    def _full( self ):
+        return( ( self.maxsize > 0 and self._qsize() >= self.maxsize ) or
+            ( self.maxbytes > 0 and self.bytes >= self.maxbytes ) )
+
+    def put( self, items, block=True, timeout=None, nbytes=None ):
+
+        """
+        Adds the items, see queue.Queue.put.
+
+        Args:
+            items: An iterable of items with a len()
+            block: Wait for room, or raise queue.Full
+            timeout: The most seconds to wait, None for no limit
+            nbytes: The bytes in items, if the caller already knows.
+                Otherwise they are added up here.
+        """
+
+        if nbytes is None:
+            nbytes = sum( len( i ) for i in items )
+
+        with self.not_full:
+            if not block:
+                if self._full():
+                    raise queue.Full
+            elif timeout is None:
+                while self._full():
+                    self.not_full.wait()
+            else:
+                endtime = time.monotonic() + timeout
+                while self._full():
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Full
+                    self.not_full.wait( remaining )
+
+            self._put( items )
+            self.bytes += nbytes
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _get( self ):
+        self.bytes = 0
+        return( IterQueue._get( self ) )
+
 # End.
@@ -4,7 +4,9 @@ calls the routines that create the threads and waits for a signal.
 
 This program responds to:
 
-    SIGUSR1: Print a status report
+    SIGUSR1: Print a status report.  The counts are the change since
+        the last report.  With --metrics, the cumulative counters can
+        also be scraped by Prometheus, see ipfixd_app.metrics.
     SIGHUP: Graceful shutdown.  Finishes processing the queues and closes files
     SIGTERM: Empties the queues and then gracefully closes the files.
 
@@ -19,11 +21,16 @@ thread based.
 First, we have socket reader threads.  They are bound to a
 particular UDP port.  They maximize their UDP buffer, and create
 a Queue object from the threading module.  Packets read from the
-network are written to the Queue object.  We can expand these to
-support TCP as well.  If we expand to support TCP, we will need to
-break into appropriate sized buffers to drop on the packet queue.
-TCP is obviously stream based, so something will need to chunk
-the stream into packet.
+network are written to the Queue object.  A port can also be a
+TCP port for IPFIX over TCP.  A TCP reader thread accepts all the
+exporter connections on the port and chunks each stream into
+IPFIX messages using the length in the message header.  Each
+message is dropped on the packet queue just like a UDP packet.
+
+With --engine asyncio, there is a single socket thread for all
+the UDP ports instead of one per port.  It runs an asyncio event
+loop and drains each socket when it becomes readable.  The queues
+and buffers are the same, so nothing else changes.
 
 Packet processing threads read from the Socket queue (input queue),
 process the data into a possibly different format and then write
@@ -43,6 +50,21 @@ new temp file will be created when data is received.  Of course,
 before writing to the file, the Writer thread must acquire a Lock
 on the file.
 
+With the 'aggregate' format, an Aggregator thread sits between the
+packet threads and the aggregate writer.  It takes the extended
+records off its queue, adds them up in a hash table, and queues the
+totals on the writer at the end of every --aggregate-interval.
+
+With --forward, each port has a Forwarder thread too.  The packet
+thread hands it the socket items after processing them, and it sends
+the datagrams on to the other collectors and returns the buffers to
+the socket.
+
+With the 'export' format or --ipfix-export, an Exporter thread for
+each temp directory takes the extended records like an Aggregator,
+and sends them as IPFIX messages to the 'export' writer and the
+collectors.
+
 Socket threads are unique to the port being listen on.  Writer
 threads are unique to the temp/dest dir tuple.  Note that a temp
 dir can not have multiple dest dirs.  This is checked for during
@@ -75,8 +97,15 @@ import pwd
 
 import ipfixd_app.args
 import ipfixd_app.sockets
+import ipfixd_app.async_engine
 import ipfixd_app.packet
 import ipfixd_app.writer
+import ipfixd_app.aggregator
+import ipfixd_app.talkers
+import ipfixd_app.cardinality
+import ipfixd_app.forwarder
+import ipfixd_app.exporter
+import ipfixd_app.metrics
 from  ipfixd_app.ipfixd_log import log
 from  ipfixd_app.util import set_exit, get_exit
 
@@ -153,9 +182,9 @@ def _main( cmdparse ):
 
     log().info( 'IPFixd Version: %s, %s' % ( VERSION, RCS ) )
     for p in list(cmdparse.ports.values()):
-        log().info( 'INFO: port %d, timeout=%d, temp dir=%s, dest dir=%s' %
-            ( p[ 'port' ], p[ 'write_timeout' ], p[ 'temp_directory' ],
-                p[ 'dest_directory' ] ) )
+        log().info( 'INFO: port %d/%s, timeout=%d, temp dir=%s, dest dir=%s' %
+            ( p[ 'port' ], p[ 'transport' ], p[ 'write_timeout' ],
+                p[ 'temp_directory' ], p[ 'dest_directory' ] ) )
 
     signal.signal( signal.SIGUSR1, usr1_handler )   # Set info request
     signal.signal( signal.SIGHUP, hup_handler )     # Gracefull shutdown
@@ -168,6 +197,8 @@ def _main( cmdparse ):
 #
 
     ipfixd_app.cflowd.set_cflowd_log_options( cmdparse )
+    ipfixd_app.cflowd.options_cache.max_records = cmdparse.options_cache_size
+    ipfixd_app.cflowd.exporter_stats.max_exporters = cmdparse.max_exporters
 
     ipfixd_app.cflowd.netflow_v5_to_cflowd_tuple = (
         ipfixd_app.cflowd.netflow_v5_init(
@@ -180,56 +211,196 @@ def _main( cmdparse ):
 
     writers = {}
     for (t,v) in list(cmdparse.temp_directories.items()):
-        ipfix = v[ 'ipfix' ]
-        cflowd = v[ 'cflowd' ]
         v[ 'profile' ] = cmdparse.profile
 
-        if v[ 'cflowd' ]:
-            v[ 'ipfix' ] = False
-            writer = ipfixd_app.writer.Writer( **v )
-            writers[ t + '-cflowd' ] = writer
-            writer.start()
-            all_threads.append( writer )
-            v[ 'ipfix' ] = ipfix
+        for fmt in ipfixd_app.writer.file_formats:
+            if not v[ fmt ]:
+                continue
 
-        if ipfix:
-            v[ 'cflowd' ] = False
-            writer = ipfixd_app.writer.Writer( **v )
-            writers[ t + '-ipfix' ] = writer
+            writer_args = { k: v[ k ] for k in ( 'temp_directory',
+                'write_timeout', 'dest_directory', 'profile', 'port' ) }
+            writer_args[ 'max_queue_bytes' ] = cmdparse.queue_bytes * 2**20
+            writer_args[ 'spill_directory' ] = cmdparse.spill_directory
+            writer_args[ 'spill_max_bytes' ] = cmdparse.spill_max * 2**20
+            for f in ipfixd_app.writer.file_formats:
+                writer_args[ f ] = ( f == fmt ) # One format per writer
+
+            writer = ipfixd_app.writer.Writer( **writer_args )
+            writers[ t + '-' + fmt ] = writer
+            if fmt == 'ipfix':          # Templates go in every file
+                ipfix_templates = ipfixd_app.cflowd.IPFixFileTemplates()
+                writer.set_prefix( ipfix_templates.prefix,
+                                                    ipfix_templates.reset )
             writer.start()
             all_threads.append( writer )
-            v[ 'cflowd' ] = cflowd
+
+            if fmt == 'aggregate':
+                aggregator = ipfixd_app.aggregator.Aggregator( writer, t,
+                    interval=cmdparse.aggregate_interval,
+                    table_size=cmdparse.aggregate_table_size,
+                    v4_prefix=cmdparse.aggregate_prefix[0],
+                    v6_prefix=cmdparse.aggregate_prefix[1],
+                    profile=v[ 'profile' ],
+                    max_queue_bytes=writer_args[ 'max_queue_bytes' ] )
+                writers[ t + '-aggregator' ] = aggregator
+                aggregator.start()
+                all_threads.append( aggregator )
+
+#
+# An Exporter for the ports of the temp directory, for the 'export'
+# format or the --ipfix-export collectors, or both.
+#
+
+        sinks = []
+        if v[ 'export' ]:
+            sinks.append( ipfixd_app.exporter.FileSink(
+                writers[ t + '-export' ], cmdparse.ipfix_export_domain ) )
+        for ( transport, host, port ) in cmdparse.ipfix_export:
+            if transport == 'udp':
+                sinks.append( ipfixd_app.exporter.UDPSink( host, port,
+                    cmdparse.ipfix_export_domain,
+                    mtu=cmdparse.ipfix_export_mtu,
+                    template_refresh=cmdparse.ipfix_export_template_refresh ) )
+            else:
+                sinks.append( ipfixd_app.exporter.TCPSink( host, port,
+                    cmdparse.ipfix_export_domain ) )
+        if sinks:
+            exporter = ipfixd_app.exporter.Exporter( sinks, t,
+                profile=v[ 'profile' ],
+                max_queue_bytes=cmdparse.queue_bytes * 2**20 )
+            writers[ t + '-exporter' ] = exporter
+            exporter.start()
+            all_threads.append( exporter )
 
 #
 # Start the socket and packet threads.
 #
 
+    if cmdparse.engine == 'asyncio':
+        engine = ipfixd_app.async_engine.AsyncEngine(
+                                            profile=cmdparse.profile )
+    else:
+        engine = None
+
     for (p,v) in list(cmdparse.ports.items()):
-        s = ipfixd_app.sockets.Socket( p, profile=cmdparse.profile )
-        s.start()
-        sockets.append( s )
-        all_threads.append( s )
+        if v[ 'transport' ] == 'tcp':
+            socket_class = ipfixd_app.sockets.TCPSocket
+        else:
+            socket_class = ipfixd_app.sockets.Socket
+
+# The port's output files.  The top talkers and distinct counts are
+# written next to each of them.
+
+        port_writers = []
+
+        try:
+            writer_capture = writers[ v['temp_directory'] + '-capture' ]
+            writer = writer_capture
+            port_writers.append( writer )
+        except KeyError:
+            writer_capture = None
+
+        s = socket_class( p, profile=cmdparse.profile,
+            bind_address=v[ 'bind_address' ], capture_writer=writer_capture,
+            trace_every=cmdparse.trace_sample )
+        if engine and v[ 'transport' ] == 'udp':
+            engine.add_socket( s )      # The engine reads it
+        else:
+            s.start()
+            sockets.append( s )
+            all_threads.append( s )
 
         try:
             writer_cflowd = writers[ v['temp_directory'] + '-cflowd' ]
             writer = writer_cflowd
+            port_writers.append( writer )
         except KeyError:
             writer_cflowd = None
 
         try:
             writer_ipfix = writers[ v['temp_directory'] + '-ipfix' ]
             writer = writer_ipfix
+            port_writers.append( writer )
         except KeyError:
             writer_ipfix = None
 
+        try:
+            writer_cflowd6 = writers[ v['temp_directory'] + '-cflowd6' ]
+            writer = writer_cflowd6
+            port_writers.append( writer )
+        except KeyError:
+            writer_cflowd6 = None
+
+        try:
+            writer_aggregate = writers[ v['temp_directory'] + '-aggregator' ]
+            writer = writers[ v['temp_directory'] + '-aggregate' ]
+            port_writers.append( writer )
+        except KeyError:
+            writer_aggregate = None
+
+        try:
+            writer_export = writers[ v['temp_directory'] + '-exporter' ]
+            if v[ 'export' ]:
+                writer = writers[ v['temp_directory'] + '-export' ]
+                port_writers.append( writer )
+        except KeyError:
+            writer_export = None
+
+        if cmdparse.top_talkers:
+            talkers = ipfixd_app.talkers.TopTalkers( p, cmdparse.top_talkers,
+                v[ 'temp_directory' ], extended=bool( writer_cflowd6 or
+                                    writer_aggregate or not writer_cflowd ),
+                interval=v[ 'write_timeout' ] )
+            for w in port_writers:
+                w.add_rotate_hook( talkers.rotate )
+        else:
+            talkers = None
+
+        if cmdparse.distinct:
+            distinct = ipfixd_app.cardinality.DistinctCounts( p,
+                cmdparse.distinct, v[ 'temp_directory' ], extended=bool(
+                    writer_cflowd6 or writer_aggregate or not writer_cflowd ),
+                interval=v[ 'write_timeout' ] )
+            for w in port_writers:
+                w.add_rotate_hook( distinct.rotate )
+        else:
+            distinct = None
+
+        if cmdparse.forward:
+            forwarder = ipfixd_app.forwarder.Forwarder( s, cmdparse.forward,
+                preserve_source=cmdparse.forward_preserve_source,
+                max_pending=cmdparse.forward_max_pending,
+                profile=cmdparse.profile )
+            forwarder.start()
+            all_threads.append( forwarder )
+        else:
+            forwarder = None
+
         packet = ipfixd_app.packet.Packet(
-            cmdparse, s, s.name, writer_cflowd, writer_ipfix )
+            cmdparse, s, s.name, writer_cflowd, writer_ipfix, writer_cflowd6,
+            max_latency=v[ 'max_latency' ], overload=cmdparse.overload,
+            shed_sample=cmdparse.shed_sample, sample_every=v[ 'sample_every' ],
+            sample_mode=v[ 'sample_mode' ],
+            normalize_sampling=cmdparse.normalize_sampling,
+            aggregate_writer=writer_aggregate, talkers=talkers,
+            distinct=distinct, forwarder=forwarder,
+            export_writer=writer_export )
         packet.start()
         packets.append( packet )
         all_threads.append( packet )
 
         log().info('INFO: Port %d is sending to thread "%s"' % (p, writer.name))
 
+    if engine:
+        engine.start()
+        sockets.append( engine )
+        all_threads.append( engine )
+
+    if cmdparse.metrics:
+        metrics_server = ipfixd_app.metrics.MetricsServer( cmdparse.metrics )
+        metrics_server.start()
+        all_threads.append( metrics_server )
+
 #
 # Let's check for startup errors.
 #
@@ -239,8 +410,20 @@ def _main( cmdparse ):
         if s.should_stop():
             hup_handler( None, None )
     
+#
+# Now, main thread responds to signals.  It also logs the sequence
+# gap summary and the counts of rate limited log messages.
+#
+
+    interval = cmdparse.sequence_summary
+    last_summary = time.monotonic()
     while True:
-        time.sleep( 24*60*60 )      # Now, main thread responds to signals
+        time.sleep( min( interval, 10 ) if interval > 0 else 10 )
+        ipfixd_app.ipfixd_log.flush_suppressed()
+        now = time.monotonic()
+        if interval > 0 and now - last_summary >= interval:
+            ipfixd_app.cflowd.log_sequence_summary( now - last_summary )
+            last_summary = now
 
     exit( get_exit() )
 
@@ -308,14 +491,11 @@ def hup_handler( signum, frame ):
             continue
 
 #
-# Make a socket and send a 0 length packet to the server socket.
-# This will cause the socket thread and threads depending on it
-# to stop.
+# Send a 0 length packet to the server socket.  This will cause the
+# socket thread and threads depending on it to stop.
 #
 
-        ws = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
-        ws.sendto( bytearray(0), ('localhost', s.port ) )
-        ws.close()
+        s.wakeup()
 
     while usr1_handler( signal.SIGHUP, None ):
         time.sleep( 2 )
@@ -0,0 +1,417 @@
+"""
+Metrics registry and the Prometheus endpoint.
+
+The threads already count things in plain metric_* attributes that
+only the owning thread changes.  Adding a lock, or even a method
+call, to the read and packet loops would cost more than the
+counting, so the registry does not hold the values.  Each metric is
+registered with a function that fetches the current value when
+someone scrapes.  Reading an int another thread is incrementing is
+safe under the GIL, and at worst we are one packet behind.
+
+Counters must be cumulative for Prometheus rate() to work.  The
+SIGUSR1 log output used to reset the counters after printing them.
+Now print_metrics logs the change since the last print instead, see
+deltas.
+
+Histograms keep their own bucket counts and are updated by one
+thread with observe().  A scrape may see an observe half done, the
+count updated and the sum not yet.  That is off by one sample, which
+is fine for something scraped every 15 seconds.
+
+    registry.register( Counter( 'ipfixd_socket_datagrams_total',
+        'Datagrams read.', { 'port': '2055' },
+        lambda: s.metric_io_read_result ) )
+
+The endpoint is a small HTTP server thread serving the text format
+on /metrics, on a TCP address or a Unix socket.  Tables that don't fit
+as metrics, like the per exporter details, are served as JSON on
+/status.  See MetricsServer.
+"""
+
+import os
+import json
+import bisect
+import socket
+import threading
+import socketserver
+import http.server
+from ipfixd_app.ipfixd_log import log
+import ipfixd_app.ipfixd_thread
+
+class Metric( object ):
+
+    """
+    A metric with a name, help text and labels.  The value comes from
+    fn if one is given, or from the value attribute.
+    """
+
+    kind = 'untyped'
+
+    def __init__( self, name, help_text, labels=None, fn=None ):
+
+        """
+        Args:
+            name: The metric name, Prometheus style
+            help_text: One line of help for the HELP comment
+            labels: A dict of label names and values, or None
+            fn: A function returning the current value, or None
+        """
+
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels or {}
+        self.fn = fn
+        self.value = 0
+
+    def get( self ):
+
+        """
+        Returns the current value.
+        """
+
+        if self.fn:
+            return( self.fn() )
+        return( self.value )
+
+    def samples( self ):
+
+        """
+        Returns a list of ( name suffix, extra labels, value ) for the
+        text format.
+        """
+
+        return( [ ( '', {}, self.get() ) ] )
+
+class Counter( Metric ):
+
+    """
+    A value that only goes up.  Use inc() from the owning thread.
+    """
+
+    kind = 'counter'
+
+    def inc( self, n=1 ):
+        self.value += n
+
+class Gauge( Metric ):
+
+    """
+    A value that goes up and down, like a queue length.
+    """
+
+    kind = 'gauge'
+
+    def set( self, v ):
+        self.value = v
+
+    def inc( self, n=1 ):
+        self.value += n
+
+class Histogram( Metric ):
+
+    """
+    Counts observations into buckets.  The buckets are upper bounds,
+    and an observation lands in the first bucket it is less than or
+    equal to.  Buckets are stored non-cumulative and summed at scrape
+    time, so observe() only touches one count.
+    """
+
+    kind = 'histogram'
+
+    def __init__( self, name, help_text, buckets, labels=None ):
+
+        """
+        Args:
+            name: The metric name, without _bucket, _sum or _count
+            help_text: One line of help for the HELP comment
+            buckets: Sorted list of bucket upper bounds.  +Inf is added.
+            labels: A dict of label names and values, or None
+        """
+
+        Metric.__init__( self, name, help_text, labels )
+        self.buckets = list( buckets )
+        self.counts = [ 0 ] * ( len( self.buckets ) + 1 )
+        self.sum = 0
+        self.count = 0
+
+    def observe( self, v ):
+
+        """
+        Adds an observation.  Owning thread only.
+        """
+
+        self.counts[ bisect.bisect_left( self.buckets, v ) ] += 1
+        self.sum += v
+        self.count += 1
+
+    def samples( self ):
+
+        l = []
+        total = 0
+        for ( le, n ) in zip( self.buckets + [ '+Inf' ], self.counts ):
+            total += n
+            l.append( ( '_bucket', { 'le': _format_value( le ) }, total ) )
+        l.append( ( '_sum', {}, self.sum ) )
+        l.append( ( '_count', {}, total ) )
+
+        return( l )
+
+class Registry( object ):
+
+    """
+    Holds the metrics.  The lock only covers registering and
+    rendering, never the values.
+    """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._status = {}
+
+    def register( self, metric ):
+
+        """
+        Adds a metric and returns it.
+        """
+
+        with self._lock:
+            self._metrics.append( metric )
+
+        return( metric )
+
+    def add_status( self, name, fn ):
+
+        """
+        Adds a section to the /status JSON.  For tables that don't fit
+        well as metrics, like per exporter details.
+
+        Args:
+            name: The key in the JSON object
+            fn: Returns something json.dumps can handle
+        """
+
+        with self._lock:
+            self._status[ name ] = fn
+
+    def status( self ):
+
+        """
+        Returns the /status JSON text.
+        """
+
+        with self._lock:
+            status = list( self._status.items() )
+
+        return( json.dumps( { name: fn() for ( name, fn ) in status },
+                                                                indent=1 ) )
+
+    def render( self ):
+
+        """
+        Returns the Prometheus text format for all the metrics.
+        Metrics with the same name are grouped under one HELP and
+        TYPE, in the order they were first registered.
+        """
+
+        with self._lock:
+            metrics = list( self._metrics )
+
+        families = {}
+        for m in metrics:
+            families.setdefault( m.name, [] ).append( m )
+
+        lines = []
+        for ( name, family ) in families.items():
+            lines.append( '# HELP %s %s' % ( name, family[0].help_text ) )
+            lines.append( '# TYPE %s %s' % ( name, family[0].kind ) )
+            for m in family:
+                try:
+                    samples = m.samples()
+                except Exception as e:     # A thread went away, etc.
+                    log().info( 'INFO: metric %s: %s' % ( name, e ) )
+                    continue
+                for ( suffix, extra, v ) in samples:
+                    labels = dict( m.labels )
+                    labels.update( extra )
+                    lines.append( '%s%s%s %s' % ( name, suffix,
+                        _format_labels( labels ), _format_value( v ) ) )
+
+        return( '\n'.join( lines ) + '\n' )
+
+registry = Registry()
+
+def _format_value( v ):
+
+    """
+    Formats a sample value or bucket bound.
+    """
+
+    if isinstance( v, str ):
+        return( v )
+    if isinstance( v, float ):
+        return( repr( v ) )
+    return( '%d' % v )
+
+def _format_labels( labels ):
+
+    """
+    Returns {a="b",...} or an empty string.
+    """
+
+    if not labels:
+        return( '' )
+
+    return( '{%s}' % ','.join( '%s="%s"' % ( k, str( v ).replace( '\\',
+        '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' ) )
+            for ( k, v ) in labels.items() ) )
+
+def deltas( obj, names ):
+
+    """
+    Returns the change in some counter attributes since the last call
+    for the object.  This is how print_metrics logs per-interval
+    numbers while the counters themselves stay cumulative.
+
+    Args:
+        obj: The object owning the counters
+        names: A list of attribute names
+
+    Returns:
+        A dict of attribute name to change.
+    """
+
+    try:
+        last = obj._metrics_last
+    except AttributeError:
+        last = obj._metrics_last = {}
+
+    d = {}
+    for n in names:
+        v = getattr( obj, n )
+        d[ n ] = v - last.get( n, 0 )
+        last[ n ] = v
+
+    return( d )
+
+class _Handler( http.server.BaseHTTPRequestHandler ):
+
+    """
+    Serves GET /metrics and /status.
+    """
+
+    def do_GET( self ):
+
+        path = self.path.split( '?' )[0]
+        if path in ( '/metrics', '/' ):
+            body = self.server.registry.render()
+            content_type = 'text/plain; version=0.0.4'
+        elif path == '/status':
+            body = self.server.registry.status()
+            content_type = 'application/json'
+        else:
+            self.send_error( 404 )
+            return
+
+        body = body.encode( 'utf-8' )
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', content_type )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def address_string( self ):
+        return( str( self.client_address ) )
+
+    def log_message( self, fmt, *args ):
+        pass                            # Scrapes every 15s are just noise
+
+class _TCPServer( socketserver.ThreadingMixIn, http.server.HTTPServer ):
+    daemon_threads = True
+
+class _TCPServer6( _TCPServer ):
+    address_family = socket.AF_INET6
+
+class _UnixServer( socketserver.ThreadingMixIn,
+                                        socketserver.UnixStreamServer ):
+    daemon_threads = True
+
+class MetricsServer( ipfixd_app.ipfixd_thread.IPFixdThread ):
+
+    """
+    A thread serving the registry in the Prometheus text format.
+
+    To get this thread to stop, call stop().  It does not use a queue,
+    so there is nothing to wake up.
+    """
+
+    def __init__( self, address, metrics_registry=None ):
+
+        """
+        Args:
+            address: host:port, [v6 address]:port, or the path of a
+                Unix socket, which must start with /
+            metrics_registry: The Registry to serve.  The module
+                registry by default.
+        """
+
+        self._address = address
+        self._registry = metrics_registry or registry
+        self._server = None
+
+        name = 'Metrics server on %s' % address
+        ipfixd_app.ipfixd_thread.IPFixdThread.__init__( self, name=name,
+                                                target=self.serve_loop )
+        self.daemon = True
+
+    def _make_server( self ):
+
+        """
+        Creates the server for the address.
+        """
+
+        if self._address.startswith( '/' ):
+            try:
+                os.unlink( self._address )      # Left from the last run
+            except FileNotFoundError:
+                pass
+            return( _UnixServer( self._address, _Handler ) )
+
+        ( host, sep, port ) = self._address.rpartition( ':' )
+        if host.startswith( '[' ):
+            return( _TCPServer6( ( host[1:-1], int( port ) ), _Handler ) )
+
+        return( _TCPServer( ( host, int( port ) ), _Handler ) )
+
+    def serve_loop( self ):
+
+        """
+        Thread target.  Serves until stop() is called.
+        """
+
+        try:
+            self._server = self._make_server()
+        except ( OSError, ValueError ) as e:
+            log().error( 'ERROR: %s: %s' % ( self.name, e ) )
+            return
+
+        self._server.registry = self._registry
+        self._server.timeout = 1.0      # How often we check should_stop
+        log().info( 'INFO: %s started' % self.name )
+
+        while not self.should_stop():
+            self._server.handle_request()
+
+        self._server.server_close()
+        if self._address.startswith( '/' ):
+            try:
+                os.unlink( self._address )
+            except OSError:
+                pass
+
+        log().info( 'INFO: Thread %s stopping by request', self.name )
+
+    def qsize( self ):
+        return( 0, 0 )
+
+# End.
@@ -0,0 +1,112 @@
+"""
+This is cython module.  It needs to be converted to C and compiled before use.
+
+Linux sendmmsg(2) for UDP sockets.  Sending a datagram at a time
+from Python costs a system call and a trip through the socket
+module for every packet.  sendmmsg sends a whole list of buffers
+with one call, which is how the load generator keeps up with the
+collector from one core, and how ipfixd_app.forwarder fans
+datagrams out.
+"""
+
+import cython
+
+from libc.errno cimport errno
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from posix.uio cimport iovec
+
+cdef extern from "sys/socket.h" nogil:
+    ctypedef unsigned int socklen_t
+
+    cdef struct msghdr:
+        void *msg_name
+        socklen_t msg_namelen
+        iovec *msg_iov
+        size_t msg_iovlen
+        void *msg_control
+        size_t msg_controllen
+        int msg_flags
+
+    cdef struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+
+    int sendmmsg( int sockfd, mmsghdr *msgvec, unsigned int vlen, int flags )
+
+max_batch = 1024        # Linux UIO_MAXIOV, the most sendmmsg will take
+
+def send_mmsg( int fd, list buffs, int flags=0, list headers=None ):
+
+    """
+    Sends a list of buffers as datagrams on a connected socket.
+
+    Args:
+        fd: The socket's fileno()
+        buffs: A list of bytes or bytearray objects, at most max_batch.
+            Memoryview slices send part of a buffer without a copy.
+        flags: send(2) flags
+        headers: If given, a buffer for each datagram that is sent in
+            front of it, such as the IP and UDP headers on a raw
+            socket.
+
+    Returns:
+        The number of datagrams sent.  This can be less than the
+        number of buffers, just like send can send less than all
+        the bytes.  Call again with the rest.
+    """
+
+    cdef unsigned int cnt = len( buffs )
+    cdef unsigned int i
+    cdef int sent
+    cdef unsigned int parts = 1
+    cdef mmsghdr *msgs
+    cdef iovec *iovs
+    cdef const unsigned char[::1] b
+    cdef const unsigned char[::1] h
+
+    if cnt == 0:
+        return( 0 )
+    if cnt > max_batch:
+        raise ValueError( 'at most %d buffers per call' % max_batch )
+    if headers is not None:
+        if len( headers ) != cnt:
+            raise ValueError( 'need a header for each buffer' )
+        parts = 2
+
+    msgs = <mmsghdr *>PyMem_Malloc( cnt * sizeof( mmsghdr ) )
+    iovs = <iovec *>PyMem_Malloc( cnt * parts * sizeof( iovec ) )
+    if not msgs or not iovs:
+        PyMem_Free( msgs )
+        PyMem_Free( iovs )
+        raise MemoryError()
+
+    try:
+        for i in range( cnt ):
+            if parts == 2:
+                h = headers[ i ]
+                iovs[ 2 * i ].iov_base = <void *>&h[ 0 ]
+                iovs[ 2 * i ].iov_len = h.shape[ 0 ]
+            b = buffs[ i ]
+            iovs[ parts * i + parts - 1 ].iov_base = <void *>&b[ 0 ]
+            iovs[ parts * i + parts - 1 ].iov_len = b.shape[ 0 ]
+            msgs[ i ].msg_hdr.msg_name = NULL
+            msgs[ i ].msg_hdr.msg_namelen = 0
+            msgs[ i ].msg_hdr.msg_iov = &iovs[ parts * i ]
+            msgs[ i ].msg_hdr.msg_iovlen = parts
+            msgs[ i ].msg_hdr.msg_control = NULL
+            msgs[ i ].msg_hdr.msg_controllen = 0
+            msgs[ i ].msg_hdr.msg_flags = 0
+            msgs[ i ].msg_len = 0
+
+        with nogil:
+            sent = sendmmsg( fd, msgs, cnt, flags )
+
+        if sent < 0:
+            raise OSError( errno, 'sendmmsg failed' )
+    finally:
+        PyMem_Free( msgs )
+        PyMem_Free( iovs )
+
+    return( sent )
+
+# End.
@@ -0,0 +1,195 @@
+"""
+A cache of the IPFIX options data the exporters send.
+
+Options data describes the exporter rather than flows: the sampler
+settings, interface names, VRF names and so on.  Each options data
+record has scope fields, saying what it describes, for example
+ingressInterface 5 or the observation domain, and data fields, for
+example interfaceName "xe-0/0/1".  The cache keeps the latest data
+fields for each exporter and scope, so other stages can look things
+up:
+
+    options_cache.get( exporter, ( ( 'ingressInterface', 5 ), ) )
+    options_cache.latest( exporter ).get( 'samplingInterval' )
+
+An exporter is ( packed address, port, obs_id ), the same key as
+exporter_stats.  Records from different options templates with the
+same scope are merged.
+
+Exporters resend their options data every so often.  Each record
+remembers when it was last sent and the cache keeps at most
+max_records of them.  When it is full, the record that was refreshed
+longest ago goes first, so an exporter that stopped describing
+something loses it before one that still sends it.  An exporter
+whose last record goes is forgotten entirely, its refresh tracking
+and latest values too, so the cache stays bounded however many
+exporters, spoofed or not, send options data.  The refresh counts
+and times for each exporter are on /status.
+
+The packet threads update the cache and the metrics server reads
+it, so a lock covers every method.  Options data is a few records a
+minute per exporter, so the lock costs nothing that matters.
+"""
+
+import time
+import threading
+import collections
+import ipfixd_app.util
+
+class OptionsCache( object ):
+
+    """
+    Options data records by exporter and scope.
+    """
+
+    def __init__( self, max_records=10000 ):
+
+        """
+        Args:
+            max_records: The most records kept, for all exporters
+        """
+
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        self._records = collections.OrderedDict()  # Oldest refresh first
+        self._latest = {}           # exporter: { field: value }
+        self._exporters = {}        # exporter: refresh tracking
+
+        self.metric_updates = 0
+        self.metric_evictions = 0
+
+    def __len__( self ):
+        return( len( self._records ) )
+
+    def update( self, exporter, template_id, scope, values ):
+
+        """
+        Stores an options data record.
+
+        Args:
+            exporter: ( packed address, port, obs_id )
+            template_id: The options template it came with
+            scope: A tuple of ( name, value ) for the scope fields
+            values: A dict of the data fields
+
+        Returns:
+            True if the record is new or any value changed.
+        """
+
+        now = time.time()
+        key = ( exporter, scope )
+
+        with self._lock:
+            self.metric_updates += 1
+            try:
+                info = self._exporters[ exporter ]
+            except KeyError:
+                info = self._exporters[ exporter ] = { 'records': 0,
+                    'updates': 0, 'changes': 0, 'first_update': now,
+                    'last_update': now, 'templates': set() }
+
+            info[ 'updates' ] += 1
+            info[ 'last_update' ] = now
+            info[ 'templates' ].add( template_id )
+
+            try:
+                record = self._records[ key ]
+                self._records.move_to_end( key )
+                changed = any( record[ 'values' ].get( k ) != v
+                                            for ( k, v ) in values.items() )
+                record[ 'values' ].update( values )
+            except KeyError:
+                record = self._records[ key ] = { 'values': dict( values ),
+                                                        'first_update': now }
+                info[ 'records' ] += 1
+                changed = True
+                self._evict()
+
+            record[ 'last_update' ] = now
+            if changed:
+                info[ 'changes' ] += 1
+            self._latest.setdefault( exporter, {} ).update( values )
+
+        return( changed )
+
+    def _evict( self ):
+
+        """
+        Removes the records refreshed longest ago until there are at
+        most max_records, and the exporters left with none.  Called
+        with the lock held.
+        """
+
+        while len( self._records ) > self.max_records:
+            ( ( exporter, scope ), record ) = self._records.popitem(
+                                                                last=False )
+            info = self._exporters[ exporter ]
+            info[ 'records' ] -= 1
+            if not info[ 'records' ]:
+                del self._exporters[ exporter ]
+                self._latest.pop( exporter, None )
+            self.metric_evictions += 1
+
+    def get( self, exporter, scope ):
+
+        """
+        Returns a copy of the data fields for a scope, or None.
+
+        Args:
+            exporter: ( packed address, port, obs_id )
+            scope: A tuple of ( name, value ) for the scope fields, in
+                the order of the options template
+        """
+
+        with self._lock:
+            try:
+                return( dict( self._records[ ( exporter, scope ) ][
+                                                                'values' ] ) )
+            except KeyError:
+                return( None )
+
+    def latest( self, exporter ):
+
+        """
+        Returns a copy of the last value of every data field the
+        exporter sent, whatever its scope.  For settings the exporter
+        has one of, like the sampling interval.
+        """
+
+        with self._lock:
+            return( dict( self._latest.get( exporter, {} ) ) )
+
+    def refreshed( self, exporter ):
+
+        """
+        Returns when the exporter last sent options data, Unix time,
+        or None if it never has.
+        """
+
+        with self._lock:
+            try:
+                return( self._exporters[ exporter ][ 'last_update' ] )
+            except KeyError:
+                return( None )
+
+    def status( self ):
+
+        """
+        Returns the refresh tracking for each exporter, for /status.
+        """
+
+        now = time.time()
+        with self._lock:
+            return( [ { 'exporter': ipfixd_app.util.format_address(
+                    exporter[0] ), 'port': exporter[1],
+                'observation_domain': exporter[2],
+                'records': info[ 'records' ], 'updates': info[ 'updates' ],
+                'changes': info[ 'changes' ],
+                'first_update': int( info[ 'first_update' ] ),
+                'last_update': int( info[ 'last_update' ] ),
+                'age': int( now - info[ 'last_update' ] ),
+                'templates': sorted( info[ 'templates' ] ),
+                'latest': dict( self._latest.get( exporter, {} ) ) }
+                    for ( exporter, info ) in self._exporters.items() ] )
+
+# End.
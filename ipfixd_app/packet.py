@@ -11,8 +11,11 @@ import time
 import queue
 import traceback
 import ipfixd_app.header
+import ipfixd_app.util
+import ipfixd_app.metrics
 from ipfixd_app.ipfixd_log import log
 import ipfixd_app.ipfixd_thread
+from ipfixd_app.trace import Trace
 from collections import namedtuple
 import cProfile
 
@@ -21,21 +24,53 @@ import cProfile
 # cflowd needs these.
 #
 
-t_address = 0       # Address tuple for sending router
+t_address = 0       # Packed 16 byte address of sending router
 t_port = 1          # Port we are listening on
 t_p = 2             # The packet buffer
 t_p_len = 3         # The packet length
+t_trace = 4         # A sampled ipfixd_app.trace.Trace, if there is one
 
 import ipfixd_app.cflowd
+import ipfixd_app.byte_mover
 
 class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
 
     def __init__( self, cmdparse, src_obj, socket_thread_name,
-        cflowd_writer, ipfix_writer ):
+        cflowd_writer, ipfix_writer, cflowd6_writer=None, max_latency=10,
+        overload='block', shed_sample=0, sample_every=1, sample_mode='count',
+        normalize_sampling=False, aggregate_writer=None, talkers=None,
+        distinct=None, forwarder=None, export_writer=None ):
 
         """
         Starts a thread that processes a particular src_obj using the
-        queue method as a queue object.
+        queue method as a queue object.  Output is held for at most
+        max_latency seconds before it is queued for the writers.
+
+        When a writer's queue is full, overload 'block' waits for the
+        writer, which backs up to the socket and the kernel.  'shed'
+        throws the output away instead, keeping one buffer in
+        shed_sample once the queue is half full, if shed_sample is
+        given.  See _put_data_list.
+
+        With sample_every more than 1, only one cflowd and extended
+        flow record in sample_every is kept, picked by sample_mode
+        'count' or 'hash', and the counters of the ones kept are
+        scaled up to match.  normalize_sampling also scales them by
+        the sampling interval the exporter reports.  See
+        ipfixd_app.byte_mover.FlowSampler.
+
+        aggregate_writer is an ipfixd_app.aggregator.Aggregator.  It is
+        given the extended records, which are made for it even when
+        there is no cflowd6_writer.  export_writer, an
+        ipfixd_app.exporter.Exporter, is given them likewise.
+
+        talkers is an ipfixd_app.talkers.TopTalkers to feed the
+        cflowd6 records, or the cflowd records if it says so, and
+        distinct an ipfixd_app.cardinality.DistinctCounts, likewise.
+
+        forwarder is an ipfixd_app.forwarder.Forwarder.  The socket
+        items are handed to it after they are processed, and it
+        returns the buffers to src_obj when they have been sent.
         """
 
         self._cmdparse = cmdparse
@@ -57,9 +92,72 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
             self._ipfix_queue = None
             self.ipfix = False
 
+        if cflowd6_writer:          # Extended cflowd records go here
+            self._cflowd6_queue = cflowd6_writer.queue()
+            self.cflowd6 = True
+        else:
+            self._cflowd6_queue = None
+            self.cflowd6 = False
+
+        if aggregate_writer:        # Extended records to roll up
+            self._aggregate_queue = aggregate_writer.queue()
+            self.aggregate = True
+        else:
+            self._aggregate_queue = None
+            self.aggregate = False
+
+        if export_writer:           # Extended records to send as IPFIX
+            self._export_queue = export_writer.queue()
+            self.export = True
+        else:
+            self._export_queue = None
+            self.export = False
+
+#
+# Output queues in the order the conversion routines return their
+# buffers: cflowd, ipfix, cflowd6.  The aggregator and the exporter
+# get the cflowd6 buffer too, _out_results says which buffer goes to
+# which queue.
+#
+
+        self._out_queues = [ self._cflowd_queue, self._ipfix_queue,
+                                self._cflowd6_queue, self._aggregate_queue,
+                                self._export_queue ]
+        self._out_formats = [ 'cflowd', 'ipfix', 'cflowd6', 'aggregate',
+                                                                'export' ]
+        self._out_results = [ 0, 1, 2, 2, 2 ]
+        self._out_record_sizes = [ ipfixd_app.cflowd.cflowd_struct.size, 0,
+                                ipfixd_app.cflowd.cflowd6_struct.size,
+                                ipfixd_app.cflowd.cflowd6_struct.size,
+                                ipfixd_app.cflowd.cflowd6_struct.size ]
+
+        self.talkers = talkers          # Fed results[ _talkers_result ]
+        if talkers and talkers.extended:
+            self._talkers_result = 2
+        else:
+            self._talkers_result = 0
+
+        self.distinct = distinct        # Fed results[ _distinct_result ]
+        if distinct and distinct.extended:
+            self._distinct_result = 2
+        else:
+            self._distinct_result = 0
+
+        self.forwarder = forwarder
+
+        self._shed_policy = ( overload == 'shed' )
+        self._shed_sample = shed_sample
+
+        if sample_every > 1 or normalize_sampling:
+            self._sampler = ipfixd_app.byte_mover.FlowSampler( sample_every,
+                                        sample_mode, normalize_sampling )
+        else:
+            self._sampler = None
+
         self._max_qsize = 0
-        self._data_list_max = 10000
-        self._max_time_in_list = 10
+        self._data_list_min = 64        # Batch size limits, see
+        self._data_list_max = 10000     # _process_loop
+        self._max_time_in_list = max_latency
 
         name = "Packet processor for: %s" % socket_thread_name
 
@@ -69,7 +167,99 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
         self.daemon = True
         self.header_fmt = struct.Struct( '!H' )
 
+        self.metric_packets = 0
+        self.metric_unknown_packets = 0
+        self.metric_short_packets = 0
+        self.metric_decode_errors = 0
+        self.metric_flush_size = 0
+        self.metric_flush_latency = 0
+        self.metric_flush_idle = 0
+        self.metric_shed_items = [ 0 for q in self._out_queues ]
+        self.metric_shed_bytes = [ 0 for q in self._out_queues ]
+        self._register_metrics()
+
         log().info( 'INFO: Created thread %s' % self.name )
+        if self._sampler:
+            log().info( 'INFO: %s: %s', self.name, self._sampler )
+
+    def _register_metrics( self ):
+
+        """
+        Adds our counters to the metrics registry.  The batch size
+        histogram shows how well the socket reader is batching; lots
+        of batches of one means we pay the queue locking per packet.
+        """
+
+        labels = { 'port': str( self._src_obj.port ) }
+        Counter = ipfixd_app.metrics.Counter
+
+        self._batch_items = ipfixd_app.metrics.Histogram(
+            'ipfixd_packet_batch_items',
+            'Items taken from the socket queue at once.',
+            [ 1, 4, 16, 64, 256, 1024, 4096 ], labels )
+
+        self._flush_items = ipfixd_app.metrics.Histogram(
+            'ipfixd_packet_flush_items',
+            'Items in each data list put on a writer queue.',
+            [ 1, 4, 16, 64, 256, 1024, 4096, 10000 ], labels )
+
+        for m in (
+            Counter( 'ipfixd_packet_packets_total',
+                'Packets taken from the socket queue.', labels,
+                lambda: self.metric_packets ),
+            Counter( 'ipfixd_packet_unknown_packets_total',
+                'Packets with an unknown NetFlow version.', labels,
+                lambda: self.metric_unknown_packets ),
+            Counter( 'ipfixd_packet_short_packets_total',
+                'Packets too short to have a version.', labels,
+                lambda: self.metric_short_packets ),
+            Counter( 'ipfixd_packet_decode_errors_total',
+                'Packets the decoder could not parse.', labels,
+                lambda: self.metric_decode_errors ),
+            Counter( 'ipfixd_packet_flushes_total',
+                'Data lists put on writer queues, by reason.',
+                dict( labels, reason='size' ),
+                lambda: self.metric_flush_size ),
+            Counter( 'ipfixd_packet_flushes_total',
+                'Data lists put on writer queues, by reason.',
+                dict( labels, reason='latency' ),
+                lambda: self.metric_flush_latency ),
+            Counter( 'ipfixd_packet_flushes_total',
+                'Data lists put on writer queues, by reason.',
+                dict( labels, reason='idle' ),
+                lambda: self.metric_flush_idle ),
+            self._batch_items, self._flush_items ):
+            ipfixd_app.metrics.registry.register( m )
+
+        for ( i, q ) in enumerate( self._out_queues ):
+            if not q:
+                continue
+            out_labels = dict( labels, format=self._out_formats[i] )
+            for m in (
+                Counter( 'ipfixd_packet_shed_items_total',
+                    'Output buffers thrown away by --overload shed.',
+                    out_labels, lambda i=i: self.metric_shed_items[i] ),
+                Counter( 'ipfixd_packet_shed_bytes_total',
+                    'Output bytes thrown away by --overload shed.',
+                    out_labels, lambda i=i: self.metric_shed_bytes[i] ) ):
+                ipfixd_app.metrics.registry.register( m )
+            if self._out_record_sizes[i]:
+                ipfixd_app.metrics.registry.register( Counter(
+                    'ipfixd_packet_shed_records_total',
+                    'Flow records thrown away by --overload shed.',
+                    out_labels, lambda i=i: self.metric_shed_bytes[i] //
+                                            self._out_record_sizes[i] ) )
+
+        if self._sampler:
+            sampler = self._sampler
+            for m in (
+                Counter( 'ipfixd_packet_sampler_records_total',
+                    'Flow records seen by the flow sampler.', labels,
+                    lambda: sampler.records_in ),
+                Counter( 'ipfixd_packet_sampler_kept_records_total',
+                    'Flow records the flow sampler kept.', labels,
+                    lambda: sampler.records_kept ) ):
+                ipfixd_app.metrics.registry.register( m )
 
 # Scope and data
 
@@ -90,7 +280,7 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
             log().error( 'Thread aborted: %s' % self.name )
             raise exc_type
 
-    def _do_stop( self, ipfix_data_list, cflowd_data_list ):
+    def _do_stop( self ):
 
         """
         This routine handles the thread stop actions.  It does
@@ -101,17 +291,15 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
         log().info( 'INFO: Thread %s stopping by request',
             self.name )
 
-        if ipfix_data_list:
-            self._ipfix_queue.put( ipfix_data_list )
-            ipfix_data_list[:] = []
-        if cflowd_data_list:
-            self._cflowd_queue.put( cflowd_data_list )
-            cflowd_data_list[:] = []
+        for i in range( len( self._out_queues ) ):
+            if self._data_lists[i]:
+                self._put_data_list( i )
 
-        if self._cflowd_queue:
-            self._cflowd_queue.put( [ bytearray(0) ] )
-        if self._ipfix_queue:
-            self._ipfix_queue.put( [ bytearray(0) ] )
+        for q in self._out_queues:
+            if q:
+                q.put( [ bytearray(0) ] )
+        if self.forwarder:
+            self.forwarder.queue().put( [ [] ] )
 
         if self._profile:
             self._profile.disable()
@@ -124,15 +312,36 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
         routine should handle it, call the processing code,
         and add the output to the output queue.
 
-        We buffer items to add to the output queue in
-        cflowd_data_list and ipfix_data_list.  The queue type we
-        are using expects an iterable object to provide the items
-        to add to the queue.  Since the buffers are covered by
-        mutexs, adding items in groups saves a lot of locking and
-        unlocked time.  We keep track of the time when an item is
-        first added to a list, and limit the amount of time an item
-        can be in the list as well as the list length.  We don't
-        want stale data hanging around and not being written.
+        We buffer items to add to the output queues in data_lists,
+        one list per output queue.  The queue type we are using
+        expects an iterable object to provide the items to add to
+        the queue.  Since the buffers are covered by mutexs, adding
+        items in groups saves a lot of locking and unlocked time.
+
+        How big a group is adapts to the load.  A data list is put on
+        its queue when:
+
+            - It reaches its target size.  Under load this is what
+              happens, and big lists are cheap to queue and write.
+            - We have caught up, the input queue is empty, and the
+              writer has nothing queued.  When idle this is what
+              happens, so output is written as soon as it is made.
+            - Its first item is _max_time_in_list seconds old.  This
+              bounds the latency whatever the load.
+
+        The target size doubles, up to _data_list_max, whenever a list
+        is queued while the input queue is backed up or the writer
+        still has lists to write, since smaller lists would only add
+        locking to a thread that is behind.  It halves, down to
+        _data_list_min, when the input queue is empty.  Times are
+        taken from the monotonic clock, once per batch of input.
+
+        A sampled packet's Trace is put in the data list after its
+        output, and kept in traces until the list is queued.  See
+        ipfixd_app.trace.
+
+        From a TCP socket, an item with no bytes ends an exporter's
+        session, see ipfixd_app.cflowd.end_session.
         """
 
         if self._profile:
@@ -143,27 +352,34 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
 #        dispatch[ 5 ] = ipfixd_app.cflowd.null_cvt_rtn     # Debugging
         dispatch[ 10 ] = ipfixd_app.cflowd.netflow_v10_to_cflowd
 
-        dispatch_arg_list = [0] * 3
+        dispatch_arg_list = [0] * 5
         dispatch_arg_list[ 0 ] = self.cflowd
         dispatch_arg_list[ 1 ] = self.ipfix
-
-        ipfix_data_list = []
-        cflowd_data_list = []
-        ipfix_data_list_time = 0
-        cflowd_data_list_time = 0
+        dispatch_arg_list[ 2 ] = ( self.cflowd6 or self.aggregate or
+                            self.export ) or bool(
+                            self.talkers and self._talkers_result == 2 or
+                            self.distinct and self._distinct_result == 2 )
+        dispatch_arg_list[ 4 ] = self._sampler
+
+        out_results = self._out_results
+        queues = self._out_queues
+        outputs = [ i for i in range( len( queues ) ) if queues[i] ]
+        batch_items = self._batch_items
+        sessions = self._src_obj.sessions
+        talkers = self.talkers
+        distinct = self.distinct
+        forwarder = self.forwarder
+        data_lists = self._data_lists = [ [] for q in queues ]
+        data_list_times = self._data_list_times = [ 0 for q in queues ]
+        data_list_bytes = self._data_list_bytes = [ 0 for q in queues ]
+        traces = self._traces = [ [] for q in queues ]
+        self._data_list_targets = [ self._data_list_min for q in queues ]
 
         while True:
-            if cflowd_data_list or ipfix_data_list:
-                now = time.time()           # Compute minimum timeout
-                if cflowd_data_list:
-                    t1 = now - cflowd_data_list_time
-                else:
-                    t1 = 0
-                if ipfix_data_list:
-                    t2 = now - ipfix_data_list_time
-                else:
-                    t2 = 0
-                timeout = self._max_time_in_list - max( [t1, t2] )
+            if any( data_lists ):
+                timeout = self._max_time_in_list - ( time.monotonic() -
+                    min( [ data_list_times[i] for i in outputs
+                                                    if data_lists[i] ] ) )
 
                 if timeout > 0:
                     try:
@@ -175,36 +391,37 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
             else:
                 items = self._queue.get( block=True )
 
-            now = time.time()
-            if ipfix_data_list:
-                if (len(ipfix_data_list) > self._data_list_max or
-                        (now - ipfix_data_list_time > self._max_time_in_list)
-                    ):
-                    self._ipfix_queue.put( ipfix_data_list )
-                    ipfix_data_list = []
-
-            if cflowd_data_list:
-                if (len(cflowd_data_list) > self._data_list_max or
-                        (now - cflowd_data_list_time > self._max_time_in_list)
-                    ):
-                    self._cflowd_queue.put( cflowd_data_list )
-                    cflowd_data_list = []
-
-            if not items:
+            if not items:                   # Timed out, flush old lists
+                self._flush_data_lists( 0 )
                 continue
 
+            now = time.monotonic()
+            self.metric_packets += len( items )
+            batch_items.observe( len( items ) )
+            backlog = self._queue.qsize()
+            self._max_qsize = max( self._max_qsize, backlog )
+
             for t in items:
                 p = t[ t_p ]
                 p_len = t[ t_p_len ]
 
                 if p_len == 0 and self.should_stop():
-                    self._do_stop( ipfix_data_list, cflowd_data_list )
+                    self._do_stop()
                     return
+                elif p_len == 0 and sessions:
+                    ipfixd_app.cflowd.end_session( t[ t_address ],
+                                                            t[ t_port ] )
+                    continue
                 elif p_len < 2:
                     log().info( 'INFO: main: short packet, len=%d', p_len )
+                    self.metric_short_packets += 1
                     continue
 
-                self._max_qsize = max( self._max_qsize, self._queue.qsize() )
+                if len( t ) > t_trace:
+                    trace = t[ t_trace ]
+                    trace.stamp( 'dequeue' )
+                else:
+                    trace = None
 
                 try:
                     rtn = dispatch[ ipfixd_app.header.netflow_version( p ) ]
@@ -215,19 +432,140 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
                     self._unknown_packet( t )
                     continue
 
-                dispatch_arg_list[ 2 ] = t
-                ( cflowd_data, ipfix_data ) = rtn( *dispatch_arg_list ) # CALL!
+                dispatch_arg_list[ 3 ] = t
+                try:
+                    results = rtn( *dispatch_arg_list ) # CALL!
+                except ( ValueError, struct.error ):    # Truncated, etc.
+                    self._bad_packet( t )
+                    continue
+
+                if trace:
+                    trace.stamp( 'decode' )
+
+                if talkers and results[ self._talkers_result ]:
+                    talkers.add( results[ self._talkers_result ] )
+                if distinct and results[ self._distinct_result ]:
+                    distinct.add( t[ t_address ],
+                                        results[ self._distinct_result ] )
+
+                for i in outputs:
+                    r = results[ out_results[i] ]
+                    if r:
+                        if not data_lists[i]:
+                            data_list_times[i] = now
+                        data_lists[i].append( r )
+                        data_list_bytes[i] += len( r )
+                        if trace:           # Follow the first output only
+                            data_lists[i].append( trace )
+                            traces[i].append( trace )
+                            trace = None
+
+            if forwarder:
+                forwarder.forward( items )
+            else:
+                self._src_obj.return_buffs( items )
+            self._flush_data_lists( backlog )
+
+    def _flush_data_lists( self, backlog ):
+
+        """
+        Puts the data lists that are ready on their writer queues,
+        and adjusts the target sizes.  See _process_loop.
 
-                if cflowd_data:
-                    if not cflowd_data_list:
-                        cflowd_data_list_time = time.time()
-                    cflowd_data_list.append( cflowd_data )
-                if ipfix_data:
-                    if not ipfix_data_list:
-                        ipfix_data_list_time = time.time()
-                    ipfix_data_list.append( ipfix_data )
+        Args:
+            backlog: Items waiting on the input queue
+        """
 
-            self._src_obj.return_buffs( items )
+        data_lists = self._data_lists
+        targets = self._data_list_targets
+        now = time.monotonic()
+
+        for i in range( len( data_lists ) ):
+            if not data_lists[i]:
+                continue
+
+            writer_backlog = self._out_queues[i].qsize()
+            if len( data_lists[i] ) >= targets[i]:
+                self.metric_flush_size += 1
+            elif now - self._data_list_times[i] >= self._max_time_in_list:
+                self.metric_flush_latency += 1
+            elif not backlog and not writer_backlog:
+                self.metric_flush_idle += 1
+            else:
+                continue
+
+            if writer_backlog or backlog > targets[i]:
+                targets[i] = min( targets[i] * 2, self._data_list_max )
+            elif not backlog:
+                targets[i] = max( targets[i] // 2, self._data_list_min )
+
+            self._put_data_list( i )
+
+    def _put_data_list( self, i ):
+
+        """
+        Puts a data list on its writer queue, and starts a new one.
+        With --overload shed, a list that doesn't fit under the
+        queue's byte limit is thrown away, or sampled with
+        --shed-sample, instead of waiting for the writer.  Every
+        buffer thrown away is counted, see _shed.
+
+        Args:
+            i: The output index
+        """
+
+        data_list = self._data_lists[i]
+        nbytes = self._data_list_bytes[i]
+        q = self._out_queues[i]
+
+        for trace in self._traces[i]:
+            trace.stamp( 'enqueue' )
+        self._flush_items.observe( len( data_list ) )
+
+        self._data_lists[i] = []
+        self._data_list_bytes[i] = 0
+        self._traces[i] = []
+
+        if not self._shed_policy:
+            q.put( data_list, nbytes=nbytes )
+            return
+
+        if self._shed_sample and q.maxbytes and q.bytes >= q.maxbytes // 2:
+            data_list = self._shed( i, data_list, self._shed_sample )
+            nbytes = sum( len( b ) for b in data_list )
+
+        try:
+            q.put( data_list, block=False, nbytes=nbytes )
+        except queue.Full:
+            self._shed( i, data_list, 0 )
+
+    def _shed( self, i, data_list, keep ):
+
+        """
+        Throws away output buffers and counts them.
+
+        Args:
+            i: The output index, for the counters
+            data_list: The buffers.  Traces in it are dropped.
+            keep: Keep one buffer in this many, 0 to keep none
+
+        Returns:
+            The buffers kept.
+        """
+
+        kept = []
+        n = 0
+        for b in data_list:
+            if b.__class__ is Trace:
+                continue
+            if keep and n % keep == 0:
+                kept.append( b )
+            else:
+                self.metric_shed_items[i] += 1
+                self.metric_shed_bytes[i] += len( b )
+            n += 1
+
+        return( kept )
 
     def _unknown_packet( self, t ):
 
@@ -239,12 +577,70 @@ class Packet( ipfixd_app.ipfixd_thread.IPFixdThread ):
                 top of this module.
         """
 
+        self.metric_unknown_packets += 1
+        ipfixd_app.cflowd.count_decode_error( t )
+
         h=self.header_fmt.unpack_from( t[ t_p ] )
         p = t[ t_p ]
         p_len = t[ t_p_len ]
 
         log().info( 'ERROR: Received a packet from %s, type: %d, '
-            'len = %d, unknown type.' % ( t[ t_address ], h[0], p_len ) )
+            'len = %d, unknown type.',
+                ipfixd_app.util.format_address( t[ t_address ] ),
+                h[0], p_len )
+
+    def _bad_packet( self, t ):
+
+        """
+        Handles a packet the decoder choked on, usually a length that
+        runs past the end of the packet.  Before, this stopped the
+        thread.
+
+        Args:
+            t: Tuple in standard format.  See the t_* constants at the
+                top of this module.
+        """
+
+        self.metric_decode_errors += 1
+        ipfixd_app.cflowd.count_decode_error( t )
+
+        log().info( 'ERROR: Could not decode a packet from %s, len = %d.',
+            ipfixd_app.util.format_address( t[ t_address ] ), t[ t_p_len ] )
+
+    def print_metrics( self ):
+
+        """
+        Logs the packet counts since the last call.
+        """
+
+        d = ipfixd_app.metrics.deltas( self, [ 'metric_packets',
+                    'metric_unknown_packets', 'metric_short_packets',
+                    'metric_decode_errors', 'metric_flush_size',
+                    'metric_flush_latency', 'metric_flush_idle' ] )
+        self.metric_shed = sum( self.metric_shed_items )
+        d.update( ipfixd_app.metrics.deltas( self, [ 'metric_shed' ] ) )
+        if self._sampler:
+            self.metric_sampled_in = self._sampler.records_in
+            self.metric_sampled_kept = self._sampler.records_kept
+        else:
+            self.metric_sampled_in = self.metric_sampled_kept = 0
+        d.update( ipfixd_app.metrics.deltas( self, [ 'metric_sampled_in',
+                                                'metric_sampled_kept' ] ) )
+
+        log().info( 'INFO: %s: packets: %d, unknown: %d, short: %d, '
+            'decode errors: %d, flushes size/latency/idle: %d/%d/%d, '
+            'shed: %d, sampled records kept: %d/%d' %
+            ( self.name,
+                d[ 'metric_packets' ],
+                d[ 'metric_unknown_packets' ],
+                d[ 'metric_short_packets' ],
+                d[ 'metric_decode_errors' ],
+                d[ 'metric_flush_size' ],
+                d[ 'metric_flush_latency' ],
+                d[ 'metric_flush_idle' ],
+                d[ 'metric_shed' ],
+                d[ 'metric_sampled_kept' ],
+                d[ 'metric_sampled_in' ] ) )
 
     def qsize( self ):
         m = self._max_qsize
@@ -4,6 +4,13 @@ listen on runs in its own thread.  Packets are read from the
 network and dumped on the associated Queue.  Very little work in
 done here.
 
+UDP ports are handled by Socket.  TCP ports are handled by TCPSocket,
+which accepts any number of exporter connections and chops each
+stream into IPFIX messages so the queue looks the same as for UDP.
+When the last connection from an exporter closes, an item with no
+bytes follows its messages, so the packet thread can forget the
+exporter's templates, which belong to the session.
+
 Packets are read into a free allocated bytearray obtained from
 the free_queue.  After the buffer is processed, it must be re-added
 to the free queue or we will run out of buffers.
@@ -16,6 +23,8 @@ objects from the network.
 """
 
 import socket
+import selectors
+import struct
 import time
 import sys
 import threading
@@ -23,9 +32,35 @@ import queue
 from ipfixd_app.ipfixd_log import log
 import ipfixd_app.ipfixd_thread
 import ipfixd_app.ipfixd_queue
+import ipfixd_app.util
+import ipfixd_app.metrics
+import ipfixd_app.trace
+from ipfixd_app.capture import capture_record
 
 import enum
 
+_ipfix_frame_struct = struct.Struct( '!HH' )    # IPFIX version and length
+
+#
+# Linux socket options the socket module does not always define.
+# SO_RXQ_OVFL adds the socket's kernel drop count to received
+# datagrams.  SO_MEMINFO returns the socket's memory use, the first
+# item being the bytes used by the receive queue.
+#
+
+if sys.platform.startswith( 'linux' ):
+    _SO_RXQ_OVFL = getattr( socket, 'SO_RXQ_OVFL', 40 )
+    _SO_MEMINFO = getattr( socket, 'SO_MEMINFO', 55 )
+    _SO_RCVBUFFORCE = getattr( socket, 'SO_RCVBUFFORCE', 33 )
+else:
+    _SO_RXQ_OVFL = None
+    _SO_MEMINFO = None
+    _SO_RCVBUFFORCE = None
+
+_rxq_ovfl_struct = struct.Struct( '=I' )
+_rxq_ovfl_cmsg_size = socket.CMSG_SPACE( _rxq_ovfl_struct.size )
+_meminfo_struct = struct.Struct( '=9I' )
+
 class ReadListReasons(enum.Enum):
     large_list = 1,
     timeout = 2,
@@ -49,7 +84,13 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
     packet to the port.
     """
 
-    def __init__( self, port, profile=False, max_queue_size=50000 ):
+    _reader_type = 'socket'
+    _transport = 'udp'
+    sessions = False        # Items with no bytes end a session
+
+    def __init__( self, port, profile=False, max_queue_size=50000,
+        bind_address=None, buff_size=1024*4, capture_writer=None,
+        trace_every=0 ):
 
         """
         Returns a thread object.  Call start on it to cause it
@@ -62,12 +103,48 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
 
         Args:
             port: The port to listen on.
+            bind_address: The address to listen on.  By default we
+                listen on all addresses, using a dual-stack IPv6
+                socket if the host supports IPv6.
+            buff_size: The size of each buffer in the free list.
+            capture_writer: If given, a capture Writer.  Every
+                datagram is also written to it with its arrival
+                time.  See ipfixd_app.capture.
+            trace_every: Trace one packet in this many through the
+                pipeline, 0 for none.  See ipfixd_app.trace.
         """
 
-        name = 'Port %d socket reader' % port
+        if bind_address:
+            name = 'Port [%s]:%d %s reader' % ( bind_address, port,
+                                                    self._reader_type )
+        else:
+            name = 'Port %d %s reader' % ( port, self._reader_type )
         self.port = port
+        self.bind_address = bind_address
+        self._family = socket.AF_INET
         self._queue_size = max_queue_size
 
+# Exporter addresses are converted to packed 16 byte keys.  Cache
+# the conversion so the read loop only pays for it once per exporter.
+
+        self._exporter_keys = {}
+
+# Capture records are collected in _capture_list and put on the
+# capture writer's queue along with the read_list.
+
+        if capture_writer:
+            self._capture_queue = capture_writer.queue()
+            self._capture_list = []
+        else:
+            self._capture_queue = None
+            self._capture_list = None
+        self.metric_capture_dropped = 0
+
+        if trace_every:
+            self._tracer = ipfixd_app.trace.Tracer( port, trace_every )
+        else:
+            self._tracer = None
+
         ipfixd_app.ipfixd_thread.IPFixdThread.__init__(
                     self, name=name, profile=profile, target=self.read_loop )
         self.daemon = True
@@ -84,11 +161,89 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
         self._queue = ipfixd_app.ipfixd_queue.IterQueue(
                                     maxsize = max_queue_size )
         self._max_qsize = 0
-        self._buff_size = 1024*4
+        self._buff_size = buff_size
+
+# Kernel side information.  See _set_socket_buffer, _enable_rxq_ovfl
+# and sample_rx_queue.  _kernel_drops is the drop count from the last
+# datagram that carried one.
+
+        self._rcvbuf = 0
+        self._rxq_ovfl = False
+        self._kernel_drops = 0
+        self._kernel_drops_seen = 0
+        self._sample_rx_queue = False
+        self._rx_queue_sample_time = 0
+        self.metric_kernel_drops = 0
+        self.metric_kernel_drop_batches = 0
+        self.metric_rx_queue = 0
+        self.metric_rx_queue_max = 0
+
+        self._fill_free_queue()
+
+        self.read_list_management( [], ReadListReasons.none )
+        self.free_list_management( [], FreeListReasons.none )
+        self._register_metrics()
+
+    def _fill_free_queue( self ):
+
+        """
+        Allocates the buffers.  Called once, by __init__.
+        """
 
         self._free_queue.put( [ bytearray( self._buff_size )
-                                    for i in range( max_queue_size ) ] )
-        self._free_len = max_queue_size
+                                    for i in range( self._queue_size ) ] )
+        self._free_len = self._queue_size
+
+    def _register_metrics( self ):
+
+        """
+        Adds our counters to the metrics registry.  The registry reads
+        the metric_* attributes when scraped, see ipfixd_app.metrics.
+        """
+
+        labels = { 'port': str( self.port ), 'transport': self._transport }
+        Counter = ipfixd_app.metrics.Counter
+        Gauge = ipfixd_app.metrics.Gauge
+
+        for m in (
+            Counter( 'ipfixd_socket_datagrams_total',
+                'Datagrams or TCP messages read.', labels,
+                lambda: self.metric_io_read_result ),
+            Counter( 'ipfixd_socket_read_list_flushes_total',
+                'Read lists put on the packet queue.', labels,
+                lambda: self.metric_read_list_cnt ),
+            Counter( 'ipfixd_socket_read_list_items_total',
+                'Items put on the packet queue.', labels,
+                lambda: self.metric_read_list_total ),
+            Counter( 'ipfixd_socket_free_list_exhausted_total',
+                'Times the reader waited for the packet thread to return '
+                'buffers.', labels,
+                lambda: self.metric_free_list_exhausted ),
+            Counter( 'ipfixd_socket_kernel_drops_total',
+                'Datagrams the kernel dropped, from SO_RXQ_OVFL.', labels,
+                lambda: self.metric_kernel_drops ),
+            Counter( 'ipfixd_socket_capture_dropped_total',
+                'Capture records dropped because the capture writer was '
+                'behind.', labels,
+                lambda: self.metric_capture_dropped ),
+            Gauge( 'ipfixd_socket_rcvbuf_bytes',
+                'Kernel receive buffer size granted.', labels,
+                lambda: self._rcvbuf ),
+            Gauge( 'ipfixd_socket_rx_queue_bytes',
+                'Bytes waiting in the kernel receive queue, last sample.',
+                labels, lambda: self.metric_rx_queue ),
+            Gauge( 'ipfixd_queue_items',
+                'Items waiting on the queue.',
+                dict( labels, thread='socket' ),
+                lambda: self._queue.qsize() ) ):
+            ipfixd_app.metrics.registry.register( m )
+
+        for reason in ( 'large_list', 'timeout', 'blocked_io' ):
+            ipfixd_app.metrics.registry.register( Counter(
+                'ipfixd_socket_read_list_reason_total',
+                'Read list flushes by reason.',
+                dict( labels, reason=reason ),
+                lambda r='metric_read_list_' + reason: getattr( self, r ) ) )
 
     def qsize( self ):
 
@@ -123,6 +278,51 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
 
         return( self._queue )
 
+    def _new_socket( self, sock_type ):
+
+        """
+        Creates a socket for the bind address.  With no bind address,
+        we try for a dual-stack IPv6 socket that also accepts IPv4
+        exporters, and fall back to IPv4 if IPv6 is not available.
+
+        Args:
+            sock_type: socket.SOCK_DGRAM, etc.
+
+        Returns:
+            The socket and the address to bind it to.
+        """
+
+        if self.bind_address and ':' not in self.bind_address:
+            family = socket.AF_INET
+            address = self.bind_address
+        elif self.bind_address:
+            family = socket.AF_INET6
+            address = self.bind_address
+        elif socket.has_ipv6:
+            family = socket.AF_INET6
+            address = '::'
+        else:
+            family = socket.AF_INET
+            address = ''
+
+        try:
+            s = socket.socket( family, sock_type )
+        except OSError:
+            if self.bind_address:
+                raise
+            log().info( 'INFO: IPv6 not available, %s listening on IPv4.' %
+                self.name )
+            family = socket.AF_INET
+            address = ''
+            s = socket.socket( family, sock_type )
+
+        if family == socket.AF_INET6:           # Accept IPv4 too
+            s.setsockopt( socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0 )
+
+        self._family = family
+
+        return( s, address )
+
     def _make_socket( self ):
 
         """
@@ -130,47 +330,154 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
         and 'sel'.
         """
 
-        self.s = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        ( self.s, address ) = self._new_socket( socket.SOCK_DGRAM )
         self.s.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
         self._set_socket_buffer()
+        self._enable_rxq_ovfl()
+        self._sample_rx_queue = True
 
         try:
-            self.s.bind( ('', self.port) )
+            self.s.bind( (address, self.port) )
         except OSError as e:
             log().error( 'ERROR: bind, errno=%d: %s' % ( e.errno, e.strerror ))
             ipfixd_app.main.stop_all_threads()
             time.sleep(2)       # Race conditions...
-            self._queue.put( [[('0.0.0.0','0'), self.port, bytearray( 0 ), 0]] )
+            self._queue.put( [[bytes( 16 ), self.port, bytearray( 0 ), 0]] )
             log().info( 'ERROR: Thread %s stopping because of error.',
                 self.name )
             raise
 
         self.s.settimeout( 2 )
 
+    def _exporter_key( self, ip ):
+
+        """
+        Returns the packed 16 byte key for an exporter address string
+        and caches it.  See ipfixd_app.util.exporter_key.
+        """
+
+        if len( self._exporter_keys ) > 65536:   # Don't grow forever
+            self._exporter_keys.clear()
+
+        key = self._exporter_keys[ ip ] = ipfixd_app.util.exporter_key( ip )
+
+        return( key )
+
+    def wakeup( self ):
+
+        """
+        Sends a zero length packet to the port.  If the thread was asked
+        to stop, this causes the socket thread and threads depending on
+        it to stop.
+        """
+
+        if self.bind_address and self.bind_address not in ( '::', '0.0.0.0' ):
+            host = self.bind_address
+        elif self._family == socket.AF_INET6:
+            host = '::1'
+        else:
+            host = '127.0.0.1'
+
+        ws = socket.socket( self._family, socket.SOCK_DGRAM )
+        ws.sendto( bytearray(0), ( host, self.port ) )
+        ws.close()
+
     def _set_socket_buffer( self ):
 
         """
         This routine attempts to maximize the size of the OS buffer
-        associated with the socket.
+        associated with the socket.  The kernel quietly caps SO_RCVBUF
+        at net.core.rmem_max, so we try SO_RCVBUFFORCE first, which
+        works when running as root, and then read back what we really
+        got.  Linux reports double the size asked for, to allow for
+        its own overhead.
         """
 
-        size = 2<<24            # 16MB
+        size = 2<<24            # 32MB
 
-        while size > 2048:
+        try:
+            self.s.setsockopt( socket.SOL_SOCKET, _SO_RCVBUFFORCE, size )
+        except ( OSError, TypeError ):
             try:
                 self.s.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, size )
-                break
-            except KeyError:    # bogus
-                size /= 2
+            except OSError as e:
+                log().error( 'ERROR: %s: Setting SO_RCVBUF, errno=%d: %s' %
+                                        ( self.name, e.errno, e.strerror ) )
 
-        if size == 2048:
-            log().error( 'ERROR: Error setting SO_RCVBUF.  Got to 2K.' )
+        self._rcvbuf = self.s.getsockopt( socket.SOL_SOCKET,
+                                                        socket.SO_RCVBUF )
+
+        if self._rcvbuf < size:
+            log().warn( 'WARN: %s: Asked for a %d byte receive buffer, '
+                'got %d.  Raise net.core.rmem_max.' %
+                ( self.name, size, self._rcvbuf ) )
+        else:
+            log().info( 'INFO: Set receive buffer for port %d to %d.' %
+                            (self.port, self._rcvbuf ) )
+
+    def _enable_rxq_ovfl( self ):
+
+        """
+        Asks the kernel to add its drop counter for the socket to
+        received datagrams, Linux only.  The read loops then use
+        recvmsg_into instead of recvfrom_into.  See _note_kernel_drops.
+        """
+
+        if _SO_RXQ_OVFL is None:
             return
 
-        log().info( 'INFO: Set receive buffer for port %d to %d.' %
-                        (self.port, size ) )
+        try:
+            self.s.setsockopt( socket.SOL_SOCKET, _SO_RXQ_OVFL, 1 )
+            self._rxq_ovfl = True
+        except OSError as e:
+            log().info( 'INFO: %s: SO_RXQ_OVFL not available, errno=%d: %s' %
+                                        ( self.name, e.errno, e.strerror ) )
+
+    def _note_kernel_drops( self, ancdata ):
+
+        """
+        Saves the drop counter from the ancillary data recvmsg_into
+        returned.  The counter is the total for the socket, and is only
+        sent once the kernel has dropped something.  read_list_management
+        turns it into a count of new drops.
+
+        Args:
+            ancdata: The ancillary data list from recvmsg_into
+        """
+
+        for ( level, cmsg_type, data ) in ancdata:
+            if level == socket.SOL_SOCKET and cmsg_type == _SO_RXQ_OVFL:
+                self._kernel_drops = _rxq_ovfl_struct.unpack_from( data )[0]
 
-    def free_list_management( self, free_list, reason ):
+    def sample_rx_queue( self ):
+
+        """
+        Samples the bytes waiting in the kernel receive queue.  Uses
+        SO_MEMINFO if the kernel has it, otherwise /proc/net/udp.  If
+        neither works, sampling is turned off.
+
+        Returns:
+            The bytes in the receive queue, or None.
+        """
+
+        self._rx_queue_sample_time = time.monotonic()
+
+        try:
+            rx_queue = _meminfo_struct.unpack( self.s.getsockopt(
+                socket.SOL_SOCKET, _SO_MEMINFO, _meminfo_struct.size ) )[0]
+        except ( OSError, TypeError, struct.error ):
+            stats = ipfixd_app.util.udp_socket_stats( self.port )
+            if stats is None:
+                self._sample_rx_queue = False
+                return( None )
+            rx_queue = stats[0]
+
+        self.metric_rx_queue = rx_queue
+        self.metric_rx_queue_max = max( self.metric_rx_queue_max, rx_queue )
+
+        return( rx_queue )
+
+    def free_list_management( self, free_list, reason, block=True ):
 
         """
         This routine is used to obtain buffers from the free
@@ -185,6 +492,8 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
             reason: An enum from class FreeListReason.  With value
                 FreeListReason.none, the counters are reset to zero
                 and the routine exits.  This is how to init info.
+            block: If False, return with an empty free_list instead of
+                waiting for the packet thread to return buffers.
         """
 
         if reason == FreeListReasons.none:
@@ -209,9 +518,12 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
         except queue.Empty:     # This really shouldn't happen. Meh.
             pass
 
+        if not free_list and not block:
+            return
+
         if not free_list:           # Exhausted free list
             if not self.first_time: # Shouldn't generally happen
-                log().warn( 'WARN: Exhausted socket free list %s' %
+                log().warn( 'WARN: Exhausted socket free list %s',
                                                 self.name )
 
             free_list.extend( self._free_queue.get( block=True ) )
@@ -219,12 +531,12 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
 
             if not self.first_time:
                 log().info( 'INFO: Exhausted socket free list '
-                        'relieved %s' % self.name )
+                        'relieved %s', self.name )
                 self.metric_free_list_exhausted += 1
             else:
                 self.first_time = False
 
-    def read_list_management( self, read_list, reason ):
+    def read_list_management( self, read_list, reason, block=True ):
 
         """
         This routine is used to manage copying information from the
@@ -236,6 +548,9 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
             reason: An enum from class ReadListReasons.  With value
                 ReadListReasons.none, the counters are reset to zero
                 and the routine exits.  This is how to init info.
+            block: If False, the capture records are dropped and
+                counted rather than waiting for room on the capture
+                writer's queue.
         """
 
         if reason == ReadListReasons.none:
@@ -250,6 +565,9 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
             self.metric_io_read_result = 0
             self.metric_io_non_blocking_result = 0
             self.metric_io_timeout_result = 0
+            self.metric_kernel_drops = 0
+            self.metric_kernel_drop_batches = 0
+            self.metric_rx_queue_max = 0
             return
 
         self.metric_read_list_cnt += 1
@@ -267,42 +585,81 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
         self._max_qsize = max( self._queue.qsize(),
                                             self._max_qsize)
 
+        if self._capture_list:
+            try:
+                self._capture_queue.put( self._capture_list, block=block )
+            except queue.Full:
+                self.metric_capture_dropped += len( self._capture_list )
+            self._capture_list[:] = []
+
+        if self._kernel_drops != self._kernel_drops_seen:
+            self.metric_kernel_drops += ( ( self._kernel_drops -
+                                    self._kernel_drops_seen ) & 0xffffffff )
+            self.metric_kernel_drop_batches += 1
+            self._kernel_drops_seen = self._kernel_drops
+
+        if self._sample_rx_queue and ( time.monotonic() -
+                                    self._rx_queue_sample_time >= 1.0 ):
+            self.sample_rx_queue()
+
     def print_metrics( self ):
 
         """
         This routine will prints some stats that help tune the code.
+        The counts are the change since the last call, the counters
+        themselves are never reset.  See ipfixd_app.metrics.
         """
 
+        d = ipfixd_app.metrics.deltas( self, [
+            'metric_read_list_cnt', 'metric_read_list_large_list',
+            'metric_read_list_timeout', 'metric_read_list_blocked_io',
+            'metric_read_list_total', 'metric_free_list_large_list',
+            'metric_free_list_blocked_io', 'metric_free_list_empty',
+            'metric_io_non_blocking', 'metric_io_timeout',
+            'metric_io_blocking', 'metric_io_non_blocking_result',
+            'metric_io_timeout_result', 'metric_io_read_result',
+            'metric_kernel_drops', 'metric_kernel_drop_batches' ] )
+
         log().info( 'INFO: %s: Read list outputs: %d, large_list: %d, '
             'timeout: %d, blocked_io: %d, total: %d, average %d' %
             ( self.name,
-                self.metric_read_list_cnt,
-                self.metric_read_list_large_list,
-                self.metric_read_list_timeout,
-                self.metric_read_list_blocked_io,
-                self.metric_read_list_total,
-                self.metric_read_list_total // self.metric_read_list_cnt ))
+                d[ 'metric_read_list_cnt' ],
+                d[ 'metric_read_list_large_list' ],
+                d[ 'metric_read_list_timeout' ],
+                d[ 'metric_read_list_blocked_io' ],
+                d[ 'metric_read_list_total' ],
+                d[ 'metric_read_list_total' ] //
+                                    max( d[ 'metric_read_list_cnt' ], 1 ) ))
 
         log().info( 'INFO: %s: Free list counts: large_list: %d, '
             'blocked_io: %d, empty: %d' %
             ( self.name,
-                self.metric_free_list_large_list,
-                self.metric_free_list_blocked_io,
-                self.metric_free_list_empty ))
+                d[ 'metric_free_list_large_list' ],
+                d[ 'metric_free_list_blocked_io' ],
+                d[ 'metric_free_list_empty' ] ))
 
         log().info( 'INFO: %s: IO Types non_blocking/timeout/blocking: '
             '%d/%d/%d, Results non_blocking/timeout/read: '
             '%d/%d/%d' %
             ( self.name,
-                self.metric_io_non_blocking,
-                self.metric_io_timeout,
-                self.metric_io_blocking,
-                self.metric_io_non_blocking_result,
-                self.metric_io_timeout_result,
-                self.metric_io_read_result ) )
-
-        self.read_list_management( [], ReadListReasons.none )
-        self.free_list_management( [], FreeListReasons.none )
+                d[ 'metric_io_non_blocking' ],
+                d[ 'metric_io_timeout' ],
+                d[ 'metric_io_blocking' ],
+                d[ 'metric_io_non_blocking_result' ],
+                d[ 'metric_io_timeout_result' ],
+                d[ 'metric_io_read_result' ] ) )
+
+        if self._sample_rx_queue:
+            log().info( 'INFO: %s: Kernel rcvbuf: %d, drops: %d in %d '
+                'batches, rx queue: %d, max %d' %
+                ( self.name,
+                    self._rcvbuf,
+                    d[ 'metric_kernel_drops' ],
+                    d[ 'metric_kernel_drop_batches' ],
+                    self.metric_rx_queue,
+                    self.metric_rx_queue_max ) )
+
+        self.metric_rx_queue_max = 0
 
     def request_stop( self, read_list ):
 
@@ -316,6 +673,10 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
             self._queue.put( read_list )
             self._max_qsize = max(self._queue.qsize(), self._max_qsize)
 
+        if self._capture_queue:
+            self._capture_queue.put( self._capture_list + [ bytearray(0) ] )
+            self._capture_list[:] = []
+
         log().info( 'INFO: Thread %s stopping by request', self.name )
 
     def return_buffs( self, m_objs ):
@@ -350,6 +711,10 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
         is received, then the thread will gracefully stop.
         Additionally, a tuple with a zero length buffer is added
         to the queue to tell other threads to stop.
+
+        The address in the tuple is the packed 16 byte form of the
+        sender's address, not the tuple returned by recvfrom.  See
+        ipfixd_app.util.exporter_key.
         """
 
         if self._profile:
@@ -384,6 +749,10 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
 
         read_list = []
         free_list = []
+        exporter_keys = self._exporter_keys
+        capture_list = self._capture_list
+        tracer = self._tracer
+        rxq_ovfl = self._rxq_ovfl
         read_list_reason = ReadListReasons.none
         free_list_reason = FreeListReasons.none
         self.read_list_management( read_list, read_list_reason )
@@ -431,7 +800,13 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
                 self.metric_io_blocking += 1
 
             try:
-                (nbytes, address) = self.s.recvfrom_into(free_list[-1],
+                if rxq_ovfl:
+                    ( nbytes, ancdata, flags, address ) = self.s.recvmsg_into(
+                                    [ free_list[-1] ], _rxq_ovfl_cmsg_size )
+                    if ancdata:
+                        self._note_kernel_drops( ancdata )
+                else:
+                    (nbytes, address) = self.s.recvfrom_into(free_list[-1],
                                             self._buff_size )
                 self.metric_io_read_result += 1
             except BlockingIOError:
@@ -444,8 +819,20 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
                 self.metric_io_timeout_result += 1
                 continue
 
+            try:
+                key = exporter_keys[ address[0] ]
+            except KeyError:
+                key = self._exporter_key( address[0] )
+
             buff = free_list.pop()
-            read_list.append( [ address, self.port, buff, nbytes ] )
+            read_list.append( [ key, self.port, buff, nbytes ] )
+            if capture_list is not None and nbytes:
+                capture_list.append( capture_record( time.time(), key,
+                                                self.port, buff, nbytes ) )
+            if tracer:
+                trace = tracer.sample()
+                if trace:
+                    read_list[-1].append( trace )
             if nbytes == 0 and self.should_stop():  # Stopping
                 self.request_stop( read_list )
                 if self._profile:
@@ -453,4 +840,375 @@ class Socket( ipfixd_app.ipfixd_thread.IPFixdThread ):
                     self._profile.dump_stats( "stats/" + self.name )
                 return( 0 )
 
+class TCPSocket( Socket ):
+
+    """
+    Handles a TCP port that IPFIX exporters connect to.  One thread
+    watches the listening socket and all the exporter connections
+    with a selector.  Each stream is framed into IPFIX messages using
+    the length in the message header.  Every message is copied into a
+    buffer from the free list, so the queue carries the same
+    [ address, port, buffer, length ] items as a UDP Socket.
+
+    The IPFIX message length is 16 bits, so buffers are 64K and any
+    message fits in one.  Since the buffers are big, they are
+    allocated as exporters connect, buffers_per_connection each up
+    to max_queue_size, and given back as they disconnect.  When the
+    free list runs dry we simply stop reading and TCP flow control
+    pushes back on the exporters.
+
+    Templates are scoped to the TCP session (RFC 7011, section 8).
+    When the last connection from an exporter closes, an item with
+    no bytes is queued after its messages, see
+    ipfixd_app.cflowd.end_session.
+
+    To get this thread to stop, call stop() and wakeup().
+    """
+
+    _reader_type = 'tcp'
+    _transport = 'tcp'
+    sessions = True
+    buffers_per_connection = 64
+
+    def __init__( self, port, profile=False, max_queue_size=1024,
+        bind_address=None, capture_writer=None, trace_every=0 ):
+
+        """
+        Returns a thread object.  Call start on it to cause it to
+        accept connections on the port.  See Socket.
+
+        Args:
+            port: The port to listen on.
+            bind_address: The address to listen on.  See Socket.
+            capture_writer: Each IPFIX message is captured.  See Socket.
+            trace_every: Messages to trace.  See Socket.
+        """
+
+        Socket.__init__( self, port, profile=profile,
+            max_queue_size=max_queue_size, bind_address=bind_address,
+            buff_size=2**16, capture_writer=capture_writer,
+            trace_every=trace_every )
+
+        self._connections = 0
+        self._sessions = {}             # Exporter key: connections
+        self.metric_tcp_accepts = 0
+        self.metric_tcp_closes = 0
+        self.metric_tcp_framing_errors = 0
+
+    def _fill_free_queue( self ):
+
+        """
+        Allocates no buffers.  See _add_buffers.
+        """
+
+        self._buffers = 0               # Allocated, free or not
+
+    def _add_buffers( self, free_list ):
+
+        """
+        Allocates buffers for a new connection, or frees the ones
+        closed connections no longer need.  Buffers out on the queue
+        are freed when they come back.
+
+        Args:
+            free_list: Where new buffers go, and extra ones come from
+        """
+
+        want = min( self._queue_size,
+                            self._connections * self.buffers_per_connection )
+        if self._buffers < want:
+            free_list.extend( bytearray( self._buff_size )
+                                    for i in range( want - self._buffers ) )
+            self._buffers = want
+        elif self._buffers > want and free_list:
+            n = min( self._buffers - want, len( free_list ) )
+            del free_list[ -n: ]
+            self._buffers -= n
+
+    def _spare_buffer( self, free_list ):
+
+        """
+        Returns a buffer for an item with no bytes, without waiting
+        for one to come back.
+        """
+
+        if free_list:
+            return( free_list.pop() )
+        self._buffers += 1
+
+        return( bytearray( self._buff_size ) )
+
+    def _register_metrics( self ):
+
+        """
+        Adds the connection counters to the Socket metrics.
+        """
+
+        Socket._register_metrics( self )
+
+        labels = { 'port': str( self.port ), 'transport': self._transport }
+        Counter = ipfixd_app.metrics.Counter
+
+        for m in (
+            ipfixd_app.metrics.Gauge( 'ipfixd_tcp_connections',
+                'Exporter connections open.', labels,
+                lambda: self._connections ),
+            Counter( 'ipfixd_tcp_accepts_total',
+                'Exporter connections accepted.', labels,
+                lambda: self.metric_tcp_accepts ),
+            Counter( 'ipfixd_tcp_closes_total',
+                'Exporter connections closed.', labels,
+                lambda: self.metric_tcp_closes ),
+            Counter( 'ipfixd_tcp_framing_errors_total',
+                'Connections closed for a bad IPFIX message header.', labels,
+                lambda: self.metric_tcp_framing_errors ) ):
+            ipfixd_app.metrics.registry.register( m )
+
+    def _make_socket( self ):
+
+        """
+        This method sets up the listening socket.  Sets the instance
+        attribute 's'.
+        """
+
+        ( self.s, address ) = self._new_socket( socket.SOCK_STREAM )
+        self.s.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+
+        try:
+            self.s.bind( (address, self.port) )
+            self.s.listen( 128 )
+        except OSError as e:
+            log().error( 'ERROR: bind, errno=%d: %s' % ( e.errno, e.strerror ))
+            ipfixd_app.main.stop_all_threads()
+            time.sleep(2)       # Race conditions...
+            self._queue.put( [[bytes( 16 ), self.port, bytearray( 0 ), 0]] )
+            log().info( 'ERROR: Thread %s stopping because of error.',
+                self.name )
+            raise
+
+        self.s.setblocking( False )
+
+    def wakeup( self ):
+
+        """
+        Connects to the port and hangs up.  This wakes up the selector
+        so the thread notices a stop request.
+        """
+
+        if self.bind_address and self.bind_address not in ( '::', '0.0.0.0' ):
+            host = self.bind_address
+        elif self._family == socket.AF_INET6:
+            host = '::1'
+        else:
+            host = '127.0.0.1'
+
+        try:
+            ws = socket.create_connection( ( host, self.port ), timeout=2 )
+            ws.close()
+        except OSError:
+            pass                # The selector times out anyway
+
+    def print_metrics( self ):
+
+        """
+        Adds the connection counts to the Socket metrics.
+        """
+
+        d = ipfixd_app.metrics.deltas( self, [ 'metric_tcp_accepts',
+                    'metric_tcp_closes', 'metric_tcp_framing_errors' ] )
+
+        log().info( 'INFO: %s: Connections: %d, accepts: %d, closes: %d, '
+            'framing errors: %d' %
+            ( self.name,
+                self._connections,
+                d[ 'metric_tcp_accepts' ],
+                d[ 'metric_tcp_closes' ],
+                d[ 'metric_tcp_framing_errors' ] ))
+
+        Socket.print_metrics( self )
+
+    def _accept( self, sel, free_list ):
+
+        """
+        Accepts a new exporter connection, registers it with the
+        selector and adds its buffers to the free_list.  The selector
+        data for a connection is a list of: the socket, the exporter
+        key, a receive buffer and the number of bytes in it.
+        """
+
+        try:
+            ( conn, address ) = self.s.accept()
+        except BlockingIOError:
+            return
+
+        conn.setblocking( False )
+        key = self._exporter_key( address[0] )
+        sel.register( conn, selectors.EVENT_READ,
+            [ conn, key, bytearray( 2**17 ), 0 ] )
+
+        self._connections += 1
+        self._sessions[ key ] = self._sessions.get( key, 0 ) + 1
+        self._add_buffers( free_list )
+        self.metric_tcp_accepts += 1
+        log().info( 'INFO: %s: connection from %s' % ( self.name,
+            ipfixd_app.util.format_address( key ) ) )
+
+    def _close( self, sel, c, reason, free_list, read_list ):
+
+        """
+        Closes an exporter connection.  Any partial message is lost.
+        If it was the exporter's last, its session ends.
+        """
+
+        sel.unregister( c[ 0 ] )
+        c[ 0 ].close()
+
+        self._sessions[ c[ 1 ] ] -= 1
+        if not self._sessions[ c[ 1 ] ]:
+            del self._sessions[ c[ 1 ] ]
+            read_list.append( [ c[ 1 ], self.port,
+                                        self._spare_buffer( free_list ), 0 ] )
+
+        self._connections -= 1
+        self.metric_tcp_closes += 1
+        log().info( 'INFO: %s: connection from %s closed, %s, '
+            '%d bytes discarded' % ( self.name,
+                ipfixd_app.util.format_address( c[ 1 ] ), reason, c[ 3 ] ) )
+
+    def _read_connection( self, sel, c, free_list, read_list ):
+
+        """
+        Reads what is available on a connection and moves all the
+        complete IPFIX messages to buffers on the read_list.  The
+        incomplete tail is moved to the front of the receive buffer.
+
+        Args:
+            sel: The selector
+            c: The connection's selector data.  See _accept.
+            free_list: Buffers to copy messages into
+            read_list: Where the messages go
+        """
+
+        ( conn, key, rbuff, filled ) = c
+
+        try:
+            nbytes = conn.recv_into( memoryview( rbuff )[ filled: ] )
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._close( sel, c, e.strerror, free_list, read_list )
+            return
+
+        if nbytes == 0:
+            self._close( sel, c, 'end of stream', free_list, read_list )
+            return
+
+        filled += nbytes
+        offset = 0
+
+        while filled - offset >= 4:
+            ( version, msg_len ) = _ipfix_frame_struct.unpack_from( rbuff,
+                                                                    offset )
+            if version != 10 or msg_len < 16:
+                self.metric_tcp_framing_errors += 1
+                c[ 3 ] = filled - offset
+                self._close( sel, c, 'bad message header, version %d, '
+                    'length %d' % ( version, msg_len ), free_list, read_list )
+                return
+            if filled - offset < msg_len:
+                break
+
+            if not free_list:       # Hand off what we have before waiting
+                if read_list:
+                    self.read_list_management( read_list,
+                                                ReadListReasons.large_list )
+                self.free_list_management( free_list, FreeListReasons.empty )
+            buff = free_list.pop()
+            buff[ :msg_len ] = rbuff[ offset:offset + msg_len ]
+            read_list.append( [ key, self.port, buff, msg_len ] )
+            if self._capture_list is not None:
+                self._capture_list.append( capture_record( time.time(),
+                                            key, self.port, buff, msg_len ) )
+            if self._tracer:
+                trace = self._tracer.sample()
+                if trace:
+                    read_list[-1].append( trace )
+            offset += msg_len
+
+        if offset:
+            rbuff[ :filled - offset ] = rbuff[ offset:filled ]
+        c[ 3 ] = filled - offset
+
+    def read_loop( self ):
+
+        """
+        This routine implements the main TCP read loop.  It accepts
+        connections and reads from all of them using a selector.
+        Complete messages are added to the read_list, and the
+        read_list is added to the queue when it gets large or when
+        there is nothing left to read.
+
+        If should_stop is True when the selector wakes up, the
+        read_list and a zero length item are added to the queue and
+        the thread stops.
+        """
+
+        if self._profile:
+            self._profile.enable()
+
+        try:
+            self._make_socket()     # Sets self.s
+        except OSError:
+            return( 0 )
+
+        read_list = []
+        free_list = []
+        self.read_list_management( read_list, ReadListReasons.none )
+        self.free_list_management( free_list, FreeListReasons.none )
+
+        sel = selectors.DefaultSelector()
+        sel.register( self.s, selectors.EVENT_READ, None )
+
+        while True:
+            if len( read_list ) >= ( self._queue_size // 2 ):
+                self.read_list_management( read_list,
+                                                ReadListReasons.large_list )
+            elif self._free_len >= ( self._buffers // 2 or 1 ):
+                self.free_list_management( free_list,
+                                                FreeListReasons.large_list )
+                self._add_buffers( free_list )  # Closed connections'
+
+            if read_list:
+                self.metric_io_non_blocking += 1
+                events = sel.select( 0 )            # Opportunistic work
+                if not events:
+                    self.metric_io_non_blocking_result += 1
+                    self.read_list_management( read_list,
+                                                ReadListReasons.blocked_io )
+                    continue
+            else:
+                self.metric_io_timeout += 1
+                events = sel.select( 2.0 )          # Notice stop requests
+                if not events:
+                    self.metric_io_timeout_result += 1
+
+            if self.should_stop():
+                read_list.append( [ bytes( 16 ), self.port,
+                                        self._spare_buffer( free_list ), 0 ] )
+                self.request_stop( read_list )
+                for k in list( sel.get_map().values() ):
+                    k.fileobj.close()
+                sel.close()
+                if self._profile:
+                    self._profile.disable()
+                    self._profile.dump_stats( "stats/" + self.name )
+                return( 0 )
+
+            for ( k, mask ) in events:
+                self.metric_io_read_result += 1
+                if k.data is None:
+                    self._accept( sel, free_list )
+                else:
+                    self._read_connection( sel, k.data, free_list, read_list )
+
 # End.
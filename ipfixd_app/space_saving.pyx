@@ -0,0 +1,312 @@
+"""
+This is cython module.  It needs to be converted to C and compiled before use.
+
+The Space-Saving heavy hitter sketch (Metwally, Agrawal and El Abbadi)
+over weighted keys, used for the top talkers, see ipfixd_app.talkers.
+It monitors a fixed number of keys with a counter each.  A key that
+is monitored has its weight added to its counter.  A key that is not
+takes over the counter with the smallest count, adding its weight to
+that count and remembering the old count as its error.  So the
+memory is fixed whatever the number of keys, every count is at most
+its error too high, and any key with more than total / counters of
+the weight is monitored.
+
+The counters are kept in a min heap on their counts, so the smallest
+is always at the top, and found from the key through an open
+addressing hash table of heap indexes.  When a key loses its counter
+it is taken out of the hash table with backward shift deletion, so
+there are no tombstones and probe chains stay short.
+
+Keys are 16 byte addresses.  4 byte IPv4 keys, native integers as in
+a cflowd record, are stored IPv4 mapped like the extended record, so
+both kinds of record can feed a sketch.
+
+Not thread safe.  ipfixd_app.talkers holds a lock around it.
+"""
+
+import cython
+
+from libc.stdint cimport uint8_t, uint32_t, uint64_t, int32_t
+from libc.string cimport memcpy, memset, memcmp
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+cdef struct counter:
+    uint8_t key[ 16 ]
+    uint64_t count
+    uint64_t error
+    uint32_t hash
+    uint32_t slot           # Index in the hash table
+
+cdef uint8_t _v4_mapped[ 12 ]
+memset( _v4_mapped, 0, 10 )
+_v4_mapped[ 10 ] = 0xff
+_v4_mapped[ 11 ] = 0xff
+
+cdef inline uint32_t _hash_key( uint8_t * key ) noexcept nogil:
+
+    """
+    FNV-1a over the 16 key bytes.
+    """
+
+    cdef uint32_t h = 2166136261U
+    cdef unsigned int i
+
+    for i in range( 16 ):
+        h = ( h ^ key[ i ] ) * 16777619U
+    return( h )
+
+cdef class SpaceSaving:
+
+    """
+    Top keys by weight in fixed memory.
+    """
+
+    cdef counter * _heap
+    cdef int32_t * _slots               # Heap index, -1 for empty
+    cdef unsigned int _max_counters
+    cdef unsigned int _num_counters
+    cdef unsigned int _mask             # Hash table size - 1
+
+    cdef unsigned int _record_len       # Input record layout
+    cdef unsigned int _key_offset
+    cdef unsigned int _key_len
+    cdef unsigned int _weight_offset
+    cdef unsigned int _weight_len
+
+    cdef readonly uint64_t total        # Weight added since the reset
+    cdef readonly uint64_t records      # Records added since the reset
+
+    def __cinit__( self ):
+        self._heap = NULL
+        self._slots = NULL
+
+    def __init__( self, counters, record_len, key_field, weight_field ):
+
+        """
+        Args:
+            counters: How many keys to monitor
+            record_len: The length of the input records
+            key_field: ( offset, len ) of the key in a record, a 16
+                byte address or a 4 byte native integer IPv4 address
+            weight_field: ( offset, len ) of the weight in a record,
+                a native unsigned integer of len 4 or 8
+        """
+
+        cdef unsigned int size = 16
+
+        if counters < 1 or key_field[1] not in ( 4, 16 ) or (
+                                            weight_field[1] not in ( 4, 8 ) ):
+            raise ValueError
+
+        while size < counters * 2:
+            size *= 2
+
+        self._heap = <counter *>PyMem_Malloc( counters * sizeof( counter ) )
+        self._slots = <int32_t *>PyMem_Malloc( size * sizeof( int32_t ) )
+        if self._heap == NULL or self._slots == NULL:
+            raise MemoryError()
+        self._max_counters = counters
+        self._mask = size - 1
+
+        self._record_len = record_len
+        ( self._key_offset, self._key_len ) = key_field
+        ( self._weight_offset, self._weight_len ) = weight_field
+
+        self.reset()
+
+    def __dealloc__( self ):
+        PyMem_Free( self._heap )
+        PyMem_Free( self._slots )
+
+    def __len__( self ):
+        return( self._num_counters )
+
+    property counters:
+        """The most keys monitored."""
+        def __get__( self ):
+            return( self._max_counters )
+
+    def reset( self ):
+
+        """
+        Forgets every key.
+        """
+
+        memset( self._slots, 0xff, ( self._mask + 1 ) * sizeof( int32_t ) )
+        self._num_counters = 0
+        self.total = 0
+        self.records = 0
+
+    cdef inline void _swap( self, unsigned int i,
+                                        unsigned int j ) noexcept nogil:
+
+        cdef counter c = self._heap[ i ]
+
+        self._heap[ i ] = self._heap[ j ]
+        self._heap[ j ] = c
+        self._slots[ self._heap[ i ].slot ] = i
+        self._slots[ self._heap[ j ].slot ] = j
+
+    cdef void _sift_up( self, unsigned int i ) noexcept nogil:
+
+        cdef unsigned int parent
+
+        while i:
+            parent = ( i - 1 ) // 2
+            if self._heap[ parent ].count <= self._heap[ i ].count:
+                break
+            self._swap( i, parent )
+            i = parent
+
+    cdef void _sift_down( self, unsigned int i ) noexcept nogil:
+
+        cdef unsigned int child
+        cdef unsigned int n = self._num_counters
+
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if ( child + 1 < n and self._heap[ child + 1 ].count <
+                                            self._heap[ child ].count ):
+                child += 1
+            if self._heap[ i ].count <= self._heap[ child ].count:
+                break
+            self._swap( i, child )
+            i = child
+
+    cdef void _unlink( self, unsigned int i ) noexcept nogil:
+
+        """
+        Removes hash table slot i, moving back the entries after it
+        that would no longer be found.
+        """
+
+        cdef unsigned int j = i
+        cdef unsigned int home
+        cdef unsigned int mask = self._mask
+
+        while True:
+            j = ( j + 1 ) & mask
+            if self._slots[ j ] < 0:
+                break
+            home = self._heap[ self._slots[ j ] ].hash & mask
+            if ( ( j - home ) & mask ) < ( ( j - i ) & mask ):
+                continue            # Still between home and j
+            self._slots[ i ] = self._slots[ j ]
+            self._heap[ self._slots[ i ] ].slot = i
+            i = j
+
+        self._slots[ i ] = -1
+
+    cdef void _add( self, uint8_t * key, uint64_t weight ) noexcept nogil:
+
+        cdef uint32_t h = _hash_key( key )
+        cdef unsigned int mask = self._mask
+        cdef unsigned int s = h & mask
+        cdef int32_t i
+        cdef counter * c
+
+        while True:
+            i = self._slots[ s ]
+            if i < 0:
+                break
+            c = &self._heap[ i ]
+            if c.hash == h and memcmp( c.key, key, 16 ) == 0:
+                c.count += weight
+                self._sift_down( i )
+                return
+            s = ( s + 1 ) & mask
+
+# Not monitored.  Take a new counter if there is one, else the
+# smallest.  Its slot is freed first, which may move the empty slot
+# found above, so look again.
+
+        if self._num_counters < self._max_counters:
+            i = self._num_counters
+            self._num_counters += 1
+            c = &self._heap[ i ]
+            c.count = weight
+            c.error = 0
+        else:
+            i = 0
+            c = &self._heap[ 0 ]
+            self._unlink( c.slot )
+            c.error = c.count
+            c.count += weight
+            s = h & mask
+            while self._slots[ s ] >= 0:
+                s = ( s + 1 ) & mask
+
+        memcpy( c.key, key, 16 )
+        c.hash = h
+        c.slot = s
+        self._slots[ s ] = i
+        if i:
+            self._sift_up( i )
+        else:
+            self._sift_down( 0 )
+
+    def add( self, const uint8_t[:] buff ):
+
+        """
+        Adds every record in a buffer.
+
+        Args:
+            buff: A buffer of records, as laid out in __init__
+        """
+
+        cdef:
+            unsigned int n
+            unsigned int cnt = buff.shape[0] // self._record_len
+            const uint8_t * p
+            const uint8_t * rec
+            uint8_t key[ 16 ]
+            uint64_t weight
+            uint32_t w32
+            uint32_t a32
+
+        if not cnt:
+            return
+        p = &buff[0]
+
+        with nogil:
+            memcpy( key, _v4_mapped, 12 )
+            for n in range( cnt ):
+                rec = p + n * self._record_len
+                if self._key_len == 4:
+                    memcpy( &a32, rec + self._key_offset, 4 )
+                    key[ 12 ] = a32 >> 24
+                    key[ 13 ] = ( a32 >> 16 ) & 0xff
+                    key[ 14 ] = ( a32 >> 8 ) & 0xff
+                    key[ 15 ] = a32 & 0xff
+                else:
+                    memcpy( key, rec + self._key_offset, 16 )
+                if self._weight_len == 4:
+                    memcpy( &w32, rec + self._weight_offset, 4 )
+                    weight = w32
+                else:
+                    memcpy( &weight, rec + self._weight_offset, 8 )
+                self._add( key, weight )
+                self.total += weight
+            self.records += cnt
+
+    def top( self, n ):
+
+        """
+        Returns the n keys with the largest counts, largest first, as
+        a list of ( packed 16 byte key, count, error ).  The real
+        weight of a key is between count - error and count.
+        """
+
+        cdef unsigned int i
+        cdef list l = []
+
+        for i in range( self._num_counters ):
+            l.append( ( bytes( self._heap[ i ].key[ :16 ] ),
+                            self._heap[ i ].count, self._heap[ i ].error ) )
+        l.sort( key=lambda c: c[1], reverse=True )
+
+        return( l[ :n ] )
+
+# End.
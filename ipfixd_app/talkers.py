@@ -0,0 +1,176 @@
+"""
+Top talkers per port.  With --top-talkers N, each port's packet
+thread feeds its decoded flow records to a TopTalkers, which keeps
+the bytes sent by each source address in a Space-Saving sketch (see
+ipfixd_app.space_saving) of 16 * N counters.  So the memory is fixed
+however many addresses there are.  The sketch is fed a whole
+converted buffer at a time, in C.
+
+The window is the port's output file.  When a writer rotates its
+temp file, the top N for the window are written next to it as JSON,
+talkers-<port>.<date>, and the sketch starts over.  A port with more
+than one output format has a writer per format, rotating at about
+the same time.  The first of them to rotate ends the window, and the
+others write that same window next to their files.  The window so
+far and the last complete one are on --metrics /status.
+
+A count can be too high by at most its error, and any address that
+sent more than the window's bytes / (16 * N) is sure to be listed.
+
+The packet thread adds and the writer's rename thread and the
+metrics server read, so a lock covers the sketch.  It is taken once
+per packet.
+"""
+
+import os
+import json
+import time
+import threading
+import ipfixd_app.util
+import ipfixd_app.metrics
+import ipfixd_app.cflowd
+import ipfixd_app.space_saving
+from ipfixd_app.ipfixd_log import log
+
+counters_per_talker = 16
+
+top_talkers = []            # Every TopTalkers, for /status
+
+class TopTalkers( object ):
+
+    """
+    The top source addresses by bytes for a port, per output file.
+    """
+
+    def __init__( self, port, n, temp_directory, extended=True,
+                                                            interval=0 ):
+
+        """
+        Args:
+            port: The port, for the file name and /status
+            n: How many addresses to list
+            temp_directory: Where to write the file before it is moved
+                next to the output file
+            extended: True if fed extended (cflowd6) records, else
+                cflowd records
+            interval: The writers' write timeout.  A rotation less
+                than half of it after the window ended gets that
+                window again.
+        """
+
+        if extended:
+            fields = ipfixd_app.util.field_offsets(
+                                    ipfixd_app.cflowd.cflowd6_field_list )
+            key = fields[ 'sourceIPv6Address' ]
+        else:
+            fields = ipfixd_app.util.field_offsets(
+                                    ipfixd_app.cflowd.cflowd_field_list )
+            key = fields[ 'sourceIPv4Address' ]
+
+        self.port = port
+        self.n = n
+        self.extended = extended
+        self._temp_directory = temp_directory
+        self._lock = threading.Lock()
+        self._sketch = ipfixd_app.space_saving.SpaceSaving(
+            n * counters_per_talker, fields[ 'record_len' ], key,
+            fields[ 'octetDeltaCount' ] )
+        self._start = time.time()
+        self._last = None
+        self._interval = interval
+
+        self.metric_dumps = 0
+        self.metric_dump_errors = 0
+
+        labels = { 'port': str( port ) }
+        for m in (
+            ipfixd_app.metrics.Counter( 'ipfixd_talkers_dumps_total',
+                'Top talker files written.', labels,
+                lambda: self.metric_dumps ),
+            ipfixd_app.metrics.Counter( 'ipfixd_talkers_dump_errors_total',
+                'Top talker files that could not be written.', labels,
+                lambda: self.metric_dump_errors ) ):
+            ipfixd_app.metrics.registry.register( m )
+
+        top_talkers.append( self )
+
+    def add( self, buff ):
+
+        """
+        Adds the flow records in a buffer.
+        """
+
+        with self._lock:
+            self._sketch.add( buff )
+
+    def _window( self, end ):
+
+        """
+        Returns the top talkers so far as a dict.  Called with the
+        lock held.
+        """
+
+        return( { 'port': self.port, 'start': int( self._start ),
+            'end': int( end ), 'records': self._sketch.records,
+            'bytes': self._sketch.total,
+            'counters': self._sketch.counters,
+            'talkers': [ { 'address': ipfixd_app.util.format_address( k ),
+                            'bytes': count, 'error': error }
+                for ( k, count, error ) in self._sketch.top( self.n ) ] } )
+
+    def rotate( self, dest_file_name ):
+
+        """
+        Writes the window's top talkers next to a rotated output
+        file, and starts a new window.  A Writer rotate hook, called
+        from its rename thread.
+
+        Args:
+            dest_file_name: The name the output file was renamed to
+        """
+
+        now = time.time()
+        with self._lock:
+            if self._last and now - self._start < self._interval / 2:
+                window = self._last     # Another writer ended it
+            else:
+                window = self._window( now )
+                self._sketch.reset()
+                self._start = now
+                self._last = window
+
+        ( dest_directory, base ) = os.path.split( dest_file_name )
+        name = 'talkers-%d.%s' % ( self.port, base.partition( '.' )[2] )
+        temp_name = os.path.join( self._temp_directory, name + '.current' )
+
+        try:
+            with open( temp_name, 'w' ) as f:
+                json.dump( window, f, indent=1 )
+            os.rename( temp_name, os.path.join( dest_directory, name ) )
+            self.metric_dumps += 1
+        except OSError as e:
+            self.metric_dump_errors += 1
+            log().error( 'ERROR: writing top talkers for port %d to %s: %s' %
+                ( self.port, name, e ) )
+
+    def status( self ):
+
+        """
+        Returns the window so far and the last one, for /status.
+        """
+
+        with self._lock:
+            return( { 'current': self._window( time.time() ),
+                                                    'last': self._last } )
+
+def status():
+
+    """
+    Returns the top talkers of every port, for /status.
+    """
+
+    return( [ t.status() for t in top_talkers ] )
+
+ipfixd_app.metrics.registry.add_status( 'talkers', status )
+
+# End.
@@ -0,0 +1,116 @@
+"""
+Sampled latency tracing.  With --trace-sample N, one packet in N read
+on a port gets a Trace, which follows it through the pipeline:
+
+    recv        The socket thread read it
+    dequeue     The packet thread got to it
+    decode      The packet thread converted it
+    enqueue     Its output buffer was put on the writer's queue
+    write       The writer handed the output to the temp file
+
+At each stage the time since the last stage is put in the
+ipfixd_trace_stage_seconds histogram for the port and stage, and at
+write the time since recv goes in ipfixd_trace_total_seconds.  That
+shows where the time goes, mostly waiting in the packet thread's
+data lists (_max_time_in_list) and the queues, so the batching knobs
+can be set from data.  The temp file is opened with a 1 MB buffer,
+so write is when the bytes reached the buffer, not the disk.
+
+The Trace rides along as a fifth item in the socket queue tuple,
+then as an item of its own in the writer's data list right after
+the output buffer.  If a packet has more than one output format,
+only the first is followed.  A packet with no output, such as a
+template only packet, stops being traced at decode.
+
+Each histogram has one port, and each stage of a port is done by
+one thread, so the histograms are updated by one thread as
+ipfixd_app.metrics wants.  With tracing off the cost is an if in
+the read loops and a len() per packet in the packet thread.
+"""
+
+import time
+import ipfixd_app.metrics
+
+stages = ( 'dequeue', 'decode', 'enqueue', 'write' )
+
+#
+# Latencies run from microseconds (an idle pipeline) to the 10 second
+# data list limit plus the queue waits.
+#
+
+buckets = [ 0.00001, 0.0001, 0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 20, 60 ]
+
+class Tracer( object ):
+
+    """
+    Samples packets for one port and holds its histograms.  Only the
+    socket thread calls sample().
+    """
+
+    def __init__( self, port, every ):
+
+        """
+        Args:
+            port: The port, for the metric labels
+            every: Trace one packet in this many
+        """
+
+        self.port = port
+        self.every = every
+        self._countdown = every
+
+        labels = { 'port': str( port ) }
+        self.histograms = {}
+        for stage in stages:
+            self.histograms[ stage ] = ipfixd_app.metrics.registry.register(
+                ipfixd_app.metrics.Histogram( 'ipfixd_trace_stage_seconds',
+                    'Sampled seconds from the previous stage to this one.',
+                    buckets, dict( labels, stage=stage ) ) )
+
+        self.total = ipfixd_app.metrics.registry.register(
+            ipfixd_app.metrics.Histogram( 'ipfixd_trace_total_seconds',
+                'Sampled seconds from recv to write.', buckets, labels ) )
+
+    def sample( self ):
+
+        """
+        Called for each packet read.  Returns a Trace stamped recv for
+        one packet in every, otherwise None.
+        """
+
+        self._countdown -= 1
+        if self._countdown:
+            return( None )
+
+        self._countdown = self.every
+        return( Trace( self ) )
+
+class Trace( object ):
+
+    """
+    The stamps for one packet.
+    """
+
+    __slots__ = ( 'tracer', 'recv', 'last' )
+
+    def __init__( self, tracer ):
+        self.tracer = tracer
+        self.recv = self.last = time.monotonic()
+
+    def stamp( self, stage ):
+
+        """
+        Records reaching a stage.
+
+        Args:
+            stage: One of stages
+        """
+
+        now = time.monotonic()
+        self.tracer.histograms[ stage ].observe( now - self.last )
+        self.last = now
+
+        if stage == 'write':
+            self.tracer.total.observe( now - self.recv )
+
+# End.
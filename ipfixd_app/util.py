@@ -1,11 +1,16 @@
 import sys
+import re
 import struct
+import socket
 import copy
 from collections import namedtuple
 from ipfixd_app.ipfixd_log import log
 
 exit_code = 0
 
+_fmt_items_re = re.compile( r'(\d*)([a-zA-Z?])' )    # struct format items
+_v4_mapped_prefix = bytes( 10 ) + b'\xff\xff'
+
 def set_exit( code ):
 
     global exit_code
@@ -73,6 +78,28 @@ def make_pack_items( l, network_byte_order=True ):
 
     return( the_struct, d )
 
+def field_offsets( l ):
+
+    """
+    Returns where each field of a record is.
+
+    Args:
+        l: The list of fields, as for make_pack_items
+
+    Returns:
+        A dict of field names to ( offset, length ).  'record_len' is
+        the length of the whole record.
+    """
+
+    d = {}
+    offset = 0
+    for f in l:
+        d[ f[0] ] = ( offset, f[1] )
+        offset += f[1]
+    d[ 'record_len' ] = offset
+
+    return( d )
+
 def get_fmt_len( c ):
 
     """
@@ -108,6 +135,11 @@ def make_byte_moves( input_struct, input_keys, output_struct, output_keys ):
     Note that if the output field is larger, we should be OK
     because the output buffer is usually zeroed to start with.
 
+    Output fields that are byte strings ('16s', for instance, an
+    IPv6 address) are copied without swapping.  A shorter input
+    field is right aligned in the output field, so an IPv4 address
+    lands in the last four bytes of an IPv6 address.
+
     Args:
         input_struct: A struct type for input
         input_keys: A dict, keyed by input keys, data item index
@@ -149,16 +181,18 @@ def make_byte_moves( input_struct, input_keys, output_struct, output_keys ):
 
         byte_offset = 0
         field_index = 0
-        for c in format:
-            if c == '!' or c == '=':
-                continue
-            len = get_fmt_len( c )
+        for ( count, c ) in _fmt_items_re.findall( format ):
+            if c == 's':                # Byte string, count is the length
+                len = int( count )
+            else:
+                len = get_fmt_len( c ) * int( count or 1 )
             if c == 'x':                # Padding, no field.
                 byte_offset += len
             else:
                 k = data_by_index[ field_index ]
                 data[ k ][ 'byte_offset' ] = byte_offset
                 data[ k ][ 'len' ] = len
+                data[ k ][ 'fmt' ] = c
                 byte_offset += len
                 field_index += 1
 
@@ -196,6 +230,13 @@ def make_byte_moves( input_struct, input_keys, output_struct, output_keys ):
         except KeyError:
             continue
 
+        if out_info[ 'fmt' ] == 's':    # Byte strings are not swapped
+            for i in range( 0, len, 1 ):
+                input.append( in_info[ 'byte_offset' ] + i )
+                output.append( out_info[ 'byte_offset' ] +
+                                        out_info[ 'len' ] - len + i )
+            continue
+
         if in_skip > 0:
             for i in range( in_skip ):
                 check_for_zero.append( in_info[ 'byte_offset' ] + i )
@@ -221,6 +262,113 @@ def make_byte_moves( input_struct, input_keys, output_struct, output_keys ):
 
     return( input, output, in_data, out_data, check_for_zero )
 
+def exporter_key( ip ):
+
+    """
+    Converts an exporter address string, as returned by recvfrom,
+    into the packed 16 byte form used to key exporters.  IPv4
+    addresses are mapped into IPv6 space (::ffff:a.b.c.d), so an
+    exporter has the same key on an IPv4 and a dual-stack socket.
+
+    Args:
+        ip: The address string.  IPv4 or IPv6.
+
+    Returns:
+        The 16 byte IPv6 (or IPv4 mapped) address in network order.
+    """
+
+    if ':' in ip:
+        return( socket.inet_pton( socket.AF_INET6, ip.split( '%' )[0] ) )
+    else:
+        return( _v4_mapped_prefix + socket.inet_pton( socket.AF_INET, ip ) )
+
+def exporter_address( a ):
+
+    """
+    Converts a packed exporter key into the forms we store in
+    output records.
+
+    Args:
+        a: The 16 byte exporter key.  See exporter_key.
+
+    Returns:
+        A tuple of:
+
+        0: The IPv4 address as an int.  0 for a real IPv6 address.
+        1: The 16 byte IPv6 (or IPv4 mapped) address in network order.
+    """
+
+    if a[:12] == _v4_mapped_prefix:
+        address_int = (a[12]<<24)+(a[13]<<16)+(a[14]<<8)+a[15]
+    else:
+        address_int = 0
+
+    return( address_int, bytes( a ) )
+
+def format_address( a ):
+
+    """
+    Returns a printable form of a packed exporter key.  IPv4 mapped
+    addresses are printed as plain IPv4 addresses.
+    """
+
+    if a[:12] == _v4_mapped_prefix:
+        return( socket.inet_ntop( socket.AF_INET, a[12:] ) )
+    else:
+        return( socket.inet_ntop( socket.AF_INET6, a ) )
+
+def format_host_port( host, port ):
+
+    """
+    Returns host:port, with an IPv6 address in brackets.
+    """
+
+    if ':' in host:
+        return( '[%s]:%d' % ( host, port ) )
+    else:
+        return( '%s:%d' % ( host, port ) )
+
+def format_key( key ):
+
+    """
+    Returns a printable form of a template or flow key.  Item zero
+    of the key is the packed exporter address.
+    """
+
+    return( str( tuple( [ format_address( key[0] ) ] + list( key[1:] ) ) ) )
+
+def udp_socket_stats( port ):
+
+    """
+    Looks up a UDP socket bound to a local port in /proc/net/udp and
+    /proc/net/udp6.  Linux only.
+
+    Args:
+        port: The local port
+
+    Returns:
+        A tuple of the bytes waiting in the receive queue and the
+        number of datagrams the kernel dropped, or None if there is
+        no such socket or no /proc.
+    """
+
+    for name in ( '/proc/net/udp', '/proc/net/udp6' ):
+        try:
+            with open( name ) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+
+        for line in lines:
+            l = line.split()
+            if int( l[1].rsplit( ':', 1 )[1], 16 ) != port:
+                continue
+            rx_queue = int( l[4].split( ':' )[1], 16 )
+            drops = int( l[-1] )
+            return( rx_queue, drops )
+
+    return( None )
+
 def find_non_zero_bytes( template, buff ):
 
     """
@@ -248,7 +396,7 @@ def find_non_zero_bytes( template, buff ):
                         log().error( 'ERROR: Stream "%s", field "%s", '
                             'offset %d, length %d at offset %d '
                             'overflows when converting to cflowd' %
-                            ( template[ 'key' ], field_name,
+                            ( format_key( template[ 'key' ] ), field_name,
                             field_offset, field_len, z ) )
             else:
                 new_check_for_zero.append( z )
@@ -2,6 +2,21 @@
 Main writer handling code.  Watches for packets on a queue and writes
 them.  Takes a mutex on the file so that it can be moved by the
 file moving thread.
+
+If the temp file can't be opened or written, the writer is stuck
+for a while.  With a spill directory, what arrives while stuck is
+appended to a journal file there instead of being thrown away.  When
+the temp file works again the journal is copied into it before any
+new data, so a full or flaky file system costs latency, not flows.
+All the output formats are streams of records or messages, so the
+journal is just the bytes, in order.  A journal left by a crash is
+drained the same way after a restart.
+
+A failed write may leave part of an item in the temp file, and items
+still in the file's buffer may never get there.  So on a write error
+the temp file is closed and cut back to the end of the last whole
+item on disk before anything more goes to the journal, and it is
+appended to when the writer is unstuck.
 """
 
 import sys
@@ -9,16 +24,28 @@ import threading
 import os
 import time
 import queue
+import collections
 from ipfixd_app.ipfixd_log import log
 import ipfixd_app.ipfixd_queue
 import ipfixd_app.ipfixd_thread
+import ipfixd_app.metrics
+from ipfixd_app.trace import Trace
 from ipfixd_app.util import set_exit
 
 _file_names = {
     'cflowd': 'flows',      # Tradition
-    'ipfix': 'ipfix-flows'  # New kid on the block
+    'cflowd6': 'flows6',    # Extended cflowd, IPv6 and 64 bit counters
+    'ipfix': 'ipfix-flows', # New kid on the block
+    'capture': 'capture',   # Raw datagrams, see ipfixd_app.capture
+    'aggregate': 'aggregate', # Rolled up flows, see ipfixd_app.aggregator
+    'export': 'ipfix-export' # IPFIX messages, see ipfixd_app.exporter
 }
 
+_buffer_size = 2**20    # The temp file's
+
+file_formats = [ 'cflowd', 'cflowd6', 'ipfix', 'capture', 'aggregate',
+                                                                'export' ]
+
 class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
 
     """
@@ -39,8 +66,15 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
             profile=False,
             cflowd=False,
             ipfix=False,
+            cflowd6=False,
+            capture=False,
+            aggregate=False,
+            export=False,
             port=0,
-            max_queue_size=100000 ):
+            max_queue_size=100000,
+            max_queue_bytes=0,
+            spill_directory=None,
+            spill_max_bytes=2**30 ):
 
         """
         Returns a thread object.  Call start on it to cause it
@@ -57,17 +91,38 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
             profile: If True, profile
             cflowd: If true, writing a cflowd file
             ipfix: If true, writing an ipfix file.  Mutually exclusive w/cflowd
+            cflowd6: If true, writing an extended cflowd file.  Mutually
+                exclusive w/cflowd and ipfix.
+            capture: If true, writing a packet capture file from the
+                socket readers.  Mutually exclusive w/the others.
+            aggregate: If true, writing aggregate records from an
+                ipfixd_app.aggregator.Aggregator.  Mutually exclusive
+                w/the others.
+            export: If true, writing IPFIX messages from an
+                ipfixd_app.exporter.Exporter.  Mutually exclusive
+                w/the others.
             port: The port the data came from
             max_queue_size: The maximum length we will allow the queue
                 to grow to.
+            max_queue_bytes: The most bytes we allow on the queue, 0 for
+                no limit.  See ipfixd_app.ipfixd_queue.ByteQueue.
+            spill_directory: Where to keep the journal while the temp
+                file can't be written, or None to throw the data away.
+                Should be on a different file system than the temp
+                directory.
+            spill_max_bytes: The largest the journal may grow.
         """
 
-        if not (bool(cflowd) ^ bool(ipfix)):
-            raise ValueError( 'One and only one of cflowd,ipfix can be True.' )
-        if cflowd:
-            self._writer_type = 'cflowd'
-        elif ipfix:
-            self._writer_type = 'ipfix'
+        writer_types = [ t for ( t, on ) in
+            ( ( 'cflowd', cflowd ), ( 'ipfix', ipfix ), ( 'cflowd6', cflowd6 ),
+                ( 'capture', capture ), ( 'aggregate', aggregate ),
+                ( 'export', export ) )
+                if on ]
+        if len( writer_types ) != 1:
+            raise ValueError(
+                'One and only one of cflowd,ipfix,cflowd6,capture,aggregate,'
+                'export can be True.' )
+        self._writer_type = writer_types[ 0 ]
 
         name = 'Writer (%s) for %s->%s:%d' % ( self._writer_type,
             temp_directory, dest_directory, write_timeout )
@@ -85,8 +140,8 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
         self.daemon = True
         log().info( 'INFO: Created thread %s' % name )
 
-        self._queue = ipfixd_app.ipfixd_queue.IterQueue(
-                                                maxsize = max_queue_size )
+        self._queue = ipfixd_app.ipfixd_queue.ByteQueue(
+                        maxsize = max_queue_size, maxbytes = max_queue_bytes )
         self._max_qsize = 0
 
 # Setup and call the file renamer.  It won't do anything to the file
@@ -96,12 +151,105 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
         self._temp_file_name = None
         self._temp_file = None
         self._rename_thread = None
+        self._temp_size = 0     # Bytes handed to the temp file
+        self._temp_ends = collections.deque( [ ( 0, None ) ] )
         self._temp_file_name = (self._temp_directory +
             _file_names[ self._writer_type ] + '.current' )
 
         self._file_lock = threading.Lock()
+        self._rotate_hooks = []
+        self._preamble = None
+        self._prefix = None
+        self._prefix_reset = None
+
+        self.metric_items = 0
+        self.metric_bytes = 0
+        self.metric_write_errors = 0
+        self.metric_renames = 0
+        self.metric_dropped_items = 0
+        self.metric_dropped_bytes = 0
+        self.metric_spilled_items = 0
+        self.metric_spilled_bytes = 0
+        self.metric_drained_bytes = 0
+
+# The spill journal.  _spill_bytes is what is in it, and
+# _spill_offset how much of that has been copied to the temp file.
+
+        self._spill_file = None
+        self._spill_max_bytes = spill_max_bytes
+        self._spill_retry_time = 0
+        self._spill_bytes = 0
+        self._spill_offset = 0
+        if spill_directory:
+            self._spill_file_name = os.path.join( spill_directory,
+                '%s.%s.spill' % ( _file_names[ self._writer_type ],
+                    temp_directory.strip( '/' ).replace( '/', '_' ) ) )
+            try:
+                self._spill_bytes = os.path.getsize( self._spill_file_name )
+                log().warn( 'WARN: %s: %d bytes left in %s will be '
+                    'written first.' % ( self.name, self._spill_bytes,
+                        self._spill_file_name ) )
+            except OSError:
+                pass
+        else:
+            self._spill_file_name = None
+
+        self._register_metrics( temp_directory )
+
         self._file_rename()
 
+    def _register_metrics( self, temp_directory ):
+
+        """
+        Adds our counters to the metrics registry.
+        """
+
+        labels = { 'format': self._writer_type, 'directory': temp_directory }
+        Counter = ipfixd_app.metrics.Counter
+
+        for m in (
+            Counter( 'ipfixd_writer_items_total',
+                'Buffers written to the temp file.', labels,
+                lambda: self.metric_items ),
+            Counter( 'ipfixd_writer_bytes_total',
+                'Bytes written to the temp file.', labels,
+                lambda: self.metric_bytes ),
+            Counter( 'ipfixd_writer_write_errors_total',
+                'Errors opening or writing the temp file.', labels,
+                lambda: self.metric_write_errors ),
+            Counter( 'ipfixd_writer_renames_total',
+                'Temp files moved to the destination directory.', labels,
+                lambda: self.metric_renames ),
+            Counter( 'ipfixd_writer_dropped_items_total',
+                'Buffers thrown away because the temp file could not be '
+                'written.', labels,
+                lambda: self.metric_dropped_items ),
+            Counter( 'ipfixd_writer_dropped_bytes_total',
+                'Bytes thrown away because the temp file could not be '
+                'written.', labels,
+                lambda: self.metric_dropped_bytes ),
+            Counter( 'ipfixd_writer_spilled_items_total',
+                'Buffers written to the spill journal.', labels,
+                lambda: self.metric_spilled_items ),
+            Counter( 'ipfixd_writer_spilled_bytes_total',
+                'Bytes written to the spill journal.', labels,
+                lambda: self.metric_spilled_bytes ),
+            Counter( 'ipfixd_writer_drained_bytes_total',
+                'Bytes copied from the spill journal to the temp file.',
+                labels, lambda: self.metric_drained_bytes ),
+            ipfixd_app.metrics.Gauge( 'ipfixd_writer_spill_bytes',
+                'Bytes in the spill journal not yet in the temp file.',
+                labels, lambda: self._spill_bytes - self._spill_offset ),
+            ipfixd_app.metrics.Gauge( 'ipfixd_queue_items',
+                'Items waiting on the queue.',
+                dict( labels, thread='writer' ),
+                lambda: self._queue.qsize() ),
+            ipfixd_app.metrics.Gauge( 'ipfixd_queue_bytes',
+                'Bytes waiting on the queue.',
+                dict( labels, thread='writer' ),
+                lambda: self._queue.bytes ) ):
+            ipfixd_app.metrics.registry.register( m )
+
     def _actual_file_rename( self ):
 
         """
@@ -124,35 +272,176 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
             log().info( 'INFO: %s: renaming %s to %s' % ( 
                 self.name, self._temp_file_name, dest_file_name ) )
             os.rename( self._temp_file_name, dest_file_name )
+            self.metric_renames += 1
             log().info( 'INFO: %s: rename successful.' % self.name )
         except OSError as e:
             log().error( 'ERROR: renaming "%s" to "%s" failed: %s' %
                 (self._temp_file_name, dest_file_name, e ) )
             raise
 
+        return( dest_file_name )
+
+    def add_rotate_hook( self, hook ):
+
+        """
+        Adds a function to call after the temp file is moved to the
+        destination directory, with the new name.  It is called from
+        the rename thread, without the file lock, and must catch its
+        own errors.  See ipfixd_app.talkers.
+        """
+
+        self._rotate_hooks.append( hook )
+
+    def set_preamble( self, preamble ):
+
+        """
+        Sets a function returning bytes to write at the start of
+        every temp file, before any data, so each file can be read
+        on its own.  It is called from the writer thread with the
+        file lock held.  See ipfixd_app.exporter.
+        """
+
+        self._preamble = preamble
+
+    def set_prefix( self, prefix, reset ):
+
+        """
+        Sets a function called with each item, returning bytes to
+        write in front of it, or None, and a function called whenever
+        what follows goes to a new temp file or to the spill journal.
+        So what a reader needs can go in each file once, in front of
+        the first item that needs it.  Both are called with the file
+        lock held.  See ipfixd_app.cflowd.IPFixFileTemplates.
+        """
+
+        self._prefix = prefix
+        self._prefix_reset = reset
+
+    def _with_prefix( self, item ):
+
+        """
+        Returns the item with the prefix in front of it, if any.
+        """
+
+        if self._prefix:
+            p = self._prefix( item )
+            if p:
+                return( p + item )
+
+        return( item )
+
+    def _reset_prefix( self ):
+
+        """
+        Tells the prefix function a new temp file or journal starts.
+        """
+
+        if self._prefix_reset:
+            self._prefix_reset()
+
+    def _wrote( self, nbytes, spill_start=None ):
+
+        """
+        Notes the end of a whole item written to the temp file.  Ends
+        more than a buffer behind are on disk, so only the last of
+        those is kept.
+
+        Args:
+            nbytes: Its length
+            spill_start: Where it starts in the journal, if it came
+                from there
+        """
+
+        self._temp_size += nbytes
+        self._temp_ends.append( ( self._temp_size, spill_start ) )
+        while ( len( self._temp_ends ) > 1 and
+                self._temp_ends[1][0] <= self._temp_size - _buffer_size ):
+            self._temp_ends.popleft()
+
+    def _forget_temp( self ):
+
+        """
+        Starts the count of the temp file over at size.
+        """
+
+        self._temp_ends = collections.deque( [ ( self._temp_size, None ) ] )
+
+    def _truncate_temp( self ):
+
+        """
+        Closes the temp file after a write error, and cuts it back to
+        the end of the last whole item that made it to disk.  What
+        was cut from the journal is copied again, the rest is counted
+        as dropped.  The file lock must be held.
+        """
+
+        try:
+            self._temp_file.close()
+        except OSError:
+            pass                # What's on disk is what counts
+        self._temp_file = None
+
+        try:
+            size = os.path.getsize( self._temp_file_name )
+        except OSError as p:
+            log().error( 'ERROR: %s: %s' % ( self.name, p ) )
+            size = 0
+
+        rewind = None
+        while len( self._temp_ends ) > 1 and self._temp_ends[-1][0] > size:
+            ( end, spill_start ) = self._temp_ends.pop()
+            if spill_start is not None:
+                rewind = spill_start
+        good = min( self._temp_ends[-1][0], size )
+
+        lost = self._temp_size - good
+        if rewind is not None:
+            lost -= self._spill_offset - rewind
+            self._spill_offset = rewind
+        if lost > 0:
+            self.metric_dropped_bytes += lost
+            log().error( 'ERROR: %s: %d bytes written to %s did not make '
+                'it' % ( self.name, lost, self._temp_file_name ) )
+
+        try:
+            if size > good:
+                os.truncate( self._temp_file_name, good )
+        except OSError as p:
+            log().error( 'ERROR: %s: truncating %s: %s' % ( self.name,
+                                                self._temp_file_name, p ) )
+            good = size
+        self._temp_size = good
+        self._forget_temp()
+
     def _file_rename( self, new_thread = True ):
 
         """
         Renames the current temp file into the dest directory.
         Will not create a new temp file.  That happens when the
         first packet is obtained.  Also, if there is no temp file,
-        then nothing is renamed/created.
+        then nothing is renamed/created.  After a rename, the rotate
+        hooks are called with the new name.
 
         The timer thread is created if needed and restarted.
         """
 
+        dest_file_name = None
         with self._file_lock:
-            if (self._temp_file):
+            if self._temp_file or self._temp_size:
                 try:
-                    self._temp_file.close()
-                    self._temp_file = None
+                    if self._temp_file:
+                        self._temp_file.close()
+                        self._temp_file = None
+                        self._reset_prefix()
                 except OSError as p:
                     log().error( 'ERROR: closing "%s": %s' %
                         (self._temp_file_name, p ) )
                     set_exit(1)
                     return
+                self._temp_size = 0
+                self._forget_temp()
                 try:
-                    self._actual_file_rename()
+                    dest_file_name = self._actual_file_rename()
                 except OSError:
                     set_exit(1)
                     return
@@ -161,6 +450,10 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
             # Renaming file end
         # Lock context
 
+        if dest_file_name:
+            for hook in self._rotate_hooks:
+                hook( dest_file_name )
+
         if new_thread:
             self._rename_thread = threading.Timer(
                 interval=self._write_timeout,
@@ -180,6 +473,142 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
 
         return( self._queue.qsize(), m )
 
+    def print_metrics( self ):
+
+        """
+        Logs the write counts since the last call.
+        """
+
+        d = ipfixd_app.metrics.deltas( self, [ 'metric_items',
+                                    'metric_bytes', 'metric_write_errors',
+                                    'metric_dropped_items',
+                                    'metric_spilled_items' ] )
+
+        log().info( 'INFO: %s: items: %d, bytes: %d, write errors: %d, '
+            'dropped: %d, spilled: %d, spill journal: %d bytes' %
+            ( self.name,
+                d[ 'metric_items' ],
+                d[ 'metric_bytes' ],
+                d[ 'metric_write_errors' ],
+                d[ 'metric_dropped_items' ],
+                d[ 'metric_spilled_items' ],
+                self._spill_bytes - self._spill_offset ) )
+
+    def _spill( self, item ):
+
+        """
+        Appends an item to the spill journal, or throws it away if
+        there is no journal, it is full, or it can't be written
+        either.  The file lock must be held.
+
+        Args:
+            item: The buffer
+        """
+
+        if ( not self._spill_file_name or
+                self._spill_bytes + len(item) > self._spill_max_bytes ):
+            self.metric_dropped_items += 1
+            self.metric_dropped_bytes += len(item)
+            return
+
+        try:
+            if not self._spill_file:
+                if time.time() < self._spill_retry_time:
+                    raise OSError( 'spill journal failed recently' )
+                self._spill_file = open( self._spill_file_name, 'ab', 2**20 )
+            self._spill_file.write( item )
+        except OSError as p:
+            self.metric_dropped_items += 1
+            self.metric_dropped_bytes += len(item)
+            if not self._spill_retry_time > time.time():
+                log().error( 'ERROR: %s: spill journal %s: %s' % (
+                    self.name, self._spill_file_name, p ) )
+                self._spill_retry_time = time.time() + 60
+            self._close_spill()
+            return
+
+        self._spill_bytes += len(item)
+        self.metric_spilled_items += 1
+        self.metric_spilled_bytes += len(item)
+
+    def _close_spill( self ):
+
+        """
+        Closes the journal if it is open.  If the close fails, some
+        buffered data may not have made it, and we count the journal
+        from what is really on disk.
+        """
+
+        if not self._spill_file:
+            return
+
+        try:
+            self._spill_file.close()
+        except OSError as p:
+            log().error( 'ERROR: %s: closing %s: %s' % ( self.name,
+                                            self._spill_file_name, p ) )
+            try:
+                self._spill_bytes = os.path.getsize( self._spill_file_name )
+            except OSError:
+                self._spill_bytes = 0
+        self._spill_file = None
+
+    def _drain_spill( self ):
+
+        """
+        Copies the journal to the temp file, and removes the journal
+        once it is all copied.  The file lock must be held and the
+        temp file open.  A read error leaves the rest of the journal
+        for later.  A write error raises OSError like any other temp
+        file write, and the copy picks up from what _truncate_temp
+        left in the temp file, so nothing is written twice.
+        """
+
+        self._close_spill()
+
+        try:
+            f = open( self._spill_file_name, 'rb' )
+        except FileNotFoundError:
+            self._spill_bytes = self._spill_offset = 0
+            return
+        except OSError as p:
+            log().error( 'ERROR: %s: reading %s: %s' % ( self.name,
+                                            self._spill_file_name, p ) )
+            return
+
+        log().info( 'INFO: %s: writing %d bytes from %s' % ( self.name,
+            self._spill_bytes - self._spill_offset, self._spill_file_name ) )
+
+        with f:
+            f.seek( self._spill_offset )
+            while True:
+                try:
+                    chunk = f.read( 2**20 )
+                except OSError as p:
+                    log().error( 'ERROR: %s: reading %s: %s' % ( self.name,
+                                            self._spill_file_name, p ) )
+                    return
+                if not chunk:
+                    break
+                self._temp_file.write( chunk )
+                self._wrote( len( chunk ), self._spill_offset )
+                self._spill_offset += len( chunk )
+                self.metric_drained_bytes += len( chunk )
+
+# The journal goes away, so all of it has to be on disk.
+
+        self._temp_file.flush()
+        self._forget_temp()
+
+        try:
+            os.unlink( self._spill_file_name )
+        except OSError as p:
+            log().error( 'ERROR: %s: removing %s: %s' % ( self.name,
+                                            self._spill_file_name, p ) )
+            return
+        self._spill_bytes = self._spill_offset = 0
+        log().info( 'INFO: %s: spill journal written' % self.name )
+
     def qempty( self ):
 
         """
@@ -209,7 +638,12 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
         and start a new temp file.  Watch for zero length objects
         on the queue and assume they mean to stop.  Rename the
         current temp file on a stop, and cancel relavent timer
-        threads.
+        threads.  While stuck, items go to the spill journal, and the
+        journal is written first when we are unstuck.  The prefix, if
+        set, goes in front of each item, and is reset when we start a
+        new file or get stuck.  A Trace in the items follows the
+        buffer it traces, and is stamped instead of written.  See
+        ipfixd_app.trace.
 
         Make sure the file lock is owned when working with
         the file.  A rename will also acquire the lock, so do
@@ -232,40 +666,79 @@ class Writer( ipfixd_app.ipfixd_thread.IPFixdThread ):
             with self._file_lock:       # Get the lock
                 if not stuck:
                     try:
-                        if not self._temp_file:
+                        if self._temp_file:
+                            pass
+                        elif self._temp_size:   # Cut back after an error
+                            self._temp_file = open( self._temp_file_name,
+                                'ab', _buffer_size )
+                        else:
 #                            self._temp_file = open( self._temp_file_name, 'wb')
                             self._temp_file = open( self._temp_file_name,
-                                'wb', 2**20 )
+                                'wb', _buffer_size )
+                            if self._preamble:
+                                preamble = self._preamble()
+                                self._temp_file.write( preamble )
+                                self._wrote( len( preamble ) )
+                                self.metric_bytes += len( preamble )
                     except OSError as p:
+                        if self._temp_file:
+                            self._truncate_temp()
+                        self.metric_write_errors += 1
                         log().error( 'ERROR: %s: %s' % (p, self.name))
                         log().error( 'ERROR: %s: will try again in %d secs.  '
                             'If you can fix the error, no need to restart.' %
                                 (self.name, stuck_wait))
                         stuck = True
                         stuck_time = time.time()
+                        self._reset_prefix()
+
+                if not stuck and self._spill_bytes:
+                    try:
+                        self._drain_spill()
+                    except OSError as p:
+                        self._truncate_temp()
+                        self.metric_write_errors += 1
+                        log().error( 'ERROR: %s: %s' % (self.name, p) )
+                        stuck = True
+                        stuck_time = time.time()
+                        self._reset_prefix()
 
                 for item in items:
-                    if len(item) == 0:
+                    if item.__class__ is Trace:
+                        if not stuck:
+                            item.stamp( 'write' )
+                        continue
+                    elif len(item) == 0:
                         stopping = True
                         break
                     elif stuck:
-                        break
+                        self._spill( self._with_prefix( item ) )
+                        continue
 
+                    data = self._with_prefix( item )
                     try:
-                        self._temp_file.write(item)
+                        self._temp_file.write(data)
+                        self._wrote( len(data) )
+                        self.metric_items += 1
+                        self.metric_bytes += len(data)
                     except OSError as p:
+                        self._truncate_temp()
+                        self.metric_write_errors += 1
+                        self._reset_prefix()
+                        self._spill( self._with_prefix( item ) )
                         log().error( 'ERROR: %s: %s' % (self.name, p) )
                         log().error( 'ERROR: %s: will try again in %d '
                             'secs.  If you can fix the error, no need to '
                             'restart.' % (self.name, stuck_wait ))
                         stuck = True
                         stuck_time = time.time()
-                        break
 
 # Rename can't be called within with context because of the file
 # lock.
 
         log().info( 'INFO: %s: Thread stopping by request', self.name )
+        with self._file_lock:
+            self._close_spill()             # Drained after the restart
         self._rename_thread.cancel()        # Cancel current rename thread
         self._file_rename( new_thread = False )
         if self._profile:
@@ -0,0 +1,304 @@
+"""
+Micro-benchmarks for the inner loops.  Each benchmark times one
+routine on a representative packet, and reports ns per call and ns
+per flow record, so a change to a hot path can be judged on its
+own instead of through the whole pipeline (see bench.py for that).
+
+    microbench.py                   # Everything
+    microbench.py byte_mover        # Names containing byte_mover
+    microbench.py --json > before.json
+
+The fixtures are a 30 record NetFlow v5 packet and IPFIX packets
+using templates like the ones Juniper MX and Cisco routers send,
+20 records each.
+
+Timing follows timeit: each benchmark is run in a loop long enough
+to take --min-time seconds, --repeat times, and the best run is
+reported.
+"""
+
+import sys
+import time
+import json
+import struct
+import argparse
+
+import ipfixd_app.ipfixd_log
+import ipfixd_app.cflowd
+import ipfixd_app.header
+import ipfixd_app.util
+
+cflowd = ipfixd_app.cflowd
+
+#
+# IPFIX templates as ( IE id, length ).  Close to what the routers
+# send for IPv4 flows.
+#
+
+juniper_fields = [
+    ( 8, 4 ), ( 12, 4 ), ( 5, 1 ), ( 4, 1 ), ( 7, 2 ), ( 11, 2 ),
+    ( 32, 2 ), ( 10, 4 ), ( 58, 2 ), ( 9, 1 ), ( 13, 1 ), ( 16, 4 ),
+    ( 17, 4 ), ( 15, 4 ), ( 6, 1 ), ( 14, 4 ), ( 52, 1 ), ( 53, 1 ),
+    ( 136, 1 ), ( 243, 2 ), ( 245, 2 ), ( 54, 4 ), ( 1, 8 ), ( 2, 8 ),
+    ( 152, 8 ), ( 153, 8 ) ]
+
+cisco_fields = [
+    ( 8, 4 ), ( 12, 4 ), ( 10, 4 ), ( 14, 4 ), ( 2, 8 ), ( 1, 8 ),
+    ( 152, 8 ), ( 153, 8 ), ( 7, 2 ), ( 11, 2 ), ( 6, 1 ), ( 4, 1 ),
+    ( 5, 1 ), ( 15, 4 ), ( 16, 4 ), ( 17, 4 ), ( 9, 1 ), ( 13, 1 ),
+    ( 61, 1 ), ( 136, 1 ) ]
+
+ipfix_records = 20
+exporter = ipfixd_app.util.exporter_key( '192.0.2.1' )
+port = 2055
+
+def v5_packet():
+
+    """
+    Returns a 30 record NetFlow v5 packet.
+    """
+
+    h = [ 0 ] * len( cflowd.netflow_v5_header_keys )
+    h[ cflowd.netflow_v5_header_keys[ 'exportProtocolVersion' ] ] = 5
+    h[ cflowd.netflow_v5_header_keys[ 'xx_cnt' ] ] = 30
+    h[ cflowd.netflow_v5_header_keys[ 'xx_sysUpTimeDeltaMilliseconds' ] ] = (
+                                                                    3600000 )
+    h[ cflowd.netflow_v5_header_keys[ 'xx_sysUpTime' ] ] = 1700000000
+    h[ cflowd.netflow_v5_header_keys[ 'flowId' ] ] = 1000
+    p = cflowd.netflow_v5_header_struct.pack( *h )
+
+    for i in range( 30 ):
+        r = [ 0 ] * len( cflowd.netflow_v5_keys )
+        for ( k, v ) in ( ( 'sourceIPv4Address', 0x0a000000 + i ),
+                ( 'destinationIPv4Address', 0xc0a80001 ),
+                ( 'ipNextHopIPv4Address', 0x0a000001 ),
+                ( 'ingressInterface', 1 ), ( 'egressInterface', 2 ),
+                ( 'packetDeltaCount', 10 ), ( 'octetDeltaCount', 8000 ),
+                ( 'flowStartSysUpTime', 3500000 ),
+                ( 'flowEndSysUpTime', 3590000 ),
+                ( 'sourceTransportPort', 1024 + i ),
+                ( 'destinationTransportPort', 443 ),
+                ( 'tcpControlBits', 0x1b ), ( 'protocolIdentifier', 6 ),
+                ( 'bgpSourceAsNumber', 65000 ),
+                ( 'bgpDestinationAsNumber', 65001 ),
+                ( 'sourceIPv4PrefixLength', 24 ),
+                ( 'destinationIPv4PrefixLength', 16 ) ):
+            r[ cflowd.netflow_v5_keys[ k ] ] = v
+        p += cflowd.netflow_v5_struct.pack( *r )
+
+    return( bytearray( p ) )
+
+def ipfix_template_set( template_id, fields ):
+
+    """
+    Returns a template set, with set header, for the fields.
+    """
+
+    t = struct.pack( '!HH', template_id, len( fields ) )
+    t += b''.join( struct.pack( '!HH', *f ) for f in fields )
+
+    return( struct.pack( '!HH', 2, 4 + len( t ) ) + t )
+
+def ipfix_record( fields, i ):
+
+    """
+    Returns a data record.  Counters are small so nothing overflows
+    the 32 bit cflowd fields.
+    """
+
+    r = b''
+    for ( ie, l ) in fields:
+        if ie == 152:
+            v = 1700000000000 + i
+        elif ie == 153:
+            v = 1700000001000 + i
+        elif ie in ( 8, 12 ):
+            v = 0x0a000000 + i
+        else:
+            v = ( i + ie ) & 0x7f
+        r += v.to_bytes( l, 'big' )
+
+    return( r )
+
+def ipfix_packet( template_id, fields, obs_id ):
+
+    """
+    Returns an IPFIX message with one data set of ipfix_records
+    records, and the template set that describes it.
+    """
+
+    records = b''.join( ipfix_record( fields, i )
+                                        for i in range( ipfix_records ) )
+    data = struct.pack( '!HH', template_id, 4 + len( records ) ) + records
+    header = struct.pack( '!HHLLL', 10, 16 + len( data ), 1700000000, 1,
+                                                                obs_id )
+
+    return( bytearray( header + data ),
+                ipfix_template_set( template_id, fields ) )
+
+def timed( fn, min_time, repeat ):
+
+    """
+    Returns the best ns per call of fn over repeat runs, each long
+    enough to take min_time seconds.
+    """
+
+    loops = 1
+    while True:
+        t = time.perf_counter_ns()
+        for i in range( loops ):
+            fn()
+        t = time.perf_counter_ns() - t
+        if t >= min_time * 1e9:
+            break
+        loops *= 2 if t == 0 else max( 2, int( min_time * 1e9 / t ) + 1 )
+
+    best = t / loops
+    for r in range( repeat - 1 ):
+        t = time.perf_counter_ns()
+        for i in range( loops ):
+            fn()
+        best = min( best, ( time.perf_counter_ns() - t ) / loops )
+
+    return( best )
+
+def v5_benchmarks():
+
+    """
+    Returns the NetFlow v5 benchmarks as ( name, callable, records ).
+    """
+
+    buff = v5_packet()
+    t = [ exporter, port, buff, len( buff ) ]
+    bm = cflowd.netflow_v5_to_cflowd_byte_mover
+    bm6 = cflowd.netflow_v5_to_cflowd6_byte_mover
+    out = bytearray( 30 * cflowd.cflowd_struct.size )
+    out6 = bytearray( 30 * cflowd.cflowd6_struct.size )
+
+    ipfixd_app.header.v5_header( buff, bm )
+    ipfixd_app.header.v5_header( buff, bm6 )
+    bm.cnt = 30
+    bm6.cnt = 30
+    bm6.address6 = ipfixd_app.util.exporter_address( exporter )[1]
+
+    return( [
+        ( 'header.v5_header', lambda: ipfixd_app.header.v5_header( buff, bm ),
+            30 ),
+        ( 'v5 ByteMoverNetflowV5.byte_mover cflowd',
+            lambda: bm.byte_mover( buff, out ), 30 ),
+        ( 'v5 ByteMoverNetflowV5.byte_mover cflowd6',
+            lambda: bm6.byte_mover( buff, out6 ), 30 ),
+        ( 'v5 netflow_v5_to_cflowd',
+            lambda: cflowd.netflow_v5_to_cflowd( True, False, False, t ), 30 ),
+    ] )
+
+def ipfix_benchmarks( name, fields, obs_id ):
+
+    """
+    Returns the IPFIX benchmarks for a template.
+    """
+
+    template_id = 256
+    ( buff, tset ) = ipfix_packet( template_id, fields, obs_id )
+    t = [ exporter, port, buff, len( buff ) ]
+    key = ( exporter, port, obs_id, template_id )
+
+    cflowd.v10_template_set( exporter, port, obs_id, tset, 4, len( tset ) )
+    template = cflowd.templates[ key ]
+    cflowd.v10_get_info( key, 1, 20, len( buff ) )
+    bm = template[ 'byte_mover' ]
+    bm6 = template[ 'byte_mover6' ]
+    out = bytearray( ipfix_records * cflowd.cflowd_struct.size )
+    out6 = bytearray( ipfix_records * cflowd.cflowd6_struct.size )
+
+    ( the_struct, the_keys ) = ipfixd_app.util.make_pack_items(
+                                                template[ 'field_list' ] )
+
+    def compile_template():
+        del cflowd.templates[ key ]
+        cflowd.v10_template_set( exporter, port, obs_id, tset, 4,
+                                                            len( tset ) )
+
+    return( [
+        ( 'header.v10_header',
+            lambda: ipfixd_app.header.v10_header( buff ), ipfix_records ),
+        ( 'header.v10_set_header',
+            lambda: ipfixd_app.header.v10_set_header( buff, 16 ), 1 ),
+        ( '%s ByteMoverMilliSeconds.byte_mover cflowd' % name,
+            lambda: bm.byte_mover( buff, out ), ipfix_records ),
+        ( '%s ByteMoverMilliSeconds.byte_mover cflowd6' % name,
+            lambda: bm6.byte_mover( buff, out6 ), ipfix_records ),
+        ( '%s netflow_v10_to_cflowd' % name,
+            lambda: cflowd.netflow_v10_to_cflowd( True, False, False, t ),
+            ipfix_records ),
+        ( '%s check_for_new_template unchanged' % name,
+            lambda: cflowd.check_for_new_template( exporter, port, obs_id,
+                cflowd.netflow_v10_template_header_struct, tset, 4,
+                len( tset ) ), 1 ),
+        ( '%s make_byte_moves' % name,
+            lambda: ipfixd_app.util.make_byte_moves( the_struct, the_keys,
+                cflowd.cflowd_struct, cflowd.cflowd_keys ), 1 ),
+        ( '%s v10_template_set new template' % name, compile_template, 1 ),
+    ] )
+
+def parse_args():
+
+    """
+    Parse the arguments.
+    """
+
+    p = argparse.ArgumentParser( description =
+        "Times the ipfixd inner loops on representative packets." )
+
+    p.add_argument( 'filter', nargs='*',
+        help='Only run benchmarks whose names contain one of these.' )
+
+    p.add_argument( '--min-time', type=float, default=0.2,
+        help='Seconds each timing run should take.' )
+
+    p.add_argument( '--repeat', type=int, default=5,
+        help='Timing runs per benchmark.  The best is reported.' )
+
+    p.add_argument( '--json', action='store_true',
+        help='Print the results as JSON.' )
+
+    return( p.parse_args() )
+
+def main():
+
+    """
+    Runs the benchmarks and prints the results.
+    """
+
+    cmdparse = parse_args()
+    ipfixd_app.ipfixd_log.set_logging( None )
+    cflowd.netflow_v5_init( cflowd.netflow_v5_header_keys,
+                                                cflowd.netflow_v5_keys )
+
+    benchmarks = ( v5_benchmarks() +
+        ipfix_benchmarks( 'ipfix juniper', juniper_fields, 1 ) +
+        ipfix_benchmarks( 'ipfix cisco', cisco_fields, 2 ) )
+
+    seen = set()
+    results = []
+    for ( name, fn, records ) in benchmarks:
+        if name in seen:            # Header benchmarks show up twice
+            continue
+        seen.add( name )
+        if cmdparse.filter and not any( f in name for f in cmdparse.filter ):
+            continue
+
+        ns = timed( fn, cmdparse.min_time, cmdparse.repeat )
+        results.append( { 'name': name, 'ns_per_call': ns,
+                            'records': records, 'ns_per_record': ns / records } )
+        if not cmdparse.json:
+            print( '%-52s %10.0f ns/call %8.1f ns/record' %
+                                        ( name, ns, ns / records ) )
+
+    if cmdparse.json:
+        print( json.dumps( results, indent=2 ) )
+
+if __name__ == '__main__':
+    main()
+
+# End.
@@ -0,0 +1,177 @@
+"""
+Replays capture files written by ipfixd (the "capture" format) to
+a collector.  By default the datagrams are sent to 127.0.0.1 on the
+port they were captured on, with the same spacing they arrived with.
+
+    replay.py capture.20240101_00:00:00+0000
+    replay.py --speed 10 --port 2056 capture.*
+    replay.py --speed 0 capture.*         # As fast as we can
+
+The exporter addresses can not be reproduced from a normal socket.
+Every datagram comes from this host, so the collector sees one
+exporter per port unless --by-exporter is given.  Then a socket is
+bound to 127.x.y.z for each exporter, which keeps the templates
+and sequence numbers of different exporters apart on Linux.  An
+IPv4 exporter gets the low 3 bytes of its address, if no other
+exporter has them, and IPv6 exporters get the next free address.
+Only IPv4 has a whole loopback network, so the collector must be
+reached over IPv4.
+"""
+
+import sys
+import time
+import socket
+import argparse
+
+import ipfixd_app.capture
+import ipfixd_app.util
+
+def parse_args():
+
+    """
+    Parse the arguments.
+    """
+
+    p = argparse.ArgumentParser( description =
+        "Sends the datagrams in ipfixd capture files to a collector." )
+
+    p.add_argument( 'files', nargs='+',
+        help='Capture files, replayed in the order given.' )
+
+    p.add_argument( '--host', default='127.0.0.1',
+        help='Where to send the datagrams.  Default 127.0.0.1.' )
+
+    p.add_argument( '--port', type=int, default=0,
+        help='Send everything to this port instead of the port each '
+            'datagram was captured on.' )
+
+    p.add_argument( '--speed', type=float, default=1.0,
+        help='1 replays at the original speed, 2 at twice the speed, '
+            'and so on.  0 sends as fast as possible.' )
+
+    p.add_argument( '--loop', type=int, default=1,
+        help='How many times to send the files.' )
+
+    p.add_argument( '--by-exporter', action='store_true',
+        help='Send each exporter from its own 127.x.y.z address.' )
+
+    cmdparse = p.parse_args()
+
+    if cmdparse.by_exporter:
+        try:
+            family = socket.getaddrinfo( cmdparse.host, None )[0][0]
+        except OSError as e:
+            p.error( '--host %s: %s' % ( cmdparse.host, e ) )
+        if family != socket.AF_INET:
+            p.error( '--by-exporter sends from 127.x.y.z addresses, so '
+                '--host must be an IPv4 address or name, not %s' %
+                                                            cmdparse.host )
+
+    return( cmdparse )
+
+def loopback_address( key, used ):
+
+    """
+    Returns the 127.x.y.z address to send an exporter's datagrams
+    from.  An IPv4 exporter gets the low 3 bytes of its address, if
+    no other exporter has them.  IPv6 exporters, and IPv4 ones that
+    collide, get the next free address from 127.255.255.254 down.
+
+    Args:
+        key: The packed 16 byte exporter address
+        used: The addresses given out so far.  The new one is added.
+    """
+
+    address = None
+    if ipfixd_app.util.exporter_address( key )[0]:
+        address = '127.%d.%d.%d' % tuple( key[13:16] )
+    if address is None or address in used:
+        n = 0x7ffffffe
+        while socket.inet_ntoa( n.to_bytes( 4, 'big' ) ) in used:
+            n -= 1
+            if n == 0x7f000000:
+                raise ValueError( 'no loopback address left for %s' %
+                                        ipfixd_app.util.format_address( key ) )
+        address = socket.inet_ntoa( n.to_bytes( 4, 'big' ) )
+    used.add( address )
+
+    return( address )
+
+def exporter_socket( sockets, key, host ):
+
+    """
+    Returns the socket used for an exporter.  With --by-exporter,
+    each exporter gets a socket bound to its own loopback address,
+    see loopback_address.
+
+    Args:
+        sockets: Dict of exporter key to socket
+        key: The packed 16 byte exporter address, or None for the
+            shared socket.
+        host: The collector address
+    """
+
+    try:
+        return( sockets[ key ] )
+    except KeyError:
+        pass
+
+    family = socket.getaddrinfo( host, None )[0][0]
+    s = socket.socket( family, socket.SOCK_DGRAM )
+    if key is not None:
+        used = set( t.getsockname()[0] for t in sockets.values() )
+        s.bind( ( loopback_address( key, used ), 0 ) )
+    sockets[ key ] = s
+
+    return( s )
+
+def replay( cmdparse ):
+
+    """
+    Sends the files.  Returns the number of datagrams and bytes sent.
+    """
+
+    sockets = {}
+    sent = 0
+    sent_bytes = 0
+    speed = cmdparse.speed
+
+    for i in range( cmdparse.loop ):
+        start = None            # Wall clock and capture time of first
+        first = None            # datagram in this pass
+
+        for name in cmdparse.files:
+            with open( name, 'rb' ) as f:
+                for ( arrival, key, port, data ) in (
+                        ipfixd_app.capture.read_capture( f ) ):
+                    if speed > 0:
+                        if start is None:
+                            start = time.monotonic()
+                            first = arrival
+                        delay = ( ( arrival - first ) / speed -
+                                        ( time.monotonic() - start ) )
+                        if delay > 0:
+                            time.sleep( delay )
+
+                    if not cmdparse.by_exporter:
+                        key = None
+                    s = exporter_socket( sockets, key, cmdparse.host )
+                    s.sendto( data, ( cmdparse.host,
+                                            cmdparse.port or port ) )
+                    sent += 1
+                    sent_bytes += len( data )
+
+    for s in sockets.values():
+        s.close()
+
+    return( sent, sent_bytes )
+
+if __name__ == '__main__':
+    cmdparse = parse_args()
+    started = time.monotonic()
+    ( sent, sent_bytes ) = replay( cmdparse )
+    elapsed = time.monotonic() - started
+    print( 'Sent %d datagrams, %d bytes in %.3f seconds, %.0f datagrams/sec' %
+        ( sent, sent_bytes, elapsed, sent / elapsed if elapsed else 0 ) )
+
+# End.